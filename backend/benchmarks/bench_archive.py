@@ -0,0 +1,140 @@
+"""
+Cold archival of dormant conversations on the Firebase stand-in.
+
+Seeds a `conversations` collection where most conversations have not been
+touched for months, then measures, before and after one archival run:
+
+- the size of the hot collection (what every full-collection read downloads);
+- GET /api/chat/conversations latency for one user;
+- opening a conversation: a hot one, and an archived one (rehydration).
+
+Usage (from backend/):
+    python -m benchmarks.bench_archive [--conversations 3000] [--dormant 0.8] [--messages 30]
+                                       [--firebase-latency-ms 5]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+from firebase_client import FirebaseClient  # noqa: E402
+from metrics import metrics  # noqa: E402
+from shared_state import MemoryStateBackend  # noqa: E402
+from standins.firebase_server import FirebaseStandin  # noqa: E402
+from storage import ArchivedConversations, ArchiveStore, FirebaseStorage  # noqa: E402
+
+WORDS = "informe ventas trimestre cliente factura pago plan equipo reunión propuesta".split()
+
+
+def seed(args, rng: random.Random) -> dict:
+    now = datetime.now(timezone.utc)
+    conversations = {}
+    for i in range(args.conversations):
+        dormant = rng.random() < args.dormant
+        updated = (now - timedelta(days=rng.randint(120, 400) if dormant else rng.randint(0, 20))).isoformat()
+        conversations[f"c{i:05d}"] = {
+            "id": f"c{i:05d}", "user_id": f"u{i % 50}", "created_at": updated, "updated_at": updated,
+            "messages": [{"id": f"c{i}-{j}", "role": "user" if j % 2 == 0 else "assistant",
+                          "content": " ".join(rng.choice(WORDS) for _ in range(rng.randint(10, 80))),
+                          "timestamp": updated} for j in range(args.messages)]}
+    return conversations
+
+
+async def timed(client, path: str, samples: list):
+    began = time.perf_counter()
+    response = await client.get(path)
+    samples.append((time.perf_counter() - began) * 1000)
+    assert response.status_code == 200, response.text
+
+
+def summary(label: str, samples: list) -> str:
+    samples = sorted(samples)
+    return f"  {label:<28}{statistics.median(samples):>10.1f}{samples[int(0.95 * (len(samples) - 1))]:>10.1f}"
+
+
+async def run(args, tmpdir: str):
+    rng = random.Random(7)
+    conversations = seed(args, rng)
+    standin = FirebaseStandin({"conversations": conversations})
+    standin.faults.latency = args.firebase_latency_ms / 1000
+    storage = FirebaseStorage(FirebaseClient("http://firebase.bench", transport=httpx.ASGITransport(app=standin.app)))
+    storage.conversations = ArchivedConversations(storage.conversations, ArchiveStore(tmpdir))
+    server.storage = storage
+    server.state = MemoryStateBackend()
+    server.ARCHIVE_AFTER_DAYS = 90
+    user = {"id": "u7", "credits": 10}
+    server.app.dependency_overrides[server.get_current_user] = lambda: user
+    own = sorted(conv_id for conv_id, conv in conversations.items() if conv["user_id"] == "u7")
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=90)).isoformat()
+    dormant = [c for c in own if conversations[c]["updated_at"] < cutoff]
+    hot = [c for c in own if c not in dormant]
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://bench",
+                                 timeout=120) as client:
+        size_before = len(json.dumps(standin.read("conversations")))
+        before = {"list": [], "open hot": []}
+        for _ in range(args.rounds):
+            await timed(client, "/api/chat/conversations", before["list"])
+        for conv_id in hot:
+            await timed(client, f"/api/chat/conversations/{conv_id}", before["open hot"])
+
+        metrics.reset()
+        began = time.perf_counter()
+        archived = 0
+        while True:
+            batch = await server.archive_conversations()
+            archived += batch
+            if batch < server.ARCHIVE_BATCH_SIZE:
+                break
+        archive_s = time.perf_counter() - began
+        size_after = len(json.dumps(standin.read("conversations")))
+        counters = metrics.snapshot()["counters"]
+
+        after = {"list": [], "open hot": [], "open archived": []}
+        for _ in range(args.rounds):
+            await timed(client, "/api/chat/conversations", after["list"])
+        for conv_id in hot:
+            await timed(client, f"/api/chat/conversations/{conv_id}", after["open hot"])
+        for conv_id in dormant:
+            await timed(client, f"/api/chat/conversations/{conv_id}", after["open archived"])
+    server.app.dependency_overrides.clear()
+    await storage.close()
+
+    print(f"archived {archived} of {len(conversations)} conversations in {archive_s:.1f}s")
+    print(f"hot collection: {size_before / 1e6:.1f} MB -> {size_after / 1e6:.1f} MB "
+          f"({1 - size_after / size_before:.0%} smaller); archive files "
+          f"{counters['archive_compressed_bytes'] / 1e6:.1f} MB\n")
+    print(f"  {'':<28}{'p50 ms':>10}{'p95 ms':>10}")
+    for label, samples in before.items():
+        print(summary(f"{label} (before)", samples))
+    for label, samples in after.items():
+        print(summary(f"{label} (after)", samples))
+
+
+def main():
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--conversations", type=int, default=3000)
+    parser.add_argument("--dormant", type=float, default=0.8, help="share not touched for 120+ days")
+    parser.add_argument("--messages", type=int, default=30, help="messages per conversation")
+    parser.add_argument("--rounds", type=int, default=10, help="list requests before and after")
+    parser.add_argument("--firebase-latency-ms", type=float, default=5.0)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        asyncio.run(run(args, tmpdir))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Chat turn latency: HTTP POST vs. the WebSocket channel.
+
+Boots the LLM stand-in (streaming, with a per-token output cost) and the app
+under uvicorn on real sockets, with SQLite storage. A registered user sends
+the same number of turns to one conversation over each transport:
+
+- HTTP: POST /api/chat/conversations/{id}/messages, one request per turn
+  (keep-alive connection, bearer token resolved on every request); the answer
+  is only visible when the whole reply has been generated;
+- WebSocket: one connection authenticated once, then `message` frames; the
+  first `delta` is what the user sees, `done` ends the turn.
+
+Reports p50/p95 time to first visible text and to the full turn.
+
+Usage (from backend/):
+    python -m benchmarks.bench_chat_ws [--turns 30] [--latency-ms 300] [--ms-per-token 8] [--reply-words 120]
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+import httpx
+import websockets
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.bench_workers import free_port, wait_ready  # noqa: E402
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+
+def p95(values):
+    return sorted(values)[int(0.95 * (len(values) - 1))]
+
+
+async def http_turns(base: str, token: str, conversation_id: str, turns: int):
+    latencies = []
+    async with httpx.AsyncClient(base_url=base, timeout=60,
+                                 headers={"Authorization": f"Bearer {token}"}) as client:
+        for i in range(turns):
+            began = time.perf_counter()
+            response = await client.post(f"/api/chat/conversations/{conversation_id}/messages",
+                                         json={"content": f"pregunta {i} por http"})
+            response.raise_for_status()
+            latencies.append((time.perf_counter() - began) * 1000)
+    return latencies, latencies
+
+
+async def ws_turns(base: str, token: str, conversation_id: str, turns: int):
+    first, full = [], []
+    async with websockets.connect(base.replace("http", "ws", 1) + "/api/chat/ws") as ws:
+        await ws.send(json.dumps({"type": "auth", "token": token}))
+        assert json.loads(await ws.recv())["type"] == "ready"
+        await ws.send(json.dumps({"type": "open", "conversation_id": conversation_id}))
+        assert json.loads(await ws.recv())["type"] == "opened"
+        for i in range(turns):
+            began = time.perf_counter()
+            await ws.send(json.dumps({"type": "message", "content": f"pregunta {i} por ws", "ref": str(i)}))
+            seen_delta = False
+            while True:
+                message = json.loads(await ws.recv())
+                if message["type"] == "delta" and not seen_delta:
+                    first.append((time.perf_counter() - began) * 1000)
+                    seen_delta = True
+                elif message["type"] == "done":
+                    full.append((time.perf_counter() - began) * 1000)
+                    break
+                elif message["type"] == "error":
+                    raise RuntimeError(message)
+    return first, full
+
+
+async def run(base: str, turns: int):
+    async with httpx.AsyncClient(base_url=base, timeout=30) as client:
+        response = await client.post("/api/auth/register", json={
+            "name": "Bench", "email": f"bench-{uuid.uuid4().hex[:8]}@brainyx.com", "password": "benchmark"})
+        response.raise_for_status()
+        token = response.json()["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        conversations = [(await client.post("/api/chat/conversations", json={}, headers=headers)).json()["id"]
+                         for _ in range(2)]
+    # Warm both paths once so connection setup and first-import costs are not measured
+    await http_turns(base, token, conversations[0], 1)
+    await ws_turns(base, token, conversations[1], 1)
+    return {
+        "http": await http_turns(base, token, conversations[0], turns),
+        "websocket": await ws_turns(base, token, conversations[1], turns),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=30)
+    parser.add_argument("--latency-ms", type=float, default=300)
+    parser.add_argument("--ms-per-token", type=float, default=8)
+    parser.add_argument("--reply-words", type=int, default=120)
+    args = parser.parse_args()
+
+    llm_port, app_port = free_port(), free_port()
+    tmp = tempfile.mkdtemp(prefix="bench-chat-ws-")
+    env = dict(os.environ, STORAGE_URL=f"sqlite:///{tmp}/brainyx.db", LLM_PROVIDER="anthropic",
+               ANTHROPIC_API_KEY="bench", ANTHROPIC_BASE_URL=f"http://127.0.0.1:{llm_port}",
+               SEARCH_INDEX_PATH=":memory:", SEMANTIC_CACHE_PATH="", CONTEXT_COMPACTION="false")
+    procs = [
+        subprocess.Popen([sys.executable, "-m", "standins.llm_server", "--port", str(llm_port),
+                          "--base-latency-ms", str(args.latency_ms), "--output-ms-per-token", str(args.ms_per_token),
+                          "--reply-words", str(args.reply_words)], cwd=BACKEND_DIR, stdout=subprocess.DEVNULL),
+        subprocess.Popen([sys.executable, "-m", "uvicorn", "server:app", "--port", str(app_port),
+                          "--log-level", "warning"], cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL),
+    ]
+    try:
+        base = f"http://127.0.0.1:{app_port}"
+        wait_ready(f"{base}/api/plans")
+        results = asyncio.run(run(base, args.turns))
+    finally:
+        for proc in procs:
+            proc.terminate()
+            proc.wait()
+
+    print(f"{args.turns} turns each, LLM {args.latency_ms:.0f} ms + {args.ms_per_token:g} ms/token, "
+          f"~{args.reply_words} words per reply\n")
+    print(f"{'transport':>10}{'first text p50':>16}{'p95':>9}{'full turn p50':>15}{'p95':>9}  (ms)")
+    for name, (first, full) in results.items():
+        print(f"{name:>10}{statistics.median(first):>16.1f}{p95(first):>9.1f}"
+              f"{statistics.median(full):>15.1f}{p95(full):>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Context compaction across conversation lengths.
+
+Replays conversations of increasing length through the anthropic provider
+against the local LLM stand-in with three prompt strategies:
+
+- window:     last N messages only (older context is lost)
+- full:       the whole history every turn
+- compaction: rolling summary plus recent turns, summary refreshed as in production
+
+Reports the prompt size and simulated latency of the last turns, and for
+compaction the cost of the background summary calls.
+
+Usage (from backend/):
+    python -m benchmarks.bench_compaction [--lengths 10,20,40,80]
+"""
+import argparse
+import asyncio
+import logging
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from compaction import Compactor  # noqa: E402
+from llm import AnthropicProvider, LlmClient, stable_window  # noqa: E402
+from server import (CHAT_HISTORY_MESSAGES, CHAT_HISTORY_STEP, COMPACTION_KEEP_MESSAGES,  # noqa: E402
+                    COMPACTION_TRIGGER_TOKENS, DEFAULT_SYSTEM_PROMPT)
+from standins.llm_server import LlmStandin  # noqa: E402
+
+TAIL = 5  # the last turns of each run are the ones reported
+
+
+async def run(turns: int, strategy: str) -> dict:
+    standin = LlmStandin()
+    client = LlmClient(AnthropicProvider("bench", base_url="http://llm.bench",
+                                         transport=httpx.ASGITransport(app=standin.app)))
+    conversation = {"messages": []}
+
+    async def load(_):
+        return conversation
+
+    async def store(_, summary):
+        conversation["summary"] = summary
+
+    compactor = Compactor(client, model="claude-bench", load=load, store=store,
+                          trigger_tokens=COMPACTION_TRIGGER_TOKENS, keep_messages=COMPACTION_KEEP_MESSAGES,
+                          max_messages=CHAT_HISTORY_MESSAGES, window_step=CHAT_HISTORY_STEP)
+    prompt_tokens, latencies, summary_ms, summary_calls = [], [], 0.0, 0
+    for i in range(turns):
+        message = f"Turno {i}: revisemos la sección {i} del informe trimestral y sus cifras. " * 6
+        messages = conversation["messages"]
+        if strategy == "window":
+            system_prompt, history = DEFAULT_SYSTEM_PROMPT, stable_window(messages, CHAT_HISTORY_MESSAGES,
+                                                                          CHAT_HISTORY_STEP)
+        elif strategy == "full":
+            system_prompt, history = DEFAULT_SYSTEM_PROMPT, messages
+        else:
+            system_prompt, history = compactor.context(DEFAULT_SYSTEM_PROMPT, conversation)
+        result = await client.complete(model="claude-bench", system_prompt=system_prompt,
+                                       history=history, message=message)
+        messages += [{"role": "user", "content": message}, {"role": "assistant", "content": result.text * 4}]
+        prompt_tokens.append(result.usage.total_input_tokens)
+        latencies.append(result.latency_ms)
+        if strategy == "compaction" and compactor.needs_compaction(conversation):
+            # Off the request path in production; timed separately here
+            began = time.perf_counter()
+            if await compactor.compact("bench"):
+                summary_calls += 1
+                summary_ms += (time.perf_counter() - began) * 1000
+    await client.close()
+    return {
+        "prompt_tokens": statistics.mean(prompt_tokens[-TAIL:]),
+        "latency_ms": statistics.mean(latencies[-TAIL:]),
+        "summary_calls": summary_calls,
+        "summary_ms": summary_ms,
+    }
+
+
+def main():
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lengths", default="10,20,40,80", help="conversation lengths in turns")
+    args = parser.parse_args()
+    lengths = [int(n) for n in args.lengths.split(",")]
+
+    print(f"prompt tokens and latency averaged over the last {TAIL} turns (LLM stand-in)\n")
+    print(f"{'turns':>6}  {'strategy':<11}{'prompt tok':>11}{'turn ms':>9}{'summaries':>11}{'summary ms':>12}")
+    for turns in lengths:
+        for strategy in ("window", "full", "compaction"):
+            r = asyncio.run(run(turns, strategy))
+            extra = (f"{r['summary_calls']:>11}{r['summary_ms']:>12.1f}" if strategy == "compaction"
+                     else f"{'-':>11}{'-':>12}")
+            print(f"{turns:>6}  {strategy:<11}{r['prompt_tokens']:>11.0f}{r['latency_ms']:>9.1f}{extra}")
+        print()
+
+
+if __name__ == "__main__":
+    main()
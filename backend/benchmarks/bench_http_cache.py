@@ -0,0 +1,101 @@
+"""
+Conditional GETs and compression on GET /api/chat/conversations/{id}.
+
+Seeds SQLite storage with conversations of several sizes (alternating short
+questions and longer Spanish answers) and fetches each through the ASGI app
+as identity, gzip and brotli, and with a matching If-None-Match (304).
+Reports bytes on the wire, in-process latency (storage read, serialisation,
+compression), and the estimated time to transfer the body on a slow link.
+
+Usage (from backend/):
+    python -m benchmarks.bench_http_cache [--sizes 10 50 200 500] [--mbps 10] [--rounds 30]
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("SEARCH_INDEX_PATH", ":memory:")
+os.environ.setdefault("SEMANTIC_CACHE_PATH", "")
+
+import server  # noqa: E402
+from storage import SqlStorage  # noqa: E402
+
+NOW = "2024-01-01T00:00:00+00:00"
+WORDS = ("el plan de la cuenta permite configurar las llaves de API para cada proyecto y revisar el consumo "
+         "mensual de créditos desde el panel además puedes exportar tus conversaciones o cambiar el modelo "
+         "que responde en cada equipo").split()
+
+
+def text(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def conversation(conv_id: str, n_messages: int, rng: random.Random) -> dict:
+    return {"id": conv_id, "user_id": "bench", "created_at": NOW, "updated_at": NOW,
+            "messages": [{"id": f"{conv_id}-{i}", "role": "user" if i % 2 == 0 else "assistant",
+                          "content": text(rng, 25 if i % 2 == 0 else 150), "timestamp": NOW}
+                         for i in range(n_messages)]}
+
+
+async def measure(client: httpx.AsyncClient, path: str, headers: dict, rounds: int):
+    timings, size = [], 0
+    for _ in range(rounds):
+        began = time.perf_counter()
+        response = await client.get(path, headers=headers)
+        await response.aread()
+        timings.append((time.perf_counter() - began) * 1000)
+        size = len(response.content) if response.status_code == 304 else int(response.headers["content-length"])
+    return size, statistics.median(timings), response
+
+
+async def run(sizes, rounds: int, mbps: float):
+    storage = SqlStorage("sqlite:///:memory:")
+    server.storage = storage
+    server.app.dependency_overrides[server.get_current_user] = lambda: {"id": "bench", "credits": 0}
+    rng = random.Random(3)
+    for n in sizes:
+        await storage.conversations.create(conversation(f"c{n}", n, rng))
+
+    transport = httpx.ASGITransport(app=server.app)
+    rows = []
+    # Raw bytes are counted: the client must not decode them
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        for n in sizes:
+            path = f"/api/chat/conversations/c{n}"
+            identity, identity_ms, first = await measure(client, path, {"Accept-Encoding": "identity"}, rounds)
+            row = {"messages": n, "identity": (identity, identity_ms)}
+            for encoding in ("gzip", "br"):
+                row[encoding] = (await measure(client, path, {"Accept-Encoding": encoding}, rounds))[:2]
+            row["304"] = (await measure(client, path, {"If-None-Match": first.headers["etag"]}, rounds))[:2]
+            rows.append(row)
+
+    bytes_per_ms = mbps * 1e6 / 8 / 1000
+    print(f"transfer estimated at {mbps:g} Mbit/s; latency is in-process median of {rounds} requests\n")
+    print(f"{'messages':>8}{'variant':>10}{'bytes':>10}{'saved':>8}{'server ms':>11}{'+ transfer ms':>15}")
+    for row in rows:
+        base = row["identity"][0]
+        for variant in ("identity", "gzip", "br", "304"):
+            size, ms = row[variant]
+            print(f"{row['messages']:>8}{variant:>10}{size:>10}{1 - size / base:>8.0%}{ms:>11.2f}"
+                  f"{ms + size / bytes_per_ms:>15.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10, 50, 200, 500])
+    parser.add_argument("--rounds", type=int, default=30)
+    parser.add_argument("--mbps", type=float, default=10)
+    args = parser.parse_args()
+    asyncio.run(run(args.sizes, args.rounds, args.mbps))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Login under credential-stuffing traffic, with and without the email filter.
+
+Seeds the Firebase stand-in with registered users, then sends logins for
+emails that do not exist (spread over many client IPs, as a stuffing list
+would be) mixed with a few real logins, and reports latency per kind, the
+Firebase reads of `users` they caused and throughput. A second table gives
+the filter's size and its predicted and measured false-positive rate per
+user count.
+
+Usage (from backend/):
+    python -m benchmarks.bench_login [--users 5000] [--attempts 300] [--firebase-latency-ms 5]
+"""
+import argparse
+import asyncio
+import logging
+import random
+import statistics
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+from bloom import BloomFilter  # noqa: E402
+from firebase_client import FirebaseClient  # noqa: E402
+from shared_state import MemoryStateBackend  # noqa: E402
+from standins.firebase_server import FirebaseStandin  # noqa: E402
+from storage import FirebaseStorage  # noqa: E402
+
+NOW = "2024-05-01T10:00:00+00:00"
+PASSWORD = "bench-password"
+
+
+async def run(filtered: bool, args, password_hash: str) -> dict:
+    users = {f"-u{i}": {"id": f"u{i}", "name": f"Bench {i}", "email": f"bench{i}@brainyx.com",
+                        "password_hash": password_hash, "credits": 10, "created_at": NOW, "updated_at": NOW}
+             for i in range(args.users)}
+    standin = FirebaseStandin({"users": users})
+    standin.faults.latency = args.firebase_latency_ms / 1000
+    server.storage = FirebaseStorage(FirebaseClient("http://firebase.bench",
+                                                    transport=httpx.ASGITransport(app=standin.app)))
+    server.state = MemoryStateBackend()
+    server.FORWARDED_FOR_HOPS = 1
+    server.email_filter = None
+    if filtered:
+        await server.rebuild_email_filter()
+
+    rng = random.Random(7)
+    timings = defaultdict(list)
+    reads_before = standin.count("GET", "users")
+
+    async def attempt(client, i):
+        real = i % 10 == 0
+        email = f"bench{rng.randrange(args.users)}@brainyx.com" if real else f"leak{i}@example.com"
+        kind = "real login" if real else "unknown email"
+        began = time.perf_counter()
+        response = await client.post("/api/auth/login", json={"email": email, "password": PASSWORD},
+                                     headers={"X-Forwarded-For": f"10.{i // 250}.{i % 250}.1"})
+        timings[kind].append((time.perf_counter() - began) * 1000)
+        assert response.status_code == (200 if real else 401), response.text
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://bench",
+                                 timeout=60) as client:
+        began = time.perf_counter()
+        for start in range(0, args.attempts, args.concurrency):
+            await asyncio.gather(*[attempt(client, i)
+                                   for i in range(start, min(args.attempts, start + args.concurrency))])
+        elapsed = time.perf_counter() - began
+    await server.storage.close()
+    return {"timings": timings, "elapsed": elapsed, "reads": standin.count("GET", "users") - reads_before}
+
+
+def filter_table(sizes, error_rate: float):
+    print(f"\n{'users':>9}{'bytes':>10}{'hashes':>8}{'predicted fp':>14}{'measured fp':>13}{'build ms':>10}")
+    for size in sizes:
+        began = time.perf_counter()
+        bloom = BloomFilter.of((f"user{i}@brainyx.com" for i in range(size)), error_rate, headroom=1.0)
+        built = (time.perf_counter() - began) * 1000
+        probes = 50_000
+        measured = sum(f"other{i}@example.com" in bloom for i in range(probes)) / probes
+        print(f"{size:>9}{bloom.size_bytes:>10}{bloom.hashes:>8}{bloom.false_positive_rate():>14.5f}"
+              f"{measured:>13.5f}{built:>10.1f}")
+
+
+def main():
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=5000, help="registered users in the stand-in")
+    parser.add_argument("--attempts", type=int, default=300, help="login attempts, 1 in 10 real")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--firebase-latency-ms", type=float, default=5.0)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[1_000, 10_000, 100_000])
+    args = parser.parse_args()
+
+    password_hash = server.hash_password(PASSWORD)
+    print(f"{args.users} users, {args.attempts} logins, Firebase stand-in latency {args.firebase_latency_ms} ms\n")
+    for filtered in (False, True):
+        result = asyncio.run(run(filtered, args, password_hash))
+        label = "email filter" if filtered else "no filter"
+        print(f"[{label}] {args.attempts / result['elapsed']:.1f} logins/s, {result['reads']} reads of users")
+        print(f"  {'kind':<16}{'p50 ms':>10}{'p95 ms':>10}")
+        for kind, samples in sorted(result["timings"].items()):
+            samples.sort()
+            print(f"  {kind:<16}{statistics.median(samples):>10.1f}{samples[int(0.95 * (len(samples) - 1))]:>10.1f}")
+    filter_table(args.sizes, server.EMAIL_FILTER_ERROR_RATE)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Token metering against the LLM stand-in.
+
+Replays a synthetic chat workload (short questions, long pastes, growing
+conversations) through LlmClient -> AnthropicProvider -> the in-process
+stand-in and reports:
+
+- preflight latency (the admission estimate) per prompt size;
+- how far the preflight input estimate is from the provider's count, over the
+  first calls (uncalibrated) and the rest (calibrated from provider usage);
+- credits charged per call by the old flat price and by token rates, per
+  model and per kind of request.
+
+Usage (from backend/):
+    python -m benchmarks.bench_metering [--calls 600] [--seed 7]
+"""
+import argparse
+import asyncio
+import random
+import statistics
+import sys
+import time
+from collections import defaultdict
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import httpx  # noqa: E402
+
+from llm import AnthropicProvider, LlmClient  # noqa: E402
+from metering import Meter, prompt_chars  # noqa: E402
+from model_routing import load_catalog  # noqa: E402
+from standins.llm_server import LlmStandin  # noqa: E402
+
+SYSTEM_PROMPT = ("Eres Brainyx, un asistente que responde en español de forma clara y breve. "
+                 "Cita las fuentes cuando las tengas. ") * 8
+WORDS = ("cuenta pago plan error envío factura crédito contraseña acceso reporte usuario equipo "
+         "configuración integración límite consumo webhook exportar importar").split()
+
+
+def sentence(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def workload(rng: random.Random, calls: int):
+    """(kind, history, message) tuples; conversations grow turn by turn"""
+    conversations = [[] for _ in range(20)]
+    for _ in range(calls):
+        kind = rng.choices(["question", "paste", "conversation"], weights=[5, 1, 4])[0]
+        if kind == "question":
+            yield kind, [], sentence(rng, rng.randint(5, 25))
+        elif kind == "paste":
+            yield kind, [], " ".join(sentence(rng, 12) for _ in range(rng.randint(100, 600)))
+        else:
+            history = rng.choice(conversations)
+            message = sentence(rng, rng.randint(5, 40))
+            yield kind, list(history), message
+            history.append({"role": "user", "content": message})
+            history.append({"role": "assistant", "content": " ".join(sentence(rng, 15) for _ in range(6))})
+
+
+def preflight_latency(meter: Meter, spec, rng: random.Random):
+    print(f"{'prompt chars':>13}{'p50 us':>9}{'p99 us':>9}")
+    for turns in (0, 10, 50, 200):
+        history = [{"role": "user", "content": sentence(rng, 30)} for _ in range(turns)]
+        message = sentence(rng, 20)
+        samples = []
+        for _ in range(2_000):
+            began = time.perf_counter()
+            meter.preflight(spec, prompt_chars(SYSTEM_PROMPT, history, message))
+            samples.append((time.perf_counter() - began) * 1e6)
+        samples.sort()
+        chars = prompt_chars(SYSTEM_PROMPT, history, message)
+        print(f"{chars:>13}{statistics.median(samples):>9.1f}{samples[int(0.99 * (len(samples) - 1))]:>9.1f}")
+
+
+async def replay(args):
+    rng = random.Random(args.seed)
+    catalog = load_catalog()
+    standin = LlmStandin(base_latency_ms=0)
+    llm = LlmClient(AnthropicProvider("bench", base_url="http://llm.bench",
+                                      transport=httpx.ASGITransport(app=standin.app)))
+    meter = Meter()
+    preflight_latency(meter, catalog["claude-sonnet-4-5-20250929"], rng)
+
+    errors = defaultdict(list)
+    flat = defaultdict(int)
+    rated = defaultdict(int)
+    calls = defaultdict(int)
+    for i, (kind, history, message) in enumerate(workload(rng, args.calls)):
+        spec = catalog[rng.choice(list(catalog))]
+        estimate = meter.preflight(spec, prompt_chars(SYSTEM_PROMPT, history, message))
+        result = await llm.complete(model=spec.id, system_prompt=SYSTEM_PROMPT, history=history,
+                                    message=message, session_id=f"bench-{i}")
+        charge = meter.charge(spec, result.usage, estimate)
+        actual = result.usage.total_input_tokens
+        errors["first 50" if i < 50 else "after 50"].append(abs(estimate.input_tokens - actual) / actual * 100)
+        flat[(spec.id, kind)] += spec.credits
+        rated[(spec.id, kind)] += charge.credits
+        calls[(spec.id, kind)] += 1
+    await llm.close()
+
+    print(f"\n{'calls':>10}{'mean err %':>12}{'p95 err %':>11}")
+    for label, values in errors.items():
+        values.sort()
+        print(f"{label:>10}{statistics.mean(values):>12.1f}{values[int(0.95 * (len(values) - 1))]:>11.1f}")
+
+    print(f"\n{'model':<28}{'kind':<14}{'calls':>6}{'flat/call':>11}{'tokens/call':>13}")
+    for key in sorted(calls):
+        n = calls[key]
+        print(f"{key[0]:<28}{key[1]:<14}{n:>6}{flat[key] / n:>11.2f}{rated[key] / n:>13.2f}")
+    print(f"\ntotal credits: flat {sum(flat.values())}, by tokens {sum(rated.values())}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=600)
+    parser.add_argument("--seed", type=int, default=7)
+    asyncio.run(replay(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
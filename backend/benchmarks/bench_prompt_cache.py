@@ -0,0 +1,76 @@
+"""
+Prompt-prefix caching on long conversations.
+
+Replays an N-turn conversation through the anthropic provider against the
+local LLM stand-in, with and without cache markers, and reports input tokens
+split into cached/uncached plus the simulated per-turn latency.
+
+Usage (from backend/):
+    python -m benchmarks.bench_prompt_cache [--turns 30] [--history 10]
+"""
+import argparse
+import asyncio
+import logging
+import statistics
+import sys
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from llm import AnthropicProvider, LlmClient, stable_window  # noqa: E402
+from server import CHAT_HISTORY_STEP, DEFAULT_SYSTEM_PROMPT  # noqa: E402
+from standins.llm_server import LlmStandin  # noqa: E402
+
+SYSTEM_PROMPT = DEFAULT_SYSTEM_PROMPT + "\n" + ("Sigue las políticas internas de estilo y formato. " * 35)
+
+
+async def run(turns: int, history_size: int, prompt_caching: bool, window) -> dict:
+    standin = LlmStandin()
+    provider = AnthropicProvider("bench", base_url="http://llm.bench", prompt_caching=prompt_caching,
+                                 transport=httpx.ASGITransport(app=standin.app))
+    client = LlmClient(provider)
+    messages, latencies = [], []
+    totals = {"uncached": 0, "cached": 0, "cache_write": 0}
+    for i in range(turns):
+        message = f"Turno {i}: necesito ayuda con el informe trimestral y sus gráficos. " * 8
+        result = await client.complete(model="claude-bench", system_prompt=SYSTEM_PROMPT,
+                                       history=window(messages, history_size), message=message)
+        messages += [{"role": "user", "content": message}, {"role": "assistant", "content": result.text * 6}]
+        latencies.append(result.latency_ms)
+        totals["uncached"] += result.usage.input_tokens
+        totals["cached"] += result.usage.cached_input_tokens
+        totals["cache_write"] += result.usage.cache_write_tokens
+    await client.close()
+    return {"latency_ms": statistics.mean(latencies), "p95_ms": sorted(latencies)[int(0.95 * (turns - 1))], **totals}
+
+
+def main():
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=30)
+    parser.add_argument("--history", type=int, default=10, help="prior messages sent each turn")
+    args = parser.parse_args()
+
+    print(f"{args.turns} turns, last {args.history} messages of history per turn (LLM stand-in)\n")
+    print(f"{'mode':<12}{'uncached':>10}{'cached':>10}{'written':>10}{'avg ms':>10}{'p95 ms':>10}")
+    sliding = lambda msgs, size: msgs[-size:]  # noqa: E731
+    stepped = lambda msgs, size: stable_window(msgs, size, CHAT_HISTORY_STEP)  # noqa: E731
+    rows = {}
+    modes = (("no-cache", False, sliding), ("cache", True, sliding), ("cache+step", True, stepped))
+    for mode, caching, window in modes:
+        rows[mode] = asyncio.run(run(args.turns, args.history, caching, window))
+        r = rows[mode]
+        print(f"{mode:<12}{r['uncached']:>10}{r['cached']:>10}{r['cache_write']:>10}"
+              f"{r['latency_ms']:>10.1f}{r['p95_ms']:>10.1f}")
+    base = rows["no-cache"]
+    print()
+    for mode in ("cache", "cache+step"):
+        r = rows[mode]
+        print(f"{mode}: full-price input tokens -{1 - (r['uncached'] + r['cache_write']) / base['uncached']:.0%}, "
+              f"avg latency -{1 - r['latency_ms'] / base['latency_ms']:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Cost and reaction time of the /api/ready probes.
+
+Polls /api/ready the way a load balancer does (every --poll-ms) while the
+Firebase stand-in goes through three phases: healthy, slow (--slow-ms per
+request) and down (every request fails). Reports, per phase, the /api/ready
+latency (a poll that starts a probe waits for it), how many Firebase
+requests the probes made per poll, and how long it took the endpoint to
+report the new state.
+
+Usage (from backend/):
+    python -m benchmarks.bench_ready [--poll-ms 200] [--phase-seconds 10] [--slow-ms 800]
+"""
+import argparse
+import asyncio
+import logging
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+from firebase_client import FirebaseClient  # noqa: E402
+from standins.firebase_server import FirebaseStandin  # noqa: E402
+from storage import FirebaseStorage  # noqa: E402
+
+
+async def run(args):
+    standin = FirebaseStandin({"users": {}})
+    server.storage = FirebaseStorage(FirebaseClient(
+        "http://firebase.bench", max_retries=0, transport=httpx.ASGITransport(app=standin.app)))
+    phases = [
+        ("healthy", "ready", lambda: None),
+        ("slow", "degraded", lambda: setattr(standin.faults, "latency", args.slow_ms / 1000)),
+        ("down", "unready", lambda: (setattr(standin.faults, "latency", 0),
+                                     setattr(standin.faults, "error_rate", 1.0))),
+    ]
+    print(f"polling every {args.poll_ms:.0f} ms, probe interval {server.READY_PROBE_INTERVAL_SECONDS:g}s\n")
+    print(f"  {'phase':<10}{'polls':>7}{'p50 ms':>9}{'max ms':>9}{'firebase/poll':>15}{'detected after':>16}")
+    async with server.lifespan(server.app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://bench",
+                                     timeout=30) as client:
+            for name, expected, apply in phases:
+                apply()
+                reads_before = standin.count("GET")
+                began = time.monotonic()
+                latencies, detected = [], None
+                while time.monotonic() - began < args.phase_seconds:
+                    sent = time.perf_counter()
+                    response = await client.get("/api/ready")
+                    latencies.append((time.perf_counter() - sent) * 1000)
+                    if detected is None and response.json()["status"] == expected:
+                        detected = time.monotonic() - began
+                    await asyncio.sleep(args.poll_ms / 1000)
+                # Listener streams are GETs too; they hold one open request each, not one per poll
+                reads = standin.count("GET") - reads_before
+                print(f"  {name:<10}{len(latencies):>7}{statistics.median(latencies):>9.1f}"
+                      f"{max(latencies):>9.1f}{reads / len(latencies):>15.2f}"
+                      f"{'never' if detected is None else f'{detected:.1f}s':>16}")
+
+
+def main():
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--poll-ms", type=float, default=200)
+    parser.add_argument("--phase-seconds", type=float, default=10)
+    parser.add_argument("--slow-ms", type=float, default=800, help="Firebase latency in the slow phase")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Semantic cache on a synthetic paraphrase set.
+
+Builds FAQ-style questions from templates (product x topic), stores one
+canonical phrasing of each, then queries with:
+
+- paraphrases of stored questions (case, accents, punctuation, greetings and
+  filler words, word order, inflections) - these should hit;
+- distinct questions that share the template but differ in one content word
+  (another product or topic) - these must miss.
+
+Reports hit rate and false-hit rate per similarity threshold, and embedding
+and lookup latency as the index grows.
+
+Usage (from backend/):
+    python -m benchmarks.bench_semantic_cache [--thresholds 0.75 0.8 0.85 0.9 0.95] [--sizes 100 1000 5000]
+"""
+import argparse
+import random
+import statistics
+import sys
+import time
+import unicodedata
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from semantic_cache import SemanticCache  # noqa: E402
+
+PRODUCTS = ["plan premium", "plan estándar", "plan promoción", "la API", "la app móvil", "el widget web",
+            "la facturación", "las llaves de API", "el chat", "los créditos"]
+TOPICS = [
+    "¿Cuánto cuesta {p}?",
+    "¿Cómo activo {p}?",
+    "¿Cómo cancelo {p}?",
+    "¿Dónde veo el consumo de {p}?",
+    "¿Qué límites tiene {p}?",
+    "¿Por qué falla {p}?",
+    "¿Cómo configuro {p} para mi equipo?",
+    "¿Puedo usar {p} desde otro país?",
+]
+GREETINGS = ["", "Hola, ", "hola ", "Buenas, ", "Oye, ", "Disculpa, "]
+FILLERS = ["", " por favor", " gracias", " please", ""]
+
+
+def strip_accents(text: str) -> str:
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+
+
+def paraphrase(question: str, rng: random.Random) -> str:
+    text = question
+    if rng.random() < 0.5:
+        text = text.lower()
+    if rng.random() < 0.5:
+        text = strip_accents(text)
+    if rng.random() < 0.5:
+        text = text.replace("¿", "").replace("?", "")
+    if rng.random() < 0.3:
+        words = text.rstrip("?").split()
+        if len(words) > 3:
+            i = rng.randrange(1, len(words) - 1)
+            words[i], words[i + 1] = words[i + 1], words[i]
+            text = " ".join(words) + ("?" if question.endswith("?") else "")
+    return rng.choice(GREETINGS) + text + rng.choice(FILLERS)
+
+
+def build(rng: random.Random):
+    questions = [t.format(p=p) for t in TOPICS for p in PRODUCTS]
+    rng.shuffle(questions)
+    stored = questions[: len(questions) // 2]
+    unseen = questions[len(questions) // 2:]
+    paraphrases = [(paraphrase(q, rng), q) for q in stored for _ in range(3)]
+    return stored, unseen, paraphrases
+
+
+def accuracy(stored, unseen, paraphrases, threshold: float):
+    cache = SemanticCache(threshold=threshold)
+    for q in stored:
+        cache.store("bench", q, {"question": q})
+    hits = correct = 0
+    for text, original in paraphrases:
+        hit = cache.lookup("bench", text)
+        if hit:
+            hits += 1
+            correct += hit.answer["question"] == original
+    false_hits = sum(1 for q in unseen if cache.lookup("bench", q))
+    return hits / len(paraphrases), correct / max(hits, 1), false_hits / len(unseen)
+
+
+def latency(size: int, rng: random.Random):
+    cache = SemanticCache()
+    words = [f"{w}{i}" for i in range(200) for w in ("cuenta", "pago", "plan", "error", "envío")]
+    for i in range(size):
+        cache.store("bench", " ".join(rng.sample(words, 8)), {"i": i})
+    queries = [" ".join(rng.sample(words, 8)) for _ in range(500)]
+    embed_ms, lookup_ms = [], []
+    for q in queries:
+        began = time.perf_counter()
+        vector = cache.embedder.embed(q)
+        embedded = time.perf_counter()
+        cache.lookup("bench", q, vector)
+        embed_ms.append((embedded - began) * 1000)
+        lookup_ms.append((time.perf_counter() - embedded) * 1000)
+    p95 = lambda xs: sorted(xs)[int(0.95 * (len(xs) - 1))]  # noqa: E731
+    return statistics.median(embed_ms), p95(embed_ms), statistics.median(lookup_ms), p95(lookup_ms)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--thresholds", nargs="+", type=float, default=[0.75, 0.8, 0.85, 0.9, 0.95])
+    parser.add_argument("--sizes", nargs="+", type=int, default=[100, 1000, 5000])
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    stored, unseen, paraphrases = build(rng)
+    print(f"{len(stored)} stored questions, {len(paraphrases)} paraphrases, {len(unseen)} distinct questions\n")
+    print(f"{'threshold':>10}{'hit rate':>10}{'correct':>10}{'false hits':>12}")
+    for threshold in args.thresholds:
+        hit_rate, correct, false_rate = accuracy(stored, unseen, paraphrases, threshold)
+        print(f"{threshold:>10.2f}{hit_rate:>10.1%}{correct:>10.1%}{false_rate:>12.1%}")
+
+    print(f"\n{'entries':>8}{'embed p50':>11}{'embed p95':>11}{'lookup p50':>12}{'lookup p95':>12}  (ms)")
+    for size in args.sizes:
+        e50, e95, l50, l95 = latency(size, rng)
+        print(f"{size:>8}{e50:>11.3f}{e95:>11.3f}{l50:>12.3f}{l95:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
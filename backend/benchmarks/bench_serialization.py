@@ -0,0 +1,113 @@
+"""
+Micro-benchmark: per-endpoint response serialization cost.
+
+Compares the previous path (build Pydantic models, re-validate them against
+response_model, encode with the stdlib json encoder) with the trusted path
+(project plain dicts, encode with orjson when available).
+
+Usage (from backend/):
+    python -m benchmarks.bench_serialization [--conversations 100] [--messages 40]
+"""
+import argparse
+import asyncio
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from fastapi.responses import JSONResponse  # noqa: E402
+from fastapi.routing import serialize_response  # noqa: E402
+from pydantic import TypeAdapter  # noqa: E402
+
+import server  # noqa: E402
+
+
+def make_conversation(user_id: str, n_messages: int) -> dict:
+    now = datetime.now(timezone.utc).isoformat()
+    messages = []
+    for i in range(n_messages):
+        messages.append({
+            "id": str(uuid.uuid4()),
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 6,
+            "timestamp": now
+        })
+    return {"id": str(uuid.uuid4()), "user_id": user_id, "messages": messages, "created_at": now, "updated_at": now}
+
+
+def route_field(path: str, method: str):
+    for route in server.app.routes:
+        if getattr(route, "path", None) == path and method in getattr(route, "methods", ()):
+            return route.response_field
+    raise LookupError(path)
+
+
+def bench(fn, repeat: int) -> float:
+    fn()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--conversations", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=40)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    user_id = str(uuid.uuid4())
+    convs = [make_conversation(user_id, args.messages) for _ in range(args.conversations)]
+    user = {
+        "id": user_id, "name": "Bench", "email": "bench@brainyx.com", "created_at": convs[0]["created_at"],
+        "system_prompt": server.DEFAULT_SYSTEM_PROMPT, "credits": 1000, "plan": "free"
+    }
+    loop = asyncio.new_event_loop()
+
+    def legacy(path: str, method: str, build):
+        field = route_field(path, method)
+
+        def run():
+            content = loop.run_until_complete(serialize_response(field=field, response_content=build()))
+            return JSONResponse(content=content).body
+        return run
+
+    cases = {
+        "GET /api/chat/conversations": (
+            legacy("/api/chat/conversations", "GET",
+                   lambda: [server.ConversationResponse(**c) for c in convs]),
+            lambda: server.trusted_response([server.conversation_payload(c) for c in convs]).body,
+        ),
+        "GET /api/chat/conversations/{id}": (
+            legacy("/api/chat/conversations/{conversation_id}", "GET",
+                   lambda: server.ConversationResponse(**convs[0])),
+            lambda: server.trusted_response(server.conversation_payload(convs[0])).body,
+        ),
+        "GET /api/auth/me": (
+            legacy("/api/auth/me", "GET", lambda: server.format_user_response(user)),
+            lambda: server.trusted_response(server.user_payload(user)).body,
+        ),
+    }
+
+    # Sanity check: both paths must produce the same document
+    adapter = TypeAdapter(List[server.ConversationResponse])
+    assert adapter.validate_json(cases["GET /api/chat/conversations"][1]()) == \
+        adapter.validate_json(cases["GET /api/chat/conversations"][0]())
+
+    print(f"encoder: {server.DefaultResponse.__name__}, "
+          f"{args.conversations} conversations x {args.messages} messages\n")
+    print(f"{'endpoint':<36}{'before ms':>12}{'after ms':>12}{'speedup':>10}")
+    for name, (before, after) in cases.items():
+        b = bench(before, args.repeat)
+        a = bench(after, args.repeat)
+        print(f"{name:<36}{b:>12.3f}{a:>12.3f}{b / a:>9.1f}x")
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
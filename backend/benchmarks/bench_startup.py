@@ -0,0 +1,52 @@
+"""
+Cold-start import cost of the app, measured with `python -X importtime`.
+
+Usage (from backend/):
+    python -m benchmarks.bench_startup [--module server] [--top 15] [--runs 5]
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+
+def measure_import(module: str = "server") -> dict:
+    """Import `module` in a fresh interpreter and return its importtime breakdown (ms)"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+    )
+    cumulative = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        _, cumulative_us, name = line.split("|")
+        cumulative[name.strip()] = int(cumulative_us) / 1000
+    return {"total_ms": cumulative.get(module, 0.0), "modules": cumulative}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="server")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    runs = [measure_import(args.module) for _ in range(args.runs)]
+    totals = [r["total_ms"] for r in runs]
+    print(f"import {args.module}: median {statistics.median(totals):.1f} ms "
+          f"(min {min(totals):.1f}, max {max(totals):.1f}, {args.runs} runs)\n")
+    top = sorted(runs[-1]["modules"].items(), key=lambda kv: kv[1], reverse=True)
+    top = [(name, ms) for name, ms in top if "." not in name][:args.top]
+    print(f"{'top-level package':<32}{'cumulative ms':>14}")
+    for name, ms in top:
+        print(f"{name:<32}{ms:>14.1f}")
+    lazy = [name for name in runs[-1]["modules"] if name.startswith("emergentintegrations")]
+    print(f"\nemergentintegrations imported at startup: {'yes' if lazy else 'no'}")
+
+
+if __name__ == "__main__":
+    main()
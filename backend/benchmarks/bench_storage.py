@@ -0,0 +1,141 @@
+"""
+API load against each storage backend.
+
+Runs the app in-process with its storage pointed at either the Firebase
+stand-in (with a configurable per-request latency) or a SQLite file, seeds
+other users' conversations so collection scans have something to scan, then
+drives a mixed workload from concurrent virtual users: list conversations,
+open one, send a message (LLM stand-in), list API keys, read usage history.
+
+Usage (from backend/):
+    python -m benchmarks.bench_storage [--storage firebase sqlite] [--users 8] [--rounds 10]
+                                       [--conversations 2000] [--firebase-latency-ms 5]
+"""
+import argparse
+import asyncio
+import logging
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+from compaction import Compactor  # noqa: E402
+from firebase_client import FirebaseClient  # noqa: E402
+from llm import AnthropicProvider, LlmClient  # noqa: E402
+from search import SearchIndex  # noqa: E402
+from shared_state import MemoryStateBackend  # noqa: E402
+from standins.firebase_server import FirebaseStandin  # noqa: E402
+from standins.llm_server import LlmStandin  # noqa: E402
+from storage import FirebaseStorage, SqlStorage  # noqa: E402
+
+NOW = "2024-05-01T10:00:00+00:00"
+
+
+def make_storage(backend: str, latency_ms: float, tmpdir: str):
+    if backend == "firebase":
+        standin = FirebaseStandin()
+        standin.faults.latency = latency_ms / 1000
+        client = FirebaseClient("http://firebase.bench", transport=httpx.ASGITransport(app=standin.app),
+                                singleflight_nodes=server.FIREBASE_SINGLEFLIGHT_PATHS)
+        return FirebaseStorage(client)
+    return SqlStorage(f"sqlite:///{tmpdir}/bench.db")
+
+
+async def seed(storage, conversations: int):
+    """Conversations of other users, so per-user queries run against a realistic collection"""
+    for i in range(conversations):
+        await storage.conversations.create({
+            "id": f"noise-{i}", "user_id": f"noise-user-{i % 100}", "created_at": NOW, "updated_at": NOW,
+            "messages": [{"id": f"n{i}a", "role": "user", "content": "Hola, ¿me ayudas con un informe?",
+                          "timestamp": NOW},
+                         {"id": f"n{i}b", "role": "assistant", "content": "Claro, cuéntame más.", "timestamp": NOW}],
+        })
+
+
+async def setup_user(client: httpx.AsyncClient, index: int) -> tuple:
+    response = await client.post("/api/auth/register", json={
+        "name": f"Bench {index}", "email": f"bench{index}@brainyx.com", "password": "bench-password"})
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    conv_ids = [(await client.post("/api/chat/conversations", headers=headers)).json()["id"] for _ in range(3)]
+    await client.post("/api/api-keys", headers=headers, json={"name": "bench"})
+    return headers, conv_ids
+
+
+async def virtual_user(client: httpx.AsyncClient, headers: dict, conv_ids: list, rounds: int, timings: dict):
+    async def timed(op, method, url, **kwargs):
+        began = time.perf_counter()
+        response = await client.request(method, url, headers=headers, **kwargs)
+        timings[op].append((time.perf_counter() - began) * 1000)
+        if response.status_code >= 400:
+            raise RuntimeError(f"{op}: HTTP {response.status_code} {response.text[:200]}")
+
+    for i in range(rounds):
+        conv_id = conv_ids[i % len(conv_ids)]
+        await timed("list conversations", "GET", "/api/chat/conversations")
+        await timed("get conversation", "GET", f"/api/chat/conversations/{conv_id}")
+        await timed("send message", "POST", f"/api/chat/conversations/{conv_id}/messages",
+                    json={"content": f"Mensaje {i}: resume el punto {i} del informe."})
+        await timed("list api keys", "GET", "/api/api-keys")
+        await timed("usage history", "GET", "/api/usage/history")
+
+
+async def run(backend: str, args, tmpdir: str) -> dict:
+    storage = make_storage(backend, args.firebase_latency_ms, tmpdir)
+    llm = LlmClient(AnthropicProvider("bench", base_url="http://llm.bench",
+                                      transport=httpx.ASGITransport(app=LlmStandin(base_latency_ms=0).app)))
+    server.storage = storage
+    server.llm = llm
+    server.state = MemoryStateBackend()
+    server.search_index = SearchIndex()
+    server.compactor = Compactor(llm, model="claude-bench", load=storage.conversations.get,
+                                 store=storage.conversations.set_summary, enabled=False)
+    await seed(storage, args.conversations)
+
+    timings = defaultdict(list)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://bench",
+                                 timeout=60) as client:
+        users = [await setup_user(client, i) for i in range(args.users)]
+        began = time.perf_counter()
+        await asyncio.gather(*[virtual_user(client, headers, conv_ids, args.rounds, timings)
+                               for headers, conv_ids in users])
+        elapsed = time.perf_counter() - began
+    await llm.close()
+    await storage.close()
+    return {"timings": timings, "elapsed": elapsed}
+
+
+def main():
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    logging.getLogger("server").setLevel(logging.WARNING)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--storage", nargs="+", default=["firebase", "sqlite"], choices=["firebase", "sqlite"])
+    parser.add_argument("--users", type=int, default=8, help="concurrent virtual users")
+    parser.add_argument("--rounds", type=int, default=10, help="workload rounds per user")
+    parser.add_argument("--conversations", type=int, default=2000, help="other users' conversations seeded")
+    parser.add_argument("--firebase-latency-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    print(f"{args.users} users x {args.rounds} rounds, {args.conversations} seeded conversations, "
+          f"Firebase stand-in latency {args.firebase_latency_ms} ms\n")
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for backend in args.storage:
+            result = asyncio.run(run(backend, args, tmpdir))
+            timings = result["timings"]
+            total = sum(len(samples) for samples in timings.values())
+            print(f"[{backend}] {total} requests in {result['elapsed']:.2f}s ({total / result['elapsed']:.1f} req/s)")
+            print(f"  {'operation':<20}{'p50 ms':>10}{'p95 ms':>10}")
+            for op, samples in timings.items():
+                samples = sorted(samples)
+                print(f"  {op:<20}{statistics.median(samples):>10.1f}{samples[int(0.95 * (len(samples) - 1))]:>10.1f}")
+            print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Conversation list cost with and without messages, and model calls per title.
+
+Seeds the Firebase stand-in with one user's conversations (--conversations,
+each with --messages messages), then compares GET /api/chat/conversations
+with ?view=meta: bytes on the wire and latency. Then titles every
+conversation through the TitleWorker with batches of 1 and --batch-size and
+reports the model calls and prompt tokens per conversation.
+
+Usage (from backend/):
+    python -m benchmarks.bench_titles [--conversations 100] [--messages 40] [--batch-size 8] [--rounds 20]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import server  # noqa: E402
+from firebase_client import FirebaseClient  # noqa: E402
+from llm import AnthropicProvider, LlmClient  # noqa: E402
+from shared_state import MemoryStateBackend  # noqa: E402
+from standins.firebase_server import FirebaseStandin  # noqa: E402
+from standins.llm_server import LlmStandin  # noqa: E402
+from storage import FirebaseStorage  # noqa: E402
+from titles import TitleWorker  # noqa: E402
+
+NOW = "2024-05-01T10:00:00+00:00"
+
+
+def seed(count, messages):
+    conversations = []
+    for c in range(count):
+        conversations.append({
+            "id": f"c{c}", "user_id": "u1", "created_at": NOW, "updated_at": f"2024-05-01T10:{c // 60:02d}:{c % 60:02d}",
+            "messages": [{"id": f"c{c}-m{i}", "role": "user" if i % 2 == 0 else "assistant",
+                          "content": f"mensaje {i} de la conversación {c} " + "texto " * 60, "timestamp": NOW}
+                         for i in range(messages)]})
+    return conversations
+
+
+async def list_cost(client, path, rounds):
+    latencies, size = [], 0
+    for _ in range(rounds):
+        began = time.perf_counter()
+        response = await client.get(path, headers={"Accept-Encoding": "identity"})
+        latencies.append((time.perf_counter() - began) * 1000)
+        size = len(response.content)
+    return size, statistics.median(latencies)
+
+
+def titled_replies(payload):
+    prompt = payload["messages"][-1]["content"]
+    if isinstance(prompt, list):
+        prompt = prompt[-1]["text"]
+    return "\n".join(json.dumps({"n": n, "title": f"Título {n}"}) for n in range(1, prompt.count("### ") + 1))
+
+
+async def title_cost(conversations, batch_size):
+    standin = LlmStandin(base_latency_ms=0)
+    standin.reply_text = titled_replies
+    client = LlmClient(AnthropicProvider("k", base_url="http://llm.bench",
+                                         transport=httpx.ASGITransport(app=standin.app)))
+    by_id = {conv["id"]: dict(conv) for conv in conversations}
+
+    async def load(conversation_id):
+        return by_id.get(conversation_id)
+
+    async def store(conv, meta):
+        by_id[conv["id"]]["meta"] = meta
+
+    worker = TitleWorker(client, model="claude-bench", load=load, store=store, state=MemoryStateBackend(),
+                         batch_size=batch_size, max_queue=len(by_id), llm_calls_per_minute=0)
+    for conversation_id in by_id:
+        worker.enqueue(conversation_id)
+    while worker.queued:
+        await worker.process(worker.take())
+    await client.close()
+    titled = sum(1 for conv in by_id.values() if conv["meta"]["source"] == "llm")
+    prompt_tokens = sum(request["usage"]["input_tokens"] for request in standin.requests)
+    return len(standin.requests), prompt_tokens, titled
+
+
+async def run(args):
+    standin = FirebaseStandin({"users": {}})
+    server.storage = FirebaseStorage(FirebaseClient(
+        "http://firebase.bench", max_retries=0, transport=httpx.ASGITransport(app=standin.app)))
+    conversations = seed(args.conversations, args.messages)
+    await server.storage.conversations.create_many(conversations)
+    server.app.dependency_overrides[server.get_current_user] = lambda: {"id": "u1", "credits": 10}
+
+    print(f"{args.conversations} conversations x {args.messages} messages\n")
+    print(f"  {'list':<12}{'bytes':>12}{'p50 ms':>9}")
+    async with server.lifespan(server.app):
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server.app), base_url="http://bench",
+                                     timeout=30) as client:
+            for name, path in (("full", "/api/chat/conversations"), ("view=meta", "/api/chat/conversations?view=meta")):
+                size, p50 = await list_cost(client, path, args.rounds)
+                print(f"  {name:<12}{size:>12}{p50:>9.1f}")
+    server.app.dependency_overrides.clear()
+
+    print(f"\n  {'batch':<12}{'calls':>8}{'calls/conv':>12}{'prompt tok/conv':>17}{'titled':>8}")
+    for batch_size in sorted({1, args.batch_size}):
+        calls, prompt_tokens, titled = await title_cost(conversations, batch_size)
+        print(f"  {batch_size:<12}{calls:>8}{calls / len(conversations):>12.3f}"
+              f"{prompt_tokens / len(conversations):>17.0f}{titled:>8}")
+
+
+def main():
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--conversations", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=40)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Throughput vs. gunicorn worker count.
+
+Starts the Redis stand-in as the shared state backend, then for each worker
+count boots `gunicorn -c gunicorn.conf.py server:app` and drives it from
+several client processes for a fixed duration.
+
+Usage (from backend/):
+    python -m benchmarks.bench_workers [--workers 1 2 4] [--duration 5] [--path /api/plans]
+"""
+import argparse
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(url: str, timeout: float = 30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"server did not become ready: {url}")
+
+
+def client_loop(url: str, duration: float, counter):
+    done = 0
+    deadline = time.time() + duration
+    with httpx.Client(timeout=10) as client:
+        while time.time() < deadline:
+            if client.get(url).status_code == 200:
+                done += 1
+    with counter.get_lock():
+        counter.value += done
+
+
+def run_load(url: str, clients: int, duration: float) -> float:
+    counter = multiprocessing.Value("i", 0)
+    procs = [multiprocessing.Process(target=client_loop, args=(url, duration, counter)) for _ in range(clients)]
+    for p in procs:
+        p.start()
+    for p in procs:
+        p.join()
+    return counter.value / duration
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--path", default="/api/plans")
+    args = parser.parse_args()
+
+    redis_port = free_port()
+    redis_proc = subprocess.Popen([sys.executable, "-m", "standins.redis_server", "--port", str(redis_port)],
+                                  cwd=BACKEND_DIR, stdout=subprocess.DEVNULL)
+    results = []
+    try:
+        for workers in args.workers:
+            port = free_port()
+            env = dict(os.environ, PORT=str(port), WEB_CONCURRENCY=str(workers),
+                       STATE_BACKEND_URL=f"redis://127.0.0.1:{redis_port}/0")
+            server = subprocess.Popen(
+                [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "server:app"],
+                cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                base = f"http://127.0.0.1:{port}"
+                wait_ready(f"{base}/api/health")
+                rps = run_load(f"{base}{args.path}", args.clients, args.duration)
+                results.append((workers, rps))
+            finally:
+                server.terminate()
+                server.wait(timeout=30)
+    finally:
+        redis_proc.terminate()
+
+    base_rps = results[0][1] or 1
+    print(f"GET {args.path}, {args.clients} client processes, {args.duration:.0f}s per run, "
+          f"{os.cpu_count()} CPUs\n")
+    print(f"{'workers':>8}{'req/s':>12}{'scaling':>10}")
+    for workers, rps in results:
+        print(f"{workers:>8}{rps:>12.0f}{rps / base_rps:>9.2f}x")
+
+
+if __name__ == "__main__":
+    main()
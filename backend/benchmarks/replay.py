@@ -0,0 +1,395 @@
+"""
+Record-and-replay load tests against the stand-ins.
+
+Record on a running instance with TRAFFIC_TRACE_PATH set (see traffic.py),
+then replay the trace against each build to compare, e.g. the release
+candidate checked out with `git worktree add ../candidate <rev>`:
+
+    python -m benchmarks.replay run trace.ndjson --speed 4 --out baseline.json
+    python -m benchmarks.replay run trace.ndjson --speed 4 --app-dir ../candidate/backend --out candidate.json
+    python -m benchmarks.replay compare baseline.json candidate.json [--threshold 0.15]
+
+`run` starts the Firebase and LLM stand-ins from this tree (both builds see
+the same backends), boots the build in --app-dir with uvicorn pointed at
+them, creates one account per traced client and re-issues every traced
+request at its recorded offset divided by --speed, without waiting for
+earlier ones (open loop, as real clients do). Requests are rebuilt from the
+route template and the recorded sizes: ids come from the seeded accounts,
+text is filler of the recorded length. Routes it cannot rebuild are counted
+as skipped. Stripe is not emulated, so checkout-status polls end in the
+Stripe call and are compared as errors on both builds.
+
+`compare` prints latency percentiles and error rates per route and exits
+with status 1 when a route's p95 grew by more than --threshold (and
+--min-ms) or its error rate rose by more than --max-error-increase.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+import websockets
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks.bench_workers import free_port, wait_ready  # noqa: E402
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+WORDS = "informe ventas cliente factura pago plan equipo reunión propuesta resumen datos correo".split()
+PASSWORD = "replay-password"
+
+
+def load_trace(paths: List[str], limit: Optional[int] = None) -> List[dict]:
+    """Events of one or more trace files on a common clock, starting at 0"""
+    events = []
+    for path in paths:
+        epoch = 0.0
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record.get("type") == "trace":
+                    epoch = record["started_epoch"]
+                else:
+                    record["at"] = epoch + record["t"]
+                    events.append(record)
+    events.sort(key=lambda event: event["at"])
+    if events:
+        start = events[0]["at"]
+        for event in events:
+            event["at"] -= start
+    return events[:limit] if limit else events
+
+
+def filler(chars: int) -> str:
+    words, size = [], 0
+    while size < chars:
+        word = WORDS[len(words) % len(WORDS)]
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words)[:max(chars, 1)]
+
+
+def percentile(samples: List[float], q: float) -> float:
+    ordered = sorted(samples)
+    return ordered[int(q * (len(ordered) - 1))] if ordered else 0.0
+
+
+@dataclass
+class Account:
+    email: str
+    token: str = ""
+    api_key: str = ""
+    conversations: List[str] = field(default_factory=list)
+    ip: str = ""
+
+
+class World:
+    """Accounts standing in for the traced clients"""
+
+    def __init__(self, client: httpx.AsyncClient, firebase_url: str):
+        self.client = client
+        self.firebase_url = firebase_url
+        self.accounts: Dict[Optional[str], Account] = {}
+        self.sessions: Dict[str, str] = {}
+
+    async def seed(self, events: List[dict]):
+        clients = sorted({e.get("client") for e in events if e.get("client")}) or ["anonymous"]
+        for i, client_id in enumerate(clients):
+            account = Account(email=f"replay-{uuid.uuid4().hex[:10]}@brainyx.com", ip=f"10.9.{i // 250}.{i % 250 + 1}")
+            response = await self.client.post("/api/auth/register", json={
+                "name": f"Replay {i}", "email": account.email, "password": PASSWORD},
+                headers={"X-Forwarded-For": account.ip})
+            response.raise_for_status()
+            account.token = response.json()["access_token"]
+            headers = self.bearer(account)
+            key = await self.client.post("/api/api-keys", json={"name": "replay"}, headers=headers)
+            account.api_key = key.json().get("key", "")
+            for _ in range(2):
+                conv = await self.client.post("/api/chat/conversations", headers=headers)
+                account.conversations.append(conv.json()["id"])
+            self.accounts[client_id] = account
+        # Enough credits and the top plan for any trace; payments for checkout-status polls
+        async with httpx.AsyncClient(base_url=self.firebase_url) as firebase:
+            users = (await firebase.get("/users.json")).json() or {}
+            await firebase.patch("/users.json", json={
+                f"{key}/credits": 10 ** 9 for key in users} | {f"{key}/plan": "premium" for key in users})
+            for account in self.accounts.values():
+                session_id = f"cs_replay_{uuid.uuid4().hex[:16]}"
+                user_id = next(u["id"] for u in users.values() if u["email"] == account.email)
+                await firebase.put(f"/payment_transactions/{session_id}.json", json={
+                    "session_id": session_id, "user_id": user_id, "plan_id": "premium", "credits": 0,
+                    "payment_status": "completed", "created_at": "2024-01-01T00:00:00+00:00"})
+                self.sessions[account.email] = session_id
+        # Log in again so the cached sessions carry the new balance
+        for account in self.accounts.values():
+            response = await self.client.post("/api/auth/login", json={"email": account.email, "password": PASSWORD},
+                                              headers={"X-Forwarded-For": account.ip})
+            response.raise_for_status()
+            account.token = response.json()["access_token"]
+
+    def account(self, event: dict) -> Account:
+        return self.accounts.get(event.get("client")) or random.choice(list(self.accounts.values()))
+
+    @staticmethod
+    def bearer(account: Account) -> dict:
+        return {"Authorization": f"Bearer {account.token}", "X-Forwarded-For": account.ip}
+
+    def build(self, event: dict) -> Optional[tuple]:
+        """(method, url, headers, json body) for a traced HTTP request, or None when it cannot be rebuilt"""
+        method, route = event["method"], event["route"]
+        account = self.account(event)
+        headers = {"X-API-Key": account.api_key} if event.get("auth") == "api_key" else self.bearer(account)
+        size = event.get("req_bytes", 0)
+        conversation = random.choice(account.conversations)
+        if route == "/api/v1/chat":
+            return method, route, headers, {"message": filler(size - 14)}
+        if route == "/api/chat/conversations/{conversation_id}/messages":
+            return method, f"/api/chat/conversations/{conversation}/messages", headers, {"content": filler(size - 14)}
+        if route == "/api/chat/conversations/{conversation_id}" and method == "GET":
+            return method, f"/api/chat/conversations/{conversation}", headers, None
+        if route == "/api/stripe/checkout-status/{session_id}":
+            return method, f"/api/stripe/checkout-status/{self.sessions[account.email]}", headers, None
+        if route == "/api/auth/login":
+            return method, route, {"X-Forwarded-For": account.ip}, {"email": account.email, "password": PASSWORD}
+        if route == "/api/auth/register":
+            return method, route, {"X-Forwarded-For": account.ip}, {
+                "name": "Replay", "email": f"replay-{uuid.uuid4().hex[:10]}@brainyx.com", "password": PASSWORD}
+        if route == "/api/chat/search":
+            return method, f"{route}?q={random.choice(WORDS)}", headers, None
+        if route == "/api/settings" and method == "PUT":
+            return method, route, headers, {"system_prompt": filler(max(size - 19, 10))}
+        if "{" in route or method not in ("GET", "POST"):
+            return None
+        return method, route, headers, None
+
+
+class Replayer:
+    def __init__(self, world: World, base_url: str, speed: float):
+        self.world = world
+        self.base_url = base_url
+        self.speed = speed
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.statuses: Dict[str, Dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.skipped: Dict[str, int] = defaultdict(int)
+        self.lag: List[float] = []
+
+    def observe(self, key: str, ms: float, ok: bool, status: str = ""):
+        self.samples[key].append(round(ms, 2))
+        if status:
+            self.statuses[key][status] += 1
+        if not ok:
+            self.errors[key] += 1
+
+    async def http(self, event: dict):
+        request = self.world.build(event)
+        key = f"{event['method']} {event['route']}"
+        if request is None:
+            self.skipped[key] += 1
+            return
+        method, url, headers, body = request
+        began = time.perf_counter()
+        try:
+            response = await self.world.client.request(method, url, headers=headers, json=body)
+            status, ok = str(response.status_code), response.status_code < 500 and response.status_code != 429
+        except httpx.HTTPError as e:
+            status, ok = type(e).__name__, False
+        self.observe(key, (time.perf_counter() - began) * 1000, ok, status)
+
+    async def websocket(self, event: dict, began_at: float):
+        account = self.world.account(event)
+        url = self.base_url.replace("http", "ws", 1) + "/api/chat/ws"
+        try:
+            async with websockets.connect(url, max_size=None) as ws:
+                pending = {}
+
+                async def read():
+                    async for raw in ws:
+                        message = json.loads(raw)
+                        if message.get("type") in ("done", "error", "cancelled") and message.get("ref") in pending:
+                            sent = pending.pop(message["ref"])
+                            self.observe("WS turn", (time.perf_counter() - sent) * 1000, message["type"] == "done",
+                                         message["type"])
+
+                reader = asyncio.create_task(read())
+                for offset, kind, size in event.get("frames", []):
+                    await asyncio.sleep(max(0.0, began_at + offset / self.speed - time.perf_counter()))
+                    ref = uuid.uuid4().hex[:8]
+                    if kind == "auth":
+                        frame = {"type": "auth", "token": account.token}
+                    elif kind == "open":
+                        frame = {"type": "open", "ref": ref, "conversation_id": random.choice(account.conversations)}
+                    elif kind == "message":
+                        # Clients wait for the previous answer; the server rejects a second queued turn
+                        while pending:
+                            await asyncio.sleep(0.01)
+                        frame = {"type": "message", "ref": ref, "content": filler(size - 40)}
+                        pending[ref] = time.perf_counter()
+                    elif kind in ("ping", "pong", "cancel"):
+                        frame = {"type": kind}
+                    else:
+                        continue
+                    await ws.send(json.dumps(frame))
+                deadline = time.perf_counter() + 120
+                while pending and time.perf_counter() < deadline:
+                    await asyncio.sleep(0.05)
+                reader.cancel()
+        except Exception:
+            self.observe("WS connection", 0.0, False)
+
+    async def run(self, events: List[dict]) -> float:
+        start = time.perf_counter()
+        tasks = []
+        for event in events:
+            scheduled = start + event["at"] / self.speed
+            await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+            self.lag.append((time.perf_counter() - scheduled) * 1000)
+            if event.get("kind") == "ws":
+                tasks.append(asyncio.create_task(self.websocket(event, time.perf_counter())))
+            else:
+                tasks.append(asyncio.create_task(self.http(event)))
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - start
+
+
+def git_revision(path: Path) -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=path, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def replay(args, events: List[dict], base_url: str, firebase_url: str) -> dict:
+    async with httpx.AsyncClient(base_url=base_url, timeout=120,
+                                 limits=httpx.Limits(max_connections=args.max_connections)) as client:
+        world = World(client, firebase_url)
+        await world.seed(events)
+        replayer = Replayer(world, base_url, args.speed)
+        elapsed = await replayer.run(events)
+    return {"elapsed_s": round(elapsed, 3), "routes": {
+        key: {"latencies_ms": samples, "errors": replayer.errors.get(key, 0),
+              "statuses": dict(replayer.statuses.get(key, {}))}
+        for key, samples in replayer.samples.items()},
+        "skipped": dict(replayer.skipped), "lag_p95_ms": round(percentile(replayer.lag, 0.95), 2)}
+
+
+def run(args):
+    events = load_trace(args.trace, args.limit)
+    app_dir = Path(args.app_dir).resolve()
+    firebase_port, llm_port, app_port = free_port(), free_port(), free_port()
+    tmp = tempfile.mkdtemp(prefix="replay-")
+    env = dict(os.environ, STORAGE_URL="firebase", FIREBASE_DB_URL=f"http://127.0.0.1:{firebase_port}",
+               LLM_PROVIDER="anthropic", ANTHROPIC_API_KEY="replay", ANTHROPIC_BASE_URL=f"http://127.0.0.1:{llm_port}",
+               SEARCH_INDEX_PATH=":memory:", SEMANTIC_CACHE_PATH="", ARCHIVE_PATH=f"{tmp}/archive",
+               TRAFFIC_TRACE_PATH="", FORWARDED_FOR_HOPS="1", STATE_BACKEND_URL="memory://",
+               JWT_SECRET=uuid.uuid4().hex + uuid.uuid4().hex)
+    procs = [
+        subprocess.Popen([sys.executable, "-m", "standins.firebase_server", "--port", str(firebase_port),
+                          "--latency-ms", str(args.firebase_latency_ms)], cwd=BACKEND_DIR, stdout=subprocess.DEVNULL),
+        subprocess.Popen([sys.executable, "-m", "standins.llm_server", "--port", str(llm_port),
+                          "--base-latency-ms", str(args.llm_latency_ms),
+                          "--output-ms-per-token", str(args.output_ms_per_token)],
+                         cwd=BACKEND_DIR, stdout=subprocess.DEVNULL),
+        subprocess.Popen([sys.executable, "-m", "uvicorn", "server:app", "--port", str(app_port),
+                          "--log-level", "warning"], cwd=app_dir, env=env, stdout=subprocess.DEVNULL),
+    ]
+    try:
+        base_url = f"http://127.0.0.1:{app_port}"
+        wait_ready(f"{base_url}/api/plans")
+        result = asyncio.run(replay(args, events, base_url, f"http://127.0.0.1:{firebase_port}"))
+    finally:
+        # The app first: the Firebase stand-in waits for its open streams before exiting
+        for proc in reversed(procs):
+            proc.terminate()
+            proc.wait()
+    result.update({"label": args.label or app_dir.name, "app_dir": str(app_dir), "revision": git_revision(app_dir),
+                   "trace": args.trace, "events": len(events), "speed": args.speed})
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(result, f)
+    requests = sum(len(r["latencies_ms"]) for r in result["routes"].values())
+    print(f"{result['label']} ({result['revision']}): {requests} requests in {result['elapsed_s']:.1f}s, "
+          f"schedule lag p95 {result['lag_p95_ms']} ms, skipped {sum(result['skipped'].values())} -> {args.out}")
+
+
+def compare_results(baseline: dict, candidate: dict, threshold: float, min_ms: float,
+                    max_error_increase: float) -> tuple:
+    """Rows per route and the routes that regressed"""
+    rows, regressions = [], []
+    for key in sorted(set(baseline["routes"]) | set(candidate["routes"])):
+        stats = []
+        for result in (baseline, candidate):
+            route = result["routes"].get(key, {"latencies_ms": [], "errors": 0})
+            samples = route["latencies_ms"]
+            stats.append({"count": len(samples), "p50": percentile(samples, 0.5), "p95": percentile(samples, 0.95),
+                          "p99": percentile(samples, 0.99),
+                          "error_rate": route["errors"] / len(samples) if samples else 0.0})
+        before, after = stats
+        change = (after["p95"] - before["p95"]) / before["p95"] if before["p95"] else 0.0
+        slower = before["count"] and after["count"] and change > threshold and after["p95"] - before["p95"] > min_ms
+        failing = after["error_rate"] - before["error_rate"] > max_error_increase
+        if slower or failing:
+            regressions.append(key)
+        rows.append((key, before, after, change, bool(slower or failing)))
+    return rows, regressions
+
+
+def compare(args):
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    with open(args.candidate, encoding="utf-8") as f:
+        candidate = json.load(f)
+    rows, regressions = compare_results(baseline, candidate, args.threshold, args.min_ms, args.max_error_increase)
+    print(f"baseline {baseline['label']} ({baseline['revision']}) vs candidate {candidate['label']} "
+          f"({candidate['revision']}), {baseline['events']} events at {baseline['speed']}x\n")
+    print(f"{'route':<58}{'n':>6}{'p50':>9}{'p95':>9}{'p99':>9}{'err%':>7}   {'p95 change':>10}")
+    for key, before, after, change, flagged in rows:
+        for label, stats in (("  base", before), ("  cand", after)):
+            print(f"{(key if label == '  base' else '') :<52}{label:>6}{stats['count']:>6}{stats['p50']:>9.1f}"
+                  f"{stats['p95']:>9.1f}{stats['p99']:>9.1f}{stats['error_rate'] * 100:>7.1f}"
+                  + (f"   {change:>+9.0%}{'  REGRESSION' if flagged else ''}" if label == "  cand" else ""))
+    if regressions:
+        print(f"\n{len(regressions)} route(s) regressed: {', '.join(regressions)}")
+        sys.exit(1)
+    print("\nno regressions")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run", help="replay a trace against one build")
+    run_parser.add_argument("trace", nargs="+", help="trace files (one per worker is fine)")
+    run_parser.add_argument("--app-dir", default=str(BACKEND_DIR), help="backend directory of the build")
+    run_parser.add_argument("--speed", type=float, default=1.0, help="1 = recorded pace, 4 = four times faster")
+    run_parser.add_argument("--out", required=True)
+    run_parser.add_argument("--label")
+    run_parser.add_argument("--limit", type=int, help="replay only the first N events")
+    run_parser.add_argument("--max-connections", type=int, default=200)
+    run_parser.add_argument("--firebase-latency-ms", type=float, default=5.0)
+    run_parser.add_argument("--llm-latency-ms", type=float, default=300.0)
+    run_parser.add_argument("--output-ms-per-token", type=float, default=2.0)
+    compare_parser = commands.add_parser("compare", help="compare two replay results")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("candidate")
+    compare_parser.add_argument("--threshold", type=float, default=0.15, help="allowed relative p95 growth")
+    compare_parser.add_argument("--min-ms", type=float, default=5.0, help="ignore p95 growth below this")
+    compare_parser.add_argument("--max-error-increase", type=float, default=0.01)
+    args = parser.parse_args()
+    run(args) if args.command == "run" else compare(args)
+
+
+if __name__ == "__main__":
+    main()
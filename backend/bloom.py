@@ -0,0 +1,60 @@
+"""
+Bloom filter over registered emails.
+
+`email in filter` is False only for emails that were never added, so
+register and login can skip the `users` lookup (a download of the whole
+collection on Firebase) for addresses that certainly do not exist. A True
+answer may be a false positive and goes the usual way.
+
+Sized for `capacity` items at `error_rate`: m = -n ln p / (ln 2)^2 bits and
+k = (m / n) ln 2 probes, taken by double hashing one blake2b digest. Items
+cannot be removed; deleted users only cost a false positive until the next
+rebuild.
+"""
+import hashlib
+import math
+from typing import Iterable
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.bits = max(64, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.bits / self.capacity * math.log(2)))
+        self._array = bytearray((self.bits + 7) // 8)
+        self._set_bits = 0
+        self.count = 0
+
+    @classmethod
+    def of(cls, items: Iterable[str], error_rate: float = 0.001, headroom: float = 2.0) -> "BloomFilter":
+        """A filter holding `items`, with room for `headroom` times as many"""
+        items = list(items)
+        bloom = cls(math.ceil(max(len(items), 1000) * headroom), error_rate)
+        for item in items:
+            bloom.add(item)
+        return bloom
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.bits for i in range(self.hashes))
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            byte, mask = position >> 3, 1 << (position & 7)
+            if not self._array[byte] & mask:
+                self._array[byte] |= mask
+                self._set_bits += 1
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._array[p >> 3] & (1 << (p & 7)) for p in self._positions(item))
+
+    @property
+    def size_bytes(self) -> int:
+        return len(self._array)
+
+    def false_positive_rate(self) -> float:
+        """Current rate, from the fraction of bits set"""
+        return (self._set_bits / self.bits) ** self.hashes
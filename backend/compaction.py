@@ -0,0 +1,189 @@
+"""
+Context compaction for long conversations.
+
+Each conversation may carry a rolling `summary` stored next to its messages:
+
+    {"text": "...", "covers": 24, "tokens": 180, "model": "...", "updated_at": "..."}
+
+`covers` is the index in `messages` up to which the summary stands in for the
+raw turns. Prompts are built from the summary (appended to the system prompt)
+plus the messages after it. When those pass a token or message budget, the
+Compactor folds all but the most recent turns into a new summary in the
+background, so the request path never waits for it.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from llm import LlmClient, estimate_tokens, stable_window
+from metrics import metrics
+from shared_state import StateBackend, StateLock
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_SYSTEM_PROMPT = """Eres un asistente que resume conversaciones.
+Actualiza el resumen existente con los nuevos mensajes. Conserva hechos, datos, decisiones,
+preferencias del usuario y tareas pendientes; omite saludos y relleno.
+Escribe en el idioma de la conversación, en prosa compacta y sin exceder 250 palabras.
+Responde solo con el resumen."""
+
+ROLE_LABELS = {"user": "Usuario", "assistant": "Asistente"}
+
+
+def pending_indices(messages: List[Optional[dict]], summary: Optional[dict]) -> List[int]:
+    """Indices of the stored messages the summary does not cover yet"""
+    start = (summary or {}).get("covers", 0)
+    return [i for i in range(start, len(messages)) if messages[i]]
+
+
+def with_summary(system_prompt: str, summary: Optional[dict]) -> str:
+    if not summary or not summary.get("text"):
+        return system_prompt
+    return f"{system_prompt}\n\nResumen de la conversación hasta ahora:\n{summary['text']}"
+
+
+def transcript(messages: List[dict], max_tokens: int) -> str:
+    """Messages as labelled lines, dropping the oldest ones beyond max_tokens"""
+    lines, used = [], 0
+    for msg in reversed(messages):
+        line = f"{ROLE_LABELS.get(msg.get('role'), msg.get('role'))}: {msg.get('content', '')}"
+        used += estimate_tokens(line)
+        if lines and used > max_tokens:
+            break
+        lines.append(line)
+    return "\n\n".join(reversed(lines))
+
+
+class Compactor:
+    """Maintains the rolling summary of each conversation"""
+
+    def __init__(self, llm: LlmClient, *, model: str,
+                 load: Callable[[str], Awaitable[Optional[dict]]],
+                 store: Callable[[str, dict], Awaitable[object]],
+                 state: Optional[StateBackend] = None, trigger_tokens: int = 2000,
+                 keep_messages: int = 4, max_messages: int = 10, window_step: int = 4,
+                 max_input_tokens: int = 8000, enabled: bool = True):
+        self.llm = llm
+        self.model = model
+        self.load = load
+        self.store = store
+        self.state = state
+        self.trigger_tokens = trigger_tokens
+        self.keep_messages = keep_messages
+        self.max_messages = max_messages
+        self.window_step = window_step
+        self.max_input_tokens = max_input_tokens
+        self.enabled = enabled
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    # ---- prompt assembly ----
+
+    def context(self, system_prompt: str, conversation: dict) -> Tuple[str, List[dict]]:
+        """System prompt with the summary folded in, and the recent turns to send as history"""
+        messages = conversation.get("messages") or []
+        summary = conversation.get("summary")
+        recent = [messages[i] for i in pending_indices(messages, summary)]
+        # The window only bites when compaction lags behind; it keeps the prompt bounded meanwhile
+        return with_summary(system_prompt, summary), stable_window(recent, self.max_messages, self.window_step)
+
+    def needs_compaction(self, conversation: dict) -> bool:
+        messages = conversation.get("messages") or []
+        pending = pending_indices(messages, conversation.get("summary"))
+        if len(pending) <= self.keep_messages:
+            return False
+        if len(pending) > self.max_messages:
+            return True
+        return sum(estimate_tokens(messages[i].get("content", "")) for i in pending) > self.trigger_tokens
+
+    def fold_until(self, messages: List[Optional[dict]], summary: Optional[dict]) -> int:
+        """New `covers` index: everything but the last keep_messages, ending before a user turn"""
+        pending = pending_indices(messages, summary)
+        cut = len(pending) - self.keep_messages
+        # Kept history must open with a user turn, or normalize_history would drop it
+        while 0 < cut < len(pending) and messages[pending[cut]].get("role") != "user":
+            cut += 1
+        if cut <= 0 or cut >= len(pending):
+            return (summary or {}).get("covers", 0)
+        return pending[cut]
+
+    # ---- background compaction ----
+
+    @property
+    def running(self) -> int:
+        return len(self._tasks)
+
+    def schedule(self, conversation_id: str, conversation: dict) -> bool:
+        """Start a background compaction if the conversation needs one and none is running.
+        The new summary is also set on `conversation`, so a caller that keeps it resident
+        (the chat WebSocket) builds its next prompt from it without reloading"""
+        if not self.enabled or conversation_id in self._tasks or not self.needs_compaction(conversation):
+            return False
+        task = asyncio.create_task(self.compact(conversation_id))
+        self._tasks[conversation_id] = task
+
+        def done(_):
+            self._tasks.pop(conversation_id, None)
+            summary = None if task.cancelled() else task.result()
+            if summary and summary["covers"] > (conversation.get("summary") or {}).get("covers", 0):
+                conversation["summary"] = summary
+
+        task.add_done_callback(done)
+        return True
+
+    async def compact(self, conversation_id: str) -> Optional[dict]:
+        lock = StateLock(self.state, f"compact:{conversation_id}", ttl=120) if self.state else None
+        if lock and not await lock.acquire():
+            metrics.incr("compaction_skipped", reason="locked")
+            return None
+        try:
+            conversation = await self.load(conversation_id)
+            if not conversation or not self.needs_compaction(conversation):
+                return None
+            return await self._compact(conversation_id, conversation)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            metrics.incr("compaction_failures")
+            logger.error(f"Error compacting conversation {conversation_id}: {e}")
+            return None
+        finally:
+            if lock:
+                await lock.release()
+
+    async def _compact(self, conversation_id: str, conversation: dict) -> Optional[dict]:
+        messages = conversation.get("messages") or []
+        summary = conversation.get("summary")
+        covers = self.fold_until(messages, summary)
+        folded = [messages[i] for i in pending_indices(messages, summary) if i < covers]
+        if not folded:
+            return None
+        began = time.perf_counter()
+        previous = (summary or {}).get("text") or "(sin resumen previo)"
+        result = await self.llm.complete(
+            model=self.model,
+            system_prompt=SUMMARY_SYSTEM_PROMPT,
+            history=[],
+            message=f"Resumen actual:\n{previous}\n\nNuevos mensajes:\n{transcript(folded, self.max_input_tokens)}",
+            session_id=f"summary-{conversation_id}"
+        )
+        new_summary = {
+            "text": result.text.strip(),
+            "covers": covers,
+            "tokens": estimate_tokens(result.text),
+            "model": result.model,
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+        }
+        await self.store(conversation_id, new_summary)
+        metrics.incr("compaction_runs")
+        metrics.incr("compaction_folded_messages", len(folded))
+        metrics.observe("compaction_ms", (time.perf_counter() - began) * 1000)
+        return new_summary
+
+    async def close(self):
+        """Cancel in-flight compactions; they are retried on the next message"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
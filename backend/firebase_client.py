@@ -0,0 +1,267 @@
+"""
+Resilient client for the Firebase Realtime Database REST API.
+
+Every `firebase_*` helper in server.py goes through FirebaseClient, which adds:
+
+- per-operation deadlines (read and write budgets, retries included)
+- retries with exponential backoff and full jitter for idempotent operations
+- a circuit breaker that fails fast while Firebase is unhealthy
+- optional hedged GETs: a second identical read is sent when the first is slow
+- single-flight: concurrent reads of the same opted-in path share one request
+
+Availability failures raise FirebaseUnavailable (an HTTP 503) instead of
+looking like missing data.
+"""
+import asyncio
+import random
+import time
+from typing import Any, Iterable, Optional, Tuple
+
+import httpx
+from fastapi import HTTPException
+
+from metrics import metrics
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:  # orjson is optional
+    import json
+    json_loads = json.loads
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class FirebaseUnavailable(HTTPException):
+    """Firebase could not be reached in time; surfaced to clients as 503"""
+
+    def __init__(self, reason: str):
+        super().__init__(status_code=503, detail="Servicio temporalmente no disponible")
+        self.reason = reason
+
+
+class CircuitBreaker:
+    """Opens after `failure_threshold` consecutive failures; after `reset_timeout`
+    one probe is let through (half-open) and its outcome closes or re-opens it."""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 10.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open" and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def release_probe(self):
+        """The probe ended without an outcome (cancelled, unexpected error): the next call probes"""
+        self._probe_in_flight = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                metrics.incr("firebase_circuit_opened")
+            self.opened_at = time.monotonic()
+
+
+class _RetryableError(Exception):
+    pass
+
+
+class FirebaseClient:
+    def __init__(self, base_url: str, *, read_timeout: float = 5.0, write_timeout: float = 10.0,
+                 max_retries: int = 3, backoff_base: float = 0.1, backoff_max: float = 2.0,
+                 hedge_after: float = 0.0, breaker: Optional[CircuitBreaker] = None,
+                 singleflight_nodes: Iterable[str] = (), auth: str = "",
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.base_url = base_url.rstrip("/")
+        self.read_timeout = read_timeout
+        self.write_timeout = write_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_after = hedge_after
+        self.breaker = breaker or CircuitBreaker()
+        self.singleflight_nodes = set(singleflight_nodes)
+        self.auth = auth
+        self._transport = transport
+        self._client: Optional[httpx.AsyncClient] = None
+        self._inflight: dict = {}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(transport=self._transport,
+                                             limits=httpx.Limits(max_connections=100, max_keepalive_connections=20))
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}/{path}.json" if path else f"{self.base_url}/.json"
+
+    # ---- core request loop ----
+
+    async def _send(self, method: str, path: str, timeout: float, **kwargs) -> httpx.Response:
+        params = dict(kwargs.pop("params", None) or {})
+        if self.auth:
+            params["auth"] = self.auth
+        try:
+            response = await self.client.request(method, self.url(path), params=params or None,
+                                                 timeout=timeout, **kwargs)
+        except httpx.TransportError as e:
+            raise _RetryableError(f"{type(e).__name__}: {e}") from e
+        if response.status_code in RETRYABLE_STATUS:
+            raise _RetryableError(f"HTTP {response.status_code}")
+        return response
+
+    async def _send_hedged(self, path: str, timeout: float, **kwargs) -> httpx.Response:
+        """GET with a backup request fired if the first has not answered after hedge_after"""
+        first = asyncio.ensure_future(self._send("GET", path, timeout, **kwargs))
+        done, _ = await asyncio.wait({first}, timeout=self.hedge_after)
+        if done:
+            return first.result()
+        metrics.incr("firebase_hedged_requests")
+        second = asyncio.ensure_future(self._send("GET", path, max(timeout - self.hedge_after, 0.001), **kwargs))
+        pending = {first, second}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            metrics.incr("firebase_hedge_wins")
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def request(self, method: str, path: str, *, idempotent: bool = True, timeout: Optional[float] = None,
+                      **kwargs) -> httpx.Response:
+        """`timeout` overrides the read/write deadline, for callers that must hear back sooner"""
+        node = path.split("/", 1)[0] or "/"
+        budget = timeout or (self.read_timeout if method == "GET" else self.write_timeout)
+        deadline = time.monotonic() + budget
+        attempts = 1 + (self.max_retries if idempotent else 0)
+        last_error = "no attempt"
+        began = time.perf_counter()
+        for attempt in range(attempts):
+            probe = self.breaker.state == "half_open"
+            if not self.breaker.allow():
+                metrics.incr("firebase_circuit_rejected", op=method)
+                raise FirebaseUnavailable("circuit open")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                if probe:
+                    self.breaker.release_probe()
+                break
+            try:
+                if method == "GET" and self.hedge_after > 0:
+                    response = await asyncio.wait_for(self._send_hedged(path, remaining, **kwargs), remaining)
+                else:
+                    response = await asyncio.wait_for(self._send(method, path, remaining, **kwargs), remaining)
+            except (_RetryableError, asyncio.TimeoutError) as e:
+                last_error = str(e) or "deadline exceeded"
+                self.breaker.record_failure()
+                metrics.incr("firebase_failures", op=method, node=node)
+                if attempt + 1 < attempts:
+                    delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+                    if time.monotonic() + delay >= deadline:
+                        break
+                    metrics.incr("firebase_retries", op=method, node=node)
+                    await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # Every exit settles the breaker, or it would stay half-open rejecting everything
+                if probe:
+                    self.breaker.release_probe()
+                raise
+            self.breaker.record_success()
+            metrics.observe("firebase_latency_ms", (time.perf_counter() - began) * 1000, op=method)
+            return response
+        metrics.incr("firebase_unavailable", op=method, node=node)
+        raise FirebaseUnavailable(f"{method} {path}: {last_error}")
+
+    # ---- REST operations ----
+
+    async def _fetch(self, path: str, params: Optional[dict], timeout: Optional[float] = None) -> Optional[bytes]:
+        response = await self.request("GET", path, params=params, timeout=timeout)
+        return response.content if response.status_code == 200 else None
+
+    async def get(self, path: str, params: Optional[dict] = None, timeout: Optional[float] = None) -> Any:
+        node = path.split("/", 1)[0]
+        metrics.incr("firebase_reads", node=node)
+        if node not in self.singleflight_nodes or params:
+            body = await self._fetch(path, params, timeout)
+        else:
+            # Single-flight: callers share the raw body and each parses its own copy
+            task = self._inflight.get(path)
+            if task is not None:
+                metrics.incr("firebase_reads_coalesced", node=node)
+            else:
+                task = asyncio.ensure_future(self._fetch(path, None))
+                self._inflight[path] = task
+                task.add_done_callback(lambda t: self._inflight.pop(path, None) if self._inflight.get(path) is t else None)
+            # shield: a caller that disconnects must not cancel the read for the others
+            body = await asyncio.shield(task)
+        return json_loads(body) if body is not None else None
+
+    async def put(self, path: str, data: Any) -> bool:
+        response = await self.request("PUT", path, json=data)
+        return response.status_code == 200
+
+    async def get_with_etag(self, path: str) -> Tuple[Any, Optional[str]]:
+        """The value and its ETag, for a later put_if_match"""
+        metrics.incr("firebase_reads", node=path.split("/", 1)[0])
+        response = await self.request("GET", path, headers={"X-Firebase-ETag": "true"})
+        if response.status_code != 200:
+            return None, None
+        return json_loads(response.content), response.headers.get("etag")
+
+    async def put_if_match(self, path: str, data: Any, etag: str) -> bool:
+        """PUT only if the value is still the one `etag` was read with; False when it changed"""
+        response = await self.request("PUT", path, json=data, headers={"if-match": etag})
+        return response.status_code == 200
+
+    async def post(self, path: str, data: Any) -> Optional[str]:
+        # push() generates a new key on every call, so it is never retried
+        response = await self.request("POST", path, idempotent=False, json=data)
+        if response.status_code == 200:
+            return response.json().get("name")
+        return None
+
+    async def patch(self, path: str, data: Any, idempotent: bool = True) -> bool:
+        response = await self.request("PATCH", path, idempotent=idempotent, json=data)
+        return response.status_code == 200
+
+    async def delete(self, path: str) -> bool:
+        response = await self.request("DELETE", path)
+        return response.status_code == 200
@@ -0,0 +1,235 @@
+"""
+Firebase REST streaming (Server-Sent Events) into local mirrors.
+
+A FirebaseListener keeps one `text/event-stream` GET open on a path and
+applies its events to a Mirror, a local copy of that subtree:
+
+- `put` replaces the value at a path relative to the listened one (null
+  deletes it); the first event of every connection is a `put` of the whole
+  subtree;
+- `patch` writes each child of its data under the path;
+- `keep-alive` (every ~30 s from Firebase) only proves the stream is alive;
+- `cancel` and `auth_revoked` end the stream.
+
+The REST API has no resume tokens: after a disconnect the listener reconnects
+with backoff and the snapshot that opens the new stream replaces the mirror,
+so nothing written meanwhile is lost. The changed children (before/after) of
+each event are handed to `on_change`, except for the very first snapshot,
+which has nothing to invalidate. A mirror is `live` only while its stream is
+connected and synced; readers fall back to REST otherwise.
+
+Lag is measured on documents that carry a write timestamp (`updated_at`,
+`last_used`): firebase_stream_lag_ms is the time from that timestamp to the
+event being applied here.
+"""
+import asyncio
+import copy
+import json
+import logging
+import random
+import time
+from datetime import datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, List, Optional, Tuple
+
+import httpx
+
+from firebase_client import FirebaseClient
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+TIMESTAMP_FIELDS = ("updated_at", "last_used")
+
+Change = Tuple[str, Optional[dict], Optional[dict]]  # (child key, before, after)
+
+
+class StreamClosed(Exception):
+    pass
+
+
+def _split(path: str) -> List[str]:
+    return [p for p in path.strip("/").split("/") if p]
+
+
+class Mirror:
+    def __init__(self, path: str):
+        self.path = path
+        self.data: dict = {}
+        self.connected = False
+        self.synced = False
+        self.snapshots = 0
+        self.last_event = 0.0
+        self._synced = asyncio.Event()
+
+    @property
+    def live(self) -> bool:
+        return self.connected and self.synced
+
+    async def wait_synced(self, timeout: Optional[float] = None):
+        await asyncio.wait_for(self._synced.wait(), timeout)
+
+    def _set(self, parts: List[str], value: Any):
+        if not parts:
+            self.data = value if isinstance(value, dict) else {}
+            return
+        node, trail = self.data, []
+        for part in parts[:-1]:
+            child = node.get(part)
+            if not isinstance(child, dict):
+                if value is None:
+                    return
+                child = node[part] = {}
+            trail.append((node, part))
+            node = child
+        if value is None:
+            node.pop(parts[-1], None)
+            # Firebase drops empty parents
+            for parent, key in reversed(trail):
+                if parent[key]:
+                    break
+                del parent[key]
+        else:
+            node[parts[-1]] = value
+
+    def apply(self, kind: str, path: str, data: Any) -> List[Change]:
+        """Apply a put/patch event; returns the changed children of the mirrored path"""
+        parts = _split(path)
+        if kind == "patch":
+            writes = [(parts + _split(key), value) for key, value in (data or {}).items()]
+        else:
+            writes = [(parts, data)]
+        if not parts and kind == "put":
+            before = self.data
+            self._set([], data)
+            keys = set(before) | set(self.data)
+            changes = [(k, before.get(k), self.data.get(k)) for k in keys if before.get(k) != self.data.get(k)]
+        else:
+            tops = {write_parts[0] for write_parts, _ in writes if write_parts}
+            before = {k: copy.deepcopy(self.data.get(k)) for k in tops}
+            for write_parts, value in writes:
+                self._set(write_parts, value)
+            changes = [(k, before[k], self.data.get(k)) for k in tops if before[k] != self.data.get(k)]
+        return changes
+
+    def get(self, key: str) -> Optional[dict]:
+        doc = self.data.get(key)
+        return copy.deepcopy(doc) if doc is not None else None
+
+
+def written_at(data: Any, depth: int = 2) -> Optional[float]:
+    """Latest write timestamp found in an event payload (epoch seconds)"""
+    if not isinstance(data, dict) or depth < 0:
+        return None
+    stamps = []
+    for key, value in data.items():
+        if key.rsplit("/", 1)[-1] in TIMESTAMP_FIELDS and isinstance(value, str):
+            try:
+                stamps.append(datetime.fromisoformat(value).timestamp())
+            except ValueError:
+                pass
+        elif isinstance(value, dict):
+            stamp = written_at(value, depth - 1)
+            if stamp is not None:
+                stamps.append(stamp)
+    return max(stamps) if stamps else None
+
+
+async def sse_events(lines: AsyncIterator[str]) -> AsyncIterator[Tuple[str, str]]:
+    event, data = "message", []
+    async for line in lines:
+        if not line:
+            if data:
+                yield event, "\n".join(data)
+            event, data = "message", []
+        elif line.startswith(":"):
+            continue
+        else:
+            name, _, value = line.partition(":")
+            value = value[1:] if value.startswith(" ") else value
+            if name == "event":
+                event = value
+            elif name == "data":
+                data.append(value)
+
+
+class FirebaseListener:
+    def __init__(self, client: FirebaseClient, mirror: Mirror,
+                 on_change: Optional[Callable[[List[Change]], Awaitable[None]]] = None,
+                 stall_timeout: float = 90.0, backoff_base: float = 0.5, backoff_max: float = 30.0):
+        self.client = client
+        self.mirror = mirror
+        self.on_change = on_change
+        self.stall_timeout = stall_timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.reconnects = 0
+
+    async def run(self):
+        attempt = 0
+        while True:
+            snapshots = self.mirror.snapshots
+            try:
+                await self._listen()
+                reason = "closed"
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                reason = type(e).__name__
+                logger.warning(f"Firebase stream on {self.mirror.path} lost: {e}")
+            self._set_connected(False)
+            # A connection that delivered its snapshot was healthy: start the backoff over
+            attempt = 0 if self.mirror.snapshots > snapshots else attempt + 1
+            self.reconnects += 1
+            metrics.incr("firebase_stream_reconnects", path=self.mirror.path, reason=reason)
+            await asyncio.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt)))
+
+    def _set_connected(self, connected: bool):
+        self.mirror.connected = connected
+        metrics.gauge("firebase_stream_connected", int(connected), path=self.mirror.path)
+
+    async def _listen(self):
+        params = {"auth": self.client.auth} if self.client.auth else None
+        timeout = httpx.Timeout(self.client.read_timeout, read=self.stall_timeout)
+        async with self.client.client.stream("GET", self.client.url(self.mirror.path), params=params,
+                                             headers={"Accept": "text/event-stream"}, timeout=timeout,
+                                             follow_redirects=True) as response:
+            if response.status_code != 200:
+                raise StreamClosed(f"HTTP {response.status_code}")
+            # Not live again until this connection's snapshot has replaced what we missed
+            self.mirror.synced = False
+            self._set_connected(True)
+            async for event, data in sse_events(response.aiter_lines()):
+                await self.handle(event, data)
+
+    async def handle(self, event: str, raw: str):
+        mirror = self.mirror
+        mirror.last_event = time.monotonic()
+        metrics.incr("firebase_stream_events", path=mirror.path, event=event)
+        if event in ("cancel", "auth_revoked"):
+            raise StreamClosed(event)
+        if event not in ("put", "patch"):
+            return
+        payload = json.loads(raw)
+        path, data = payload.get("path", "/"), payload.get("data")
+        first_snapshot = mirror.snapshots == 0
+        changes = mirror.apply(event, path, data)
+        if event == "put" and not _split(path):
+            mirror.snapshots += 1
+            mirror.synced = True
+            mirror._synced.set()
+            metrics.gauge("firebase_stream_docs", len(mirror.data), path=mirror.path)
+        else:
+            stamp = written_at({path: data} if not isinstance(data, dict) else data)
+            if stamp is not None:
+                metrics.observe("firebase_stream_lag_ms", max(0.0, time.time() - stamp) * 1000, path=mirror.path)
+        if changes and self.on_change and not first_snapshot:
+            try:
+                await self.on_change(changes)
+            except Exception as e:
+                logger.error(f"Error applying Firebase change on {mirror.path}: {e}")
+
+    def report(self):
+        """Refresh the idle gauge (called when metrics are read)"""
+        if self.mirror.last_event:
+            metrics.gauge("firebase_stream_idle_seconds", round(time.monotonic() - self.mirror.last_event, 3),
+                          path=self.mirror.path)
@@ -0,0 +1,37 @@
+"""
+Multi-worker deployment profile.
+
+    gunicorn -c gunicorn.conf.py server:app
+
+Each worker is a separate process with its own memory, so anything that must
+be consistent across workers (rate limits, idempotency keys, caches) goes
+through the shared state backend. One worker by default; WEB_CONCURRENCY
+above 1 requires STATE_BACKEND_URL=redis://..., and the server refuses to
+start without it (payment idempotency, rate limits, session revocation and
+job locks would otherwise hold per worker).
+"""
+import os
+
+# Checked here as well as in server.py so a misconfigured deploy fails before forking workers
+SHARED_STATE_SCHEMES = ("redis://", "rediss://", "unix://")
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8001')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+if workers > 1 and not os.environ.get("STATE_BACKEND_URL", "").startswith(SHARED_STATE_SCHEMES):
+    raise SystemExit(f"WEB_CONCURRENCY={workers} requires a shared STATE_BACKEND_URL (redis://...)")
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# LLM calls can take a while; keep the worker alive while they complete
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = 5
+
+# Recycle workers periodically to bound memory growth
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", 5000))
+max_requests_jitter = max_requests // 10
+
+accesslog = "-"
+errorlog = "-"
+
+# Workers read WEB_CONCURRENCY to refuse process-local state
+os.environ.setdefault("WEB_CONCURRENCY", str(workers))
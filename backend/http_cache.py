@@ -0,0 +1,116 @@
+"""
+Conditional requests and response compression.
+
+ETags are weak validators built from what identifies a version of the
+resource (ids, `updated_at`, message counts), so a matching `If-None-Match`
+is answered with 304 before the body is serialised.
+
+CompressionMiddleware compresses single-body responses (what JSONResponse and
+friends send) above `minimum_size` with brotli when the client accepts it and
+the `brotli` package is installed, gzip otherwise. Streamed responses (NDJSON
+exports, SSE) are passed through untouched: they choose their own encoding
+and must not be buffered.
+"""
+import asyncio
+import gzip
+import hashlib
+import json
+from typing import Optional
+
+from starlette.datastructures import MutableHeaders
+
+from metrics import metrics
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+THREAD_ABOVE_BYTES = 256 * 1024  # larger bodies are compressed off the event loop
+
+
+def etag(*parts) -> str:
+    digest = hashlib.blake2b(json.dumps(parts, default=str, separators=(",", ":")).encode(),
+                             digest_size=12).hexdigest()
+    return f'W/"{digest}"'
+
+
+def etag_matches(if_none_match: Optional[str], tag: str) -> bool:
+    """Weak comparison, as If-None-Match requires"""
+    if not if_none_match:
+        return False
+    candidates = [c.strip() for c in if_none_match.split(",")]
+    return "*" in candidates or tag.removeprefix("W/") in (c.removeprefix("W/") for c in candidates)
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    accepted = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if name:
+            accepted[name] = q
+    for name in (("br", "gzip") if brotli else ("gzip",)):
+        if accepted.get(name, accepted.get("*", 0)) > 0:
+            return name
+    return None
+
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: int = 1024, gzip_level: int = 5, brotli_quality: int = 4):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def compress(self, body: bytes, encoding: str) -> bytes:
+        if encoding == "br":
+            return brotli.compress(body, quality=self.brotli_quality)
+        return gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept = next((v.decode("latin-1") for k, v in scope["headers"] if k == b"accept-encoding"), "")
+        encoding = choose_encoding(accept)
+        start = None
+
+        async def compressing_send(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body" or start is None:
+                await send(message)
+                return
+            pending, start = start, None
+            body = message.get("body", b"")
+            headers = MutableHeaders(raw=pending["headers"])
+            if (message.get("more_body") or len(body) < self.minimum_size or "content-encoding" in headers
+                    or not headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)):
+                await send(pending)
+                await send(message)
+                return
+            headers.add_vary_header("Accept-Encoding")
+            if encoding:
+                if len(body) > THREAD_ABOVE_BYTES:
+                    compressed = await asyncio.to_thread(self.compress, body, encoding)
+                else:
+                    compressed = self.compress(body, encoding)
+                metrics.incr("http_compressed_responses", encoding=encoding)
+                metrics.incr("http_compression_bytes_in", len(body), encoding=encoding)
+                metrics.incr("http_compression_bytes_out", len(compressed), encoding=encoding)
+                headers["Content-Encoding"] = encoding
+                headers["Content-Length"] = str(len(compressed))
+                body = compressed
+            await send(pending)
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, compressing_send)
@@ -0,0 +1,302 @@
+"""
+LLM access layer.
+
+Handlers call `LlmClient.complete()` with the system prompt, the prior turns
+and the new user message, or `LlmClient.stream()` to receive the answer as
+text deltas. The provider decides how that is sent upstream:
+
+- EmergentProvider: the emergentintegrations LlmChat wrapper (default).
+  It does not expose token usage, so usage is estimated locally, nor
+  streaming, so a stream delivers the whole answer as one delta.
+- AnthropicProvider: the Messages API called directly. The stable prefix
+  (system prompt and older history) is marked with `cache_control` so the
+  provider can serve it from its prompt cache, and the returned usage splits
+  input tokens into cached and uncached.
+"""
+import asyncio
+import json
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from typing import AsyncIterator, Callable, List, Optional, Union
+
+import httpx
+
+from metrics import metrics
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap local estimate (~4 characters per token)"""
+    return max(1, len(text) // 4) if text else 0
+
+
+@dataclass
+class LlmUsage:
+    input_tokens: int = 0           # uncached input tokens billed at the full rate
+    cached_input_tokens: int = 0    # input tokens read from the provider prompt cache
+    cache_write_tokens: int = 0     # input tokens written to the prompt cache on this call
+    output_tokens: int = 0
+    estimated: bool = False
+
+    @property
+    def total_input_tokens(self) -> int:
+        return self.input_tokens + self.cached_input_tokens + self.cache_write_tokens
+
+    def as_record(self) -> dict:
+        return asdict(self)
+
+
+@dataclass
+class LlmResult:
+    text: str
+    provider: str
+    model: str
+    latency_ms: float
+    usage: LlmUsage = field(default_factory=LlmUsage)
+
+
+def normalize_history(history: List[dict]) -> List[dict]:
+    """Turn stored conversation messages into alternating user/assistant turns"""
+    turns: List[dict] = []
+    for msg in history:
+        if not msg or msg.get("role") not in ("user", "assistant") or not msg.get("content"):
+            continue
+        if not turns and msg["role"] != "user":
+            continue
+        if turns and turns[-1]["role"] == msg["role"]:
+            turns[-1] = {"role": msg["role"], "content": f"{turns[-1]['content']}\n\n{msg['content']}"}
+        else:
+            turns.append({"role": msg["role"], "content": msg["content"]})
+    # The new user message follows, so history must end with an assistant turn
+    if turns and turns[-1]["role"] == "user":
+        turns.pop()
+    return turns
+
+
+def stable_window(messages: List[dict], size: int, step: int) -> List[dict]:
+    """Last `size` messages at most, with a start index that only moves in steps
+    of `step`, so the history prefix stays identical (and cacheable) across turns"""
+    overflow = max(0, len(messages) - size)
+    start = -(-overflow // step) * step if step > 0 else overflow
+    return messages[start:]
+
+
+class LlmProvider:
+    name = "base"
+
+    async def complete(self, *, model: str, system_prompt: str, history: List[dict], message: str,
+                       session_id: str) -> LlmResult:
+        raise NotImplementedError
+
+    async def stream(self, **kwargs) -> AsyncIterator[Union[str, LlmResult]]:
+        """Text deltas, then the LlmResult. Without upstream streaming the text comes in one piece."""
+        result = await self.complete(**kwargs)
+        yield result.text
+        yield result
+
+    async def ping(self) -> Optional[bool]:
+        """A request that reaches the API without generating anything; None when the provider has none"""
+        return None
+
+
+class EmergentProvider(LlmProvider):
+    """emergentintegrations LlmChat; `loader` returns (LlmChat, UserMessage) lazily"""
+
+    name = "emergent"
+
+    def __init__(self, api_key: str, loader: Callable, vendor: str = "anthropic"):
+        self.api_key = api_key
+        self.loader = loader
+        self.vendor = vendor
+
+    async def complete(self, *, model, system_prompt, history, message, session_id):
+        LlmChat, UserMessage = self.loader()
+        began = time.perf_counter()
+        chat = LlmChat(
+            api_key=self.api_key,
+            session_id=session_id,
+            system_message=system_prompt
+        ).with_model(self.vendor, model)
+
+        # LlmChat keeps its own history: replay the previous user turns to rebuild context
+        for msg in history:
+            if msg["role"] == "user":
+                await chat.send_message(UserMessage(text=msg["content"]))
+
+        text = await chat.send_message(UserMessage(text=message))
+        prompt = system_prompt + "".join(m["content"] for m in history) + message
+        usage = LlmUsage(input_tokens=estimate_tokens(prompt), output_tokens=estimate_tokens(text), estimated=True)
+        return LlmResult(text=text, provider=self.name, model=model,
+                         latency_ms=(time.perf_counter() - began) * 1000, usage=usage)
+
+
+class AnthropicProvider(LlmProvider):
+    """Direct Messages API client with prompt caching of the stable prefix"""
+
+    name = "anthropic"
+    API_VERSION = "2023-06-01"
+
+    def __init__(self, api_key: str, base_url: str = "https://api.anthropic.com", prompt_caching: bool = True,
+                 max_tokens: int = 4096, timeout: float = 120.0, transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.api_key = api_key
+        self.prompt_caching = prompt_caching
+        self.max_tokens = max_tokens
+        self._client = httpx.AsyncClient(base_url=base_url, timeout=timeout, transport=transport)
+
+    def build_payload(self, *, model: str, system_prompt: str, history: List[dict], message: str) -> dict:
+        cache = {"cache_control": {"type": "ephemeral"}} if self.prompt_caching else {}
+        system = [{"type": "text", "text": system_prompt, **cache}]
+        messages = [
+            {"role": turn["role"], "content": [{"type": "text", "text": turn["content"]}]}
+            for turn in normalize_history(history)
+        ]
+        # Breakpoint at the end of the older history: next turn re-reads it from cache
+        if messages and cache:
+            messages[-1]["content"][-1].update(cache)
+        messages.append({"role": "user", "content": [{"type": "text", "text": message}]})
+        return {"model": model, "max_tokens": self.max_tokens, "system": system, "messages": messages}
+
+    @property
+    def _headers(self) -> dict:
+        return {"x-api-key": self.api_key, "anthropic-version": self.API_VERSION}
+
+    @staticmethod
+    def _usage(raw: dict) -> LlmUsage:
+        return LlmUsage(
+            input_tokens=raw.get("input_tokens", 0),
+            cached_input_tokens=raw.get("cache_read_input_tokens") or 0,
+            cache_write_tokens=raw.get("cache_creation_input_tokens") or 0,
+            output_tokens=raw.get("output_tokens", 0),
+        )
+
+    async def complete(self, *, model, system_prompt, history, message, session_id):
+        payload = self.build_payload(model=model, system_prompt=system_prompt, history=history, message=message)
+        began = time.perf_counter()
+        response = await self._client.post("/v1/messages", json=payload, headers=self._headers)
+        response.raise_for_status()
+        data = response.json()
+        text = "".join(block.get("text", "") for block in data.get("content", []) if block.get("type") == "text")
+        return LlmResult(text=text, provider=self.name, model=data.get("model", model),
+                         latency_ms=(time.perf_counter() - began) * 1000, usage=self._usage(data.get("usage") or {}))
+
+    async def stream(self, *, model, system_prompt, history, message, session_id):
+        """Server-sent events of the Messages API, yielded as text deltas"""
+        payload = self.build_payload(model=model, system_prompt=system_prompt, history=history, message=message)
+        payload["stream"] = True
+        began = time.perf_counter()
+        parts, usage = [], LlmUsage()
+        async with self._client.stream("POST", "/v1/messages", json=payload, headers=self._headers) as response:
+            if response.is_error:
+                await response.aread()
+                response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                event = json.loads(line[5:])
+                kind = event.get("type")
+                if kind == "message_start":
+                    model = event["message"].get("model", model)
+                    usage = self._usage(event["message"].get("usage") or {})
+                elif kind == "content_block_delta" and event["delta"].get("type") == "text_delta":
+                    parts.append(event["delta"]["text"])
+                    yield event["delta"]["text"]
+                elif kind == "message_delta":
+                    usage.output_tokens = (event.get("usage") or {}).get("output_tokens", usage.output_tokens)
+                elif kind == "error":
+                    raise RuntimeError(f"{event['error'].get('type')}: {event['error'].get('message')}")
+        yield LlmResult(text="".join(parts), provider=self.name, model=model,
+                        latency_ms=(time.perf_counter() - began) * 1000, usage=usage)
+
+    async def ping(self):
+        response = await self._client.get("/v1/models", params={"limit": 1}, headers=self._headers)
+        response.raise_for_status()
+        return True
+
+    async def close(self):
+        await self._client.aclose()
+
+
+class LlmClient:
+    """Entry point used by the handlers; records per-call usage metrics.
+
+    With max_concurrency > 0 at most that many calls are upstream at once per
+    worker; the others wait for a slot (`waiting`). A cancelled call gives its
+    slot back as soon as the cancellation is delivered."""
+
+    def __init__(self, provider: LlmProvider, max_concurrency: int = 0):
+        self.provider = provider
+        self._slots = asyncio.Semaphore(max_concurrency) if max_concurrency > 0 else None
+        self.in_flight = 0
+        self.waiting = 0
+
+    def _enter(self):
+        self.in_flight += 1
+        metrics.gauge("llm_in_flight", self.in_flight)
+
+    def _leave(self):
+        self.in_flight -= 1
+        metrics.gauge("llm_in_flight", self.in_flight)
+
+    async def _acquire(self):
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+
+    async def _call(self, **kwargs) -> LlmResult:
+        self._enter()
+        try:
+            return await self.provider.complete(**kwargs)
+        finally:
+            self._leave()
+
+    async def complete(self, *, model: str, system_prompt: str, history: List[dict], message: str,
+                       session_id: Optional[str] = None) -> LlmResult:
+        kwargs = dict(model=model, system_prompt=system_prompt, history=history, message=message,
+                      session_id=session_id or str(uuid.uuid4()))
+        if self._slots is None:
+            result = await self._call(**kwargs)
+        else:
+            await self._acquire()
+            try:
+                result = await self._call(**kwargs)
+            finally:
+                self._slots.release()
+        self._record(result)
+        return result
+
+    async def stream(self, *, model: str, system_prompt: str, history: List[dict], message: str,
+                     session_id: Optional[str] = None) -> AsyncIterator[Union[str, LlmResult]]:
+        """Text deltas as they arrive, then the LlmResult; the slot is held until the stream ends or is closed"""
+        kwargs = dict(model=model, system_prompt=system_prompt, history=history, message=message,
+                      session_id=session_id or str(uuid.uuid4()))
+        if self._slots is not None:
+            await self._acquire()
+        self._enter()
+        try:
+            async for item in self.provider.stream(**kwargs):
+                if isinstance(item, LlmResult):
+                    self._record(item)
+                yield item
+        finally:
+            self._leave()
+            if self._slots is not None:
+                self._slots.release()
+
+    def _record(self, result: LlmResult):
+        usage = result.usage
+        metrics.incr("llm_calls", provider=result.provider)
+        metrics.incr("llm_input_tokens", usage.input_tokens, kind="uncached")
+        metrics.incr("llm_input_tokens", usage.cached_input_tokens, kind="cached")
+        metrics.incr("llm_input_tokens", usage.cache_write_tokens, kind="cache_write")
+        metrics.incr("llm_output_tokens", usage.output_tokens)
+        metrics.observe("llm_latency_ms", result.latency_ms, provider=result.provider)
+
+    async def ping(self) -> Optional[bool]:
+        return await self.provider.ping()
+
+    async def close(self):
+        close = getattr(self.provider, "close", None)
+        if close:
+            await close()
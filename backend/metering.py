@@ -0,0 +1,130 @@
+"""
+Token metering.
+
+Every LLM call is charged from its token counts: the provider's usage when it
+reports one (the Anthropic API does, prompt-cache reads and writes included),
+the local estimate the provider wrapper made otherwise. Each model prices
+tokens in credits per 1K (input, output, cached input, cache write); a call
+costs the rated amount rounded up to whole credits, and never less than the
+model's per-call minimum. A catalog without rates therefore keeps the old
+flat price.
+
+Before the call, admission control needs an estimate, not a tokenizer pass:
+`Meter.preflight` divides the prompt's character count by a chars-per-token
+ratio learned per model from the provider's own counts (an exponentially
+weighted average, starting at 4), plus `expected_output_tokens` for the
+answer. That is a few length sums per request.
+"""
+import math
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+
+@dataclass(frozen=True)
+class TokenRates:
+    """Credits per 1K tokens"""
+    input: float = 0.0
+    output: float = 0.0
+    cached_input: float = 0.0
+    cache_write: float = 0.0
+
+
+@dataclass
+class Preflight:
+    chars: int
+    input_tokens: int
+    output_tokens: int
+    credits: int
+
+
+@dataclass
+class Charge:
+    credits: int
+    input_credits: float = 0.0
+    output_credits: float = 0.0
+    cached_input_credits: float = 0.0
+    cache_write_credits: float = 0.0
+    estimated_input_tokens: int = 0
+
+    @property
+    def rated_credits(self) -> float:
+        return self.input_credits + self.output_credits + self.cached_input_credits + self.cache_write_credits
+
+    def as_record(self) -> dict:
+        return {
+            "input_credits": round(self.input_credits, 4),
+            "output_credits": round(self.output_credits, 4),
+            "cached_input_credits": round(self.cached_input_credits, 4),
+            "cache_write_credits": round(self.cache_write_credits, 4),
+            "estimated_input_tokens": self.estimated_input_tokens,
+        }
+
+
+def prompt_chars(system_prompt: str, history: List[dict], message: str) -> int:
+    return len(system_prompt or "") + sum(len(m.get("content") or "") for m in history) + len(message or "")
+
+
+class TokenEstimator:
+    def __init__(self, chars_per_token: float = 4.0, alpha: float = 0.2, bounds: tuple = (1.5, 8.0)):
+        self.initial = chars_per_token
+        self.alpha = alpha
+        self.bounds = bounds
+        self._ratios: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def ratio(self, model: str) -> float:
+        return self._ratios.get(model, self.initial)
+
+    def estimate(self, model: str, chars: int) -> int:
+        return math.ceil(chars / self.ratio(model)) if chars else 0
+
+    def observe(self, model: str, chars: int, tokens: int):
+        """Fold a provider-counted prompt into the model's ratio"""
+        if chars <= 0 or tokens <= 0:
+            return
+        low, high = self.bounds
+        observed = min(high, max(low, chars / tokens))
+        with self._lock:
+            current = self._ratios.get(model)
+            self._ratios[model] = observed if current is None else current + self.alpha * (observed - current)
+
+
+def rate(rates: TokenRates, minimum: int, usage) -> Charge:
+    """Credits for one call's usage (an llm.LlmUsage)"""
+    charge = Charge(
+        credits=minimum,
+        input_credits=usage.input_tokens / 1000 * rates.input,
+        output_credits=usage.output_tokens / 1000 * rates.output,
+        cached_input_credits=usage.cached_input_tokens / 1000 * rates.cached_input,
+        cache_write_credits=usage.cache_write_tokens / 1000 * rates.cache_write,
+    )
+    # A float sum like 0.30000000000000004 must not round up to an extra credit
+    charge.credits = max(minimum, math.ceil(round(charge.rated_credits, 6)))
+    return charge
+
+
+class Meter:
+    """Pre-flight estimates and post-call charges for a model_routing.ModelSpec (id, rates, credits)"""
+
+    def __init__(self, expected_output_tokens: int = 500, estimator: Optional[TokenEstimator] = None):
+        self.expected_output_tokens = expected_output_tokens
+        self.estimator = estimator or TokenEstimator()
+
+    def preflight(self, spec, chars: int) -> Preflight:
+        input_tokens = self.estimator.estimate(spec.id, chars)
+        rated = input_tokens / 1000 * spec.rates.input + self.expected_output_tokens / 1000 * spec.rates.output
+        return Preflight(chars, input_tokens, self.expected_output_tokens,
+                         max(spec.credits, math.ceil(round(rated, 6))))
+
+    def charge(self, spec, usage, preflight: Optional[Preflight] = None) -> Charge:
+        """Charge for a finished call; provider-counted usage also calibrates the estimator"""
+        if usage is None:
+            charge = Charge(credits=spec.credits)
+        else:
+            charge = rate(spec.rates, spec.credits, usage)
+            if preflight and not usage.estimated:
+                self.estimator.observe(spec.id, preflight.chars, usage.total_input_tokens)
+        if preflight:
+            charge.estimated_input_tokens = preflight.input_tokens
+        return charge
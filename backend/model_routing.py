@@ -0,0 +1,88 @@
+"""
+Model routing.
+
+The catalog lists the models the app may call, what their tokens cost in
+credits (per 1K, see metering.py) and the minimum credits per call, and which
+model to fall back to when the primary is overloaded or too slow.
+Each plan picks a default model and the set a caller may ask for explicitly
+(`model` on /api/v1/chat). The built-in catalog can be replaced with the
+LLM_MODEL_CATALOG environment variable, a JSON object of the same shape:
+
+    {"claude-sonnet-4-5-20250929": {"credits": 1, "fallback": "claude-haiku-4-5-20251001", "timeout": 60,
+                                    "rates": {"input": 0.2, "output": 1.0, "cached_input": 0.02, "cache_write": 0.25}}}
+
+Entries without "rates" are charged their flat per-call `credits`.
+"""
+import asyncio
+import json
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+import httpx
+
+from metering import TokenRates
+
+# Upstream statuses that mean "try elsewhere", not "the request is wrong"
+RETRYABLE_STATUS = {429, 500, 502, 503, 504, 529}
+
+# Rates follow the providers' list prices (1 credit per 1K tokens = $15 per million): a short
+# Sonnet turn stays at 1 credit, a 50K-token prompt no longer does. Cache reads cost 10% of
+# input, cache writes 125%.
+DEFAULT_CATALOG = {
+    "claude-haiku-4-5-20251001": {
+        "credits": 1, "fallback": None, "timeout": 30,
+        "rates": {"input": 0.07, "output": 0.35, "cached_input": 0.007, "cache_write": 0.0875}},
+    "claude-sonnet-4-5-20250929": {
+        "credits": 1, "fallback": "claude-haiku-4-5-20251001", "timeout": 60,
+        "rates": {"input": 0.2, "output": 1.0, "cached_input": 0.02, "cache_write": 0.25}},
+    "claude-opus-4-1-20250805": {
+        "credits": 4, "fallback": "claude-sonnet-4-5-20250929", "timeout": 90,
+        "rates": {"input": 1.0, "output": 5.0, "cached_input": 0.1, "cache_write": 1.25}},
+}
+
+
+@dataclass(frozen=True)
+class ModelSpec:
+    id: str
+    credits: int = 1  # minimum charge per call
+    fallback: Optional[str] = None
+    timeout: float = 60.0
+    rates: TokenRates = TokenRates()
+
+
+def load_catalog(raw: str = "") -> Dict[str, ModelSpec]:
+    entries = json.loads(raw) if raw else DEFAULT_CATALOG
+    catalog = {model_id: ModelSpec(id=model_id, credits=int(entry.get("credits", 1)),
+                                   fallback=entry.get("fallback"), timeout=float(entry.get("timeout", 60)),
+                                   rates=TokenRates(**entry.get("rates", {})))
+               for model_id, entry in entries.items()}
+    for spec in catalog.values():
+        if spec.fallback and spec.fallback not in catalog:
+            raise ValueError(f"Fallback model {spec.fallback} of {spec.id} is not in the catalog")
+    return catalog
+
+
+def is_overloaded(error: BaseException) -> bool:
+    """Errors worth retrying on the fallback model"""
+    if isinstance(error, (asyncio.TimeoutError, httpx.TimeoutException, httpx.TransportError)):
+        return True
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUS
+    # The emergent wrapper surfaces upstream errors as plain exceptions
+    text = str(error).lower()
+    return "overloaded" in text or "529" in text or "timed out" in text
+
+
+class ModelNotAllowed(Exception):
+    pass
+
+
+def resolve_model(catalog: Dict[str, ModelSpec], plan: dict, requested: Optional[str] = None) -> ModelSpec:
+    """The model to call for a user on `plan`; `requested` must be one the plan allows"""
+    if requested is None:
+        return catalog[plan["model"]]
+    if requested not in catalog:
+        raise KeyError(requested)
+    if requested not in plan.get("models", [plan["model"]]):
+        raise ModelNotAllowed(requested)
+    return catalog[requested]
@@ -0,0 +1,131 @@
+"""
+Readiness probes behind /api/ready.
+
+A Probe measures one thing (a dependency's round trip, event-loop lag, a
+queue depth) and grades the value against two thresholds: `ok`, `degraded`
+or `unready`. A probe that raises or times out gets its `on_failure` grade; a
+check that returns None has nothing to measure here and is `skipped`.
+
+Results are cached for `every` seconds and concurrent callers share the run
+in flight, so however often the load balancer polls, each dependency sees at
+most one probe per interval per worker.
+"""
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from metrics import metrics
+
+SEVERITY = {"ok": 0, "skipped": 0, "degraded": 1, "unready": 2}
+
+
+@dataclass
+class Check:
+    status: str
+    value: Optional[float] = None
+    detail: str = ""
+    checked_at: float = 0.0
+
+    def as_dict(self, now: float) -> dict:
+        body = {"status": self.status, "value": self.value, "age_seconds": round(now - self.checked_at, 3)}
+        if self.detail:
+            body["detail"] = self.detail
+        return body
+
+
+async def timed(fn: Callable[[], Awaitable]) -> Optional[float]:
+    """Milliseconds `fn` took, or None when it reports it has nothing to check"""
+    began = time.perf_counter()
+    answer = await fn()
+    if answer is None:
+        return None
+    if answer is False:
+        raise RuntimeError("ping rechazado")
+    return round((time.perf_counter() - began) * 1000, 2)
+
+
+def reading(fn: Callable[[], float]) -> Callable[[], Awaitable[float]]:
+    """Check for a value already at hand, such as a gauge or a queue length"""
+    async def check():
+        return fn()
+    return check
+
+
+class Probe:
+    def __init__(self, name: str, check: Callable[[], Awaitable[Optional[float]]], *, every: float = 5.0,
+                 timeout: float = 2.0, degraded: float = 0, unready: float = 0, on_failure: str = "unready"):
+        self.name = name
+        self.check = check
+        self.every = every
+        self.timeout = timeout
+        self.degraded = degraded  # 0 disables a threshold
+        self.unready = unready
+        self.on_failure = on_failure
+        self.last: Optional[Check] = None
+        self._running: Optional[asyncio.Future] = None
+
+    def grade(self, value: float) -> str:
+        if self.unready and value >= self.unready:
+            return "unready"
+        if self.degraded and value >= self.degraded:
+            return "degraded"
+        return "ok"
+
+    async def result(self) -> Check:
+        if self.last and time.monotonic() - self.last.checked_at < self.every:
+            return self.last
+        if self._running is None:
+            self._running = asyncio.ensure_future(self._run())
+        # Shielded: a caller that disconnects does not cancel the run the others wait on
+        return await asyncio.shield(self._running)
+
+    async def _run(self) -> Check:
+        try:
+            value = await asyncio.wait_for(self.check(), self.timeout)
+            check = Check("skipped") if value is None else Check(self.grade(value), value)
+        except asyncio.TimeoutError:
+            check = Check(self.on_failure, detail=f"sin respuesta en {self.timeout:g}s")
+        except Exception as e:
+            check = Check(self.on_failure, detail=f"{type(e).__name__}: {e}"[:200])
+        finally:
+            self._running = None
+        check.checked_at = time.monotonic()
+        self.last = check
+        metrics.incr("ready_probes", probe=self.name, status=check.status)
+        return check
+
+
+class LoopLagMonitor:
+    """Event-loop lag: how late a sleep of `interval` wakes up, worst of the last `window` samples"""
+
+    def __init__(self, interval: float = 0.5, window: int = 10):
+        self.interval = interval
+        self.samples: deque = deque(maxlen=window)
+
+    @property
+    def lag_ms(self) -> float:
+        return max(self.samples, default=0.0)
+
+    async def run(self):
+        while True:
+            began = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, (time.perf_counter() - began - self.interval) * 1000)
+            self.samples.append(round(lag, 2))
+            metrics.gauge("event_loop_lag_ms", round(lag, 2))
+
+
+class Readiness:
+    def __init__(self, probes: List[Probe]):
+        self.probes = probes
+
+    async def report(self) -> Tuple[str, Dict[str, dict]]:
+        """Overall status (the worst probe's: ready, degraded or unready) and each probe's result"""
+        checks = await asyncio.gather(*(probe.result() for probe in self.probes))
+        worst = max((SEVERITY[check.status] for check in checks), default=0)
+        now = time.monotonic()
+        status = ("ready", "degraded", "unready")[worst]
+        metrics.gauge("ready_status", worst)
+        return status, {probe.name: check.as_dict(now) for probe, check in zip(self.probes, checks)}
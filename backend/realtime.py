@@ -0,0 +1,73 @@
+"""
+WebSocket plumbing for the chat channel.
+
+Outbox: every message to a client goes through one sender task, so the
+producer (the LLM stream) never waits on the socket. While the client is slow
+to read, consecutive text deltas of a turn are merged into the one already
+waiting, so a slow reader gets fewer, larger deltas and the buffer is bounded
+by the size of the answer; other messages are capped by `max_pending` and
+overflowing it means the client has stopped reading.
+
+ConnectionLimiter: open connections per user, per worker.
+"""
+import asyncio
+from collections import defaultdict, deque
+from typing import Awaitable, Callable, Deque, Dict
+
+
+class OutboxFull(Exception):
+    pass
+
+
+class Outbox:
+    def __init__(self, send: Callable[[dict], Awaitable[None]], max_pending: int = 64):
+        self._send = send
+        self.max_pending = max_pending
+        self._queue: Deque[dict] = deque()
+        self._ready = asyncio.Event()
+        self.sent = 0
+        self.coalesced = 0
+
+    def __len__(self):
+        return len(self._queue)
+
+    def put(self, message: dict):
+        last = self._queue[-1] if self._queue else None
+        if (message.get("type") == "delta" and last is not None and last.get("type") == "delta"
+                and last.get("ref") == message.get("ref")):
+            last["text"] += message["text"]
+            self.coalesced += 1
+        else:
+            if len(self._queue) >= self.max_pending:
+                raise OutboxFull()
+            self._queue.append(dict(message))
+        self._ready.set()
+
+    async def run(self):
+        while True:
+            await self._ready.wait()
+            while self._queue:
+                await self._send(self._queue.popleft())
+                self.sent += 1
+            self._ready.clear()
+
+
+class ConnectionLimiter:
+    def __init__(self, per_user: int):
+        self.per_user = per_user
+        self._open: Dict[str, int] = defaultdict(int)
+
+    @property
+    def total(self) -> int:
+        return sum(self._open.values())
+
+    def acquire(self, user_id: str) -> bool:
+        if self.per_user > 0 and self._open[user_id] >= self.per_user:
+            return False
+        self._open[user_id] += 1
+        return True
+
+    def release(self, user_id: str):
+        self._open[user_id] -= 1
+        if self._open[user_id] <= 0:
+            del self._open[user_id]
@@ -0,0 +1,196 @@
+"""
+Full-text search over a user's conversations.
+
+An inverted index per user, kept in SQLite so it survives restarts and its
+memory use is bounded by the SQLite page cache rather than by the number of
+messages. Every message is one document:
+
+    docs(user_id, message_id, conversation_id, role, content, timestamp, length)
+    postings(user_id, term, message_id, tf)
+
+send_message adds its two new messages incrementally; a user's older
+conversations are backfilled once on their first search. Results are ranked
+with BM25 and come with a snippet around the first match.
+
+Methods are blocking; server.py calls them through asyncio.to_thread.
+"""
+import math
+import re
+import sqlite3
+import threading
+import unicodedata
+from collections import Counter
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+STOPWORDS = frozenset("""
+a al algo como con de del el ella ellas ellos en entre era es esa ese eso esta este esto fue ha hay la las le les
+lo los mas me mi mis muy no nos o para pero por que se si sin sobre su sus te tu un una uno unos unas y ya yo
+an and are as at be but by do for from had has have he her his i if in into is it its me my of on or our she so
+that the their them there they this to was we were what when which who will with you your
+""".split())
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def fold(text: str) -> str:
+    """Lowercase and strip accents, one output character per input character"""
+    return "".join(unicodedata.normalize("NFKD", c)[0] for c in text.lower())
+
+
+def stem(word: str) -> str:
+    """Light plural stripping shared by Spanish and English"""
+    if len(word) > 4 and word.endswith("es") and word[-3] in "dlnrj":
+        return word[:-2]
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    return [stem(w) for w in WORD_RE.findall(fold(text)) if w not in STOPWORDS and len(w) > 1]
+
+
+def snippet(content: str, terms: Iterable[str], width: int = 160) -> str:
+    """A window of `content` around the first word matching one of `terms`"""
+    terms = set(terms)
+    start = 0
+    for match in WORD_RE.finditer(fold(content)):
+        if stem(match.group()) in terms:
+            start = max(0, match.start() - width // 3)
+            break
+    end = min(len(content), start + width)
+    start = max(0, min(start, end - width))
+    text = content[start:end].strip()
+    return f"{'…' if start > 0 else ''}{text}{'…' if end < len(content) else ''}"
+
+
+class SearchIndex:
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS docs (
+        user_id TEXT NOT NULL, message_id TEXT NOT NULL, conversation_id TEXT NOT NULL,
+        role TEXT, content TEXT, timestamp TEXT, length INTEGER NOT NULL,
+        PRIMARY KEY (user_id, message_id)
+    );
+    CREATE INDEX IF NOT EXISTS docs_conversation ON docs (user_id, conversation_id);
+    CREATE TABLE IF NOT EXISTS postings (
+        user_id TEXT NOT NULL, term TEXT NOT NULL, message_id TEXT NOT NULL, tf INTEGER NOT NULL,
+        PRIMARY KEY (user_id, term, message_id)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS indexed_users (user_id TEXT PRIMARY KEY, indexed_at TEXT);
+    """
+
+    def __init__(self, path: str = ":memory:", cache_kb: int = 8192):
+        self.path = path
+        self.cache_kb = cache_kb
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        # Opened on first use so importing the app does not touch the filesystem
+        if self._conn is None:
+            if self.path != ":memory:":
+                Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute(f"PRAGMA cache_size = -{int(self.cache_kb)}")
+            if self.path != ":memory:":
+                conn.execute("PRAGMA journal_mode = WAL")
+            conn.executescript(self.SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    # ---- updates ----
+
+    def add_messages(self, user_id: str, conversation_id: str, messages: Iterable[dict]) -> int:
+        """Index (or re-index) messages; safe to call twice for the same message"""
+        added = 0
+        with self._lock, self.conn as conn:
+            for msg in messages:
+                if not msg or not msg.get("id") or not msg.get("content"):
+                    continue
+                terms = Counter(tokenize(msg["content"]))
+                conn.execute("DELETE FROM postings WHERE user_id = ? AND message_id = ?", (user_id, msg["id"]))
+                conn.execute(
+                    "INSERT OR REPLACE INTO docs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (user_id, msg["id"], conversation_id, msg.get("role"), msg["content"],
+                     msg.get("timestamp"), sum(terms.values()))
+                )
+                conn.executemany("INSERT INTO postings VALUES (?, ?, ?, ?)",
+                                 [(user_id, term, msg["id"], tf) for term, tf in terms.items()])
+                added += 1
+        return added
+
+    def remove_conversation(self, user_id: str, conversation_id: str):
+        with self._lock, self.conn as conn:
+            conn.execute(
+                "DELETE FROM postings WHERE user_id = ? AND message_id IN "
+                "(SELECT message_id FROM docs WHERE user_id = ? AND conversation_id = ?)",
+                (user_id, user_id, conversation_id)
+            )
+            conn.execute("DELETE FROM docs WHERE user_id = ? AND conversation_id = ?", (user_id, conversation_id))
+
+    def is_indexed(self, user_id: str) -> bool:
+        with self._lock:
+            row = self.conn.execute("SELECT 1 FROM indexed_users WHERE user_id = ?", (user_id,)).fetchone()
+        return row is not None
+
+    def mark_indexed(self, user_id: str, indexed_at: str):
+        with self._lock, self.conn as conn:
+            conn.execute("INSERT OR REPLACE INTO indexed_users VALUES (?, ?)", (user_id, indexed_at))
+
+    # ---- queries ----
+
+    def search(self, user_id: str, query: str, limit: int = 20, offset: int = 0) -> Tuple[int, List[dict]]:
+        """(total matches, one page of results ranked by BM25)"""
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return 0, []
+        with self._lock:
+            conn = self.conn
+            count, avg_length = conn.execute(
+                "SELECT COUNT(*), AVG(length) FROM docs WHERE user_id = ?", (user_id,)).fetchone()
+            if not count:
+                return 0, []
+            avg_length = avg_length or 1
+            scores: Counter = Counter()
+            for term in terms:
+                rows = conn.execute(
+                    "SELECT p.message_id, p.tf, d.length FROM postings p "
+                    "JOIN docs d ON d.user_id = p.user_id AND d.message_id = p.message_id "
+                    "WHERE p.user_id = ? AND p.term = ?", (user_id, term)).fetchall()
+                if not rows:
+                    continue
+                idf = math.log(1 + (count - len(rows) + 0.5) / (len(rows) + 0.5))
+                for message_id, tf, length in rows:
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+                    scores[message_id] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+            ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+            page = ranked[offset:offset + limit]
+            docs = {}
+            if page:
+                marks = ",".join("?" * len(page))
+                docs = {row[0]: row for row in conn.execute(
+                    f"SELECT message_id, conversation_id, role, content, timestamp FROM docs "
+                    f"WHERE user_id = ? AND message_id IN ({marks})", (user_id, *[m for m, _ in page]))}
+        results = []
+        for message_id, score in page:
+            _, conversation_id, role, content, timestamp = docs[message_id]
+            results.append({
+                "conversation_id": conversation_id,
+                "message_id": message_id,
+                "role": role,
+                "snippet": snippet(content, terms),
+                "timestamp": timestamp,
+                "score": round(score, 4),
+            })
+        return len(ranked), results
@@ -0,0 +1,238 @@
+"""
+Semantic response cache for the public chat API.
+
+Prompts are embedded on the CPU with a hashing vectorizer: the search
+tokenizer's terms (accents folded, stopwords, greetings and courtesy words
+dropped, plurals stripped), their bigrams and the character trigrams of each
+term are hashed (with a sign) into a fixed number of dimensions, weighted
+sublinearly and L2-normalised. No model download and well under a millisecond
+per prompt. It is lexical: rewordings that keep the content words (case,
+accents, punctuation, greetings, word order, inflections) land close
+together, while questions that differ in one content word ("plan premium" /
+"plan estándar") stay apart only with a high threshold, which is why the
+default is conservative (see benchmarks/bench_semantic_cache.py).
+
+Vectors live in one NumPy matrix per scope. A scope is an API key plus the
+model and the exact system prompt, so a cached answer is only ever reused for
+the same caller and the same instructions; similarity is computed on the
+message. A lookup is one matrix-vector product; an entry is served when its
+cosine similarity reaches the threshold and it is younger than the TTL. Each
+scope keeps at most `max_entries`, evicting the least recently used.
+
+The cache is per worker. `save()` / `load()` persist it to a single .npz file
+so a restart does not start cold. NumPy is imported on first use, so building
+the cache (and `import server`) does not pay for it.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from search import STOPWORDS, WORD_RE, fold, stem
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# Courtesy words that change nothing about what is asked (after accent folding)
+FILLER_WORDS = frozenset("""
+hola buena buenas buenos dia tarde noche oye disculpa perdon favor gracia gracias saludo saludos
+hi hello hey please thank thanks
+""".split())
+
+
+class HashingEmbedder:
+    def __init__(self, dim: int = 1024):
+        self.dim = dim
+
+    @staticmethod
+    def features(text: str) -> List[str]:
+        # Same terms as the search tokenizer, but numbers are kept whatever their length
+        words = [stem(w) for w in WORD_RE.findall(fold(text))
+                 if w.isdigit() or (len(w) > 1 and w not in STOPWORDS and w not in FILLER_WORDS)]
+        features = [f"w:{w}" for w in words]
+        features += [f"b:{a} {b}" for a, b in zip(words, words[1:])]
+        for w in words:
+            padded = f"<{w}>"
+            features += [f"c:{padded[i:i + 3]}" for i in range(len(padded) - 2)]
+        return features
+
+    def embed(self, text: str) -> "np.ndarray":
+        import numpy as np
+
+        counts: Dict[int, float] = {}
+        for feature in self.features(text):
+            digest = int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), "little")
+            index = digest % self.dim
+            sign = 1.0 if (digest >> 63) & 1 else -1.0
+            counts[index] = counts.get(index, 0.0) + sign
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for index, value in counts.items():
+            vector[index] = np.sign(value) * (1.0 + np.log(abs(value))) if value else 0.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+@dataclass
+class CacheHit:
+    answer: dict
+    similarity: float
+    age_seconds: float
+
+
+class _Scope:
+    """Vectors of one scope in a growable matrix, plus their answers and timestamps"""
+
+    def __init__(self, dim: int, capacity: int = 16):
+        import numpy as np
+
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.answers: List[dict] = []
+        self.created = np.zeros(capacity, dtype=np.float64)
+        self.used = np.zeros(capacity, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.answers)
+
+    def add(self, vector: "np.ndarray", answer: dict, now: float):
+        n = len(self.answers)
+        if n == len(self.vectors):
+            import numpy as np
+
+            grow = len(self.vectors)
+            self.vectors = np.vstack([self.vectors, np.zeros_like(self.vectors[:grow])])
+            self.created = np.concatenate([self.created, np.zeros(grow)])
+            self.used = np.concatenate([self.used, np.zeros(grow)])
+        self.vectors[n] = vector
+        self.created[n] = self.used[n] = now
+        self.answers.append(answer)
+
+    def remove(self, index: int):
+        """Swap the last entry into `index`"""
+        last = len(self.answers) - 1
+        if index != last:
+            self.vectors[index] = self.vectors[last]
+            self.created[index] = self.created[last]
+            self.used[index] = self.used[last]
+            self.answers[index] = self.answers[last]
+        self.answers.pop()
+
+
+def scope_key(api_key_id: str, model: str, system_prompt: str) -> str:
+    digest = hashlib.sha256(f"{model}\0{system_prompt}".encode()).hexdigest()[:16]
+    return f"{api_key_id}:{digest}"
+
+
+class SemanticCache:
+    def __init__(self, dim: int = 1024, threshold: float = 0.9, max_entries: int = 2000,
+                 ttl_seconds: float = 86400.0):
+        self.embedder = HashingEmbedder(dim)
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._scopes: Dict[str, _Scope] = {}
+        self._lock = threading.Lock()
+        self.dirty = False
+
+    @property
+    def entries(self) -> int:
+        return sum(len(scope) for scope in self._scopes.values())
+
+    def lookup(self, scope: str, text: str, vector: Optional["np.ndarray"] = None) -> Optional[CacheHit]:
+        import numpy as np
+
+        vector = self.embedder.embed(text) if vector is None else vector
+        now = time.time()
+        with self._lock:
+            entries = self._scopes.get(scope)
+            if not entries:
+                return None
+            n = len(entries)
+            similarities = entries.vectors[:n] @ vector
+            similarities[entries.created[:n] < now - self.ttl_seconds] = -1.0
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            if similarity < self.threshold:
+                return None
+            entries.used[best] = now
+            return CacheHit(entries.answers[best], similarity, now - float(entries.created[best]))
+
+    def store(self, scope: str, text: str, answer: dict, vector: Optional["np.ndarray"] = None) -> int:
+        """Add an entry; returns how many were evicted to make room"""
+        import numpy as np
+
+        vector = self.embedder.embed(text) if vector is None else vector
+        now = time.time()
+        with self._lock:
+            entries = self._scopes.setdefault(scope, _Scope(self.embedder.dim))
+            n = len(entries)
+            expired = np.flatnonzero(entries.created[:n] < now - self.ttl_seconds)
+            for index in sorted(expired, reverse=True):
+                entries.remove(int(index))
+            evicted = len(expired)
+            if len(entries) >= self.max_entries:
+                entries.remove(int(np.argmin(entries.used[:len(entries)])))
+                evicted += 1
+            entries.add(vector, answer, now)
+            self.dirty = True
+            return evicted
+
+    def drop_scopes(self, api_key_id: str):
+        """Forget everything cached for an API key (e.g. when it is deleted)"""
+        with self._lock:
+            for scope in [s for s in self._scopes if s.startswith(f"{api_key_id}:")]:
+                del self._scopes[scope]
+                self.dirty = True
+
+    # ---- persistence ----
+
+    def save(self, path: str):
+        import numpy as np
+
+        with self._lock:
+            scopes = list(self._scopes.items())
+            vectors = np.vstack([entries.vectors[:len(entries)] for _, entries in scopes] or
+                                [np.zeros((0, self.embedder.dim), dtype=np.float32)])
+            meta = {"dim": self.embedder.dim, "scopes": [
+                {"scope": scope, "answers": list(entries.answers), "created": entries.created[:len(entries)].tolist(),
+                 "used": entries.used[:len(entries)].tolist()} for scope, entries in scopes]}
+            self.dirty = False
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Workers may share the path; each writes its own temporary file
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            np.savez_compressed(f, vectors=vectors,
+                                meta=np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8))
+        os.replace(tmp, path)
+
+    def load(self, path: str) -> int:
+        if not os.path.exists(path):
+            return 0
+        import numpy as np
+
+        with np.load(path) as data:
+            meta = json.loads(data["meta"].tobytes())
+            vectors = data["vectors"]
+        if meta["dim"] != self.embedder.dim:
+            return 0
+        # Answers are matched to vectors by position: a file where the counts disagree is ignored
+        if len(vectors) != sum(len(saved["answers"]) for saved in meta["scopes"]) or any(
+                not len(saved["answers"]) == len(saved["created"]) == len(saved["used"]) for saved in meta["scopes"]):
+            return 0
+        offset = 0
+        with self._lock:
+            for saved in meta["scopes"]:
+                entries = _Scope(self.embedder.dim, capacity=max(16, len(saved["answers"])))
+                for i, answer in enumerate(saved["answers"]):
+                    entries.add(vectors[offset + i], answer, saved["created"][i])
+                    entries.used[i] = saved["used"][i]
+                offset += len(saved["answers"])
+                self._scopes[saved["scope"]] = entries
+        return offset
+
+    def stats(self) -> Tuple[int, int]:
+        """(scopes, entries)"""
+        with self._lock:
+            return len(self._scopes), self.entries
@@ -1,40 +1,269 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Header, Request
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Header, Request, WebSocket, WebSocketDisconnect
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi.responses import JSONResponse, ORJSONResponse, Response, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 import os
+import json
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr, ConfigDict
-from typing import List, Optional
+from typing import Any, Awaitable, Callable, List, Optional
 import uuid
 from datetime import datetime, timezone, timedelta
 import jwt
 import bcrypt
-import httpx
 import secrets
-from emergentintegrations.llm.chat import LlmChat, UserMessage
-from emergentintegrations.payments.stripe.checkout import StripeCheckout, CheckoutSessionResponse, CheckoutStatusResponse, CheckoutSessionRequest
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from functools import lru_cache, partial
+try:
+    import orjson  # noqa: F401
+    DefaultResponse = ORJSONResponse
+except ImportError:  # orjson is optional, fall back to the stdlib encoder
+    DefaultResponse = JSONResponse
+from shared_state import StateLock, create_state_backend, rate_limit_hit, rate_limit_reached
+from bloom import BloomFilter
+from firebase_client import CircuitBreaker, FirebaseClient, FirebaseUnavailable
+from firebase_stream import FirebaseListener
+from http_cache import CompressionMiddleware, etag, etag_matches
+from traffic import TraceLog, TraceRecorder
+from readiness import LoopLagMonitor, Probe, Readiness, reading, timed
+from llm import AnthropicProvider, EmergentProvider, LlmClient, LlmResult, estimate_tokens
+from metering import Charge, Meter, Preflight, prompt_chars
+from compaction import Compactor
+from titles import TitleWorker
+from model_routing import ModelNotAllowed, ModelSpec, is_overloaded, load_catalog, resolve_model
+from realtime import ConnectionLimiter, Outbox, OutboxFull
+from search import SearchIndex
+from semantic_cache import SemanticCache, scope_key
+from storage import ArchivedConversations, ArchiveStore, FirebaseStorage, create_storage, is_stub
+from transfer import Importer, export_records, gzip_chunks, ndjson_chunks
+from usage_rollups import COUNTERS, GRANULARITIES, bucket, default_range, series
+from metrics import metrics
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
 # Firebase Realtime Database Config
 FIREBASE_DB_URL = os.environ.get('FIREBASE_DB_URL', 'https://hypnotic-camp-479405-g2-default-rtdb.firebaseio.com')
+# Top-level nodes whose concurrent identical GETs share one in-flight request
+FIREBASE_SINGLEFLIGHT_PATHS = set(filter(None, os.environ.get(
+    'FIREBASE_SINGLEFLIGHT_PATHS', 'users,api_keys,payment_transactions,conversations').split(',')))
+FIREBASE_AUTH = os.environ.get('FIREBASE_AUTH', '')  # optional database secret or ID token
+# Deadlines cover every retry of one operation
+FIREBASE_READ_TIMEOUT = float(os.environ.get('FIREBASE_READ_TIMEOUT', 5))
+FIREBASE_WRITE_TIMEOUT = float(os.environ.get('FIREBASE_WRITE_TIMEOUT', 10))
+FIREBASE_MAX_RETRIES = int(os.environ.get('FIREBASE_MAX_RETRIES', 3))
+FIREBASE_HEDGE_AFTER_MS = float(os.environ.get('FIREBASE_HEDGE_AFTER_MS', 0))  # 0 disables hedged reads
+FIREBASE_BREAKER_THRESHOLD = int(os.environ.get('FIREBASE_BREAKER_THRESHOLD', 5))
+FIREBASE_BREAKER_RESET_SECONDS = float(os.environ.get('FIREBASE_BREAKER_RESET_SECONDS', 10))
+# Paths mirrored in memory through the REST streaming API ('' disables); reads are served from
+# the mirror while its stream is up, and changes made elsewhere invalidate this worker's caches
+FIREBASE_STREAM_PATHS = list(filter(None, os.environ.get('FIREBASE_STREAM_PATHS', 'users,api_keys').split(',')))
+FIREBASE_STREAM_STALL_SECONDS = float(os.environ.get('FIREBASE_STREAM_STALL_SECONDS', 90))  # keep-alives come every 30 s
+
+# Storage Config: firebase (default), sqlite:///path/to.db or postgresql://... (see storage/__init__.py)
+STORAGE_URL = os.environ.get('STORAGE_URL', 'firebase')
 
 # JWT Config
 JWT_SECRET = os.environ.get('JWT_SECRET', 'default-secret-key')
 JWT_ALGORITHM = os.environ.get('JWT_ALGORITHM', 'HS256')
 JWT_EXPIRATION_HOURS = int(os.environ.get('JWT_EXPIRATION_HOURS', 24))
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 10000))  # verified tokens kept per worker, 0 disables
+USER_SNAPSHOT_TTL_SECONDS = int(os.environ.get('USER_SNAPSHOT_TTL_SECONDS', 60))
+# While the users stream is up, changes invalidate snapshots as they happen
+USER_SNAPSHOT_STREAM_TTL_SECONDS = int(os.environ.get('USER_SNAPSHOT_STREAM_TTL_SECONDS', 900))
+
+# Login Config: register and login skip the users lookup for emails a Bloom filter has never seen,
+# and logins are throttled per client IP (every attempt) and per email (failures) before any lookup
+EMAIL_FILTER = os.environ.get('EMAIL_FILTER', 'true').lower() in ('1', 'true', 'yes')
+EMAIL_FILTER_ERROR_RATE = float(os.environ.get('EMAIL_FILTER_ERROR_RATE', 0.001))
+EMAIL_FILTER_REBUILD_SECONDS = int(os.environ.get('EMAIL_FILTER_REBUILD_SECONDS', 3600))
+LOGIN_ATTEMPTS_PER_IP_PER_MINUTE = int(os.environ.get('LOGIN_ATTEMPTS_PER_IP_PER_MINUTE', 20))  # 0 disables
+LOGIN_FAILURES_PER_EMAIL = int(os.environ.get('LOGIN_FAILURES_PER_EMAIL', 5))  # 0 disables
+LOGIN_FAILURE_WINDOW_SECONDS = int(os.environ.get('LOGIN_FAILURE_WINDOW_SECONDS', 900))
+# Proxies in front of the app that append to X-Forwarded-For (0 = use the socket peer address)
+FORWARDED_FOR_HOPS = int(os.environ.get('FORWARDED_FOR_HOPS', 0))
 
 # LLM Config
 EMERGENT_LLM_KEY = os.environ.get('EMERGENT_LLM_KEY', '')
+LLM_PROVIDER = os.environ.get('LLM_PROVIDER', 'emergent')  # emergent | anthropic
+LLM_MODEL = os.environ.get('LLM_MODEL', 'claude-sonnet-4-5-20250929')
+ANTHROPIC_API_KEY = os.environ.get('ANTHROPIC_API_KEY', '')
+ANTHROPIC_BASE_URL = os.environ.get('ANTHROPIC_BASE_URL', 'https://api.anthropic.com')
+# Mark the system prompt and older history as cacheable (anthropic provider only)
+LLM_PROMPT_CACHING = os.environ.get('LLM_PROMPT_CACHING', 'true').lower() in ('1', 'true', 'yes')
+# Model routing: catalog (JSON in LLM_MODEL_CATALOG, see model_routing.py) and the tiers plans choose from
+LLM_FAST_MODEL = os.environ.get('LLM_FAST_MODEL', 'claude-haiku-4-5-20251001')
+LLM_TOP_MODEL = os.environ.get('LLM_TOP_MODEL', 'claude-opus-4-1-20250805')
+MODEL_CATALOG = load_catalog(os.environ.get('LLM_MODEL_CATALOG', ''))
+for _model in (LLM_MODEL, LLM_FAST_MODEL, LLM_TOP_MODEL):
+    MODEL_CATALOG.setdefault(_model, ModelSpec(id=_model))
+# Upstream calls in flight per worker (0 = unlimited); extra calls wait for a slot
+LLM_MAX_CONCURRENCY = int(os.environ.get('LLM_MAX_CONCURRENCY', 0))
+# How often a pending LLM call checks whether its client is still connected
+DISCONNECT_POLL_SECONDS = float(os.environ.get('DISCONNECT_POLL_SECONDS', 0.25))
+# Metering: calls are charged by tokens at the catalog rates; admission reserves this many output tokens
+METERING_EXPECTED_OUTPUT_TOKENS = int(os.environ.get('METERING_EXPECTED_OUTPUT_TOKENS', 500))
+CHAT_HISTORY_MESSAGES = 10
+CHAT_HISTORY_STEP = 4  # the history window start moves in steps so its prefix stays cacheable
+# Chat WebSocket: one authenticated connection per chat window, answers streamed as they are generated
+WS_MAX_CONNECTIONS_PER_USER = int(os.environ.get('WS_MAX_CONNECTIONS_PER_USER', 3))  # per worker
+WS_HEARTBEAT_SECONDS = float(os.environ.get('WS_HEARTBEAT_SECONDS', 20))  # silent for two beats = gone
+WS_AUTH_TIMEOUT_SECONDS = 10
+WS_MAX_QUEUED_TURNS = 2  # messages sent while a turn is being answered
+WS_MAX_PENDING_MESSAGES = 64  # unsent non-delta messages before the client counts as stalled
+# Rolling conversation summaries: older turns are folded into a summary in the background
+CONTEXT_COMPACTION = os.environ.get('CONTEXT_COMPACTION', 'true').lower() in ('1', 'true', 'yes')
+COMPACTION_TRIGGER_TOKENS = int(os.environ.get('COMPACTION_TRIGGER_TOKENS', 2000))
+COMPACTION_KEEP_MESSAGES = int(os.environ.get('COMPACTION_KEEP_MESSAGES', 4))
+# Conversation titles and previews: written in the background, batched into one cheap-model call (see titles.py)
+TITLE_GENERATION = os.environ.get('TITLE_GENERATION', 'true').lower() in ('1', 'true', 'yes')
+TITLE_MODEL = os.environ.get('TITLE_MODEL', LLM_FAST_MODEL)
+TITLE_BATCH_SIZE = int(os.environ.get('TITLE_BATCH_SIZE', 8))
+TITLE_BATCH_WAIT_SECONDS = float(os.environ.get('TITLE_BATCH_WAIT_SECONDS', 2))
+TITLE_MAX_QUEUE = int(os.environ.get('TITLE_MAX_QUEUE', 1000))  # per worker; ids beyond it wait for the next turn
+TITLE_LLM_CALLS_PER_MINUTE = int(os.environ.get('TITLE_LLM_CALLS_PER_MINUTE', 30))  # all workers; then heuristic
+TITLE_REFRESH_MESSAGES = int(os.environ.get('TITLE_REFRESH_MESSAGES', 20))  # re-title after this many new messages
+# Fill the per-user listing index from the existing conversations at startup (Firebase; one worker runs it)
+TITLE_BACKFILL = os.environ.get('TITLE_BACKFILL', 'false').lower() in ('1', 'true', 'yes')
+
+# Search Config: per-user inverted index over conversation messages (SQLite, ':memory:' to keep it in RAM)
+SEARCH_INDEX_PATH = os.environ.get('SEARCH_INDEX_PATH', str(ROOT_DIR / 'data' / 'search_index.sqlite3'))
+SEARCH_CACHE_KB = int(os.environ.get('SEARCH_CACHE_KB', 8192))  # SQLite page cache bound
+SEARCH_MAX_RESULTS = 50
+
+# Semantic cache Config: /v1/chat requests with "semantic_cache": true reuse answers to near-identical prompts
+SEMANTIC_CACHE = os.environ.get('SEMANTIC_CACHE', 'true').lower() in ('1', 'true', 'yes')
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', 0.9))  # cosine similarity
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get('SEMANTIC_CACHE_MAX_ENTRIES', 2000))  # per API key and prompt
+SEMANTIC_CACHE_TTL_SECONDS = int(os.environ.get('SEMANTIC_CACHE_TTL_SECONDS', 86400))
+SEMANTIC_CACHE_PATH = os.environ.get('SEMANTIC_CACHE_PATH', str(ROOT_DIR / 'data' / 'semantic_cache.npz'))  # '' = no persistence
+SEMANTIC_CACHE_SAVE_SECONDS = int(os.environ.get('SEMANTIC_CACHE_SAVE_SECONDS', 300))
+SEMANTIC_CACHE_HIT_CREDITS = int(os.environ.get('SEMANTIC_CACHE_HIT_CREDITS', 0))
+
+# Export / import Config: NDJSON history export, read page by page; imports are written in batches
+EXPORT_PAGE_SIZE = int(os.environ.get('EXPORT_PAGE_SIZE', 50))
+IMPORT_BATCH_MESSAGES = int(os.environ.get('IMPORT_BATCH_MESSAGES', 500))
+IMPORT_MAX_LINE_BYTES = int(os.environ.get('IMPORT_MAX_LINE_BYTES', 1024 * 1024))
+IMPORT_MAX_BYTES = int(os.environ.get('IMPORT_MAX_BYTES', 256 * 1024 * 1024))  # decompressed; 0 = no limit
+IMPORT_PROGRESS_TTL_SECONDS = 24 * 3600
+# Support export of any user's history requires the X-Support-Token header; disabled while unset
+SUPPORT_TOKEN = os.environ.get('SUPPORT_TOKEN', '')
+
+# Archive Config: conversations untouched for ARCHIVE_AFTER_DAYS move to compressed files and leave a stub
+# in the hot store; opening one restores it. With more than one host ARCHIVE_PATH must be a shared volume
+ARCHIVE_PATH = os.environ.get('ARCHIVE_PATH', str(ROOT_DIR / 'data' / 'archive'))  # '' = no archive
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', 0))  # 0 disables the archival job
+ARCHIVE_INTERVAL_SECONDS = int(os.environ.get('ARCHIVE_INTERVAL_SECONDS', 6 * 3600))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', 500))  # conversations per run
+
+# Traffic recording Config: sanitized request traces for benchmarks/replay.py ('' disables; see traffic.py).
+# With several workers put {pid} in the path so each writes its own file
+TRAFFIC_TRACE_PATH = os.environ.get('TRAFFIC_TRACE_PATH', '')
+TRAFFIC_TRACE_SAMPLE = float(os.environ.get('TRAFFIC_TRACE_SAMPLE', 1.0))
+
+# HTTP caching Config: ETags on read endpoints, compression of larger single-body responses
+PLANS_CACHE_SECONDS = int(os.environ.get('PLANS_CACHE_SECONDS', 3600))
+COMPRESSION_MIN_BYTES = int(os.environ.get('COMPRESSION_MIN_BYTES', 1024))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', 5))  # 6 costs ~3x the CPU for ~10% fewer bytes
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', 4))
+
+# Metrics Config (if set, /api/metrics requires the X-Metrics-Token header)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
 
 # Stripe Config
 STRIPE_API_KEY = os.environ.get('STRIPE_API_KEY', '')
 
+# Shared state Config (caches, rate limits, idempotency). Use redis:// with more than one worker
+STATE_BACKEND_URL = os.environ.get('STATE_BACKEND_URL', 'memory://')
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 1))
+API_RATE_LIMIT_PER_MINUTE = int(os.environ.get('API_RATE_LIMIT_PER_MINUTE', 0))  # 0 disables the limit
+PAYMENT_CLAIM_TTL_SECONDS = 7 * 24 * 3600
+# api_keys.last_used is buffered in memory and written in one batch per interval
+API_KEY_LAST_USED_FLUSH_SECONDS = float(os.environ.get('API_KEY_LAST_USED_FLUSH_SECONDS', 60))
+
+# Usage Config: raw api_usage events are aggregated into rollups and pruned after the retention window
+USAGE_RAW_RETENTION_DAYS = int(os.environ.get('USAGE_RAW_RETENTION_DAYS', 90))  # 0 keeps raw events forever
+USAGE_RETENTION_INTERVAL_SECONDS = int(os.environ.get('USAGE_RETENTION_INTERVAL_SECONDS', 3600))
+USAGE_HISTORY_MAX_POINTS = {"hour": 24 * 31, "day": 366}
+
+# Startup Config
+# Import the LLM/Stripe integrations in the background at startup instead of on the first request
+WARMUP_INTEGRATIONS = os.environ.get('WARMUP_INTEGRATIONS', 'false').lower() in ('1', 'true', 'yes')
+
+# Readiness Config: /api/ready probes storage, shared state, the LLM API, event-loop lag and the LLM queue.
+# Each probe runs at most once per interval per worker; polls in between get the cached result.
+# Thresholds grade a probe degraded (still 200) or unready (503); 0 disables a threshold
+READY_PROBE_INTERVAL_SECONDS = float(os.environ.get('READY_PROBE_INTERVAL_SECONDS', 5))
+READY_PROBE_TIMEOUT_SECONDS = float(os.environ.get('READY_PROBE_TIMEOUT_SECONDS', 2))
+READY_LLM_PROBE_INTERVAL_SECONDS = float(os.environ.get('READY_LLM_PROBE_INTERVAL_SECONDS', 60))
+READY_STORAGE_DEGRADED_MS = float(os.environ.get('READY_STORAGE_DEGRADED_MS', 500))
+READY_STORAGE_UNREADY_MS = float(os.environ.get('READY_STORAGE_UNREADY_MS', 0))  # the timeout is the limit
+READY_LLM_DEGRADED_MS = float(os.environ.get('READY_LLM_DEGRADED_MS', 1500))
+READY_LOOP_LAG_DEGRADED_MS = float(os.environ.get('READY_LOOP_LAG_DEGRADED_MS', 100))
+READY_LOOP_LAG_UNREADY_MS = float(os.environ.get('READY_LOOP_LAG_UNREADY_MS', 1000))
+READY_LLM_QUEUE_DEGRADED = int(os.environ.get('READY_LLM_QUEUE_DEGRADED', 20))  # calls waiting for a slot
+READY_LLM_QUEUE_UNREADY = int(os.environ.get('READY_LLM_QUEUE_UNREADY', 0))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global readiness, loop_lag
+    startup["started_at"] = time.monotonic()
+    readiness, loop_lag = create_readiness(), LoopLagMonitor()
+    loop_lag_task = asyncio.create_task(loop_lag.run())
+    warmup_task = asyncio.create_task(warm_up_integrations()) if WARMUP_INTEGRATIONS else None
+    flusher_task = asyncio.create_task(last_used_flusher())
+    retention_task = asyncio.create_task(usage_retention_loop()) if USAGE_RAW_RETENTION_DAYS > 0 else None
+    archive_task = None
+    if ARCHIVE_AFTER_DAYS > 0 and isinstance(storage.conversations, ArchivedConversations):
+        archive_task = asyncio.create_task(archive_loop())
+    cache_task = None
+    if semantic_cache and SEMANTIC_CACHE_PATH:
+        await load_semantic_cache()
+        cache_task = asyncio.create_task(semantic_cache_saver())
+    stream_tasks = [asyncio.create_task(listener.run()) for listener in start_firebase_listeners()]
+    email_filter_task = asyncio.create_task(email_filter_loop()) if EMAIL_FILTER else None
+    title_task = asyncio.create_task(title_worker.run()) if TITLE_GENERATION else None
+    backfill_task = asyncio.create_task(backfill_meta_index()) if TITLE_BACKFILL else None
+    yield
+    loop_lag_task.cancel()
+    if title_task:
+        title_task.cancel()
+    if backfill_task and not backfill_task.done():
+        backfill_task.cancel()
+    for task in stream_tasks:
+        task.cancel()
+    if email_filter_task:
+        email_filter_task.cancel()
+    if retention_task:
+        retention_task.cancel()
+    if archive_task:
+        archive_task.cancel()
+    if cache_task:
+        cache_task.cancel()
+        await save_semantic_cache()
+    if warmup_task and not warmup_task.done():
+        warmup_task.cancel()
+    flusher_task.cancel()
+    try:
+        await flush_api_key_last_used()
+    except Exception as e:
+        logger.error(f"Error flushing api key last_used on shutdown: {e}")
+    await compactor.close()
+    search_index.close()
+    await llm.close()
+    await storage.close()
+    await state.close()
+    if traffic_log:
+        traffic_log.flush()
+
 # Create the main app
-app = FastAPI(title="Brainyx API")
+app = FastAPI(title="Brainyx API", default_response_class=DefaultResponse, lifespan=lifespan)
 
 # Create router with /api prefix
 api_router = APIRouter(prefix="/api")
@@ -46,52 +275,160 @@ security = HTTPBearer()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Shared state backend
+state = create_state_backend(STATE_BACKEND_URL)
+if WEB_CONCURRENCY > 1 and not state.shared:
+    # Payment idempotency, rate limits, session revocation and locks would each hold per worker
+    raise RuntimeError("WEB_CONCURRENCY > 1 requires a shared state backend: set STATE_BACKEND_URL=redis://...")
+
 # ============ PLANS CONFIG ============
 PLANS = {
-    "promocion": {"name": "Plan Promoción", "price": 250, "credits": 50000, "description": "Ideal para empezar"},
-    "estandar": {"name": "Plan Estándar", "price": 400, "credits": 100000, "description": "Para uso regular"},
-    "premium": {"name": "Plan Premium", "price": 500, "credits": 200000, "description": "Uso ilimitado profesional"}
+    "promocion": {"name": "Plan Promoción", "price": 250, "credits": 50000, "description": "Ideal para empezar",
+                  "model": LLM_MODEL, "models": [LLM_FAST_MODEL, LLM_MODEL]},
+    "estandar": {"name": "Plan Estándar", "price": 400, "credits": 100000, "description": "Para uso regular",
+                 "model": LLM_MODEL, "models": [LLM_FAST_MODEL, LLM_MODEL]},
+    "premium": {"name": "Plan Premium", "price": 500, "credits": 200000, "description": "Uso ilimitado profesional",
+                "model": LLM_MODEL, "models": [LLM_FAST_MODEL, LLM_MODEL, LLM_TOP_MODEL]}
 }
+# Users who never bought a plan get the fast model by default
+FREE_PLAN = {"name": "Plan Gratis", "model": LLM_FAST_MODEL, "models": [LLM_FAST_MODEL, LLM_MODEL]}
+
+PLANS_ETAG = etag(PLANS)
+
+def plan_for(user: dict) -> dict:
+    return PLANS.get(user.get("plan")) or FREE_PLAN
+
+# ============ STORAGE ============
+
+# The Firebase backend goes through one pooled client with deadlines, retries, a
+# circuit breaker, optional hedged reads and single-flight (see firebase_client.py).
+# When Firebase is unavailable it raises FirebaseUnavailable (HTTP 503).
+firebase = FirebaseClient(
+    FIREBASE_DB_URL,
+    read_timeout=FIREBASE_READ_TIMEOUT,
+    write_timeout=FIREBASE_WRITE_TIMEOUT,
+    max_retries=FIREBASE_MAX_RETRIES,
+    hedge_after=FIREBASE_HEDGE_AFTER_MS / 1000,
+    breaker=CircuitBreaker(FIREBASE_BREAKER_THRESHOLD, FIREBASE_BREAKER_RESET_SECONDS),
+    singleflight_nodes=FIREBASE_SINGLEFLIGHT_PATHS,
+    auth=FIREBASE_AUTH
+)
 
-# ============ FIREBASE HELPER FUNCTIONS ============
+# Handlers go through the repositories, whatever the backend (see storage/)
+storage = create_storage(STORAGE_URL, firebase, archive=ArchiveStore(ARCHIVE_PATH) if ARCHIVE_PATH else None)
+
+# ============ INTEGRATIONS (lazy) ============
+# emergentintegrations pulls in the LLM and Stripe SDKs, which dominate import time.
+# They are loaded on first use so workers can answer /api/health immediately.
+
+@lru_cache(maxsize=None)
+def llm_integration():
+    from emergentintegrations.llm.chat import LlmChat, UserMessage
+    return LlmChat, UserMessage
+
+@lru_cache(maxsize=None)
+def stripe_integration():
+    from emergentintegrations.payments.stripe.checkout import StripeCheckout, CheckoutSessionRequest
+    return StripeCheckout, CheckoutSessionRequest
+
+def create_llm_client() -> LlmClient:
+    if LLM_PROVIDER == "anthropic":
+        return LlmClient(AnthropicProvider(ANTHROPIC_API_KEY, base_url=ANTHROPIC_BASE_URL,
+                                           prompt_caching=LLM_PROMPT_CACHING), max_concurrency=LLM_MAX_CONCURRENCY)
+    return LlmClient(EmergentProvider(EMERGENT_LLM_KEY, loader=llm_integration), max_concurrency=LLM_MAX_CONCURRENCY)
+
+llm = create_llm_client()
+
+meter = Meter(expected_output_tokens=METERING_EXPECTED_OUTPUT_TOKENS)
+
+compactor = Compactor(
+    llm,
+    model=LLM_MODEL,
+    load=lambda conversation_id: storage.conversations.get(conversation_id),
+    store=lambda conversation_id, summary: storage.conversations.set_summary(conversation_id, summary),
+    state=state,
+    trigger_tokens=COMPACTION_TRIGGER_TOKENS,
+    keep_messages=COMPACTION_KEEP_MESSAGES,
+    max_messages=CHAT_HISTORY_MESSAGES,
+    window_step=CHAT_HISTORY_STEP,
+    enabled=CONTEXT_COMPACTION,
+)
 
-async def firebase_get(path: str):
-    async with httpx.AsyncClient() as client:
-        response = await client.get(f"{FIREBASE_DB_URL}/{path}.json")
-        if response.status_code == 200:
-            return response.json()
-        return None
+title_worker = TitleWorker(
+    llm,
+    model=TITLE_MODEL,
+    load=lambda conversation_id: storage.conversations.get(conversation_id),
+    store=lambda conversation, meta: storage.conversations.set_meta(conversation, meta),
+    state=state,
+    batch_size=TITLE_BATCH_SIZE,
+    batch_wait=TITLE_BATCH_WAIT_SECONDS,
+    max_queue=TITLE_MAX_QUEUE,
+    llm_calls_per_minute=TITLE_LLM_CALLS_PER_MINUTE,
+    refresh_messages=TITLE_REFRESH_MESSAGES,
+    enabled=TITLE_GENERATION,
+)
 
-async def firebase_set(path: str, data: dict):
-    async with httpx.AsyncClient() as client:
-        response = await client.put(f"{FIREBASE_DB_URL}/{path}.json", json=data)
-        return response.status_code == 200
+search_index = SearchIndex(SEARCH_INDEX_PATH, cache_kb=SEARCH_CACHE_KB)
 
-async def firebase_push(path: str, data: dict):
-    async with httpx.AsyncClient() as client:
-        response = await client.post(f"{FIREBASE_DB_URL}/{path}.json", json=data)
-        if response.status_code == 200:
-            return response.json().get('name')
-        return None
+semantic_cache = SemanticCache(threshold=SEMANTIC_CACHE_THRESHOLD, max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+                               ttl_seconds=SEMANTIC_CACHE_TTL_SECONDS) if SEMANTIC_CACHE else None
 
-async def firebase_update(path: str, data: dict):
-    async with httpx.AsyncClient() as client:
-        response = await client.patch(f"{FIREBASE_DB_URL}/{path}.json", json=data)
-        return response.status_code == 200
-
-async def firebase_delete(path: str):
-    async with httpx.AsyncClient() as client:
-        response = await client.delete(f"{FIREBASE_DB_URL}/{path}.json")
-        return response.status_code == 200
-
-async def firebase_find_by_field(collection: str, field: str, value: str):
-    data = await firebase_get(collection)
-    if data:
-        for doc_id, doc in data.items():
-            if doc.get(field) == value:
-                doc['_firebase_id'] = doc_id
-                return doc
-    return None
+startup = {"started_at": time.monotonic(), "warmup": "skipped"}
+
+async def warm_up_integrations():
+    """Import the integrations off the event loop; /api/ready reports progress"""
+    startup["warmup"] = "pending"
+    began = time.perf_counter()
+    try:
+        await asyncio.to_thread(llm_integration)
+        await asyncio.to_thread(stripe_integration)
+        startup["warmup"] = "done"
+        logger.info(f"Integrations warmed up in {(time.perf_counter() - began) * 1000:.0f} ms")
+    except Exception as e:
+        startup["warmup"] = "failed"
+        logger.error(f"Error warming up integrations: {e}")
+
+def integrations_loaded() -> dict:
+    return {
+        "llm": llm_integration.cache_info().currsize > 0,
+        "stripe": stripe_integration.cache_info().currsize > 0
+    }
+
+# ---- Readiness probes ----
+
+loop_lag = LoopLagMonitor()
+readiness: Optional[Readiness] = None
+
+def create_readiness() -> Readiness:
+    """Probes look up storage/state/llm when they run, so they follow whatever the globals point at.
+    A failed LLM probe only degrades: the rest of the API still works, and an outage of the shared
+    provider must not pull every instance out of rotation at once."""
+    probe = partial(Probe, every=READY_PROBE_INTERVAL_SECONDS, timeout=READY_PROBE_TIMEOUT_SECONDS)
+    return Readiness([
+        # The storage client ends the ping at the probe timeout itself; cancelling a Firebase request
+        # from outside would cut short its breaker probe. The probe's own timeout is only a backstop
+        probe("storage", lambda: timed(partial(storage.ping, timeout=READY_PROBE_TIMEOUT_SECONDS)),
+              timeout=READY_PROBE_TIMEOUT_SECONDS + 1, degraded=READY_STORAGE_DEGRADED_MS,
+              unready=READY_STORAGE_UNREADY_MS),
+        probe("state", lambda: timed(state.ping), degraded=READY_STORAGE_DEGRADED_MS,
+              unready=READY_STORAGE_UNREADY_MS),
+        probe("llm", lambda: timed(llm.ping), every=READY_LLM_PROBE_INTERVAL_SECONDS,
+              degraded=READY_LLM_DEGRADED_MS, on_failure="degraded"),
+        probe("event_loop", reading(lambda: loop_lag.lag_ms), every=0,
+              degraded=READY_LOOP_LAG_DEGRADED_MS, unready=READY_LOOP_LAG_UNREADY_MS),
+        probe("llm_queue", reading(lambda: llm.waiting), every=0,
+              degraded=READY_LLM_QUEUE_DEGRADED, unready=READY_LLM_QUEUE_UNREADY),
+    ])
+
+def queue_depths() -> dict:
+    return {
+        "llm_in_flight": llm.in_flight,
+        "llm_waiting": llm.waiting,
+        "ws_connections": ws_connections.total,
+        "compactions": compactor.running,
+        "titles_queued": title_worker.queued,
+        "api_key_last_used_pending": len(_pending_last_used)
+    }
 
 # ============ MODELS ============
 
@@ -172,6 +509,8 @@ class PlanPurchase(BaseModel):
 class BrainyxAPIRequest(BaseModel):
     message: str = Field(..., min_length=1)
     system_prompt: Optional[str] = None
+    model: Optional[str] = None  # defaults to the plan's model
+    semantic_cache: bool = False  # reuse the answer to a near-identical earlier prompt
 
 class StripeCheckoutRequest(BaseModel):
     plan_id: str
@@ -198,22 +537,40 @@ def hash_password(password: str) -> str:
 def verify_password(password: str, hashed: str) -> bool:
     return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
-def create_token(user_id: str) -> str:
+def create_token(user: dict) -> str:
     payload = {
-        "sub": user_id,
+        "sub": user["id"],
+        # Session claims: a session_version bump in the user doc revokes every older token
+        "sv": user.get("session_version", 0),
         "exp": datetime.now(timezone.utc) + timedelta(hours=JWT_EXPIRATION_HOURS),
         "iat": datetime.now(timezone.utc)
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
+# Verified claims keyed by sha256(token), in LRU order. Only successful
+# verifications are cached and entries are dropped once `exp` has passed.
+_token_cache: "OrderedDict[bytes, dict]" = OrderedDict()
+
 def decode_token(token: str) -> dict:
+    digest = hashlib.sha256(token.encode('utf-8')).digest()
+    cached = _token_cache.get(digest)
+    if cached is not None:
+        if cached.get("exp", float("inf")) > time.time():
+            _token_cache.move_to_end(digest)
+            return cached
+        del _token_cache[digest]
+        raise HTTPException(status_code=401, detail="Token expirado")
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        return payload
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expirado")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Token inválido")
+    if TOKEN_CACHE_SIZE > 0:
+        _token_cache[digest] = payload
+        if len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+    return payload
 
 def generate_api_key() -> str:
     return f"byx_{secrets.token_hex(32)}"
@@ -221,21 +578,84 @@ def generate_api_key() -> str:
 def hash_api_key(key: str) -> str:
     return bcrypt.hashpw(key.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
 
+# ---- Session snapshots ----
+# The shared state keeps, per user, the current session version (`sv:{id}`) and a
+# snapshot of the user doc (`user:{id}`) so cheap endpoints skip the `users` scan.
+# Every user write goes through update_user(), which bumps the user's generation
+# (`ug:{id}`) and drops the snapshot. A snapshot is only written when missing, by a
+# reader whose generation (read before it loaded the doc) is still current, so a
+# request racing an update cannot put the old doc back.
+
+async def session_generation(user_id: str) -> Optional[str]:
+    return await state.get(f"ug:{user_id}")
+
+async def invalidate_user_session(user_id: str):
+    await state.incr(f"ug:{user_id}", ttl=JWT_EXPIRATION_HOURS * 3600)
+    await state.delete(f"user:{user_id}")
+
+async def cache_user_session(user: dict, generation: Optional[str]):
+    """Snapshot `user` unless a snapshot exists or the user changed since `generation`"""
+    snapshot = {k: v for k, v in user.items() if k != "password_hash"}
+    if not await state.add_json(f"user:{user['id']}", snapshot, ttl=user_snapshot_ttl()):
+        return
+    # An update landing meanwhile bumped the generation before dropping the snapshot
+    if await session_generation(user["id"]) != generation:
+        await state.delete(f"user:{user['id']}")
+        return
+    version = user.get("session_version", 0)
+    await state.set(f"sv:{user['id']}", str(version), ttl=JWT_EXPIRATION_HOURS * 3600)
+
+def user_snapshot_ttl() -> int:
+    mirror = getattr(storage, "mirrors", {}).get("users")
+    return USER_SNAPSHOT_STREAM_TTL_SECONDS if mirror is not None and mirror.live else USER_SNAPSHOT_TTL_SECONDS
+
+async def update_user(user: dict, fields: dict) -> bool:
+    """Write user fields and invalidate the cached session snapshot"""
+    ok = await storage.users.update(user, fields)
+    await invalidate_user_session(user["id"])
+    return ok
+
+async def revoke_user_sessions(user: dict) -> int:
+    """Bump the session version so every token issued before now is rejected"""
+    version = user.get("session_version", 0) + 1
+    await update_user(user, {"session_version": version, "updated_at": datetime.now(timezone.utc).isoformat()})
+    await state.set(f"sv:{user['id']}", str(version), ttl=JWT_EXPIRATION_HOURS * 3600)
+    return version
+
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
     payload = decode_token(credentials.credentials)
     user_id = payload.get("sub")
-    user = await firebase_find_by_field("users", "id", user_id)
+    generation = await session_generation(user_id)
+    user = await storage.users.get(user_id)
     if not user:
         raise HTTPException(status_code=401, detail="Usuario no encontrado")
+    if payload.get("sv", 0) < user.get("session_version", 0):
+        raise HTTPException(status_code=401, detail="Sesión revocada")
+    await cache_user_session(user, generation)
     return user
 
+async def get_session_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Like get_current_user, but served from the session snapshot when the token carries
+    a current session version. Only for read-only endpoints that tolerate a short TTL."""
+    payload = decode_token(credentials.credentials)
+    user_id = payload.get("sub")
+    token_version = payload.get("sv")
+    if token_version is not None:
+        current_version = await state.get(f"sv:{user_id}")
+        if current_version is not None and token_version < int(current_version):
+            raise HTTPException(status_code=401, detail="Sesión revocada")
+        snapshot = await state.get_json(f"user:{user_id}")
+        if snapshot and snapshot.get("session_version", 0) == token_version:
+            return snapshot
+    return await get_current_user(credentials)
+
 async def get_user_by_api_key(x_api_key: str = Header(..., alias="X-API-Key")):
     """Validate API Key and return user"""
     if not x_api_key or not x_api_key.startswith("byx_"):
         raise HTTPException(status_code=401, detail="API Key inválida")
     
     # Find API key in database
-    api_keys = await firebase_get("api_keys")
+    api_keys = await storage.api_keys.all()
     if not api_keys:
         raise HTTPException(status_code=401, detail="API Key no encontrada")
     
@@ -247,7 +667,7 @@ async def get_user_by_api_key(x_api_key: str = Header(..., alias="X-API-Key")):
                         raise HTTPException(status_code=401, detail="API Key desactivada")
                     
                     # Get user
-                    user = await firebase_find_by_field("users", "id", key_data["user_id"])
+                    user = await storage.users.get(key_data["user_id"])
                     if not user:
                         raise HTTPException(status_code=401, detail="Usuario no encontrado")
                     
@@ -255,18 +675,398 @@ async def get_user_by_api_key(x_api_key: str = Header(..., alias="X-API-Key")):
                     if user.get("credits", 0) <= 0:
                         raise HTTPException(status_code=402, detail="Saldo agotado. Recarga tu plan.")
                     
-                    # Update last used
-                    await firebase_update(f"api_keys/{key_id}", {
-                        "last_used": datetime.now(timezone.utc).isoformat()
-                    })
+                    # Rate limit per key, shared across workers
+                    if await rate_limit_hit(state, f"api:{key_id}", API_RATE_LIMIT_PER_MINUTE, 60):
+                        raise HTTPException(status_code=429, detail="Demasiadas solicitudes. Intenta más tarde.")
+                    
+                    # Update last used (buffered, flushed in batches)
+                    touch_api_key(key_id)
                     
                     user["_api_key_id"] = key_id
                     return user
+            except HTTPException:
+                raise
             except Exception:
                 continue
     
     raise HTTPException(status_code=401, detail="API Key no encontrada")
 
+# ---- API key last_used buffering ----
+# Recording a timestamp is not worth a storage round trip on every /v1/chat call.
+# Keys used since the last flush are written together in one batch.
+_pending_last_used: dict = {}
+
+def touch_api_key(key_id: str):
+    _pending_last_used[key_id] = datetime.now(timezone.utc).isoformat()
+    metrics.gauge("api_key_last_used_pending", len(_pending_last_used))
+
+async def flush_api_key_last_used() -> int:
+    if not _pending_last_used:
+        return 0
+    batch = dict(_pending_last_used)
+    _pending_last_used.clear()
+    began = time.perf_counter()
+    try:
+        await storage.api_keys.touch(batch)
+    except Exception:
+        # Put the batch back unless a newer timestamp arrived meanwhile
+        for key_id, ts in batch.items():
+            _pending_last_used.setdefault(key_id, ts)
+        metrics.incr("api_key_last_used_flush_errors")
+        raise
+    metrics.observe("api_key_last_used_flush_ms", (time.perf_counter() - began) * 1000)
+    metrics.incr("api_key_last_used_flushed", len(batch))
+    metrics.gauge("api_key_last_used_pending", len(_pending_last_used))
+    return len(batch)
+
+async def last_used_flusher():
+    while True:
+        await asyncio.sleep(API_KEY_LAST_USED_FLUSH_SECONDS)
+        try:
+            await flush_api_key_last_used()
+        except Exception as e:
+            logger.error(f"Error flushing api key last_used: {e}")
+
+# ---- Firebase change stream ----
+# Writes from other instances (or the Stripe webhook on another worker) reach this worker as
+# stream events; the mirrors apply them and these handlers drop what was cached from before.
+
+stream_listeners: List[FirebaseListener] = []
+
+async def users_changed(changes: list):
+    for _, before, after in changes:
+        doc = after or before
+        if not doc or not doc.get("id"):
+            continue
+        await invalidate_user_session(doc["id"])
+        if before is None and email_filter is not None and doc.get("email"):
+            email_filter.add(doc["email"].lower())
+        version = (after or {}).get("session_version", 0)
+        if version > (before or {}).get("session_version", 0):
+            await state.set(f"sv:{doc['id']}", str(version), ttl=JWT_EXPIRATION_HOURS * 3600)
+        metrics.incr("firebase_stream_invalidations", path="users")
+
+async def api_keys_changed(changes: list):
+    for key_id, _, after in changes:
+        if after is None or not after.get("is_active", True):
+            _pending_last_used.pop(key_id, None)
+            if semantic_cache:
+                semantic_cache.drop_scopes(key_id)
+            metrics.incr("firebase_stream_invalidations", path="api_keys")
+
+# ---- Email filter and login throttling ----
+# Each worker builds its own filter from storage. A registration made on another worker reaches it
+# through the users stream or, without one, the shared `registered:` marker kept past the next rebuild.
+
+email_filter: Optional[BloomFilter] = None
+
+async def rebuild_email_filter():
+    global email_filter
+    began = time.perf_counter()
+    emails = await storage.users.emails()
+    # ~10 us per email: a large user base is hashed off the event loop
+    email_filter = await asyncio.to_thread(BloomFilter.of, [email.lower() for email in emails], EMAIL_FILTER_ERROR_RATE)
+    metrics.observe("email_filter_rebuild_ms", (time.perf_counter() - began) * 1000)
+    report_email_filter()
+
+async def email_filter_loop():
+    while True:
+        try:
+            await rebuild_email_filter()
+        except Exception as e:
+            logger.error(f"Error building the email filter: {e}")
+        await asyncio.sleep(EMAIL_FILTER_REBUILD_SECONDS)
+
+def report_email_filter():
+    if email_filter is not None:
+        metrics.gauge("email_filter_items", email_filter.count)
+        metrics.gauge("email_filter_bytes", email_filter.size_bytes)
+        metrics.gauge("email_filter_fp_rate", round(email_filter.false_positive_rate(), 6))
+
+async def remember_email(email: str):
+    if email_filter is None:
+        return
+    email_filter.add(email)
+    await state.set(f"registered:{email}", "1", ttl=2 * EMAIL_FILTER_REBUILD_SECONDS)
+
+async def find_user_by_email(email: str) -> Optional[dict]:
+    """storage.users.get_by_email, skipped for emails the filter rules out"""
+    if email_filter is None:
+        return await storage.users.get_by_email(email)
+    if email not in email_filter and not await state.get(f"registered:{email}"):
+        metrics.incr("email_filter_lookups", result="skipped")
+        return None
+    user = await storage.users.get_by_email(email)
+    metrics.incr("email_filter_lookups", result="found" if user else "false_positive")
+    return user
+
+def client_ip(request: Request) -> str:
+    if FORWARDED_FOR_HOPS > 0:
+        forwarded = [ip.strip() for ip in request.headers.get("x-forwarded-for", "").split(",") if ip.strip()]
+        if forwarded:
+            return forwarded[-min(FORWARDED_FOR_HOPS, len(forwarded))]
+    return request.client.host if request.client else "unknown"
+
+async def throttle_login(request: Request, email: str):
+    """Reject a login before any lookup or bcrypt work when its IP or email is over the limit"""
+    reason = None
+    if await rate_limit_hit(state, f"login-ip:{client_ip(request)}", LOGIN_ATTEMPTS_PER_IP_PER_MINUTE, 60):
+        reason = "ip"
+    elif await rate_limit_reached(state, f"login-fail:{email}", LOGIN_FAILURES_PER_EMAIL, LOGIN_FAILURE_WINDOW_SECONDS):
+        reason = "email"
+    if reason:
+        metrics.incr("login_throttled", reason=reason)
+        raise HTTPException(status_code=429, detail="Demasiados intentos. Intenta más tarde.")
+
+def start_firebase_listeners() -> List[FirebaseListener]:
+    if not isinstance(storage, FirebaseStorage):
+        return []
+    handlers = {"users": users_changed, "api_keys": api_keys_changed}
+    stream_listeners[:] = [
+        FirebaseListener(storage.client, storage.mirror(path), on_change=handlers.get(path),
+                         stall_timeout=FIREBASE_STREAM_STALL_SECONDS)
+        for path in FIREBASE_STREAM_PATHS
+    ]
+    return stream_listeners
+
+# ---- Model routing ----
+
+def model_for(user: dict, requested: Optional[str] = None) -> ModelSpec:
+    try:
+        return resolve_model(MODEL_CATALOG, plan_for(user), requested)
+    except KeyError:
+        raise HTTPException(status_code=400, detail=f"Modelo no disponible: {requested}")
+    except ModelNotAllowed:
+        raise HTTPException(status_code=403, detail="Tu plan no incluye este modelo")
+
+async def call_model(spec: ModelSpec, **kwargs) -> LlmResult:
+    began = time.perf_counter()
+    try:
+        result = await asyncio.wait_for(llm.complete(model=spec.id, **kwargs), spec.timeout)
+    except Exception as e:
+        metrics.incr("llm_model_errors", model=spec.id, kind="overloaded" if is_overloaded(e) else "error")
+        raise
+    metrics.incr("llm_model_calls", model=spec.id)
+    metrics.observe("llm_model_latency_ms", (time.perf_counter() - began) * 1000, model=spec.id)
+    return result
+
+async def complete_routed(spec: ModelSpec, **kwargs) -> tuple:
+    """(model that answered, result): the primary, or its fallback when the primary
+    is overloaded or times out"""
+    try:
+        return spec, await call_model(spec, **kwargs)
+    except Exception as e:
+        if not spec.fallback or not is_overloaded(e):
+            raise
+        fallback = MODEL_CATALOG[spec.fallback]
+        logger.warning(f"Model {spec.id} unavailable ({type(e).__name__}), falling back to {fallback.id}")
+        metrics.incr("llm_fallbacks", model=spec.id, fallback=fallback.id)
+        return fallback, await call_model(fallback, **kwargs)
+
+async def stream_routed(spec: ModelSpec, **kwargs):
+    """Streaming complete_routed: yields (model, text delta) pairs and finally (model, LlmResult).
+    The fallback is only tried when the primary fails before its first delta."""
+    attempt = spec
+    while True:
+        began = time.perf_counter()
+        started = False
+        events = llm.stream(model=attempt.id, **kwargs)
+        try:
+            while True:
+                try:
+                    item = await asyncio.wait_for(events.__anext__(), attempt.timeout)
+                except StopAsyncIteration:
+                    break
+                started = True
+                yield attempt, item
+        except Exception as e:
+            metrics.incr("llm_model_errors", model=attempt.id, kind="overloaded" if is_overloaded(e) else "error")
+            if started or not attempt.fallback or not is_overloaded(e):
+                raise
+            fallback = MODEL_CATALOG[attempt.fallback]
+            logger.warning(f"Model {attempt.id} unavailable ({type(e).__name__}), falling back to {fallback.id}")
+            metrics.incr("llm_fallbacks", model=attempt.id, fallback=fallback.id)
+            attempt = fallback
+            continue
+        finally:
+            await events.aclose()
+        metrics.incr("llm_model_calls", model=attempt.id)
+        metrics.observe("llm_model_latency_ms", (time.perf_counter() - began) * 1000, model=attempt.id)
+        return
+
+# ---- Metering ----
+
+def admit(user: dict, spec: ModelSpec, system_prompt: str, history: List[dict], message: str) -> Preflight:
+    """Refuse a call the user cannot pay for, judged on a local token estimate"""
+    began = time.perf_counter()
+    estimate = meter.preflight(spec, prompt_chars(system_prompt, history, message))
+    metrics.observe("metering_preflight_us", (time.perf_counter() - began) * 1e6)
+    if user.get("credits", 0) < estimate.credits:
+        metrics.incr("metering_rejected", model=spec.id)
+        raise HTTPException(status_code=402, detail="Saldo insuficiente para esta solicitud")
+    return estimate
+
+def meter_call(spec: ModelSpec, result: Optional[LlmResult], estimate: Preflight) -> Charge:
+    """What the call costs, from the provider's token counts when it gave them"""
+    charge = meter.charge(spec, result.usage if result else None, estimate)
+    metrics.incr("metering_credits", charge.credits, model=spec.id)
+    if result and not result.usage.estimated and result.usage.total_input_tokens:
+        actual = result.usage.total_input_tokens
+        metrics.observe("metering_estimate_error_pct", abs(estimate.input_tokens - actual) / actual * 100,
+                        model=spec.id)
+    return charge
+
+# ---- Semantic cache ----
+
+async def load_semantic_cache():
+    try:
+        loaded = await asyncio.to_thread(semantic_cache.load, SEMANTIC_CACHE_PATH)
+        metrics.gauge("semantic_cache_entries", semantic_cache.entries)
+        logger.info(f"Semantic cache: {loaded} entries loaded")
+    except Exception as e:
+        logger.error(f"Error loading semantic cache: {e}")
+
+async def save_semantic_cache():
+    if not semantic_cache.dirty:
+        return
+    try:
+        await asyncio.to_thread(semantic_cache.save, SEMANTIC_CACHE_PATH)
+    except Exception as e:
+        logger.error(f"Error saving semantic cache: {e}")
+
+async def semantic_cache_saver():
+    while True:
+        await asyncio.sleep(SEMANTIC_CACHE_SAVE_SECONDS)
+        await save_semantic_cache()
+
+# ---- Client disconnects ----
+
+class ClientDisconnected(Exception):
+    pass
+
+async def unless_disconnected(request: Request, call: Awaitable, endpoint: str, prompt_tokens: int = 0):
+    """Await an upstream call, cancelling it if the client goes away first.
+    Credits are only deducted after a response exists, so a cancelled call is never charged."""
+    task = asyncio.ensure_future(call)
+    began = time.perf_counter()
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_SECONDS)
+            if done:
+                return task.result()
+            if await request.is_disconnected():
+                break
+    finally:
+        if not task.done():
+            task.cancel()
+            # Wait for the cancellation to land so the concurrency slot is free when we return
+            await asyncio.gather(task, return_exceptions=True)
+    metrics.incr("llm_cancelled", endpoint=endpoint)
+    metrics.incr("llm_cancelled_prompt_tokens", prompt_tokens, endpoint=endpoint)
+    metrics.observe("llm_cancelled_after_ms", (time.perf_counter() - began) * 1000, endpoint=endpoint)
+    raise ClientDisconnected()
+
+def prompt_size(system_prompt: str, history: List[dict], message: str) -> int:
+    return estimate_tokens(system_prompt) + sum(estimate_tokens(m.get("content", "")) for m in history) + \
+        estimate_tokens(message)
+
+# ---- Conversation search ----
+
+async def index_messages(user_id: str, conversation_id: str, messages: List[dict]):
+    """Add messages to the search index; search is best effort and never fails the caller"""
+    began = time.perf_counter()
+    try:
+        await asyncio.to_thread(search_index.add_messages, user_id, conversation_id, messages)
+        metrics.observe("search_index_ms", (time.perf_counter() - began) * 1000)
+    except Exception as e:
+        logger.error(f"Error indexing messages: {e}")
+
+async def ensure_search_backfill(user_id: str):
+    """Index the conversations a user had before the index existed, once"""
+    if await asyncio.to_thread(search_index.is_indexed, user_id):
+        return
+    for conv_id, conv in await storage.conversations.list_for_user(user_id):
+        if is_stub(conv):
+            conv = await storage.conversations.read_archived(conv_id) or conv
+        await asyncio.to_thread(search_index.add_messages, user_id, conv_id, conv.get("messages") or [])
+    await asyncio.to_thread(search_index.mark_indexed, user_id, datetime.now(timezone.utc).isoformat())
+    metrics.incr("search_backfills")
+
+async def claim_payment(session_id: str) -> bool:
+    """Idempotency guard so a paid session is credited once, even when status polling
+    and the webhook race on different workers"""
+    return await state.add(f"payment:{session_id}", datetime.now(timezone.utc).isoformat(), ttl=PAYMENT_CLAIM_TTL_SECONDS)
+
+async def release_payment(session_id: str):
+    await state.delete(f"payment:{session_id}")
+
+async def record_usage(user: dict, credits_used: int, result: Optional[LlmResult] = None,
+                       source: str = "api", api_key_id: Optional[str] = None, charge: Optional[Charge] = None):
+    """Log one usage record, with the token and credit breakdown of the LLM call when there was one"""
+    record = {
+        "user_id": user["id"],
+        "credits_used": credits_used,
+        "source": source,
+        "timestamp": datetime.now(timezone.utc).isoformat()
+    }
+    if api_key_id:
+        record["api_key_id"] = api_key_id
+    if result:
+        record.update(result.usage.as_record())
+        record.update({"provider": result.provider, "model": result.model, "latency_ms": round(result.latency_ms, 1)})
+    if charge:
+        record.update(charge.as_record())
+    try:
+        await storage.usage.record(str(uuid.uuid4()), record, datetime.now(timezone.utc))
+    except Exception as e:
+        # The answer is already out and the credits deducted; a lost usage row must not turn that into an error
+        metrics.incr("usage_record_failures", source=source)
+        logger.error(f"Error recording usage for user {user['id']}: {e}")
+
+async def usage_retention_loop():
+    """Prune raw usage events past the retention window; one worker at a time"""
+    while True:
+        await asyncio.sleep(USAGE_RETENTION_INTERVAL_SECONDS)
+        try:
+            lock = StateLock(state, "usage-retention", ttl=USAGE_RETENTION_INTERVAL_SECONDS)
+            if await lock.acquire():
+                cutoff = datetime.now(timezone.utc) - timedelta(days=USAGE_RAW_RETENTION_DAYS)
+                began = time.perf_counter()
+                deleted = await storage.usage.purge_before(cutoff.isoformat())
+                metrics.incr("usage_events_purged", deleted)
+                metrics.observe("usage_retention_ms", (time.perf_counter() - began) * 1000)
+                # The lock is left to expire so other workers skip this interval
+        except Exception as e:
+            logger.error(f"Error in usage retention: {e}")
+
+async def archive_conversations() -> int:
+    cutoff = datetime.now(timezone.utc) - timedelta(days=ARCHIVE_AFTER_DAYS)
+    began = time.perf_counter()
+    archived = await storage.conversations.archive_inactive(cutoff.isoformat(), ARCHIVE_BATCH_SIZE)
+    metrics.observe("archive_run_ms", (time.perf_counter() - began) * 1000)
+    return archived
+
+async def archive_loop():
+    """Move dormant conversations to the archive; one worker at a time"""
+    while True:
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+        try:
+            lock = StateLock(state, "conversation-archive", ttl=ARCHIVE_INTERVAL_SECONDS)
+            if await lock.acquire():
+                await archive_conversations()
+        except Exception as e:
+            logger.error(f"Error archiving conversations: {e}")
+
+async def backfill_meta_index():
+    """Listings for the conversations stored before the index existed; one worker at a time"""
+    try:
+        lock = StateLock(state, "conversation-meta-backfill", ttl=3600)
+        if await lock.acquire():
+            written = await storage.conversations.rebuild_meta_index()
+            logger.info(f"Conversation listing index rebuilt: {written} conversations")
+    except Exception as e:
+        logger.error(f"Error rebuilding the conversation listing index: {e}")
+
 def format_user_response(user: dict) -> UserResponse:
     return UserResponse(
         id=user["id"],
@@ -280,6 +1080,77 @@ def format_user_response(user: dict) -> UserResponse:
         plan=user.get("plan")
     )
 
+# Payload builders for data we construct ourselves. They project exactly the
+# fields of the matching response model so the handler can skip re-validation.
+
+def user_payload(user: dict) -> dict:
+    return {
+        "id": user["id"],
+        "name": user["name"],
+        "email": user["email"],
+        "masked_email": mask_email(user["email"]),
+        "created_at": user["created_at"],
+        "system_prompt": user.get("system_prompt"),
+        "profile_image": user.get("profile_image"),
+        "credits": user.get("credits", 0),
+        "plan": user.get("plan")
+    }
+
+def message_payload(msg: dict) -> dict:
+    return {
+        "id": msg["id"],
+        "role": msg["role"],
+        "content": msg["content"],
+        "timestamp": msg["timestamp"]
+    }
+
+def conversation_payload(conv: dict, conv_id: Optional[str] = None) -> dict:
+    payload = {
+        "id": conv.get("id", conv_id),
+        "user_id": conv["user_id"],
+        "messages": [message_payload(m) for m in conv.get("messages") or [] if m],
+        "created_at": conv["created_at"],
+        "updated_at": conv["updated_at"]
+    }
+    if is_stub(conv):
+        # Listed without its messages; opening the conversation restores them
+        payload["archived"] = True
+        payload["message_count"] = conv["archived"]["messages"]
+    if conv.get("meta"):
+        payload["title"] = conv["meta"]["title"]
+        payload["preview"] = conv["meta"]["preview"]
+    return payload
+
+def conversation_listing(listing: dict, conv_id: str) -> dict:
+    """A conversation in the light list: no messages, only what the sidebar shows"""
+    meta = listing.get("meta") or {}
+    return {
+        "id": conv_id,
+        "title": meta.get("title"),
+        "preview": meta.get("preview"),
+        "message_count": listing["message_count"],
+        "created_at": listing["created_at"],
+        "updated_at": listing["updated_at"]
+    }
+
+def trusted_response(content) -> JSONResponse:
+    """Return trusted data directly, bypassing response_model validation"""
+    return DefaultResponse(content=content)
+
+def conditional_response(request: Request, tag: str, build: Callable[[], Any], endpoint: str,
+                         cache_control: str = "private, no-cache") -> Response:
+    """304 when the client already has version `tag`; otherwise build and send the body.
+    Per-user data is `private, no-cache`: browsers keep it but revalidate every time."""
+    headers = {"ETag": tag, "Cache-Control": cache_control}
+    if etag_matches(request.headers.get("if-none-match"), tag):
+        metrics.incr("http_not_modified", endpoint=endpoint)
+        return Response(status_code=304, headers=headers)
+    return DefaultResponse(content=build(), headers=headers)
+
+def conversation_version(conv: dict, conv_id: Optional[str] = None) -> tuple:
+    return (conv.get("id", conv_id), conv["updated_at"], len(conv.get("messages") or []),
+            (conv.get("meta") or {}).get("generated_at"))
+
 DEFAULT_SYSTEM_PROMPT = """Eres Brainyx, un asistente de inteligencia artificial avanzado y amigable.
 Tu objetivo es ayudar a los usuarios de manera clara, concisa y profesional.
 Responde siempre en español a menos que el usuario te hable en otro idioma."""
@@ -289,7 +1160,7 @@ Responde siempre en español a menos que el usuario te hable en otro idioma."""
 @api_router.post("/auth/register", response_model=TokenResponse)
 async def register(user_data: UserCreate):
     try:
-        existing = await firebase_find_by_field("users", "email", user_data.email.lower())
+        existing = await find_user_by_email(user_data.email.lower())
         if existing:
             raise HTTPException(status_code=400, detail="El correo electrónico ya está registrado")
         
@@ -308,11 +1179,11 @@ async def register(user_data: UserCreate):
             "updated_at": now
         }
         
-        firebase_id = await firebase_push("users", user_doc)
-        if not firebase_id:
-            raise HTTPException(status_code=500, detail="Error al crear usuario")
-        
-        token = create_token(user_id)
+        user_doc = await storage.users.create(user_doc)
+        await remember_email(user_doc["email"])
+        # A new user has no generation yet
+        await cache_user_session(user_doc, None)
+        token = create_token(user_doc)
         return TokenResponse(access_token=token, user=format_user_response(user_doc))
     except HTTPException:
         raise
@@ -321,13 +1192,18 @@ async def register(user_data: UserCreate):
         raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
 
 @api_router.post("/auth/login", response_model=TokenResponse)
-async def login(credentials: UserLogin):
+async def login(credentials: UserLogin, request: Request):
     try:
-        user = await firebase_find_by_field("users", "email", credentials.email.lower())
+        email = credentials.email.lower()
+        await throttle_login(request, email)
+        user = await find_user_by_email(email)
         if not user or not verify_password(credentials.password, user["password_hash"]):
+            await rate_limit_hit(state, f"login-fail:{email}", LOGIN_FAILURES_PER_EMAIL, LOGIN_FAILURE_WINDOW_SECONDS)
             raise HTTPException(status_code=401, detail="Credenciales inválidas")
         
-        token = create_token(user["id"])
+        # No snapshot here: the doc was found by email, before its generation could be read.
+        # The first authenticated request caches it.
+        token = create_token(user)
         return TokenResponse(access_token=token, user=format_user_response(user))
     except HTTPException:
         raise
@@ -336,18 +1212,26 @@ async def login(credentials: UserLogin):
         raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
 
 @api_router.get("/auth/me", response_model=UserResponse)
-async def get_me(current_user: dict = Depends(get_current_user)):
-    return format_user_response(current_user)
+async def get_me(current_user: dict = Depends(get_session_user)):
+    return trusted_response(user_payload(current_user))
+
+@api_router.post("/auth/logout-all")
+async def logout_all(current_user: dict = Depends(get_current_user)):
+    """Revoke every token issued to the current user"""
+    try:
+        await revoke_user_sessions(current_user)
+        return {"message": "Todas las sesiones fueron cerradas"}
+    except FirebaseUnavailable:
+        raise
+    except Exception as e:
+        logger.error(f"Error in logout_all: {e}")
+        raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
 
 # ============ USER ROUTES ============
 
 @api_router.put("/users/profile", response_model=UserResponse)
 async def update_profile(update_data: UserUpdate, current_user: dict = Depends(get_current_user)):
     try:
-        firebase_id = current_user.get('_firebase_id')
-        if not firebase_id:
-            raise HTTPException(status_code=500, detail="Error interno")
-        
         update_fields = {}
         if update_data.name:
             update_fields["name"] = update_data.name
@@ -356,9 +1240,9 @@ async def update_profile(update_data: UserUpdate, current_user: dict = Depends(g
         
         if update_fields:
             update_fields["updated_at"] = datetime.now(timezone.utc).isoformat()
-            await firebase_update(f"users/{firebase_id}", update_fields)
+            await update_user(current_user, update_fields)
         
-        updated_user = await firebase_find_by_field("users", "id", current_user["id"])
+        updated_user = await storage.users.get(current_user["id"])
         return format_user_response(updated_user)
     except HTTPException:
         raise
@@ -369,25 +1253,24 @@ async def update_profile(update_data: UserUpdate, current_user: dict = Depends(g
 # ============ API KEYS ROUTES ============
 
 @api_router.get("/api-keys", response_model=List[APIKeyResponse])
-async def get_api_keys(current_user: dict = Depends(get_current_user)):
+async def get_api_keys(request: Request, current_user: dict = Depends(get_current_user)):
     try:
-        all_keys = await firebase_get("api_keys")
-        if not all_keys:
-            return []
-        
         user_keys = []
-        for key_id, key_data in all_keys.items():
-            if key_data.get("user_id") == current_user["id"]:
-                user_keys.append(APIKeyResponse(
-                    id=key_id,
-                    name=key_data["name"],
-                    key_preview=key_data.get("key_preview", "byx_****"),
-                    created_at=key_data["created_at"],
-                    last_used=key_data.get("last_used"),
-                    is_active=key_data.get("is_active", True)
-                ))
-        
-        return sorted(user_keys, key=lambda x: x.created_at, reverse=True)
+        for key_id, key_data in (await storage.api_keys.list_for_user(current_user["id"])).items():
+            user_keys.append({
+                "id": key_id,
+                "name": key_data["name"],
+                "key_preview": key_data.get("key_preview", "byx_****"),
+                "created_at": key_data["created_at"],
+                "last_used": _pending_last_used.get(key_id) or key_data.get("last_used"),
+                "is_active": key_data.get("is_active", True)
+            })
+        
+        user_keys.sort(key=lambda x: x["created_at"], reverse=True)
+        # Keys carry no updated_at and the list is small: the version is its content
+        return conditional_response(request, etag(user_keys), lambda: user_keys, "api_keys")
+    except FirebaseUnavailable:
+        raise
     except Exception as e:
         logger.error(f"Error in get_api_keys: {e}")
         return []
@@ -413,13 +1296,15 @@ async def create_api_key(key_data: APIKeyCreate, current_user: dict = Depends(ge
             "created_at": now
         }
         
-        await firebase_set(f"api_keys/{key_id}", key_doc)
+        await storage.api_keys.create(key_id, key_doc)
         
         return APIKeyCreatedResponse(
             id=key_id,
             name=key_data.name,
             key=raw_key
         )
+    except FirebaseUnavailable:
+        raise
     except Exception as e:
         logger.error(f"Error in create_api_key: {e}")
         raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
@@ -427,11 +1312,14 @@ async def create_api_key(key_data: APIKeyCreate, current_user: dict = Depends(ge
 @api_router.delete("/api-keys/{key_id}")
 async def delete_api_key(key_id: str, current_user: dict = Depends(get_current_user)):
     try:
-        key_data = await firebase_get(f"api_keys/{key_id}")
+        key_data = await storage.api_keys.get(key_id)
         if not key_data or key_data.get("user_id") != current_user["id"]:
             raise HTTPException(status_code=404, detail="API Key no encontrada")
         
-        await firebase_delete(f"api_keys/{key_id}")
+        await storage.api_keys.delete(key_id)
+        _pending_last_used.pop(key_id, None)
+        if semantic_cache:
+            semantic_cache.drop_scopes(key_id)
         return {"message": "API Key eliminada"}
     except HTTPException:
         raise
@@ -442,8 +1330,9 @@ async def delete_api_key(key_id: str, current_user: dict = Depends(get_current_u
 # ============ PLANS ROUTES ============
 
 @api_router.get("/plans")
-async def get_plans():
-    return {"plans": PLANS}
+async def get_plans(request: Request):
+    return conditional_response(request, PLANS_ETAG, lambda: {"plans": PLANS}, "plans",
+                                cache_control=f"public, max-age={PLANS_CACHE_SECONDS}")
 
 @api_router.post("/plans/purchase")
 async def purchase_plan(purchase: PlanPurchase, current_user: dict = Depends(get_current_user)):
@@ -452,13 +1341,12 @@ async def purchase_plan(purchase: PlanPurchase, current_user: dict = Depends(get
             raise HTTPException(status_code=400, detail="Plan no válido")
         
         plan = PLANS[purchase.plan_id]
-        firebase_id = current_user.get('_firebase_id')
         
         # Add credits to user
         current_credits = current_user.get("credits", 0)
         new_credits = current_credits + plan["credits"]
         
-        await firebase_update(f"users/{firebase_id}", {
+        await update_user(current_user, {
             "credits": new_credits,
             "plan": purchase.plan_id,
             "updated_at": datetime.now(timezone.utc).isoformat()
@@ -466,7 +1354,7 @@ async def purchase_plan(purchase: PlanPurchase, current_user: dict = Depends(get
         
         # Log transaction
         transaction_id = str(uuid.uuid4())
-        await firebase_set(f"transactions/{transaction_id}", {
+        await storage.transactions.create(transaction_id, {
             "id": transaction_id,
             "user_id": current_user["id"],
             "plan_id": purchase.plan_id,
@@ -486,12 +1374,47 @@ async def purchase_plan(purchase: PlanPurchase, current_user: dict = Depends(get
         raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
 
 @api_router.get("/usage")
-async def get_usage(current_user: dict = Depends(get_current_user)):
+async def get_usage(current_user: dict = Depends(get_session_user)):
     return {
         "credits": current_user.get("credits", 0),
         "plan": current_user.get("plan", "free")
     }
 
+def parse_range_bound(value: Optional[str]) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Rango de fechas no válido")
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+@api_router.get("/usage/history")
+async def get_usage_history(granularity: str = "day", start: Optional[str] = None, end: Optional[str] = None,
+                            api_key_id: Optional[str] = None, current_user: dict = Depends(get_session_user)):
+    """Usage time series from the hourly/daily rollups, for the user or one of their API keys"""
+    try:
+        if granularity not in GRANULARITIES:
+            raise HTTPException(status_code=400, detail="Granularidad no válida")
+        now = datetime.now(timezone.utc)
+        default_start, default_end = default_range(granularity, now)
+        start_at = parse_range_bound(start) or default_start
+        end_at = parse_range_bound(end) or default_end
+        step = GRANULARITIES[granularity][1]
+        if end_at < start_at or (end_at - start_at) / step >= USAGE_HISTORY_MAX_POINTS[granularity]:
+            raise HTTPException(status_code=400, detail="Rango de fechas no válido")
+        
+        buckets = await storage.usage.rollups(current_user["id"], api_key_id, granularity,
+                                              bucket(start_at, granularity), bucket(end_at, granularity))
+        points = series(buckets, granularity, start_at, end_at)
+        totals = {name: sum(p[name] for p in points) for name in COUNTERS}
+        return {"granularity": granularity, "api_key_id": api_key_id, "points": points, "totals": totals}
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error in get_usage_history: {e}")
+        raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
+
 # ============ STRIPE PAYMENT ROUTES ============
 
 @api_router.post("/stripe/create-checkout-session")
@@ -513,6 +1436,7 @@ async def create_stripe_checkout(checkout_data: StripeCheckoutRequest, request:
         # Initialize Stripe checkout
         host_url = str(request.base_url)
         webhook_url = f"{host_url}api/webhook/stripe"
+        StripeCheckout, CheckoutSessionRequest = stripe_integration()
         stripe_checkout = StripeCheckout(api_key=STRIPE_API_KEY, webhook_url=webhook_url)
         
         # Create checkout session with fixed server-side amount
@@ -529,11 +1453,11 @@ async def create_stripe_checkout(checkout_data: StripeCheckoutRequest, request:
             }
         )
         
-        session: CheckoutSessionResponse = await stripe_checkout.create_checkout_session(checkout_request)
+        session = await stripe_checkout.create_checkout_session(checkout_request)
         
         # Create payment transaction record BEFORE redirect
         transaction_id = str(uuid.uuid4())
-        await firebase_set(f"payment_transactions/{transaction_id}", {
+        await storage.transactions.create_payment(transaction_id, {
             "id": transaction_id,
             "session_id": session.session_id,
             "user_id": current_user["id"],
@@ -564,47 +1488,46 @@ async def get_stripe_checkout_status(session_id: str, request: Request, current_
         # Initialize Stripe checkout
         host_url = str(request.base_url)
         webhook_url = f"{host_url}api/webhook/stripe"
+        StripeCheckout, _ = stripe_integration()
         stripe_checkout = StripeCheckout(api_key=STRIPE_API_KEY, webhook_url=webhook_url)
         
         # Get checkout status
-        status: CheckoutStatusResponse = await stripe_checkout.get_checkout_status(session_id)
+        status = await stripe_checkout.get_checkout_status(session_id)
         
         # Find the transaction
-        transactions = await firebase_get("payment_transactions")
-        transaction = None
-        transaction_key = None
-        
-        if transactions:
-            for key, txn in transactions.items():
-                if txn.get("session_id") == session_id:
-                    transaction = txn
-                    transaction_key = key
-                    break
-        
-        if not transaction:
+        found = await storage.transactions.find_payment(session_id)
+        if not found:
             raise HTTPException(status_code=404, detail="Transacción no encontrada")
+        transaction_key, transaction = found
         
         # Verify this transaction belongs to the current user
         if transaction.get("user_id") != current_user["id"]:
             raise HTTPException(status_code=403, detail="No autorizado")
         
         # If payment is successful and not already processed
-        if status.payment_status == "paid" and transaction.get("payment_status") != "completed":
-            # Update transaction status
-            await firebase_update(f"payment_transactions/{transaction_key}", {
-                "payment_status": "completed",
-                "completed_at": datetime.now(timezone.utc).isoformat()
-            })
-            
-            # Add credits to user
-            firebase_id = current_user.get('_firebase_id')
+        paid = status.payment_status == "paid" and transaction.get("payment_status") != "completed"
+        if paid and not await claim_payment(session_id):
+            # Another worker (or the webhook) already credited this session
+            transaction["payment_status"] = "completed"
+        elif paid:
+            # Add credits to user; if Firebase fails here nothing was written, so the claim is released
             current_credits = current_user.get("credits", 0)
             new_credits = current_credits + transaction["credits"]
             
-            await firebase_update(f"users/{firebase_id}", {
-                "credits": new_credits,
-                "plan": transaction["plan_id"],
-                "updated_at": datetime.now(timezone.utc).isoformat()
+            try:
+                await update_user(current_user, {
+                    "credits": new_credits,
+                    "plan": transaction["plan_id"],
+                    "updated_at": datetime.now(timezone.utc).isoformat()
+                })
+            except FirebaseUnavailable:
+                await release_payment(session_id)
+                raise
+            
+            # Update transaction status
+            await storage.transactions.update_payment(transaction_key, {
+                "payment_status": "completed",
+                "completed_at": datetime.now(timezone.utc).isoformat()
             })
             
             logger.info(f"Payment completed for user {current_user['id']}, added {transaction['credits']} credits")
@@ -628,7 +1551,7 @@ async def get_stripe_checkout_status(session_id: str, request: Request, current_
         
         # If expired or failed
         if status.status == "expired":
-            await firebase_update(f"payment_transactions/{transaction_key}", {
+            await storage.transactions.update_payment(transaction_key, {
                 "payment_status": "expired",
                 "updated_at": datetime.now(timezone.utc).isoformat()
             })
@@ -659,6 +1582,7 @@ async def stripe_webhook(request: Request):
         
         host_url = str(request.base_url)
         webhook_url = f"{host_url}api/webhook/stripe"
+        StripeCheckout, _ = stripe_integration()
         stripe_checkout = StripeCheckout(api_key=STRIPE_API_KEY, webhook_url=webhook_url)
         
         webhook_response = await stripe_checkout.handle_webhook(body, signature)
@@ -668,34 +1592,39 @@ async def stripe_webhook(request: Request):
             metadata = webhook_response.metadata
             
             # Find and update the transaction
-            transactions = await firebase_get("payment_transactions")
-            if transactions:
-                for key, txn in transactions.items():
-                    if txn.get("session_id") == session_id and txn.get("payment_status") != "completed":
-                        # Update transaction
-                        await firebase_update(f"payment_transactions/{key}", {
-                            "payment_status": "completed",
-                            "completed_at": datetime.now(timezone.utc).isoformat()
-                        })
+            found = await storage.transactions.find_payment(session_id)
+            if found and found[1].get("payment_status") != "completed" and await claim_payment(session_id):
+                key, txn = found
+                
+                # Add credits to user; on a Firebase outage release the claim so Stripe's retry succeeds
+                try:
+                    user = await storage.users.get(txn["user_id"])
+                    if user:
+                        current_credits = user.get("credits", 0)
+                        new_credits = current_credits + txn["credits"]
                         
-                        # Add credits to user
-                        user = await firebase_find_by_field("users", "id", txn["user_id"])
-                        if user:
-                            firebase_id = user.get('_firebase_id')
-                            current_credits = user.get("credits", 0)
-                            new_credits = current_credits + txn["credits"]
-                            
-                            await firebase_update(f"users/{firebase_id}", {
-                                "credits": new_credits,
-                                "plan": txn["plan_id"],
-                                "updated_at": datetime.now(timezone.utc).isoformat()
-                            })
-                            
-                            logger.info(f"Webhook: Payment completed for user {txn['user_id']}, added {txn['credits']} credits")
-                        break
+                        await update_user(user, {
+                            "credits": new_credits,
+                            "plan": txn["plan_id"],
+                            "updated_at": datetime.now(timezone.utc).isoformat()
+                        })
+                except FirebaseUnavailable:
+                    await release_payment(session_id)
+                    raise
+                
+                # Update transaction
+                await storage.transactions.update_payment(key, {
+                    "payment_status": "completed",
+                    "completed_at": datetime.now(timezone.utc).isoformat()
+                })
+                
+                if user:
+                    logger.info(f"Webhook: Payment completed for user {txn['user_id']}, added {txn['credits']} credits")
         
         return {"status": "ok"}
         
+    except FirebaseUnavailable:
+        raise
     except Exception as e:
         logger.error(f"Webhook error: {e}")
         return {"status": "error", "message": str(e)}
@@ -703,46 +1632,77 @@ async def stripe_webhook(request: Request):
 # ============ BRAINYX PUBLIC API ============
 
 @api_router.post("/v1/chat")
-async def brainyx_chat(request: BrainyxAPIRequest, user: dict = Depends(get_user_by_api_key)):
+async def brainyx_chat(request: BrainyxAPIRequest, http_request: Request, user: dict = Depends(get_user_by_api_key)):
     """Public API endpoint for Brainyx AI - requires API Key"""
     try:
-        firebase_id = user.get('_firebase_id')
         current_credits = user.get("credits", 0)
         
-        # Deduct credits (1 credit per request)
-        credits_to_deduct = 1
-        if current_credits < credits_to_deduct:
+        # Credits per request depend on the model
+        spec = model_for(user, request.model)
+        if current_credits < spec.credits:
             raise HTTPException(status_code=402, detail="Saldo agotado")
         
         # Get AI response
         system_prompt = request.system_prompt or user.get("system_prompt", DEFAULT_SYSTEM_PROMPT)
         
-        chat = LlmChat(
-            api_key=EMERGENT_LLM_KEY,
-            session_id=f"api-{user['id']}-{uuid.uuid4()}",
-            system_message=system_prompt
-        ).with_model("anthropic", "claude-sonnet-4-5-20250929")
-        
-        response = await chat.send_message(UserMessage(text=request.message))
-        
-        # Deduct credits
-        new_credits = current_credits - credits_to_deduct
-        await firebase_update(f"users/{firebase_id}", {"credits": new_credits})
+        cache_scope = vector = None
+        if request.semantic_cache and semantic_cache:
+            cache_scope = scope_key(user.get("_api_key_id") or user["id"], spec.id, system_prompt)
+            began = time.perf_counter()
+            vector = await asyncio.to_thread(semantic_cache.embedder.embed, request.message)
+            hit = semantic_cache.lookup(cache_scope, request.message, vector)
+            metrics.observe("semantic_cache_lookup_ms", (time.perf_counter() - began) * 1000)
+            metrics.incr("semantic_cache_lookups", result="hit" if hit else "miss")
+            if hit:
+                metrics.observe("semantic_cache_similarity", hit.similarity)
+                new_credits = current_credits - SEMANTIC_CACHE_HIT_CREDITS
+                if SEMANTIC_CACHE_HIT_CREDITS:
+                    await update_user(user, {"credits": new_credits})
+                await record_usage(user, SEMANTIC_CACHE_HIT_CREDITS, source="api_cache",
+                                   api_key_id=user.get("_api_key_id"))
+                return {
+                    "response": hit.answer["response"],
+                    "model": hit.answer["model"],
+                    "credits_used": SEMANTIC_CACHE_HIT_CREDITS,
+                    "credits_remaining": new_credits,
+                    "cached": True
+                }
+        
+        estimate = admit(user, spec, system_prompt, [], request.message)
+        spec, result = await unless_disconnected(http_request, complete_routed(
+            spec,
+            system_prompt=system_prompt,
+            history=[],
+            message=request.message,
+            session_id=f"api-{user['id']}-{uuid.uuid4()}"
+        ), "api", prompt_size(system_prompt, [], request.message))
+        
+        # Deduct the tokens used, at the rates of the model that answered
+        charge = meter_call(spec, result, estimate)
+        new_credits = max(0, current_credits - charge.credits)
+        await update_user(user, {"credits": new_credits})
         
         # Log usage
-        usage_id = str(uuid.uuid4())
-        await firebase_set(f"api_usage/{usage_id}", {
-            "user_id": user["id"],
-            "credits_used": credits_to_deduct,
-            "timestamp": datetime.now(timezone.utc).isoformat()
-        })
+        await record_usage(user, charge.credits, result, source="api", api_key_id=user.get("_api_key_id"),
+                           charge=charge)
+        
+        if cache_scope:
+            evicted = semantic_cache.store(cache_scope, request.message, {"response": result.text, "model": spec.id},
+                                           vector)
+            metrics.incr("semantic_cache_evictions", evicted)
+            metrics.gauge("semantic_cache_entries", semantic_cache.entries)
         
         return {
-            "response": response,
-            "credits_remaining": new_credits
+            "response": result.text,
+            "model": spec.id,
+            "credits_used": charge.credits,
+            "credits_remaining": new_credits,
+            "cached": False
         }
     except HTTPException:
         raise
+    except ClientDisconnected:
+        return DefaultResponse(content={"detail": "Cliente desconectado"}, status_code=499)
     except Exception as e:
         logger.error(f"Error in brainyx_chat: {e}")
         raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
@@ -750,18 +1710,19 @@ async def brainyx_chat(request: BrainyxAPIRequest, user: dict = Depends(get_user
 # ============ SETTINGS ROUTES ============
 
 @api_router.get("/settings", response_model=SettingsResponse)
-async def get_settings(current_user: dict = Depends(get_current_user)):
-    return SettingsResponse(system_prompt=current_user.get("system_prompt", DEFAULT_SYSTEM_PROMPT))
+async def get_settings(current_user: dict = Depends(get_session_user)):
+    return trusted_response({"system_prompt": current_user.get("system_prompt", DEFAULT_SYSTEM_PROMPT)})
 
 @api_router.put("/settings", response_model=SettingsResponse)
 async def update_settings(settings: SettingsUpdate, current_user: dict = Depends(get_current_user)):
     try:
-        firebase_id = current_user.get('_firebase_id')
-        await firebase_update(f"users/{firebase_id}", {
+        await update_user(current_user, {
             "system_prompt": settings.system_prompt,
             "updated_at": datetime.now(timezone.utc).isoformat()
         })
         return SettingsResponse(system_prompt=settings.system_prompt)
+    except FirebaseUnavailable:
+        raise
     except Exception as e:
         logger.error(f"Error in update_settings: {e}")
         raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
@@ -769,22 +1730,27 @@ async def update_settings(settings: SettingsUpdate, current_user: dict = Depends
 # ============ CHAT ROUTES (Internal) ============
 
 @api_router.get("/chat/conversations", response_model=List[ConversationResponse])
-async def get_conversations(current_user: dict = Depends(get_current_user)):
-    try:
-        all_convs = await firebase_get("conversations")
-        if not all_convs:
-            return []
-        
-        user_convs = []
-        for conv_id, conv in all_convs.items():
-            if conv.get("user_id") == current_user["id"]:
-                conv['id'] = conv.get('id', conv_id)
-                if 'messages' not in conv:
-                    conv['messages'] = []
-                user_convs.append(ConversationResponse(**conv))
-        
-        user_convs.sort(key=lambda x: x.updated_at, reverse=True)
-        return user_convs[:100]
+async def get_conversations(request: Request, view: Optional[str] = None,
+                            current_user: dict = Depends(get_current_user)):
+    """The user's latest 100 conversations. `?view=meta` lists them without messages (title, preview,
+    message count), read from the listing index where the backend keeps one"""
+    try:
+        if view == "meta":
+            listings = await storage.conversations.list_meta_for_user(current_user["id"], limit=100)
+            tag = etag(current_user["id"], "meta", [(conv_id, listing["updated_at"], listing["message_count"],
+                                                     (listing.get("meta") or {}).get("generated_at"))
+                                                    for conv_id, listing in listings])
+            return conditional_response(
+                request, tag, lambda: [conversation_listing(listing, conv_id) for conv_id, listing in listings],
+                "conversations_meta")
+        user_convs = await storage.conversations.list_for_user(current_user["id"], limit=100)
+        tag = etag(current_user["id"], [conversation_version(conv, conv_id) for conv_id, conv in user_convs])
+        # Only the page we return is projected; it was built by us, so skip re-validation
+        return conditional_response(
+            request, tag, lambda: [conversation_payload(conv, conv_id) for conv_id, conv in user_convs],
+            "conversations")
+    except FirebaseUnavailable:
+        raise
     except Exception as e:
         logger.error(f"Error in get_conversations: {e}")
         return []
@@ -803,21 +1769,107 @@ async def create_conversation(current_user: dict = Depends(get_current_user)):
             "updated_at": now
         }
         
-        await firebase_set(f"conversations/{conversation_id}", conversation)
-        return ConversationResponse(**conversation)
+        await storage.conversations.create(conversation)
+        return trusted_response(conversation_payload(conversation))
+    except FirebaseUnavailable:
+        raise
     except Exception as e:
         logger.error(f"Error in create_conversation: {e}")
         raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
 
+@api_router.get("/chat/search")
+async def search_conversations(q: str, limit: int = 20, offset: int = 0,
+                               current_user: dict = Depends(get_current_user)):
+    """Ranked full-text search over the user's messages"""
+    try:
+        limit = max(1, min(limit, SEARCH_MAX_RESULTS))
+        offset = max(0, offset)
+        await ensure_search_backfill(current_user["id"])
+        began = time.perf_counter()
+        total, results = await asyncio.to_thread(search_index.search, current_user["id"], q, limit, offset)
+        metrics.observe("search_ms", (time.perf_counter() - began) * 1000)
+        return {"query": q, "total": total, "limit": limit, "offset": offset, "results": results}
+    except FirebaseUnavailable:
+        raise
+    except Exception as e:
+        logger.error(f"Error in search_conversations: {e}")
+        raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
+
+def export_response(user_id: str, compress: Optional[str]) -> StreamingResponse:
+    if compress not in (None, "gzip"):
+        raise HTTPException(status_code=400, detail="Compresión no soportada")
+    metrics.incr("exports", compress=compress or "none")
+    chunks = ndjson_chunks(export_records(storage, user_id, EXPORT_PAGE_SIZE))
+    filename = f"brainyx-conversations-{datetime.now(timezone.utc):%Y%m%d}.ndjson"
+    if compress == "gzip":
+        chunks = gzip_chunks(chunks)
+        filename += ".gz"
+    return StreamingResponse(chunks, media_type="application/gzip" if compress else "application/x-ndjson",
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+@api_router.get("/chat/export")
+async def export_conversations(compress: Optional[str] = None, current_user: dict = Depends(get_current_user)):
+    """Full history as NDJSON, streamed page by page (compress=gzip for a .gz file)"""
+    return export_response(current_user["id"], compress)
+
+@api_router.get("/support/users/{user_id}/export")
+async def support_export_conversations(user_id: str, compress: Optional[str] = None,
+                                       x_support_token: Optional[str] = Header(None, alias="X-Support-Token")):
+    """Same export for the support team"""
+    if not SUPPORT_TOKEN or not secrets.compare_digest(x_support_token or "", SUPPORT_TOKEN):
+        raise HTTPException(status_code=403, detail="No autorizado")
+    if not await storage.users.get(user_id):
+        raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    return export_response(user_id, compress)
+
+@api_router.post("/chat/import")
+async def import_conversations(request: Request, job_id: Optional[str] = None,
+                               current_user: dict = Depends(get_current_user)):
+    """Bulk import of an NDJSON export (plain or gzip); imported conversations get new ids.
+    Progress is readable at /chat/import/{job_id} while the upload runs."""
+    user_id = current_user["id"]
+    job_id = job_id or str(uuid.uuid4())
+    progress_key = f"import:{user_id}:{job_id}"
+
+    async def on_batch(written):
+        for conv_id, messages in written:
+            await index_messages(user_id, conv_id, messages)
+            title_worker.enqueue(conv_id)
+
+    async def on_progress(progress):
+        await state.set_json(progress_key, {"job_id": job_id, **progress}, ttl=IMPORT_PROGRESS_TTL_SECONDS)
+
+    try:
+        importer = Importer(storage, user_id, batch_messages=IMPORT_BATCH_MESSAGES,
+                            max_line_bytes=IMPORT_MAX_LINE_BYTES, max_bytes=IMPORT_MAX_BYTES,
+                            on_batch=on_batch, on_progress=on_progress)
+        began = time.perf_counter()
+        progress = await importer.run(request.stream())
+        metrics.observe("import_ms", (time.perf_counter() - began) * 1000)
+        metrics.incr("imports", status=progress["status"])
+        metrics.incr("import_messages", progress["messages"])
+        return {"job_id": job_id, **progress}
+    except FirebaseUnavailable:
+        raise
+    except Exception as e:
+        logger.error(f"Error in import_conversations: {e}")
+        raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
+
+@api_router.get("/chat/import/{job_id}")
+async def get_import_progress(job_id: str, current_user: dict = Depends(get_current_user)):
+    progress = await state.get_json(f"import:{current_user['id']}:{job_id}")
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Importación no encontrada")
+    return progress
+
 @api_router.get("/chat/conversations/{conversation_id}", response_model=ConversationResponse)
-async def get_conversation(conversation_id: str, current_user: dict = Depends(get_current_user)):
+async def get_conversation(conversation_id: str, request: Request, current_user: dict = Depends(get_current_user)):
     try:
-        conversation = await firebase_get(f"conversations/{conversation_id}")
+        conversation = await storage.conversations.get(conversation_id)
         if not conversation or conversation.get("user_id") != current_user["id"]:
             raise HTTPException(status_code=404, detail="Conversación no encontrada")
-        if 'messages' not in conversation:
-            conversation['messages'] = []
-        return ConversationResponse(**conversation)
+        return conditional_response(request, etag(conversation_version(conversation, conversation_id)),
+                                    lambda: conversation_payload(conversation, conversation_id), "conversation")
     except HTTPException:
         raise
     except Exception as e:
@@ -827,10 +1879,11 @@ async def get_conversation(conversation_id: str, current_user: dict = Depends(ge
 @api_router.delete("/chat/conversations/{conversation_id}")
 async def delete_conversation(conversation_id: str, current_user: dict = Depends(get_current_user)):
     try:
-        conversation = await firebase_get(f"conversations/{conversation_id}")
+        conversation = await storage.conversations.get(conversation_id)
         if not conversation or conversation.get("user_id") != current_user["id"]:
             raise HTTPException(status_code=404, detail="Conversación no encontrada")
-        await firebase_delete(f"conversations/{conversation_id}")
+        await storage.conversations.delete(conversation_id, current_user["id"])
+        await asyncio.to_thread(search_index.remove_conversation, current_user["id"], conversation_id)
         return {"message": "Conversación eliminada"}
     except HTTPException:
         raise
@@ -839,39 +1892,47 @@ async def delete_conversation(conversation_id: str, current_user: dict = Depends
         raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
 
 @api_router.post("/chat/conversations/{conversation_id}/messages", response_model=MessageResponse)
-async def send_message(conversation_id: str, message: MessageCreate, current_user: dict = Depends(get_current_user)):
+async def send_message(conversation_id: str, message: MessageCreate, request: Request,
+                       current_user: dict = Depends(get_current_user)):
     try:
         # Check credits
-        if current_user.get("credits", 0) <= 0:
+        spec = model_for(current_user)
+        if current_user.get("credits", 0) < spec.credits:
             raise HTTPException(status_code=402, detail="Saldo agotado. Recarga tu plan.")
         
-        conversation = await firebase_get(f"conversations/{conversation_id}")
+        conversation = await storage.conversations.get(conversation_id)
         if not conversation or conversation.get("user_id") != current_user["id"]:
             raise HTTPException(status_code=404, detail="Conversación no encontrada")
         
         if 'messages' not in conversation:
             conversation['messages'] = []
         
+        # Summary of older turns plus the recent ones
+        system_prompt, history = compactor.context(
+            current_user.get("system_prompt", DEFAULT_SYSTEM_PROMPT), conversation)
+        first_index = len(conversation['messages'])
+        
         user_msg_id = str(uuid.uuid4())
         now = datetime.now(timezone.utc).isoformat()
         
         user_message = {"id": user_msg_id, "role": "user", "content": message.content, "timestamp": now}
+        estimate = admit(current_user, spec, system_prompt, history, message.content)
         conversation['messages'].append(user_message)
         
         # Get AI response
+        result = None
         try:
-            system_prompt = current_user.get("system_prompt", DEFAULT_SYSTEM_PROMPT)
-            chat = LlmChat(
-                api_key=EMERGENT_LLM_KEY,
-                session_id=f"conv-{conversation_id}",
-                system_message=system_prompt
-            ).with_model("anthropic", "claude-sonnet-4-5-20250929")
-            
-            for msg in conversation['messages'][-10:]:
-                if msg["role"] == "user":
-                    await chat.send_message(UserMessage(text=msg["content"]))
-            
-            ai_response = await chat.send_message(UserMessage(text=message.content))
+            spec, result = await unless_disconnected(request, complete_routed(
+                spec,
+                system_prompt=system_prompt,
+                history=history,
+                message=message.content,
+                session_id=f"conv-{conversation_id}"
+            ), "chat", prompt_size(system_prompt, history, message.content))
+            ai_response = result.text
+        except ClientDisconnected:
+            # Nothing is stored or charged for a turn nobody is waiting for
+            raise
         except Exception as e:
             logger.error(f"Error getting AI response: {e}")
             ai_response = "Lo siento, hubo un error. Intenta de nuevo."
@@ -883,20 +1944,268 @@ async def send_message(conversation_id: str, message: MessageCreate, current_use
         conversation['messages'].append(ai_message)
         conversation['updated_at'] = ai_timestamp
         
-        await firebase_set(f"conversations/{conversation_id}", conversation)
-        
-        # Deduct credits
-        firebase_id = current_user.get('_firebase_id')
-        new_credits = current_user.get("credits", 0) - 1
-        await firebase_update(f"users/{firebase_id}", {"credits": max(0, new_credits)})
-        
-        return MessageResponse(**ai_message)
+        # Append only the new turns so a summary written meanwhile is not overwritten
+        await storage.conversations.append_messages(conversation_id, first_index, [user_message, ai_message],
+                                                    ai_timestamp, user_id=current_user["id"])
+        compactor.schedule(conversation_id, conversation)
+        title_worker.enqueue(conversation_id)
+        await index_messages(current_user["id"], conversation_id, [user_message, ai_message])
+        
+        # Deduct credits for the tokens used
+        charge = meter_call(spec, result, estimate)
+        new_credits = current_user.get("credits", 0) - charge.credits
+        await update_user(current_user, {"credits": max(0, new_credits)})
+        if result:
+            await record_usage(current_user, charge.credits, result, source="chat", charge=charge)
+        
+        return trusted_response(message_payload(ai_message))
     except HTTPException:
         raise
+    except ClientDisconnected:
+        return DefaultResponse(content={"detail": "Cliente desconectado"}, status_code=499)
     except Exception as e:
         logger.error(f"Error in send_message: {e}")
         raise HTTPException(status_code=500, detail=f"Error interno: {str(e)}")
 
+# ============ CHAT WEBSOCKET ============
+
+class SessionEnded(Exception):
+    def __init__(self, code: int, reason: str):
+        super().__init__(reason)
+        self.code = code
+        self.reason = reason
+
+class ChatSession:
+    """One chat WebSocket. The user and the open conversation stay in memory between turns:
+    a turn costs one shared-state read (session snapshot) instead of a token decode, a user
+    lookup and a conversation fetch. The connection is assumed to be the only writer of the
+    conversation it has open; `open` it again to reload it.
+
+    Client -> server: auth, open, message, cancel, ping, pong
+    Server -> client: ready, opened, start, delta, done, cancelled, error, ping, pong"""
+
+    def __init__(self, websocket: WebSocket, user: dict, token_version: int):
+        self.ws = websocket
+        self.user = user
+        self.token_version = token_version
+        self.conversation_id: Optional[str] = None
+        self.conversation: Optional[dict] = None
+        self.outbox = Outbox(websocket.send_json, max_pending=WS_MAX_PENDING_MESSAGES)
+        self.requests: asyncio.Queue = asyncio.Queue(maxsize=WS_MAX_QUEUED_TURNS)
+        self.current: Optional[asyncio.Task] = None
+        self.last_seen = time.monotonic()
+
+    def error(self, code: int, detail: str, **extra):
+        self.outbox.put({"type": "error", "code": code, "detail": detail, **extra})
+
+    async def run(self):
+        self.outbox.put({"type": "ready", "user_id": self.user["id"], "credits": self.user.get("credits", 0)})
+        tasks = [asyncio.create_task(coro) for coro in (self.reader(), self.worker(), self.heartbeat(),
+                                                        self.outbox.run())]
+        try:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in tasks:
+                task.cancel()
+            if self.current:
+                self.current.cancel()
+            await asyncio.gather(*tasks, *([self.current] if self.current else []), return_exceptions=True)
+        for task in done:
+            if not task.cancelled() and task.exception() is not None:
+                raise task.exception()
+
+    # ---- inbound ----
+
+    async def reader(self):
+        while True:
+            try:
+                message = json.loads(await self.ws.receive_text())
+                kind = message.get("type") if isinstance(message, dict) else None
+            except ValueError:
+                self.error(400, "JSON no válido")
+                continue
+            self.last_seen = time.monotonic()
+            if kind == "ping":
+                self.outbox.put({"type": "pong"})
+            elif kind == "pong":
+                pass
+            elif kind == "cancel":
+                if self.current and not self.current.done():
+                    self.current.cancel()
+            elif kind in ("open", "message"):
+                try:
+                    self.requests.put_nowait(message)
+                except asyncio.QueueFull:
+                    metrics.incr("ws_rejected_messages")
+                    self.error(429, "Espera la respuesta anterior", ref=message.get("ref"))
+            else:
+                self.error(400, f"Tipo de mensaje desconocido: {kind}")
+
+    async def worker(self):
+        """Requests are handled one at a time, in order"""
+        while True:
+            message = await self.requests.get()
+            handler = self.open if message["type"] == "open" else self.turn
+            self.current = asyncio.create_task(handler(message))
+            await asyncio.wait({self.current})
+            if self.current.cancelled():
+                self.outbox.put({"type": "cancelled", "ref": message.get("ref")})
+            elif self.current.exception() is not None:
+                error = self.current.exception()
+                if isinstance(error, (SessionEnded, OutboxFull)):
+                    raise error
+                if isinstance(error, HTTPException):
+                    self.error(error.status_code, error.detail, ref=message.get("ref"))
+                else:
+                    logger.error(f"Error in chat websocket: {error}")
+                    self.error(500, f"Error interno: {error}", ref=message.get("ref"))
+            self.current = None
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(WS_HEARTBEAT_SECONDS)
+            if time.monotonic() - self.last_seen > 2 * WS_HEARTBEAT_SECONDS:
+                raise SessionEnded(4408, "Sin respuesta al ping")
+            self.outbox.put({"type": "ping"})
+
+    # ---- requests ----
+
+    async def refresh_user(self):
+        """The session snapshot is dropped on every user write, so its absence means the
+        resident copy may be stale (credits bought, sessions revoked)"""
+        snapshot = await state.get_json(f"user:{self.user['id']}")
+        if snapshot is None:
+            generation = await session_generation(self.user["id"])
+            snapshot = await storage.users.get(self.user["id"])
+            if not snapshot:
+                raise SessionEnded(4401, "Usuario no encontrado")
+            await cache_user_session(snapshot, generation)
+        if self.token_version < snapshot.get("session_version", 0):
+            raise SessionEnded(4401, "Sesión revocada")
+        self.user = snapshot
+
+    async def open(self, message: dict):
+        conversation_id = message.get("conversation_id")
+        if conversation_id:
+            conversation = await storage.conversations.get(conversation_id)
+            if not conversation or conversation.get("user_id") != self.user["id"]:
+                raise HTTPException(status_code=404, detail="Conversación no encontrada")
+            conversation.setdefault("messages", [])
+        else:
+            now = datetime.now(timezone.utc).isoformat()
+            conversation = {"id": str(uuid.uuid4()), "user_id": self.user["id"], "messages": [],
+                            "created_at": now, "updated_at": now}
+            await storage.conversations.create(conversation)
+        self.conversation_id = conversation.get("id", conversation_id)
+        self.conversation = conversation
+        self.outbox.put({"type": "opened", "ref": message.get("ref"), "conversation_id": self.conversation_id,
+                         "messages": len(conversation["messages"])})
+
+    async def turn(self, message: dict):
+        content = message.get("content")
+        if not isinstance(content, str) or not content.strip():
+            raise HTTPException(status_code=422, detail="Mensaje vacío")
+        if self.conversation is None:
+            raise HTTPException(status_code=409, detail="Abre una conversación primero")
+        await self.refresh_user()
+        spec = model_for(self.user)
+        if self.user.get("credits", 0) < spec.credits:
+            raise HTTPException(status_code=402, detail="Saldo agotado. Recarga tu plan.")
+
+        began = time.perf_counter()
+        conversation, conversation_id = self.conversation, self.conversation_id
+        system_prompt, history = compactor.context(self.user.get("system_prompt", DEFAULT_SYSTEM_PROMPT), conversation)
+        estimate = admit(self.user, spec, system_prompt, history, content)
+        first_index = len(conversation["messages"])
+        user_message = {"id": str(uuid.uuid4()), "role": "user", "content": content,
+                        "timestamp": datetime.now(timezone.utc).isoformat()}
+        # The question is stored before the answer starts, so it survives a dropped connection
+        conversation["messages"].append(user_message)
+        await storage.conversations.append_messages(conversation_id, first_index, [user_message],
+                                                    user_message["timestamp"], user_id=self.user["id"])
+        turn_id = message.get("ref") or user_message["id"]
+        self.outbox.put({"type": "start", "ref": turn_id, "message": user_message})
+
+        result, parts, first_delta = None, [], None
+        try:
+            async for spec, item in stream_routed(spec, system_prompt=system_prompt, history=history,
+                                                  message=content, session_id=f"conv-{conversation_id}"):
+                if isinstance(item, LlmResult):
+                    result = item
+                elif item:
+                    if first_delta is None:
+                        first_delta = time.perf_counter()
+                        metrics.observe("ws_first_delta_ms", (first_delta - began) * 1000)
+                    parts.append(item)
+                    self.outbox.put({"type": "delta", "ref": turn_id, "text": item})
+        except asyncio.CancelledError:
+            metrics.incr("llm_cancelled", endpoint="ws")
+            metrics.incr("llm_cancelled_prompt_tokens", prompt_size(system_prompt, history, content), endpoint="ws")
+            raise
+        except Exception as e:
+            logger.error(f"Error getting AI response: {e}")
+        ai_text = result.text if result else "Lo siento, hubo un error. Intenta de nuevo."
+
+        ai_message = {"id": str(uuid.uuid4()), "role": "assistant", "content": ai_text,
+                      "timestamp": datetime.now(timezone.utc).isoformat()}
+        conversation["messages"].append(ai_message)
+        conversation["updated_at"] = ai_message["timestamp"]
+        await storage.conversations.append_messages(conversation_id, first_index + 1, [ai_message],
+                                                    ai_message["timestamp"], user_id=self.user["id"])
+        compactor.schedule(conversation_id, conversation)
+        title_worker.enqueue(conversation_id)
+        await index_messages(self.user["id"], conversation_id, [user_message, ai_message])
+
+        charge = meter_call(spec, result, estimate)
+        new_credits = max(0, self.user.get("credits", 0) - charge.credits)
+        await update_user(self.user, {"credits": new_credits})
+        self.user["credits"] = new_credits
+        # This connection is the user's writer here: re-cache its copy under the generation it just bumped
+        await cache_user_session(self.user, await session_generation(self.user["id"]))
+        if result:
+            await record_usage(self.user, charge.credits, result, source="chat", charge=charge)
+        metrics.observe("ws_turn_ms", (time.perf_counter() - began) * 1000)
+        self.outbox.put({"type": "done", "ref": turn_id, "message": ai_message, "model": spec.id,
+                         "credits_used": charge.credits, "credits_remaining": new_credits})
+
+ws_connections = ConnectionLimiter(WS_MAX_CONNECTIONS_PER_USER)
+
+@api_router.websocket("/chat/ws")
+async def chat_websocket(websocket: WebSocket):
+    """Chat over one WebSocket; the first message must be {"type": "auth", "token": <JWT>}"""
+    await websocket.accept()
+    try:
+        auth = json.loads(await asyncio.wait_for(websocket.receive_text(), WS_AUTH_TIMEOUT_SECONDS))
+        if not isinstance(auth, dict) or auth.get("type") != "auth" or not auth.get("token"):
+            raise HTTPException(status_code=401, detail="Se esperaba un mensaje auth")
+        payload = decode_token(auth["token"])
+        user = await get_current_user(HTTPAuthorizationCredentials(scheme="Bearer", credentials=auth["token"]))
+    except (asyncio.TimeoutError, ValueError, HTTPException) as e:
+        await websocket.close(code=4401, reason=getattr(e, "detail", "No autorizado"))
+        return
+    except WebSocketDisconnect:
+        return
+    if not ws_connections.acquire(user["id"]):
+        metrics.incr("ws_refused_connections")
+        await websocket.close(code=4429, reason="Demasiadas conexiones abiertas")
+        return
+    metrics.gauge("ws_connections", ws_connections.total)
+    try:
+        await ChatSession(websocket, user, payload.get("sv", 0)).run()
+    except WebSocketDisconnect:
+        pass
+    except SessionEnded as e:
+        await websocket.close(code=e.code, reason=e.reason)
+    except OutboxFull:
+        metrics.incr("ws_stalled_clients")
+        await websocket.close(code=1008, reason="El cliente no lee los mensajes")
+    except Exception as e:
+        # Usually a send racing the client going away
+        logger.warning(f"Chat websocket closed: {e}")
+    finally:
+        ws_connections.release(user["id"])
+        metrics.gauge("ws_connections", ws_connections.total)
+
 # ============ STATUS ROUTES ============
 
 @api_router.get("/")
@@ -905,11 +2214,49 @@ async def root():
 
 @api_router.get("/health")
 async def health_check():
+    """Liveness: the process is up and the event loop answers"""
     return {"status": "healthy", "timestamp": datetime.now(timezone.utc).isoformat()}
 
+@api_router.get("/ready")
+async def readiness_check():
+    """Readiness: the instance has finished starting and its dependencies answer in time.
+    `degraded` still takes traffic (200) so orchestrators can weigh it; `unready` and `starting` are 503."""
+    warmup = startup["warmup"]
+    status, checks = await readiness.report() if readiness else ("ready", {})
+    if warmup == "pending":
+        status = "starting"
+    elif warmup not in ("done", "skipped"):
+        status = "unready"
+    body = {
+        "status": status,
+        "warmup": warmup,
+        "checks": checks,
+        "queues": queue_depths(),
+        "integrations": integrations_loaded(),
+        "uptime_seconds": round(time.monotonic() - startup["started_at"], 3)
+    }
+    return DefaultResponse(content=body, status_code=200 if status in ("ready", "degraded") else 503)
+
+@api_router.get("/metrics")
+async def get_metrics(x_metrics_token: Optional[str] = Header(None, alias="X-Metrics-Token")):
+    """Per-worker metrics snapshot"""
+    if METRICS_TOKEN and not secrets.compare_digest(x_metrics_token or "", METRICS_TOKEN):
+        raise HTTPException(status_code=403, detail="No autorizado")
+    for listener in stream_listeners:
+        listener.report()
+    report_email_filter()
+    return metrics.snapshot()
+
 # Include router
 app.include_router(api_router)
 
+app.add_middleware(
+    CompressionMiddleware,
+    minimum_size=COMPRESSION_MIN_BYTES,
+    gzip_level=COMPRESSION_GZIP_LEVEL,
+    brotli_quality=COMPRESSION_BROTLI_QUALITY,
+)
+
 # CORS
 app.add_middleware(
     CORSMiddleware,
@@ -918,3 +2265,7 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+
+# Outermost, so recorded timings cover the whole stack
+traffic_log = TraceLog(TRAFFIC_TRACE_PATH, TRAFFIC_TRACE_SAMPLE) if TRAFFIC_TRACE_PATH else None
+app.add_middleware(TraceRecorder, log=traffic_log)
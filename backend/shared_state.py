@@ -0,0 +1,200 @@
+"""
+Shared state for caches, rate limits and idempotency keys.
+
+A single uvicorn process can keep this state in memory. Under gunicorn with
+several workers (or several containers) every worker must see the same
+counters and keys, so the backend is selected from STATE_BACKEND_URL:
+
+    memory://                 in-process dict (default, single worker only)
+    redis://host:6379/0       shared Redis backend (requires the `redis` package)
+"""
+import asyncio
+import json
+import time
+from typing import Any, Dict, Optional, Tuple
+
+
+class StateBackend:
+    """Minimal key/value interface shared by every backend. Values are strings."""
+
+    shared = False
+
+    async def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    async def set(self, key: str, value: str, ttl: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+    async def add(self, key: str, value: str, ttl: Optional[float] = None) -> bool:
+        """Set key only if it does not exist. Returns True if it was set."""
+        raise NotImplementedError
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        """Increment a counter. The TTL is applied when the counter is created."""
+        raise NotImplementedError
+
+    async def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    async def ping(self) -> bool:
+        return True
+
+    async def close(self) -> None:
+        pass
+
+    # JSON helpers used by caches
+    async def get_json(self, key: str) -> Any:
+        raw = await self.get(key)
+        return json.loads(raw) if raw is not None else None
+
+    async def set_json(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        await self.set(key, json.dumps(value, separators=(",", ":")), ttl)
+
+    async def add_json(self, key: str, value: Any, ttl: Optional[float] = None) -> bool:
+        return await self.add(key, json.dumps(value, separators=(",", ":")), ttl)
+
+
+class MemoryStateBackend(StateBackend):
+    """Process-local backend. Correct only while the app runs in one process."""
+
+    def __init__(self, max_keys: int = 100_000):
+        self._data: Dict[str, Tuple[str, Optional[float]]] = {}
+        self._max_keys = max_keys
+
+    def _live(self, key: str) -> Optional[str]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    def _store(self, key: str, value: str, ttl: Optional[float]):
+        if len(self._data) >= self._max_keys and key not in self._data:
+            self._evict()
+        self._data[key] = (value, time.monotonic() + ttl if ttl else None)
+
+    def _evict(self):
+        now = time.monotonic()
+        expired = [k for k, (_, exp) in self._data.items() if exp is not None and exp <= now]
+        for k in expired:
+            del self._data[k]
+        # Still full: drop the oldest inserted keys (dicts keep insertion order)
+        overflow = len(self._data) - self._max_keys + 1
+        for k in list(self._data)[:max(0, overflow)]:
+            del self._data[k]
+
+    async def get(self, key):
+        return self._live(key)
+
+    async def set(self, key, value, ttl=None):
+        self._store(key, value, ttl)
+
+    async def add(self, key, value, ttl=None):
+        if self._live(key) is not None:
+            return False
+        self._store(key, value, ttl)
+        return True
+
+    async def incr(self, key, amount=1, ttl=None):
+        current = self._live(key)
+        if current is None:
+            self._store(key, str(amount), ttl)
+            return amount
+        value = int(current) + amount
+        self._data[key] = (str(value), self._data[key][1])
+        return value
+
+    async def delete(self, key):
+        self._data.pop(key, None)
+
+
+class RedisStateBackend(StateBackend):
+    """Backend shared by every worker and instance pointing at the same Redis."""
+
+    shared = True
+
+    def __init__(self, url: str = None, client=None, prefix: str = "brainyx:"):
+        if client is None:
+            import redis.asyncio as redis_asyncio
+            client = redis_asyncio.from_url(url, decode_responses=True, protocol=2)
+        self._client = client
+        self._prefix = prefix
+
+    def _k(self, key: str) -> str:
+        return f"{self._prefix}{key}"
+
+    async def get(self, key):
+        return await self._client.get(self._k(key))
+
+    async def set(self, key, value, ttl=None):
+        await self._client.set(self._k(key), value, px=int(ttl * 1000) if ttl else None)
+
+    async def add(self, key, value, ttl=None):
+        result = await self._client.set(self._k(key), value, px=int(ttl * 1000) if ttl else None, nx=True)
+        return bool(result)
+
+    async def incr(self, key, amount=1, ttl=None):
+        value = await self._client.incrby(self._k(key), amount)
+        if ttl and value == amount:
+            await self._client.pexpire(self._k(key), int(ttl * 1000))
+        return int(value)
+
+    async def delete(self, key):
+        await self._client.delete(self._k(key))
+
+    async def ping(self):
+        return bool(await self._client.ping())
+
+    async def close(self):
+        await self._client.aclose()
+
+
+def create_state_backend(url: str) -> StateBackend:
+    if not url or url.startswith("memory://"):
+        return MemoryStateBackend()
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisStateBackend(url)
+    raise ValueError(f"Unsupported STATE_BACKEND_URL: {url}")
+
+
+async def rate_limit_hit(backend: StateBackend, key: str, limit: int, window: int) -> bool:
+    """Fixed-window rate limit. Returns True when the call is over the limit."""
+    if limit <= 0:
+        return False
+    bucket = int(time.time() // window)
+    count = await backend.incr(f"rl:{key}:{bucket}", 1, ttl=window + 1)
+    return count > limit
+
+
+async def rate_limit_reached(backend: StateBackend, key: str, limit: int, window: int) -> bool:
+    """Whether rate_limit_hit calls already used up the current window, without counting this one"""
+    if limit <= 0:
+        return False
+    count = await backend.get(f"rl:{key}:{int(time.time() // window)}")
+    return int(count or 0) >= limit
+
+
+class StateLock:
+    """Best-effort distributed lock built on add(); used to run a job on one worker."""
+
+    def __init__(self, backend: StateBackend, name: str, ttl: float):
+        self.backend = backend
+        self.key = f"lock:{name}"
+        self.ttl = ttl
+
+    async def acquire(self) -> bool:
+        return await self.backend.add(self.key, str(time.time()), self.ttl)
+
+    async def release(self):
+        await self.backend.delete(self.key)
+
+    async def __aenter__(self):
+        while not await self.acquire():
+            await asyncio.sleep(0.05)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.release()
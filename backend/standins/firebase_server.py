@@ -0,0 +1,331 @@
+"""
+Local stand-in for the Firebase Realtime Database REST API, with fault injection.
+
+Supports GET/PUT/POST/PATCH/DELETE on `/<path>.json`, multi-path PATCH,
+`{".sv": ...}` server values, Firebase's array handling (arrays are stored as
+objects with integer keys and returned as arrays while mostly dense) and the
+basic query parameters (orderBy,
+equalTo, startAt, endAt, limitToFirst, limitToLast, shallow) and conditional writes (a GET with
+`X-Firebase-ETag: true` returns the value's ETag; a PUT or DELETE with a stale
+`if-match` gets 412 and the current value). A GET with
+`Accept: text/event-stream` opens a stream of put/patch/keep-alive events for
+the path; `drop_streams()` closes the open ones. Faults are set on
+`standin.faults` and apply to every request until changed. Usable in-process
+via httpx.ASGITransport (which buffers streams, so serve it with uvicorn to
+listen) or served with uvicorn:
+
+    python -m standins.firebase_server --port 8791
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Set
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+
+@dataclass
+class Faults:
+    latency: float = 0.0          # seconds added to every matching request
+    jitter: float = 0.0           # extra uniform random latency in seconds
+    error_rate: float = 0.0       # fraction of requests answered with error_status
+    error_status: int = 503
+    fail_next: int = 0            # the next N matching requests fail with error_status
+    slow_next: int = 0            # the next N matching requests get slow_latency instead of latency
+    slow_latency: float = 0.0
+    methods: Set[str] = field(default_factory=lambda: {"GET", "PUT", "POST", "PATCH", "DELETE"})
+
+
+def _split(path: str) -> List[str]:
+    return [p for p in path.strip("/").split("/") if p]
+
+
+def _to_tree(value: Any) -> Any:
+    """Arrays are stored as objects keyed by index, without null entries"""
+    if isinstance(value, list):
+        value = {str(i): v for i, v in enumerate(value)}
+    if isinstance(value, dict):
+        tree = {k: _to_tree(v) for k, v in value.items()}
+        return {k: v for k, v in tree.items() if v is not None} or None
+    return value
+
+
+def _relative(root: str, path: str) -> Optional[str]:
+    """`path` relative to `root` ("/" for root itself), or None when it is not below it"""
+    root_parts, parts = _split(root), _split(path)
+    if parts[:len(root_parts)] != root_parts:
+        return None
+    return "/" + "/".join(parts[len(root_parts):])
+
+
+def _to_json(value: Any) -> Any:
+    """Objects with integer keys come back as arrays when more than half the slots are set"""
+    if not isinstance(value, dict):
+        return value
+    value = {k: _to_json(v) for k, v in value.items()}
+    if value and all(k.isdigit() for k in value):
+        size = max(int(k) for k in value) + 1
+        if len(value) * 2 > size:
+            return [value.get(str(i)) for i in range(size)]
+    return value
+
+
+class FirebaseStandin:
+    def __init__(self, data: Optional[dict] = None):
+        self.data: Dict[str, Any] = _to_tree(data) or {}
+        self.faults = Faults()
+        self.requests: List[tuple] = []
+        self._push_counter = 0
+        self.keepalive_seconds = 30.0
+        self._streams: List[tuple] = []
+        self._stream_epoch = 0
+        self.app = Starlette(routes=[
+            Route("/{path:path}", self.handle, methods=["GET", "PUT", "POST", "PATCH", "DELETE"]),
+        ])
+
+    # ---- tree operations ----
+
+    def read(self, path: str) -> Any:
+        node = self.data
+        for part in _split(path):
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return node
+
+    def write(self, path: str, value: Any):
+        value = _to_tree(value)
+        parts = _split(path)
+        if not parts:
+            self.data = value if isinstance(value, dict) else {}
+            return
+        node = self.data
+        for part in parts[:-1]:
+            child = node.get(part)
+            if not isinstance(child, dict):
+                if value is None:
+                    return
+                child = node[part] = {}
+            node = child
+        if value is None:
+            node.pop(parts[-1], None)
+        else:
+            node[parts[-1]] = value
+        self._prune(path)
+
+    def _prune(self, path: str):
+        """Firebase drops empty parents"""
+        parts = _split(path)
+        while parts:
+            parent = "/".join(parts[:-1])
+            node = self.read("/".join(parts))
+            if node in ({}, None):
+                holder = self.read(parent) if parent else self.data
+                if isinstance(holder, dict):
+                    holder.pop(parts[-1], None)
+            parts = parts[:-1]
+
+    def resolve_server_values(self, path: str, value: Any) -> Any:
+        if isinstance(value, dict):
+            sv = value.get(".sv")
+            if sv == "timestamp":
+                return int(time.time() * 1000)
+            if isinstance(sv, dict) and "increment" in sv:
+                current = self.read(path)
+                return (current if isinstance(current, (int, float)) else 0) + sv["increment"]
+            return {k: self.resolve_server_values(f"{path}/{k}", v) for k, v in value.items()}
+        return value
+
+    def push_key(self) -> str:
+        self._push_counter += 1
+        return f"-N{int(time.time() * 1000):013d}{self._push_counter:07d}"
+
+    # ---- queries ----
+
+    @staticmethod
+    def _param(request: Request, name: str) -> Any:
+        raw = request.query_params.get(name)
+        return json.loads(raw) if raw is not None else None
+
+    def query(self, value: Any, request: Request) -> Any:
+        if request.query_params.get("shallow") == "true" and isinstance(value, dict):
+            return {k: True for k in value}
+        order_by = self._param(request, "orderBy")
+        if order_by is None or not isinstance(value, dict):
+            return value
+
+        def sort_key(item):
+            key, child = item
+            if order_by == "$key":
+                return (0, key)
+            if order_by == "$value":
+                return (0, child, key)
+            v = child.get(order_by) if isinstance(child, dict) else None
+            return (0 if v is None else 1, v if v is not None else "", key)
+
+        items = sorted(value.items(), key=sort_key)
+
+        def field_value(item):
+            key, child = item
+            if order_by == "$key":
+                return key
+            if order_by == "$value":
+                return child
+            return child.get(order_by) if isinstance(child, dict) else None
+
+        equal_to = self._param(request, "equalTo")
+        start_at = self._param(request, "startAt")
+        end_at = self._param(request, "endAt")
+        if equal_to is not None:
+            items = [i for i in items if field_value(i) == equal_to]
+        if start_at is not None:
+            items = [i for i in items if field_value(i) is not None and field_value(i) >= start_at]
+        if end_at is not None:
+            items = [i for i in items if field_value(i) is not None and field_value(i) <= end_at]
+        first = self._param(request, "limitToFirst")
+        last = self._param(request, "limitToLast")
+        if first is not None:
+            items = items[:first]
+        if last is not None:
+            items = items[-last:] if last else []
+        return dict(items)
+
+    # ---- streaming ----
+
+    def _notify(self, kind: str, path: str, data: Any):
+        """Queue the events a write produces for every stream it is visible to"""
+        for root, queue in self._streams:
+            relative = _relative(root, path)
+            if relative is not None:
+                queue.put_nowait((kind, relative, data))
+            elif kind == "patch":
+                for key, value in (data or {}).items():
+                    child = f"{path}/{key}"
+                    relative = _relative(root, child)
+                    if relative is not None:
+                        queue.put_nowait(("put", relative, value))
+                    elif _relative(child, root) is not None:
+                        queue.put_nowait(("put", "/", _to_json(self.read(root))))
+            elif _relative(path, root) is not None:
+                queue.put_nowait(("put", "/", _to_json(self.read(root))))
+
+    def drop_streams(self):
+        """Close every open stream (thread-safe: streams notice on their next wake-up)"""
+        self._stream_epoch += 1
+
+    async def _events(self, path: str):
+        def event(kind: str, data: Any) -> bytes:
+            return f"event: {kind}\ndata: {json.dumps(data)}\n\n".encode()
+
+        queue: asyncio.Queue = asyncio.Queue()
+        entry = (path, queue)
+        epoch = self._stream_epoch
+        self._streams.append(entry)
+        try:
+            yield event("put", {"path": "/", "data": _to_json(self.read(path))})
+            last_sent = time.monotonic()
+            while epoch == self._stream_epoch:
+                try:
+                    kind, relative, data = await asyncio.wait_for(queue.get(), 0.1)
+                except asyncio.TimeoutError:
+                    if time.monotonic() - last_sent >= self.keepalive_seconds:
+                        last_sent = time.monotonic()
+                        yield event("keep-alive", None)
+                    continue
+                last_sent = time.monotonic()
+                yield event(kind, {"path": relative, "data": data})
+        finally:
+            self._streams.remove(entry)
+
+    # ---- faults ----
+
+    async def inject(self, method: str) -> Optional[Response]:
+        f = self.faults
+        if method not in f.methods:
+            return None
+        delay = f.latency + (random.uniform(0, f.jitter) if f.jitter else 0)
+        if f.slow_next > 0:
+            f.slow_next -= 1
+            delay = f.slow_latency
+        if delay:
+            await asyncio.sleep(delay)
+        if f.fail_next > 0:
+            f.fail_next -= 1
+            return JSONResponse({"error": "injected failure"}, status_code=f.error_status)
+        if f.error_rate and random.random() < f.error_rate:
+            return JSONResponse({"error": "injected failure"}, status_code=f.error_status)
+        return None
+
+    # ---- HTTP ----
+
+    def etag(self, path: str) -> str:
+        """Digest of the value at `path`, as sent with X-Firebase-ETag and checked against if-match"""
+        value = json.dumps(_to_json(self.read(path)), sort_keys=True, separators=(",", ":"))
+        return hashlib.sha1(value.encode()).hexdigest()
+
+    async def handle(self, request: Request):
+        path = request.path_params["path"]
+        if path.endswith(".json"):
+            path = path[:-5]
+        method = request.method
+        self.requests.append((method, path, dict(request.query_params)))
+        fault = await self.inject(method)
+        if fault is not None:
+            return fault
+        body = await request.body()
+        payload = json.loads(body) if body else None
+        if method == "GET" and request.headers.get("accept") == "text/event-stream":
+            return StreamingResponse(self._events(path), media_type="text/event-stream")
+        if method == "GET":
+            headers = {"ETag": self.etag(path)} if request.headers.get("x-firebase-etag") == "true" else None
+            return JSONResponse(_to_json(self.query(self.read(path), request)), headers=headers)
+        expected = request.headers.get("if-match")
+        if expected and method in ("PUT", "DELETE") and expected != self.etag(path):
+            return JSONResponse(_to_json(self.read(path)), status_code=412, headers={"ETag": self.etag(path)})
+        if method == "PUT":
+            value = self.resolve_server_values(path, payload)
+            self.write(path, value)
+            self._notify("put", path, value)
+            return JSONResponse(value)
+        if method == "POST":
+            key = self.push_key()
+            value = self.resolve_server_values(f"{path}/{key}", payload)
+            self.write(f"{path}/{key}", value)
+            self._notify("put", f"{path}/{key}", value)
+            return JSONResponse({"name": key})
+        if method == "PATCH":
+            resolved = {}
+            for key, value in (payload or {}).items():
+                child = f"{path}/{key}" if path else key
+                resolved[key] = self.resolve_server_values(child, value)
+                self.write(child, resolved[key])
+            self._notify("patch", path, resolved)
+            return JSONResponse(payload)
+        if method == "DELETE":
+            self.write(path, None)
+            self._notify("put", path, None)
+            return JSONResponse(None)
+        return Response(status_code=405)
+
+    def count(self, method: str, path: Optional[str] = None) -> int:
+        return sum(1 for m, p, _ in self.requests if m == method and (path is None or p == path))
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8791)
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="added to every request")
+    args = parser.parse_args()
+    standin = FirebaseStandin()
+    standin.faults.latency = args.latency_ms / 1000
+    uvicorn.run(standin.app, host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,172 @@
+"""
+Local stand-in for the Anthropic Messages API.
+
+Simulates prompt caching (prefixes ending at a `cache_control` breakpoint are
+remembered and billed as cache reads on the next call) and a latency model
+where uncached input tokens cost more than cached ones. Usable in-process via
+httpx.ASGITransport or served with uvicorn:
+
+    python -m standins.llm_server --port 8790
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import time
+from typing import Dict, List, Tuple
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+
+def count_tokens(text: str) -> int:
+    return max(1, len(text) // 4) if text else 0
+
+
+class LlmStandin:
+    LOOKBACK_BLOCKS = 20
+
+    def __init__(self, base_latency_ms: float = 5.0, uncached_ms_per_1k: float = 20.0,
+                 cached_ms_per_1k: float = 2.0, output_ms_per_token: float = 0.0,
+                 cache_ttl: float = 300.0, min_cacheable_tokens: int = 0, reply_words: int = 0):
+        self.base_latency_ms = base_latency_ms
+        self.uncached_ms_per_1k = uncached_ms_per_1k
+        self.cached_ms_per_1k = cached_ms_per_1k
+        self.output_ms_per_token = output_ms_per_token
+        self.cache_ttl = cache_ttl
+        self.min_cacheable_tokens = min_cacheable_tokens
+        self.reply_words = reply_words  # pad replies to this many words (longer streams)
+        self.cache: Dict[str, float] = {}
+        self.requests: List[dict] = []
+        self.overloaded: set = set()  # models that answer 529 overloaded_error
+        self.app = Starlette(routes=[Route("/v1/messages", self.messages, methods=["POST"]),
+                                     Route("/v1/models", self.models)])
+
+    # ---- prompt cache simulation ----
+
+    @staticmethod
+    def _blocks(payload: dict) -> List[Tuple[str, bool]]:
+        """Flatten the prompt into (text, is_breakpoint) blocks in prompt order"""
+        blocks = [(b.get("text", ""), "cache_control" in b) for b in payload.get("system", [])]
+        for msg in payload.get("messages", []):
+            content = msg["content"]
+            if isinstance(content, str):
+                blocks.append((content, False))
+            else:
+                blocks.extend((b.get("text", ""), "cache_control" in b) for b in content)
+        return blocks
+
+    def account(self, payload: dict) -> dict:
+        now = time.monotonic()
+        blocks = self._blocks(payload)
+        digest = hashlib.sha256(payload.get("model", "").encode())
+        prefix_tokens = 0
+        boundaries = []  # (prefix key, prefix tokens, is_breakpoint) after every block
+        for text, is_breakpoint in blocks:
+            digest.update(text.encode())
+            prefix_tokens += count_tokens(text)
+            boundaries.append((digest.copy().hexdigest(), prefix_tokens, is_breakpoint))
+        total = prefix_tokens
+        # Like the real API, a breakpoint also matches cached prefixes ending at earlier
+        # block boundaries (up to LOOKBACK_BLOCKS back), not only at itself
+        cached = 0
+        breakpoint_tokens = 0
+        breakpoint_keys = []
+        for i, (key, tokens, is_breakpoint) in enumerate(boundaries):
+            if not is_breakpoint:
+                continue
+            breakpoint_keys.append(key)
+            breakpoint_tokens = tokens
+            for prior_key, prior_tokens, _ in reversed(boundaries[max(0, i - self.LOOKBACK_BLOCKS):i + 1]):
+                if self.cache.get(prior_key, 0) > now:
+                    cached = max(cached, prior_tokens)
+                    break
+        write = 0
+        if breakpoint_tokens > cached and breakpoint_tokens >= self.min_cacheable_tokens:
+            write = breakpoint_tokens - cached
+        for key in breakpoint_keys:
+            if breakpoint_tokens >= self.min_cacheable_tokens:
+                self.cache[key] = now + self.cache_ttl
+        return {
+            "input_tokens": total - cached - write,
+            "cache_read_input_tokens": cached,
+            "cache_creation_input_tokens": write,
+        }
+
+    def reply_text(self, payload: dict) -> str:
+        last = payload["messages"][-1]["content"]
+        text = last if isinstance(last, str) else "".join(b.get("text", "") for b in last)
+        reply = f"Respuesta simulada a: {text[:80]}"
+        padding = self.reply_words - len(reply.split())
+        return reply + " palabra" * padding if padding > 0 else reply
+
+    async def models(self, request: Request):
+        await asyncio.sleep(self.base_latency_ms / 1000)
+        return JSONResponse({"data": [{"type": "model", "id": "claude-sonnet-4-5-20250929"}], "has_more": False})
+
+    async def messages(self, request: Request):
+        payload = json.loads(await request.body())
+        if payload.get("model") in self.overloaded:
+            return JSONResponse({"type": "error", "error": {"type": "overloaded_error", "message": "Overloaded"}},
+                                status_code=529)
+        usage = self.account(payload)
+        text = self.reply_text(payload)
+        usage["output_tokens"] = count_tokens(text)
+        self.requests.append({"payload": payload, "usage": usage})
+        uncached = usage["input_tokens"] + usage["cache_creation_input_tokens"]
+        delay_ms = (self.base_latency_ms
+                    + uncached / 1000 * self.uncached_ms_per_1k
+                    + usage["cache_read_input_tokens"] / 1000 * self.cached_ms_per_1k
+                    + usage["output_tokens"] * self.output_ms_per_token)
+        if payload.get("stream"):
+            return StreamingResponse(self._events(payload, text, usage, delay_ms), media_type="text/event-stream")
+        await asyncio.sleep(delay_ms / 1000)
+        return JSONResponse({
+            "id": f"msg_{len(self.requests)}",
+            "type": "message",
+            "role": "assistant",
+            "model": payload.get("model"),
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn",
+            "usage": usage,
+        })
+
+    async def _events(self, payload: dict, text: str, usage: dict, delay_ms: float):
+        """Messages API stream: the input cost before the first delta, then one word per delta"""
+        def event(kind: str, data: dict) -> bytes:
+            return f"event: {kind}\ndata: {json.dumps({'type': kind, **data})}\n\n".encode()
+
+        output_ms = usage["output_tokens"] * self.output_ms_per_token
+        await asyncio.sleep((delay_ms - output_ms) / 1000)
+        yield event("message_start", {"message": {
+            "id": f"msg_{len(self.requests)}", "type": "message", "role": "assistant", "model": payload.get("model"),
+            "content": [], "usage": dict(usage, output_tokens=0)}})
+        yield event("content_block_start", {"index": 0, "content_block": {"type": "text", "text": ""}})
+        words = text.split(" ")
+        began = time.perf_counter()
+        for i, word in enumerate(words):
+            # Paced against the start so per-delta overhead does not add up over a long answer
+            await asyncio.sleep(max(0.0, began + output_ms * (i + 1) / len(words) / 1000 - time.perf_counter()))
+            yield event("content_block_delta", {"index": 0, "delta": {
+                "type": "text_delta", "text": word if i == 0 else f" {word}"}})
+        yield event("content_block_stop", {"index": 0})
+        yield event("message_delta", {"delta": {"stop_reason": "end_turn"},
+                                      "usage": {"output_tokens": usage["output_tokens"]}})
+        yield event("message_stop", {})
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8790)
+    parser.add_argument("--base-latency-ms", type=float, default=5.0)
+    parser.add_argument("--output-ms-per-token", type=float, default=0.0)
+    parser.add_argument("--reply-words", type=int, default=0)
+    args = parser.parse_args()
+    standin = LlmStandin(base_latency_ms=args.base_latency_ms, output_ms_per_token=args.output_ms_per_token,
+                         reply_words=args.reply_words)
+    uvicorn.run(standin.app, host=args.host, port=args.port, log_level="warning")
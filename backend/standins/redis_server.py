@@ -0,0 +1,145 @@
+"""
+Local Redis stand-in speaking enough RESP2 for RedisStateBackend.
+
+Used by the tests and benchmarks so the shared state backend can be exercised
+across processes without a real Redis server.
+
+    python -m standins.redis_server --port 6390
+"""
+import argparse
+import asyncio
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+class RedisStandin:
+    def __init__(self):
+        self.data: Dict[bytes, Tuple[bytes, Optional[float]]] = {}
+        self.commands = 0
+        self._server = None
+
+    # ---- storage ----
+
+    def _get(self, key: bytes) -> Optional[bytes]:
+        item = self.data.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    def execute(self, args: List[bytes]):
+        self.commands += 1
+        cmd = args[0].upper()
+        if cmd in (b"PING",):
+            return b"+PONG"
+        if cmd in (b"CLIENT", b"SELECT"):
+            return b"+OK"
+        if cmd == b"GET":
+            return self._get(args[1])
+        if cmd == b"SET":
+            key, value = args[1], args[2]
+            ttl, nx = None, False
+            opts = [a.upper() for a in args[3:]]
+            i = 0
+            while i < len(opts):
+                if opts[i] == b"EX":
+                    ttl = float(opts[i + 1])
+                    i += 1
+                elif opts[i] == b"PX":
+                    ttl = float(opts[i + 1]) / 1000
+                    i += 1
+                elif opts[i] == b"NX":
+                    nx = True
+                i += 1
+            if nx and self._get(key) is not None:
+                return None
+            self.data[key] = (value, time.monotonic() + ttl if ttl else None)
+            return b"+OK"
+        if cmd in (b"INCR", b"INCRBY"):
+            key = args[1]
+            amount = int(args[2]) if cmd == b"INCRBY" else 1
+            current = self._get(key)
+            expires_at = self.data[key][1] if current is not None else None
+            value = (int(current) if current is not None else 0) + amount
+            self.data[key] = (str(value).encode(), expires_at)
+            return value
+        if cmd in (b"EXPIRE", b"PEXPIRE"):
+            key = args[1]
+            if self._get(key) is None:
+                return 0
+            ttl = float(args[2]) / (1000 if cmd == b"PEXPIRE" else 1)
+            self.data[key] = (self.data[key][0], time.monotonic() + ttl)
+            return 1
+        if cmd == b"DEL":
+            removed = 0
+            for key in args[1:]:
+                if self._get(key) is not None:
+                    removed += 1
+                self.data.pop(key, None)
+            return removed
+        if cmd == b"FLUSHALL":
+            self.data.clear()
+            return b"+OK"
+        return Exception(f"ERR unknown command '{cmd.decode()}'")
+
+    # ---- protocol ----
+
+    @staticmethod
+    def encode(value) -> bytes:
+        if value is None:
+            return b"$-1\r\n"
+        if isinstance(value, Exception):
+            return f"-{value}\r\n".encode()
+        if isinstance(value, int):
+            return f":{value}\r\n".encode()
+        if isinstance(value, bytes) and value[:1] == b"+":
+            return value + b"\r\n"
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.startswith(b"*"):
+                    args = line.strip().split()
+                else:
+                    args = []
+                    for _ in range(int(line[1:])):
+                        size = int((await reader.readline())[1:])
+                        args.append((await reader.readexactly(size + 2))[:-2])
+                if args:
+                    writer.write(self.encode(self.execute(args)))
+                    await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+
+async def _serve(host: str, port: int):
+    standin = RedisStandin()
+    bound = await standin.start(host, port)
+    print(f"redis stand-in listening on redis://{host}:{bound}/0", flush=True)
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    args = parser.parse_args()
+    asyncio.run(_serve(args.host, args.port))
@@ -0,0 +1,191 @@
+"""
+Cold archive for conversations nobody has touched in a while.
+
+`ArchivedConversations` wraps the hot conversation repository. Its
+`archive_inactive` job writes each conversation last updated before a cutoff
+to a compressed file (zstd when the `zstandard` package is installed, gzip
+otherwise) and replaces the hot document with a stub: id, owner, timestamps
+and an `archived` record (when, how many messages, compressed size). Lists
+read only the stubs, so full-collection reads stop paying for dormant
+history.
+
+`get` rehydrates a stub transparently: the archived document is written back
+to the hot store and the file removed, so the next turn appends to a normal
+conversation. `iter_for_user` (export) reads archived conversations without
+restoring them. Every other call goes to the hot repository unchanged.
+
+The file store is local; with more than one host, ARCHIVE_PATH has to be a
+shared volume.
+"""
+import asyncio
+import gzip
+import json
+import os
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Optional
+
+from metrics import metrics
+
+from .base import ConversationRepository
+
+try:
+    import zstandard
+except ImportError:  # zstandard is optional, gzip is always available
+    zstandard = None
+
+CODECS = (".zst", ".gz")
+
+
+def is_stub(conversation: Optional[dict]) -> bool:
+    return bool(conversation) and "archived" in conversation
+
+
+def _size(doc: dict) -> int:
+    return len(json.dumps(doc, ensure_ascii=False, separators=(",", ":")).encode())
+
+
+class ArchiveStore:
+    """One compressed JSON file per conversation, sharded by the first two characters of the id"""
+
+    def __init__(self, root: str, gzip_level: int = 6, zstd_level: int = 10):
+        self.root = Path(root)
+        self.gzip_level = gzip_level
+        self.zstd_level = zstd_level
+        self.suffix = ".zst" if zstandard else ".gz"
+
+    def _path(self, conversation_id: str, suffix: str) -> Path:
+        return self.root / conversation_id[:2] / f"{conversation_id}.json{suffix}"
+
+    def write(self, conversation: dict) -> int:
+        raw = json.dumps(conversation, ensure_ascii=False, separators=(",", ":")).encode()
+        if zstandard:
+            data = zstandard.ZstdCompressor(level=self.zstd_level).compress(raw)
+        else:
+            data = gzip.compress(raw, compresslevel=self.gzip_level, mtime=0)
+        path = self._path(conversation["id"], self.suffix)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        return len(data)
+
+    def read(self, conversation_id: str) -> Optional[dict]:
+        for suffix in CODECS:
+            path = self._path(conversation_id, suffix)
+            if path.exists():
+                data = path.read_bytes()
+                raw = zstandard.ZstdDecompressor().decompress(data) if suffix == ".zst" else gzip.decompress(data)
+                return json.loads(raw)
+        return None
+
+    def delete(self, conversation_id: str):
+        for suffix in CODECS:
+            self._path(conversation_id, suffix).unlink(missing_ok=True)
+
+
+class ArchivedConversations(ConversationRepository):
+    def __init__(self, hot: ConversationRepository, store: ArchiveStore):
+        self.hot = hot
+        self.store = store
+        self._rehydrating: Dict[str, asyncio.Lock] = {}
+
+    async def get(self, conversation_id):
+        conversation = await self.hot.get(conversation_id)
+        return await self.rehydrate(conversation_id) if is_stub(conversation) else conversation
+
+    async def rehydrate(self, conversation_id: str) -> Optional[dict]:
+        lock = self._rehydrating.setdefault(conversation_id, asyncio.Lock())
+        try:
+            async with lock:
+                began = time.perf_counter()
+                # Another request may have restored it while we waited
+                conversation = await self.hot.get(conversation_id)
+                if not is_stub(conversation):
+                    return conversation
+                archived = await asyncio.to_thread(self.store.read, conversation_id)
+                if archived is None:
+                    metrics.incr("archive_missing")
+                    return conversation
+                await self.hot.replace(archived)
+                await asyncio.to_thread(self.store.delete, conversation_id)
+                metrics.incr("archive_rehydrated")
+                metrics.incr("archive_hot_bytes_restored", _size(archived) - _size(conversation))
+                metrics.observe("archive_rehydrate_ms", (time.perf_counter() - began) * 1000)
+                return archived
+        finally:
+            if not lock.locked():
+                self._rehydrating.pop(conversation_id, None)
+
+    async def read_archived(self, conversation_id: str) -> Optional[dict]:
+        """The archived document, without restoring it"""
+        return await asyncio.to_thread(self.store.read, conversation_id)
+
+    async def list_for_user(self, user_id, limit=None):
+        return await self.hot.list_for_user(user_id, limit)
+
+    async def iter_for_user(self, user_id, page_size=100):
+        async for conv_id, conv in self.hot.iter_for_user(user_id, page_size):
+            if is_stub(conv):
+                conv = await self.read_archived(conv_id) or conv
+            yield conv_id, conv
+
+    async def create(self, conversation):
+        await self.hot.create(conversation)
+
+    async def create_many(self, conversations):
+        await self.hot.create_many(conversations)
+
+    async def delete(self, conversation_id, user_id=None):
+        await self.hot.delete(conversation_id, user_id)
+        await asyncio.to_thread(self.store.delete, conversation_id)
+
+    async def append_messages(self, conversation_id, first_index, messages, updated_at, user_id=None):
+        await self.hot.append_messages(conversation_id, first_index, messages, updated_at, user_id)
+
+    async def set_summary(self, conversation_id, summary):
+        await self.hot.set_summary(conversation_id, summary)
+
+    async def set_meta(self, conversation, meta):
+        await self.hot.set_meta(conversation, meta)
+
+    async def list_meta_for_user(self, user_id, limit=None):
+        return await self.hot.list_meta_for_user(user_id, limit)
+
+    async def rebuild_meta_index(self, page_size=100):
+        return await self.hot.rebuild_meta_index(page_size)
+
+    async def replace(self, conversation):
+        await self.hot.replace(conversation)
+
+    async def replace_if_unchanged(self, conversation, updated_at):
+        return await self.hot.replace_if_unchanged(conversation, updated_at)
+
+    def iter_inactive(self, before, page_size=100):
+        return self.hot.iter_inactive(before, page_size)
+
+    async def archive_inactive(self, before: str, limit: int = 500, page_size: int = 100) -> int:
+        """Move up to `limit` conversations last updated before `before` to the archive"""
+        archived = 0
+        async for conv_id, conv in self.hot.iter_inactive(before, page_size):
+            if archived >= limit:
+                break
+            if is_stub(conv) or not conv.get("messages"):
+                continue
+            conv = dict(conv, id=conv.get("id", conv_id))
+            compressed = await asyncio.to_thread(self.store.write, conv)
+            stub = {key: conv[key] for key in ("id", "user_id", "created_at", "updated_at", "meta")
+                    if key in conv}
+            stub["archived"] = {"at": datetime.now(timezone.utc).isoformat(),
+                                "messages": sum(1 for m in conv["messages"] if m), "bytes": compressed}
+            # Written to meanwhile (checked in the same write as the swap): it stays hot
+            if not await self.hot.replace_if_unchanged(stub, conv["updated_at"]):
+                await asyncio.to_thread(self.store.delete, conv_id)
+                metrics.incr("archive_skipped_written")
+                continue
+            archived += 1
+            metrics.incr("archive_conversations")
+            metrics.incr("archive_hot_bytes_freed", _size(conv) - _size(stub))
+            metrics.incr("archive_compressed_bytes", compressed)
+        return archived
@@ -0,0 +1,155 @@
+"""
+Repository interfaces used by the handlers.
+
+Documents are plain dicts in the same shape the app has always stored in
+Firebase; each backend decides how to lay them out and query them.
+"""
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+
+class UserRepository:
+    async def get(self, user_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def get_by_email(self, email: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def emails(self) -> List[str]:
+        """Every registered email; read once per worker to build the email Bloom filter"""
+        raise NotImplementedError
+
+    async def create(self, user: dict) -> dict:
+        """Store a new user and return it as later reads will (with any storage keys)"""
+        raise NotImplementedError
+
+    async def update(self, user: dict, fields: dict) -> bool:
+        raise NotImplementedError
+
+
+class ApiKeyRepository:
+    async def get(self, key_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def all(self) -> Dict[str, dict]:
+        """Every key by id; API key lookup has to bcrypt-check each hash"""
+        raise NotImplementedError
+
+    async def list_for_user(self, user_id: str) -> Dict[str, dict]:
+        raise NotImplementedError
+
+    async def create(self, key_id: str, key: dict) -> None:
+        raise NotImplementedError
+
+    async def delete(self, key_id: str) -> None:
+        raise NotImplementedError
+
+    async def touch(self, last_used: Dict[str, str]) -> None:
+        """Set last_used for a batch of keys in one write"""
+        raise NotImplementedError
+
+
+class ConversationRepository:
+    async def get(self, conversation_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def list_for_user(self, user_id: str, limit: Optional[int] = None) -> List[Tuple[str, dict]]:
+        """(id, conversation) pairs, most recently updated first"""
+        raise NotImplementedError
+
+    def iter_for_user(self, user_id: str, page_size: int = 100) -> AsyncIterator[Tuple[str, dict]]:
+        """Every conversation of the user, read page by page, in no particular order"""
+        raise NotImplementedError
+
+    async def create(self, conversation: dict) -> None:
+        raise NotImplementedError
+
+    async def create_many(self, conversations: List[dict]) -> None:
+        """Several new conversations in one write"""
+        raise NotImplementedError
+
+    async def delete(self, conversation_id: str, user_id: Optional[str] = None) -> None:
+        """`user_id`, when the caller knows it, saves a lookup where the metadata index is kept per user"""
+        raise NotImplementedError
+
+    async def append_messages(self, conversation_id: str, first_index: int, messages: List[dict],
+                              updated_at: str, user_id: Optional[str] = None) -> None:
+        """Store messages at first_index onwards without rewriting the rest of the conversation"""
+        raise NotImplementedError
+
+    async def set_summary(self, conversation_id: str, summary: dict) -> None:
+        raise NotImplementedError
+
+    async def set_meta(self, conversation: dict, meta: dict) -> None:
+        """Title and preview of the conversation (see titles.py)"""
+        raise NotImplementedError
+
+    async def list_meta_for_user(self, user_id: str, limit: Optional[int] = None) -> List[Tuple[str, dict]]:
+        """(id, listing) pairs, most recently updated first, without reading messages. A listing has
+        user_id, created_at, updated_at, message_count and, once generated, meta"""
+        raise NotImplementedError
+
+    async def rebuild_meta_index(self, page_size: int = 100) -> int:
+        """Write the listing of every conversation where listings are stored apart (conversations
+        created before the index existed); returns how many were written"""
+        return 0
+
+    async def replace(self, conversation: dict) -> None:
+        """Write the whole conversation over the stored one (archive stubs and their rehydration)"""
+        raise NotImplementedError
+
+    async def replace_if_unchanged(self, conversation: dict, updated_at: str) -> bool:
+        """replace(), atomically, only while the stored conversation's updated_at is still `updated_at`;
+        False when it was written to meanwhile (or is gone)"""
+        raise NotImplementedError
+
+    def iter_inactive(self, before: str, page_size: int = 100) -> AsyncIterator[Tuple[str, dict]]:
+        """Every conversation last updated before `before`, read page by page"""
+        raise NotImplementedError
+
+
+class TransactionRepository:
+    async def create(self, transaction_id: str, transaction: dict) -> None:
+        """Direct plan purchases"""
+        raise NotImplementedError
+
+    async def create_payment(self, transaction_id: str, payment: dict) -> None:
+        """Stripe checkout sessions"""
+        raise NotImplementedError
+
+    async def find_payment(self, session_id: str) -> Optional[Tuple[str, dict]]:
+        raise NotImplementedError
+
+    async def update_payment(self, transaction_id: str, fields: dict) -> None:
+        raise NotImplementedError
+
+
+class UsageRepository:
+    async def record(self, event_id: str, record: dict, at: datetime) -> None:
+        """Store a raw usage event and add it to the hourly/daily rollups, atomically"""
+        raise NotImplementedError
+
+    async def rollups(self, user_id: str, api_key_id: Optional[str], granularity: str,
+                      start_bucket: str, end_bucket: str) -> Dict[str, dict]:
+        """Counters by bucket key for start_bucket..end_bucket (inclusive)"""
+        raise NotImplementedError
+
+    async def purge_before(self, cutoff: str) -> int:
+        """Delete raw events with a timestamp up to cutoff; returns how many"""
+        raise NotImplementedError
+
+
+class Storage:
+    name = "base"
+    users: UserRepository
+    api_keys: ApiKeyRepository
+    conversations: ConversationRepository
+    transactions: TransactionRepository
+    usage: UsageRepository
+
+    async def ping(self, timeout: Optional[float] = None) -> bool:
+        """A cheap round trip; `timeout` bounds it where the backend has a deadline of its own"""
+        return True
+
+    async def close(self) -> None:
+        pass
@@ -0,0 +1,300 @@
+"""
+Firebase Realtime Database repositories.
+
+The layout is the one the app has always used (`users`, `api_keys`,
+`conversations`, `transactions`, `payment_transactions`, `api_usage`,
+`usage_rollups`). Lookups by a field other than the key still download the
+collection, as before; the relational backend is the one with indexes.
+
+`conversation_meta/<user_id>/<conversation_id>` holds each conversation's
+listing (timestamps, message count, title and preview), written in the same
+multi-path update as the conversation, so a user's list is one small read.
+
+`users` and `api_keys` can be mirrored: while a stream listener keeps the
+mirror live (see firebase_stream.py), reads are served from memory and
+writes are applied to the mirror as soon as Firebase accepts them, so a
+caller reads its own writes before the stream event arrives.
+"""
+import json
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+from firebase_client import FirebaseClient
+from firebase_stream import Mirror
+from metrics import metrics
+from usage_rollups import purge_raw_events, rollup_root, rollup_updates
+
+from .archive import is_stub
+from .base import (ApiKeyRepository, ConversationRepository, Storage, TransactionRepository,
+                   UsageRepository, UserRepository)
+
+
+class _Repository:
+    def __init__(self, client: FirebaseClient, mirrors: Optional[Dict[str, Mirror]] = None):
+        self.client = client
+        self.mirrors = mirrors if mirrors is not None else {}
+
+    def live_mirror(self, collection: str) -> Optional[Mirror]:
+        mirror = self.mirrors.get(collection)
+        if mirror is not None and mirror.live:
+            metrics.incr("firebase_mirror_reads", node=collection)
+            return mirror
+        return None
+
+    def write_through(self, collection: str, kind: str, path: str, data):
+        mirror = self.mirrors.get(collection)
+        if mirror is not None and mirror.synced:
+            mirror.apply(kind, path, data)
+
+    async def find_by_field(self, collection: str, field: str, value) -> Optional[Tuple[str, dict]]:
+        mirror = self.live_mirror(collection)
+        data = mirror.data if mirror else await self.client.get(collection)
+        for doc_id, doc in (data or {}).items():
+            if doc and doc.get(field) == value:
+                return doc_id, mirror.get(doc_id) if mirror else doc
+        return None
+
+
+class FirebaseUsers(_Repository, UserRepository):
+    """User docs live under push keys; the key is carried as `_firebase_id`"""
+
+    async def _find(self, field: str, value: str) -> Optional[dict]:
+        found = await self.find_by_field("users", field, value)
+        if not found:
+            return None
+        doc_id, doc = found
+        doc["_firebase_id"] = doc_id
+        return doc
+
+    async def get(self, user_id):
+        return await self._find("id", user_id)
+
+    async def get_by_email(self, email):
+        return await self._find("email", email)
+
+    async def emails(self):
+        mirror = self.live_mirror("users")
+        data = mirror.data if mirror else await self.client.get("users")
+        return [doc["email"] for doc in (data or {}).values() if doc and doc.get("email")]
+
+    async def create(self, user):
+        firebase_id = await self.client.post("users", user)
+        if not firebase_id:
+            raise RuntimeError("Firebase did not return a key for the new user")
+        self.write_through("users", "put", firebase_id, dict(user))
+        return dict(user, _firebase_id=firebase_id)
+
+    async def update(self, user, fields):
+        ok = await self.client.patch(f"users/{user['_firebase_id']}", fields)
+        if ok:
+            self.write_through("users", "patch", user["_firebase_id"], dict(fields))
+        return ok
+
+
+class FirebaseApiKeys(_Repository, ApiKeyRepository):
+    async def get(self, key_id):
+        mirror = self.live_mirror("api_keys")
+        if mirror:
+            return mirror.get(key_id)
+        return await self.client.get(f"api_keys/{key_id}")
+
+    async def all(self):
+        mirror = self.live_mirror("api_keys")
+        if mirror:
+            return {key_id: dict(key) for key_id, key in mirror.data.items() if key}
+        return await self.client.get("api_keys") or {}
+
+    async def list_for_user(self, user_id):
+        return {key_id: key for key_id, key in (await self.all()).items() if key and key.get("user_id") == user_id}
+
+    async def create(self, key_id, key):
+        await self.client.put(f"api_keys/{key_id}", key)
+        self.write_through("api_keys", "put", key_id, dict(key))
+
+    async def delete(self, key_id):
+        await self.client.delete(f"api_keys/{key_id}")
+        self.write_through("api_keys", "put", key_id, None)
+
+    async def touch(self, last_used):
+        updates = {f"{key_id}/last_used": ts for key_id, ts in last_used.items()}
+        await self.client.patch("api_keys", updates)
+        self.write_through("api_keys", "patch", "", updates)
+
+
+def _listing(conversation: dict) -> dict:
+    listing = {"created_at": conversation["created_at"], "updated_at": conversation["updated_at"],
+               "message_count": len(conversation.get("messages") or [])}
+    if is_stub(conversation):
+        listing["message_count"] = conversation["archived"]["messages"]
+    if conversation.get("meta"):
+        listing["meta"] = conversation["meta"]
+    return listing
+
+
+class FirebaseConversations(_Repository, ConversationRepository):
+    async def get(self, conversation_id):
+        return await self.client.get(f"conversations/{conversation_id}")
+
+    async def _owner(self, conversation_id: str, user_id: Optional[str]) -> Optional[str]:
+        return user_id or await self.client.get(f"conversations/{conversation_id}/user_id")
+
+    async def list_for_user(self, user_id, limit=None):
+        all_convs = await self.client.get("conversations") or {}
+        user_convs = [(conv_id, conv) for conv_id, conv in all_convs.items()
+                      if conv and conv.get("user_id") == user_id]
+        user_convs.sort(key=lambda item: item[1]["updated_at"], reverse=True)
+        return user_convs[:limit] if limit else user_convs
+
+    async def _pages(self, page_size):
+        # The whole collection by key; each page repeats the last key of the previous one
+        last = None
+        while True:
+            params = {"orderBy": '"$key"', "limitToFirst": page_size + (last is not None)}
+            if last is not None:
+                params["startAt"] = json.dumps(last)
+            page = await self.client.get("conversations", params=params) or {}
+            keys = sorted(key for key in page if key != last)
+            for conv_id in keys:
+                if page[conv_id]:
+                    yield conv_id, page[conv_id]
+            if len(keys) < page_size:
+                return
+            last = keys[-1]
+
+    async def iter_for_user(self, user_id, page_size=100):
+        async for conv_id, conv in self._pages(page_size):
+            if conv.get("user_id") == user_id:
+                yield conv_id, conv
+
+    async def iter_inactive(self, before, page_size=100):
+        # No index on updated_at is assumed in the database rules, so this reads every page
+        async for conv_id, conv in self._pages(page_size):
+            if conv.get("updated_at", "") < before:
+                yield conv_id, conv
+
+    async def create(self, conversation):
+        await self.create_many([conversation])
+
+    async def create_many(self, conversations):
+        updates = {}
+        for conv in conversations:
+            updates[f"conversations/{conv['id']}"] = conv
+            updates[f"conversation_meta/{conv['user_id']}/{conv['id']}"] = _listing(conv)
+        await self.client.patch("", updates)
+
+    async def delete(self, conversation_id, user_id=None):
+        user_id = await self._owner(conversation_id, user_id)
+        updates = {f"conversations/{conversation_id}": None}
+        if user_id:
+            updates[f"conversation_meta/{user_id}/{conversation_id}"] = None
+        await self.client.patch("", updates)
+
+    async def append_messages(self, conversation_id, first_index, messages, updated_at, user_id=None):
+        root = f"conversations/{conversation_id}"
+        updates = {f"{root}/messages/{first_index + i}": msg for i, msg in enumerate(messages)}
+        updates[f"{root}/updated_at"] = updated_at
+        user_id = await self._owner(conversation_id, user_id)
+        if user_id:
+            listing = f"conversation_meta/{user_id}/{conversation_id}"
+            updates[f"{listing}/updated_at"] = updated_at
+            updates[f"{listing}/message_count"] = first_index + len(messages)
+        await self.client.patch("", updates)
+
+    async def set_summary(self, conversation_id, summary):
+        await self.client.put(f"conversations/{conversation_id}/summary", summary)
+
+    async def set_meta(self, conversation, meta):
+        await self.client.patch("", {
+            f"conversations/{conversation['id']}/meta": meta,
+            f"conversation_meta/{conversation['user_id']}/{conversation['id']}/meta": meta,
+        })
+
+    async def list_meta_for_user(self, user_id, limit=None):
+        listings = await self.client.get(f"conversation_meta/{user_id}") or {}
+        user_convs = [(conv_id, {"id": conv_id, "user_id": user_id, **listing})
+                      for conv_id, listing in listings.items() if listing and "updated_at" in listing]
+        user_convs.sort(key=lambda item: item[1]["updated_at"], reverse=True)
+        return user_convs[:limit] if limit else user_convs
+
+    async def rebuild_meta_index(self, page_size=100):
+        written = 0
+        updates = {}
+        async for conv_id, conv in self._pages(page_size):
+            if not conv.get("user_id") or not conv.get("updated_at"):
+                continue
+            updates[f"conversation_meta/{conv['user_id']}/{conv_id}"] = _listing({"created_at": "", **conv})
+            if len(updates) >= page_size:
+                await self.client.patch("", updates)
+                written += len(updates)
+                updates = {}
+        if updates:
+            await self.client.patch("", updates)
+            written += len(updates)
+        return written
+
+    async def replace(self, conversation):
+        await self.client.put(f"conversations/{conversation['id']}", conversation)
+
+    async def replace_if_unchanged(self, conversation, updated_at):
+        path = f"conversations/{conversation['id']}"
+        current, tag = await self.client.get_with_etag(path)
+        if not current or current.get("updated_at") != updated_at or not tag:
+            return False
+        # A write between the read and the PUT changes the ETag and the PUT is refused
+        return await self.client.put_if_match(path, conversation, tag)
+
+
+class FirebaseTransactions(_Repository, TransactionRepository):
+    async def create(self, transaction_id, transaction):
+        await self.client.put(f"transactions/{transaction_id}", transaction)
+
+    async def create_payment(self, transaction_id, payment):
+        await self.client.put(f"payment_transactions/{transaction_id}", payment)
+
+    async def find_payment(self, session_id):
+        return await self.find_by_field("payment_transactions", "session_id", session_id)
+
+    async def update_payment(self, transaction_id, fields):
+        await self.client.patch(f"payment_transactions/{transaction_id}", fields)
+
+
+class FirebaseUsage(_Repository, UsageRepository):
+    async def record(self, event_id, record, at: datetime):
+        # Raw event and rollup increments in one atomic write; increments must not be replayed
+        updates = {f"api_usage/{event_id}": record, **rollup_updates(record, at)}
+        await self.client.patch("", updates, idempotent=False)
+
+    async def rollups(self, user_id, api_key_id, granularity, start_bucket, end_bucket):
+        return await self.client.get(f"{rollup_root(user_id, api_key_id)}/{granularity}", params={
+            "orderBy": '"$key"',
+            "startAt": f'"{start_bucket}"',
+            "endAt": f'"{end_bucket}"',
+        }) or {}
+
+    async def purge_before(self, cutoff):
+        return await purge_raw_events(self.client, cutoff)
+
+
+class FirebaseStorage(Storage):
+    name = "firebase"
+
+    def __init__(self, client: FirebaseClient):
+        self.client = client
+        self.mirrors: Dict[str, Mirror] = {}
+        self.users = FirebaseUsers(client, self.mirrors)
+        self.api_keys = FirebaseApiKeys(client, self.mirrors)
+        self.conversations = FirebaseConversations(client)
+        self.transactions = FirebaseTransactions(client)
+        self.usage = FirebaseUsage(client)
+
+    def mirror(self, collection: str) -> Mirror:
+        """Mirror for `collection`, used for reads once a listener makes it live"""
+        return self.mirrors.setdefault(collection, Mirror(collection))
+
+    async def ping(self, timeout=None):
+        # Top-level keys only: a round trip that does not depend on the size of the data
+        await self.client.get("", {"shallow": "true"}, timeout=timeout)
+        return True
+
+    async def close(self):
+        await self.client.close()
@@ -0,0 +1,14 @@
+import os
+import sys
+from pathlib import Path
+
+# Make the backend modules importable from the tests
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# Keep local indexes off the filesystem
+os.environ.setdefault("SEARCH_INDEX_PATH", ":memory:")
+os.environ.setdefault("SEMANTIC_CACHE_PATH", "")
+# No background read of the users collection for the email filter
+os.environ.setdefault("EMAIL_FILTER", "false")
+# Titles are generated by tests that start their own worker
+os.environ.setdefault("TITLE_GENERATION", "false")
@@ -0,0 +1,139 @@
+"""
+Archive tests - dormant conversations become stubs, reads rehydrate them, export sees archived messages
+"""
+import asyncio
+import json
+from datetime import datetime, timezone
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+from firebase_client import FirebaseClient
+from llm import AnthropicProvider, LlmClient
+from metrics import metrics
+from standins.firebase_server import FirebaseStandin
+from standins.llm_server import LlmStandin
+from storage import ArchivedConversations, ArchiveStore, FirebaseStorage, SqlStorage, is_stub
+
+OLD = "2024-01-01T00:00:00+00:00"
+RECENT = "2024-06-01T00:00:00+00:00"
+CUTOFF = "2024-03-01T00:00:00+00:00"
+
+
+def conversation(conv_id, updated_at, messages=20):
+    return {"id": conv_id, "user_id": "u1", "created_at": OLD, "updated_at": updated_at,
+            "messages": [{"id": f"{conv_id}-{i}", "role": "user" if i % 2 == 0 else "assistant",
+                          "content": f"Mensaje {i} sobre el informe trimestral de ventas.", "timestamp": updated_at}
+                         for i in range(messages)]}
+
+
+def test_archive_and_rehydrate_sql(tmp_path):
+    async def scenario():
+        storage = SqlStorage("sqlite:///:memory:")
+        conversations = ArchivedConversations(storage.conversations, ArchiveStore(str(tmp_path)))
+        await conversations.create_many([conversation("c1", OLD), conversation("c2", OLD), conversation("c3", RECENT)])
+        original = await conversations.get("c1")
+
+        assert await conversations.archive_inactive(CUTOFF) == 2
+        assert await conversations.archive_inactive(CUTOFF) == 0
+        stub = await storage.conversations.get("c1")
+        assert is_stub(stub) and stub["messages"] == [] and stub["archived"]["messages"] == 20
+        listed = dict(await conversations.list_for_user("u1"))
+        assert is_stub(listed["c2"]) and not is_stub(listed["c3"])
+        assert len(list(tmp_path.rglob("*.json.*"))) == 2
+
+        # Export reads the archive without restoring
+        exported = {conv_id: conv async for conv_id, conv in conversations.iter_for_user("u1")}
+        assert exported["c2"]["messages"] == conversation("c2", OLD)["messages"]
+        assert is_stub(await storage.conversations.get("c2"))
+
+        restored = await asyncio.gather(conversations.get("c1"), conversations.get("c1"))
+        assert restored[0] == restored[1] == original
+        assert not is_stub(await storage.conversations.get("c1"))
+        assert len(list(tmp_path.rglob("*.json.*"))) == 1
+
+        counters = metrics.snapshot()["counters"]
+        assert counters["archive_conversations"] == 2 and counters["archive_rehydrated"] == 1
+        assert counters["archive_hot_bytes_freed"] > 2 * counters["archive_compressed_bytes"]
+        assert metrics.snapshot()["summaries"]["archive_rehydrate_ms"]["count"] == 1
+        await storage.close()
+
+    metrics.reset()
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("backend", ["firebase", "sqlite"])
+def test_turn_appended_while_archiving_is_kept(tmp_path, backend):
+    standin = FirebaseStandin()
+    storage = (FirebaseStorage(FirebaseClient("http://firebase.test", transport=httpx.ASGITransport(app=standin.app)))
+               if backend == "firebase" else SqlStorage("sqlite:///:memory:"))
+    store = ArchiveStore(str(tmp_path))
+    conversations = ArchivedConversations(storage.conversations, store)
+    turn = {"id": "nuevo", "role": "user", "content": "¿Sigues ahí?", "timestamp": RECENT}
+
+    async def scenario():
+        await conversations.create(conversation("c1", OLD))
+        loop = asyncio.get_running_loop()
+        write = store.write
+
+        def write_during_turn(conv):
+            # The turn lands after the conversation was read for archiving, before the swap
+            asyncio.run_coroutine_threadsafe(
+                storage.conversations.append_messages("c1", 20, [turn], RECENT), loop).result()
+            return write(conv)
+
+        store.write = write_during_turn
+        assert await conversations.archive_inactive(CUTOFF) == 0
+        stub = {"id": "c1", "user_id": "u1", "created_at": OLD, "updated_at": OLD, "archived": {"messages": 20}}
+        assert not await storage.conversations.replace_if_unchanged(stub, OLD)
+        if backend == "firebase":
+            # The ETag catches a write between the check and the swap, even one that keeps updated_at
+            _, tag = await storage.client.get_with_etag("conversations/c1")
+            await storage.conversations.append_messages("c1", 21, [dict(turn, id="otro")], RECENT)
+            assert not await storage.client.put_if_match("conversations/c1", stub, tag)
+        return await storage.conversations.get("c1")
+
+    metrics.reset()
+    kept = asyncio.run(scenario())
+    assert not is_stub(kept) and kept["messages"][20]["id"] == "nuevo"
+    assert not list(tmp_path.rglob("*.json.*"))
+    assert metrics.snapshot()["counters"]["archive_skipped_written"] == 1
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    metrics.reset()
+    now = datetime.now(timezone.utc).isoformat()
+    standin = FirebaseStandin({"conversations": {"c1": conversation("c1", OLD), "c2": conversation("c2", now)}})
+    storage = FirebaseStorage(FirebaseClient("http://firebase.test", transport=httpx.ASGITransport(app=standin.app)))
+    storage.conversations = ArchivedConversations(storage.conversations, ArchiveStore(str(tmp_path)))
+    monkeypatch.setattr(server, "storage", storage)
+    monkeypatch.setattr(server, "llm", LlmClient(AnthropicProvider(
+        "k", base_url="http://llm.test", transport=httpx.ASGITransport(app=LlmStandin(base_latency_ms=0).app))))
+    monkeypatch.setattr(server, "update_user", lambda *args: asyncio.sleep(0))
+    monkeypatch.setattr(server, "ARCHIVE_AFTER_DAYS", 30)
+    server.app.dependency_overrides[server.get_current_user] = lambda: {"id": "u1", "credits": 10}
+    try:
+        with TestClient(server.app) as client:
+            yield client, standin
+    finally:
+        server.app.dependency_overrides.clear()
+
+
+def test_archived_conversation_is_listed_and_restored_on_open(app):
+    client, standin = app
+    hot_before = len(json.dumps(standin.read("conversations/c1")))
+    assert client.portal.call(server.archive_conversations) == 1
+    assert len(json.dumps(standin.read("conversations/c1"))) < hot_before / 10
+
+    listed = {conv["id"]: conv for conv in client.get("/api/chat/conversations").json()}
+    assert listed["c1"]["archived"] is True and listed["c1"]["message_count"] == 20
+    assert listed["c1"]["messages"] == [] and "archived" not in listed["c2"]
+
+    opened = client.get("/api/chat/conversations/c1").json()
+    assert len(opened["messages"]) == 20 and "archived" not in opened
+    reply = client.post("/api/chat/conversations/c1/messages", json={"content": "¿Y el resumen?"})
+    assert reply.status_code == 200
+    assert len(standin.read("conversations/c1")["messages"]) == 22
@@ -0,0 +1,189 @@
+"""
+Chat WebSocket tests - one authentication per connection, streamed answers, incremental persistence,
+backpressure, cancellation and the per-user connection cap
+"""
+import asyncio
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+import server
+from compaction import SUMMARY_SYSTEM_PROMPT, Compactor
+from llm import AnthropicProvider, LlmClient
+from realtime import Outbox, OutboxFull
+from search import SearchIndex
+from shared_state import MemoryStateBackend
+from standins.llm_server import LlmStandin
+from storage import SqlStorage
+
+
+@pytest.fixture
+def env(monkeypatch):
+    storage = SqlStorage("sqlite:///:memory:")
+    user = asyncio.run(storage.users.create({
+        "id": "u1", "name": "Ana", "email": "ana@brainyx.com", "password_hash": "x", "credits": 10,
+        "plan": "estandar", "created_at": "2024-01-01T00:00:00+00:00"}))
+    standin = LlmStandin(base_latency_ms=0, reply_words=20)
+    llm = LlmClient(AnthropicProvider("k", base_url="http://llm.test", transport=httpx.ASGITransport(app=standin.app)))
+    lookups = []
+    real_get = storage.users.get
+
+    async def counting_get(user_id):
+        lookups.append(user_id)
+        return await real_get(user_id)
+
+    monkeypatch.setattr(storage.users, "get", counting_get)
+    monkeypatch.setattr(server, "storage", storage)
+    monkeypatch.setattr(server, "llm", llm)
+    monkeypatch.setattr(server, "state", MemoryStateBackend())
+    monkeypatch.setattr(server, "search_index", SearchIndex())
+    monkeypatch.setattr(server, "compactor", Compactor(llm, model="m", load=storage.conversations.get,
+                                                       store=storage.conversations.set_summary, enabled=False))
+    monkeypatch.setattr(server, "ws_connections", server.ConnectionLimiter(2))
+    server._token_cache.clear()
+    with TestClient(server.app) as client:
+        yield {"client": client, "storage": storage, "standin": standin, "lookups": lookups,
+               "token": server.create_token(user), "user": user}
+
+
+def connect(env):
+    ws = env["client"].websocket_connect("/api/chat/ws")
+    session = ws.__enter__()
+    session.send_json({"type": "auth", "token": env["token"]})
+    assert session.receive_json()["type"] == "ready"
+    return ws, session
+
+
+def until(session, kind):
+    received = []
+    while True:
+        message = session.receive_json()
+        received.append(message)
+        if message["type"] == kind:
+            return received
+
+
+def test_turns_stream_and_persist(env):
+    ws, session = connect(env)
+    session.send_json({"type": "open"})
+    conversation_id = session.receive_json()["conversation_id"]
+    lookups_after_open = len(env["lookups"])
+
+    for i in range(2):
+        session.send_json({"type": "message", "content": f"pregunta {i}", "ref": f"t{i}"})
+        received = until(session, "done")
+        assert received[0]["type"] == "start"
+        text = "".join(m["text"] for m in received if m["type"] == "delta")
+        assert text == received[-1]["message"]["content"]
+        assert received[-1]["credits_remaining"] == 9 - i
+    ws.__exit__(None, None, None)
+
+    conversation = asyncio.run(env["storage"].conversations.get(conversation_id))
+    assert [m["content"] for m in conversation["messages"] if m["role"] == "user"] == ["pregunta 0", "pregunta 1"]
+    assert len(conversation["messages"]) == 4
+    # The user stayed resident: no lookups after the one at connect time
+    assert len(env["lookups"]) == lookups_after_open
+
+
+def test_resident_conversation_picks_up_the_summary(env, monkeypatch):
+    standin = env["standin"]
+    chat_reply = standin.reply_text
+
+    def reply_text(payload):
+        if payload["system"][0]["text"] == SUMMARY_SYSTEM_PROMPT:
+            return "El usuario pregunta por el clima de Lima."
+        return chat_reply(payload)
+
+    monkeypatch.setattr(standin, "reply_text", reply_text)
+    monkeypatch.setattr(server, "compactor", Compactor(server.llm, model="m", load=env["storage"].conversations.get,
+                                                       store=env["storage"].conversations.set_summary))
+    asyncio.run(env["storage"].users.update(env["user"], {"credits": 100}))
+    ws, session = connect(env)
+    session.send_json({"type": "open"})
+    session.receive_json()
+    for i in range(server.compactor.max_messages + 2):
+        session.send_json({"type": "message", "content": f"pregunta {i}"})
+        until(session, "done")
+    ws.__exit__(None, None, None)
+
+    chats = [r["payload"] for r in standin.requests if r["payload"]["system"][0]["text"] != SUMMARY_SYSTEM_PROMPT]
+    assert "clima de Lima" in chats[-1]["system"][0]["text"]
+    assert len(chats[-1]["messages"]) <= server.compactor.max_messages + 1
+    # Once folded, turns stop rescheduling compaction until the budget is passed again
+    assert len(standin.requests) - len(chats) <= 2
+
+
+def test_bad_token_is_refused(env):
+    with env["client"].websocket_connect("/api/chat/ws") as ws:
+        ws.send_json({"type": "auth", "token": "nope"})
+        with pytest.raises(WebSocketDisconnect) as closed:
+            ws.receive_json()
+    assert closed.value.code == 4401
+
+
+def test_connection_cap_per_user(env):
+    first, _ = connect(env)
+    second, _ = connect(env)
+    with env["client"].websocket_connect("/api/chat/ws") as ws:
+        ws.send_json({"type": "auth", "token": env["token"]})
+        with pytest.raises(WebSocketDisconnect) as closed:
+            ws.receive_json()
+    assert closed.value.code == 4429
+    first.__exit__(None, None, None)
+    second.__exit__(None, None, None)
+
+
+def test_cancel_stops_the_turn_without_charge(env):
+    env["standin"].base_latency_ms = 2000
+    ws, session = connect(env)
+    session.send_json({"type": "open"})
+    conversation_id = session.receive_json()["conversation_id"]
+    session.send_json({"type": "message", "content": "larga", "ref": "t1"})
+    assert session.receive_json()["type"] == "start"
+    session.send_json({"type": "cancel"})
+    assert session.receive_json() == {"type": "cancelled", "ref": "t1"}
+    ws.__exit__(None, None, None)
+
+    conversation = asyncio.run(env["storage"].conversations.get(conversation_id))
+    assert [m["role"] for m in conversation["messages"]] == ["user"]
+    assert asyncio.run(env["storage"].users.get("u1"))["credits"] == 10
+    assert server.llm.in_flight == 0
+
+
+def test_messages_beyond_the_queue_are_rejected(env):
+    env["standin"].base_latency_ms = 300
+    ws, session = connect(env)
+    session.send_json({"type": "open"})
+    session.receive_json()
+    for i in range(5):
+        session.send_json({"type": "message", "content": f"pregunta {i}", "ref": f"t{i}"})
+    rejected = done = 0
+    while rejected + done < 5:
+        message = session.receive_json()
+        rejected += message["type"] == "error" and message["code"] == 429
+        done += message["type"] == "done"
+    assert rejected >= 2
+    ws.__exit__(None, None, None)
+
+
+def test_revoked_session_is_closed(env):
+    ws, session = connect(env)
+    session.send_json({"type": "open"})
+    session.receive_json()
+    asyncio.run(server.revoke_user_sessions(dict(env["user"])))
+    session.send_json({"type": "message", "content": "hola"})
+    with pytest.raises(WebSocketDisconnect) as closed:
+        until(session, "done")
+    assert closed.value.code == 4401
+
+
+def test_outbox_coalesces_deltas_and_bounds_the_rest():
+    outbox = Outbox(send=None, max_pending=2)
+    for word in ("uno", " dos", " tres"):
+        outbox.put({"type": "delta", "ref": "t", "text": word})
+    assert len(outbox) == 1 and outbox.coalesced == 2
+    outbox.put({"type": "ping"})
+    with pytest.raises(OutboxFull):
+        outbox.put({"type": "ping"})
@@ -0,0 +1,125 @@
+"""
+Context compaction tests - rolling summaries built in the background and used for prompt assembly
+"""
+import asyncio
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+from compaction import Compactor, pending_indices
+from firebase_client import FirebaseClient
+from llm import AnthropicProvider, LlmClient
+from metrics import metrics
+from shared_state import MemoryStateBackend
+from standins.firebase_server import FirebaseStandin
+from standins.llm_server import LlmStandin
+from storage import FirebaseStorage
+
+
+def turns(n, words=50):
+    messages = []
+    for i in range(n):
+        messages.append({"id": f"u{i}", "role": "user", "content": f"pregunta {i} " + "detalle " * words})
+        messages.append({"id": f"a{i}", "role": "assistant", "content": f"respuesta {i} " + "dato " * words})
+    return messages
+
+
+@pytest.fixture
+def llm_standin():
+    metrics.reset()
+    return LlmStandin(base_latency_ms=0)
+
+
+def make_compactor(llm_standin, conversations, **kwargs):
+    client = LlmClient(AnthropicProvider("k", base_url="http://llm.test",
+                                         transport=httpx.ASGITransport(app=llm_standin.app)))
+
+    async def load(conversation_id):
+        return conversations.get(conversation_id)
+
+    async def store(conversation_id, summary):
+        conversations[conversation_id]["summary"] = summary
+
+    options = dict(model="claude-test", load=load, store=store, state=MemoryStateBackend(),
+                   trigger_tokens=500, keep_messages=4, max_messages=10)
+    options.update(kwargs)
+    return Compactor(client, **options)
+
+
+def test_context_without_summary_uses_recent_window(llm_standin):
+    compactor = make_compactor(llm_standin, {})
+    prompt, history = compactor.context("sistema", {"messages": turns(3)})
+    assert prompt == "sistema"
+    assert len(history) == 6
+
+
+def test_short_conversation_is_not_compacted(llm_standin):
+    compactor = make_compactor(llm_standin, {})
+    assert not compactor.needs_compaction({"messages": turns(2, words=5)})
+    assert compactor.needs_compaction({"messages": turns(4)})
+
+
+def test_compaction_folds_older_turns(llm_standin):
+    conversations = {"c1": {"messages": turns(6)}}
+    compactor = make_compactor(llm_standin, conversations)
+    summary = asyncio.run(compactor.compact("c1"))
+    assert summary["covers"] == 8
+    assert conversations["c1"]["summary"] == summary
+    request = llm_standin.requests[-1]["payload"]
+    assert "pregunta 0" in request["messages"][-1]["content"][0]["text"]
+
+    prompt, history = compactor.context("sistema", conversations["c1"])
+    assert summary["text"] in prompt
+    assert [m["id"] for m in history] == ["u4", "a4", "u5", "a5"]
+    assert metrics.counter("compaction_folded_messages") == 8
+
+
+def test_kept_history_starts_with_user_turn(llm_standin):
+    messages = turns(6)[:-1]  # ends with a user message
+    compactor = make_compactor(llm_standin, {})
+    covers = compactor.fold_until(messages, None)
+    assert messages[covers]["role"] == "user"
+    assert len(pending_indices(messages, {"covers": covers})) <= 4
+
+
+def test_schedule_runs_once_per_conversation(llm_standin):
+    conversations = {"c1": {"messages": turns(6)}}
+    compactor = make_compactor(llm_standin, conversations)
+
+    async def scenario():
+        assert compactor.schedule("c1", conversations["c1"])
+        assert not compactor.schedule("c1", conversations["c1"])
+        await asyncio.gather(*compactor._tasks.values())
+
+    asyncio.run(scenario())
+    assert len(llm_standin.requests) == 1
+
+
+def test_send_message_keeps_summary(llm_standin, monkeypatch):
+    standin = FirebaseStandin({"conversations": {"c1": {
+        "id": "c1", "user_id": "u1", "messages": turns(2, words=5),
+        "summary": {"text": "El usuario prepara un informe.", "covers": 2},
+        "created_at": "2024-01-01T00:00:00+00:00", "updated_at": "2024-01-01T00:00:00+00:00",
+    }}})
+    firebase = FirebaseClient("http://firebase.test", transport=httpx.ASGITransport(app=standin.app))
+    compactor = make_compactor(llm_standin, {}, enabled=False)
+    user = {"id": "u1", "credits": 10}
+    monkeypatch.setattr(server, "storage", FirebaseStorage(firebase))
+    monkeypatch.setattr(server, "llm", compactor.llm)
+    monkeypatch.setattr(server, "compactor", compactor)
+    monkeypatch.setattr(server, "update_user", lambda *args: asyncio.sleep(0))
+    server.app.dependency_overrides[server.get_current_user] = lambda: user
+    try:
+        with TestClient(server.app) as client:
+            response = client.post("/api/chat/conversations/c1/messages", json={"content": "¿y ahora?"})
+    finally:
+        server.app.dependency_overrides.clear()
+    assert response.status_code == 200
+    conversation = standin.read("conversations/c1")
+    assert conversation["summary"]["text"] == "El usuario prepara un informe."
+    assert len(conversation["messages"]) == 6
+    payload = llm_standin.requests[-1]["payload"]
+    assert "El usuario prepara un informe." in payload["system"][0]["text"]
+    assert len(payload["messages"]) == 3
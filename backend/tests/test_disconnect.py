@@ -0,0 +1,100 @@
+"""
+Client disconnect tests - in-flight LLM calls are cancelled, their slot freed and nothing is charged
+"""
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+import server
+from llm import AnthropicProvider, LlmClient
+from metrics import metrics
+from standins.firebase_server import FirebaseStandin
+from standins.llm_server import LlmStandin
+from firebase_client import FirebaseClient
+from storage import FirebaseStorage
+
+NOW = "2024-01-01T00:00:00+00:00"
+
+
+@pytest.fixture
+def setup(monkeypatch):
+    metrics.reset()
+    llm = LlmClient(AnthropicProvider("k", base_url="http://llm.test",
+                                      transport=httpx.ASGITransport(app=LlmStandin(base_latency_ms=2000).app)),
+                    max_concurrency=1)
+    standin = FirebaseStandin({"conversations": {"c1": {
+        "id": "c1", "user_id": "u1", "messages": [], "created_at": NOW, "updated_at": NOW}}})
+    charges = []
+
+    async def update_user(user, fields):
+        charges.append(fields)
+        return True
+
+    monkeypatch.setattr(server, "llm", llm)
+    monkeypatch.setattr(server, "storage", FirebaseStorage(
+        FirebaseClient("http://firebase.test", transport=httpx.ASGITransport(app=standin.app))))
+    monkeypatch.setattr(server, "update_user", update_user)
+    monkeypatch.setattr(server, "DISCONNECT_POLL_SECONDS", 0.01)
+    user = {"id": "u1", "credits": 10, "_api_key_id": "k1"}
+    server.app.dependency_overrides[server.get_current_user] = lambda: user
+    server.app.dependency_overrides[server.get_user_by_api_key] = lambda: user
+    yield llm, standin, charges
+    server.app.dependency_overrides.clear()
+
+
+async def call_and_hang_up(path: str, body: dict, after: float):
+    """Raw ASGI request whose client disconnects `after` seconds after sending the body"""
+    sent = []
+    payload = json.dumps(body).encode()
+    messages = [{"type": "http.request", "body": payload, "more_body": False}]
+
+    hang_up_at = time.monotonic() + after
+
+    async def receive():
+        # Like uvicorn: once the client is gone, receive() answers immediately
+        if messages:
+            return messages.pop(0)
+        if time.monotonic() < hang_up_at:
+            await asyncio.sleep(hang_up_at - time.monotonic())
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "POST",
+             "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"", "root_path": "",
+             "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode())],
+             "client": ("test", 1), "server": ("test", 80)}
+    began = time.perf_counter()
+    await server.app(scope, receive, send)
+    return sent[0]["status"], time.perf_counter() - began
+
+
+def test_send_message_cancelled_on_disconnect(setup):
+    llm, standin, charges = setup
+    status, elapsed = asyncio.run(call_and_hang_up("/api/chat/conversations/c1/messages",
+                                                   {"content": "hola"}, after=0.05))
+    assert status == 499
+    assert elapsed < 1
+    assert charges == []
+    assert standin.read("conversations/c1").get("messages") in (None, [])
+    assert llm.in_flight == 0
+    assert metrics.counter("llm_cancelled", endpoint="chat") == 1
+    assert metrics.counter("llm_cancelled_prompt_tokens", endpoint="chat") > 0
+
+
+def test_api_call_frees_concurrency_slot(setup):
+    llm, _, charges = setup
+
+    async def scenario():
+        status, _ = await call_and_hang_up("/api/v1/chat", {"message": "hola"}, after=0.05)
+        # The only slot was given back, so the next call does not wait behind the cancelled one
+        assert not llm._slots.locked()
+        return status
+
+    assert asyncio.run(scenario()) == 499
+    assert charges == []
+    assert metrics.counter("llm_cancelled", endpoint="api") == 1
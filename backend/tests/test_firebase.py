@@ -0,0 +1,178 @@
+"""
+Firebase client tests - single-flight, deadlines, retries, circuit breaker and hedged reads,
+run against the local fault-injecting Firebase stand-in
+"""
+import asyncio
+import time
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+from firebase_client import CircuitBreaker, FirebaseClient, FirebaseUnavailable
+from metrics import metrics
+from standins.firebase_server import FirebaseStandin
+from storage import FirebaseStorage
+
+
+@pytest.fixture
+def standin():
+    metrics.reset()
+    return FirebaseStandin({
+        "api_keys": {"k1": {"user_id": "u1"}},
+        "users": {"-fb1": {"id": "u1", "email": "a@b.com"}},
+        "payment_transactions": {"t1": {"session_id": "cs_1"}},
+    })
+
+
+def make_client(standin, **kwargs):
+    options = dict(read_timeout=2.0, write_timeout=2.0, backoff_base=0.001, backoff_max=0.005,
+                   singleflight_nodes={"users", "api_keys", "payment_transactions"})
+    options.update(kwargs)
+    return FirebaseClient("http://firebase.test", transport=httpx.ASGITransport(app=standin.app), **options)
+
+
+def run(coro_factory):
+    async def main():
+        return await coro_factory()
+    return asyncio.run(main())
+
+
+class TestSingleFlight:
+
+    def test_concurrent_reads_share_one_request(self, standin):
+        standin.faults.latency = 0.05
+        client = make_client(standin)
+        results = run(lambda: asyncio.gather(*[client.get("api_keys") for _ in range(10)]))
+        assert standin.count("GET", "api_keys") == 1
+        assert all(r == {"k1": {"user_id": "u1"}} for r in results)
+        assert metrics.counter("firebase_reads_coalesced", node="api_keys") == 9
+
+    def test_callers_get_independent_copies(self, standin):
+        standin.faults.latency = 0.05
+        client = make_client(standin)
+        first, second = run(lambda: asyncio.gather(client.get("users"), client.get("users")))
+        first["-fb1"]["_firebase_id"] = "-fb1"
+        assert "_firebase_id" not in second["-fb1"]
+
+    def test_paths_not_opted_in_are_not_coalesced(self, standin):
+        standin.faults.latency = 0.02
+        client = make_client(standin)
+        run(lambda: asyncio.gather(*[client.get("api_usage") for _ in range(3)]))
+        assert standin.count("GET", "api_usage") == 3
+
+    def test_cancelled_caller_does_not_cancel_followers(self, standin):
+        standin.faults.latency = 0.05
+        client = make_client(standin)
+
+        async def scenario():
+            leader = asyncio.ensure_future(client.get("payment_transactions"))
+            await asyncio.sleep(0)
+            follower = asyncio.ensure_future(client.get("payment_transactions"))
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            return await follower
+
+        assert run(scenario) == {"t1": {"session_id": "cs_1"}}
+        assert standin.count("GET", "payment_transactions") == 1
+
+
+class TestRetries:
+
+    def test_idempotent_read_is_retried(self, standin):
+        standin.faults.fail_next = 2
+        client = make_client(standin)
+        assert run(lambda: client.get("users/-fb1")) == {"id": "u1", "email": "a@b.com"}
+        assert standin.count("GET", "users/-fb1") == 3
+        assert metrics.counter("firebase_retries", op="GET", node="users") == 2
+
+    def test_push_is_never_retried(self, standin):
+        standin.faults.fail_next = 1
+        client = make_client(standin)
+        with pytest.raises(FirebaseUnavailable):
+            run(lambda: client.post("users", {"id": "u2"}))
+        assert standin.count("POST", "users") == 1
+
+    def test_client_errors_are_not_retried(self, standin):
+        standin.faults.fail_next = 1
+        standin.faults.error_status = 401
+        client = make_client(standin)
+        assert run(lambda: client.get("users")) is None
+        assert standin.count("GET", "users") == 1
+
+    def test_deadline_bounds_total_time(self, standin):
+        standin.faults.latency = 1.0
+        client = make_client(standin, read_timeout=0.2)
+        began = time.monotonic()
+        with pytest.raises(FirebaseUnavailable):
+            run(lambda: client.get("users"))
+        assert time.monotonic() - began < 0.5
+
+
+class TestCircuitBreaker:
+
+    def test_open_circuit_sheds_load(self, standin):
+        standin.faults.error_rate = 1.0
+        client = make_client(standin, max_retries=0, breaker=CircuitBreaker(failure_threshold=2, reset_timeout=0.2))
+        for _ in range(2):
+            with pytest.raises(FirebaseUnavailable):
+                run(lambda: client.get("users"))
+        assert client.breaker.state == "open"
+        sent = len(standin.requests)
+        with pytest.raises(FirebaseUnavailable) as exc:
+            run(lambda: client.get("users"))
+        assert exc.value.reason == "circuit open"
+        assert len(standin.requests) == sent
+
+    def test_half_open_probe_closes_circuit(self, standin):
+        standin.faults.error_rate = 1.0
+        client = make_client(standin, max_retries=0, breaker=CircuitBreaker(failure_threshold=1, reset_timeout=0.05))
+        with pytest.raises(FirebaseUnavailable):
+            run(lambda: client.get("users"))
+        standin.faults.error_rate = 0.0
+        time.sleep(0.06)
+        assert client.breaker.state == "half_open"
+        assert run(lambda: client.get("users")) is not None
+        assert client.breaker.state == "closed"
+
+    def test_cancelled_probe_lets_the_next_call_probe(self, standin):
+        standin.faults.error_rate = 1.0
+        client = make_client(standin, max_retries=0, breaker=CircuitBreaker(failure_threshold=1, reset_timeout=0.05))
+        with pytest.raises(FirebaseUnavailable):
+            run(lambda: client.get("users"))
+        standin.faults.error_rate = 0.0
+        standin.faults.latency = 0.3
+        time.sleep(0.06)
+        with pytest.raises(asyncio.TimeoutError):
+            run(lambda: asyncio.wait_for(client.get("users"), 0.05))
+        standin.faults.latency = 0.0
+        assert run(lambda: client.get("users")) is not None
+        assert client.breaker.state == "closed"
+
+
+class TestHedgedReads:
+
+    def test_slow_primary_is_hedged(self, standin):
+        standin.faults.slow_next = 1
+        standin.faults.slow_latency = 0.5
+        client = make_client(standin, hedge_after=0.03)
+        began = time.monotonic()
+        assert run(lambda: client.get("users/-fb1"))["id"] == "u1"
+        assert time.monotonic() - began < 0.3
+        assert metrics.counter("firebase_hedge_wins") == 1
+
+    def test_fast_primary_is_not_hedged(self, standin):
+        client = make_client(standin, hedge_after=0.2)
+        run(lambda: client.get("users/-fb1"))
+        assert standin.count("GET", "users/-fb1") == 1
+        assert metrics.counter("firebase_hedged_requests") == 0
+
+
+def test_outage_surfaces_as_503_not_401(standin, monkeypatch):
+    standin.faults.error_rate = 1.0
+    monkeypatch.setattr(server, "storage", FirebaseStorage(make_client(standin, max_retries=1)))
+    token = server.create_token({"id": "u1"})
+    with TestClient(server.app) as client:
+        response = client.get("/api/chat/conversations", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 503
@@ -0,0 +1,140 @@
+"""
+Firebase stream tests - mirrors kept current from the SSE stand-in, reconnect and resync, cache invalidation
+"""
+import asyncio
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+
+import pytest
+import uvicorn
+
+import server
+from firebase_client import FirebaseClient
+from firebase_stream import FirebaseListener, Mirror
+from metrics import metrics
+from shared_state import MemoryStateBackend
+from standins.firebase_server import FirebaseStandin
+from storage import FirebaseStorage
+
+NOW = "2024-01-01T00:00:00+00:00"
+
+
+@pytest.fixture
+def standin():
+    """The stand-in served on a real socket: httpx.ASGITransport would buffer the stream"""
+    metrics.reset()
+    standin = FirebaseStandin({"users": {"-a": {"id": "u1", "email": "ana@brainyx.com", "credits": 10}}})
+    standin.keepalive_seconds = 0.2
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    served = uvicorn.Server(uvicorn.Config(standin.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=served.run, daemon=True)
+    thread.start()
+    while not served.started:
+        time.sleep(0.01)
+    standin.url = f"http://127.0.0.1:{port}"
+    yield standin
+    standin.drop_streams()
+    served.should_exit = True
+    thread.join(5)
+
+
+async def eventually(check, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while not check():
+        assert time.monotonic() < deadline, "condition not met in time"
+        await asyncio.sleep(0.02)
+
+
+def test_mirror_follows_writes_and_resyncs_after_reconnect(standin):
+    async def scenario():
+        client = FirebaseClient(standin.url)
+        mirror = Mirror("users")
+        changes = []
+
+        async def on_change(batch):
+            changes.extend(batch)
+
+        listener = FirebaseListener(client, mirror, on_change=on_change, backoff_base=0.05)
+        task = asyncio.create_task(listener.run())
+        try:
+            await mirror.wait_synced(3)
+            assert mirror.live and mirror.data["-a"]["credits"] == 10
+            assert changes == []  # the first snapshot invalidates nothing
+
+            written = datetime.now(timezone.utc).isoformat()
+            await client.patch("users/-a", {"credits": 7, "updated_at": written})
+            await client.post("users", {"id": "u2", "email": "luis@brainyx.com"})
+            await eventually(lambda: len(mirror.data) == 2 and mirror.data["-a"]["credits"] == 7)
+            assert ("-a", {"id": "u1", "email": "ana@brainyx.com", "credits": 10}) == changes[0][:2]
+            assert metrics.snapshot()["summaries"]["firebase_stream_lag_ms{path=users}"]["count"] == 1
+
+            # Drop the stream and fail the first reconnect; a write lands while we are away
+            standin.faults.methods = {"GET"}
+            standin.faults.fail_next = 1
+            standin.drop_streams()
+            await eventually(lambda: not mirror.live)
+            await client.delete("users/-a")
+            await eventually(lambda: mirror.live and "-a" not in mirror.data)
+            assert listener.reconnects >= 2
+            assert changes[-1] == ("-a", {"id": "u1", "email": "ana@brainyx.com", "credits": 7,
+                                          "updated_at": written}, None)
+        finally:
+            task.cancel()
+            await client.close()
+
+    asyncio.run(scenario())
+
+
+def test_nested_patches_and_deletes_apply():
+    mirror = Mirror("api_keys")
+    mirror.apply("put", "/", {"k1": {"user_id": "u1", "is_active": True}, "k2": {"user_id": "u2"}})
+    changes = mirror.apply("patch", "/", {"k1/last_used": NOW, "k2/last_used": NOW})
+    assert sorted(key for key, _, _ in changes) == ["k1", "k2"]
+    assert mirror.data["k1"] == {"user_id": "u1", "is_active": True, "last_used": NOW}
+    assert mirror.apply("put", "/k2", None) == [("k2", {"user_id": "u2", "last_used": NOW}, None)]
+    mirror.apply("put", "/k1/is_active", None)
+    mirror.apply("put", "/k1/user_id", None)
+    mirror.apply("put", "/k1/last_used", None)
+    assert mirror.data == {}
+
+
+def test_storage_reads_from_live_mirror_and_other_writers_invalidate(standin, monkeypatch):
+    async def scenario():
+        storage = FirebaseStorage(FirebaseClient(standin.url))
+        state = MemoryStateBackend()
+        monkeypatch.setattr(server, "storage", storage)
+        monkeypatch.setattr(server, "state", state)
+        monkeypatch.setattr(server, "FIREBASE_STREAM_PATHS", ["users"])
+        tasks = [asyncio.create_task(listener.run()) for listener in server.start_firebase_listeners()]
+        try:
+            mirror = storage.mirrors["users"]
+            await mirror.wait_synced(3)
+            user = await storage.users.get("u1")
+            await server.cache_user_session(user, await server.session_generation("u1"))
+            expires_in = state._data["user:u1"][1] - time.monotonic()
+            assert expires_in > server.USER_SNAPSHOT_TTL_SECONDS
+            reads = standin.count("GET", "users")
+
+            # Our own write is visible at once; no REST reads while the mirror is live
+            await server.update_user(user, {"credits": 3})
+            assert (await storage.users.get("u1"))["credits"] == 3
+            assert (await storage.users.get_by_email("ana@brainyx.com"))["_firebase_id"] == "-a"
+            assert standin.count("GET", "users") == reads
+
+            # Another instance bumps the session version: the snapshot goes, sv follows
+            await server.cache_user_session(await storage.users.get("u1"), await server.session_generation("u1"))
+            other = FirebaseClient(standin.url)
+            await other.patch("users/-a", {"session_version": 1, "updated_at": NOW})
+            await other.close()
+            await eventually(lambda: "user:u1" not in state._data)
+            assert await state.get("sv:u1") == "1"
+        finally:
+            for task in tasks:
+                task.cancel()
+            await storage.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,100 @@
+"""
+HTTP caching tests - ETag / If-None-Match on read endpoints and compression of larger responses
+"""
+import asyncio
+import gzip
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+
+import server
+from http_cache import CompressionMiddleware, choose_encoding, etag, etag_matches
+from metrics import metrics
+from storage import SqlStorage
+
+NOW = "2024-01-01T00:00:00+00:00"
+
+
+@pytest.fixture
+def client(monkeypatch):
+    metrics.reset()
+    storage = SqlStorage("sqlite:///:memory:")
+    asyncio.run(storage.conversations.create({
+        "id": "c1", "user_id": "u1", "created_at": NOW, "updated_at": NOW,
+        "messages": [{"id": f"m{i}", "role": "user", "content": f"mensaje número {i} " * 20, "timestamp": NOW}
+                     for i in range(50)]}))
+    monkeypatch.setattr(server, "storage", storage)
+    server.app.dependency_overrides[server.get_current_user] = lambda: {"id": "u1", "credits": 10}
+    try:
+        with TestClient(server.app) as client:
+            yield client, storage
+    finally:
+        server.app.dependency_overrides.clear()
+
+
+def test_plans_are_cacheable_and_revalidated(client):
+    client, _ = client
+    first = client.get("/api/plans")
+    assert first.headers["cache-control"].startswith("public, max-age=")
+    second = client.get("/api/plans", headers={"If-None-Match": first.headers["etag"]})
+    assert second.status_code == 304 and second.content == b""
+    assert metrics.counter("http_not_modified", endpoint="plans") == 1
+
+
+def test_conversation_etag_changes_with_new_messages(client):
+    client, storage = client
+    first = client.get("/api/chat/conversations/c1")
+    tag = first.headers["etag"]
+    assert first.headers["cache-control"] == "private, no-cache"
+    assert client.get("/api/chat/conversations/c1", headers={"If-None-Match": tag}).status_code == 304
+    listed = client.get("/api/chat/conversations")
+    assert client.get("/api/chat/conversations", headers={"If-None-Match": listed.headers["etag"]}).status_code == 304
+
+    later = "2024-01-01T00:05:00+00:00"
+    asyncio.run(storage.conversations.append_messages(
+        "c1", 50, [{"id": "m50", "role": "assistant", "content": "nuevo", "timestamp": later}], later))
+    changed = client.get("/api/chat/conversations/c1", headers={"If-None-Match": tag})
+    assert changed.status_code == 200 and changed.headers["etag"] != tag
+    assert client.get("/api/chat/conversations", headers={"If-None-Match": listed.headers["etag"]}).status_code == 200
+
+
+def test_large_responses_are_compressed(client):
+    client, _ = client
+    plain = client.get("/api/chat/conversations/c1", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+    for encoding in ("gzip", "br"):
+        response = client.get("/api/chat/conversations/c1", headers={"Accept-Encoding": encoding})
+        assert response.headers["content-encoding"] == encoding
+        assert "Accept-Encoding" in response.headers["vary"]
+        assert int(response.headers["content-length"]) < len(plain.content) / 5
+        assert response.json() == plain.json()
+    small = client.get("/api/plans", headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in small.headers
+
+
+def test_streamed_and_precompressed_responses_pass_through():
+    async def stream(request):
+        return StreamingResponse(iter([b"x" * 4096, b"y" * 4096]), media_type="application/x-ndjson")
+
+    async def precompressed(request):
+        return PlainTextResponse(gzip.compress(b"z" * 4096), headers={"Content-Encoding": "gzip"})
+
+    app = CompressionMiddleware(Starlette(routes=[Route("/stream", stream), Route("/gz", precompressed)]))
+    with TestClient(app) as client:
+        streamed = client.get("/stream", headers={"Accept-Encoding": "gzip"})
+        assert "content-encoding" not in streamed.headers and len(streamed.content) == 8192
+        assert client.get("/gz", headers={"Accept-Encoding": "gzip"}).content == b"z" * 4096
+
+
+def test_validators_and_negotiation():
+    tag = etag("c1", NOW, 3)
+    assert etag_matches(f'"abc", {tag}', tag)
+    assert etag_matches(tag.removeprefix("W/"), tag)
+    assert etag_matches("*", tag)
+    assert not etag_matches(etag("c1", NOW, 4), tag)
+    assert choose_encoding("gzip, deflate, br") == "br"
+    assert choose_encoding("br;q=0, gzip") == "gzip"
+    assert choose_encoding("identity") is None
@@ -0,0 +1,60 @@
+"""
+API key last_used buffering - touches are coalesced and flushed in one multi-path PATCH
+"""
+import asyncio
+
+import httpx
+import pytest
+
+import server
+from firebase_client import FirebaseClient, FirebaseUnavailable
+from metrics import metrics
+from standins.firebase_server import FirebaseStandin
+from storage import FirebaseStorage
+
+
+@pytest.fixture
+def standin(monkeypatch):
+    metrics.reset()
+    standin = FirebaseStandin({
+        "api_keys": {
+            "k1": {"user_id": "u1", "name": "uno"},
+            "k2": {"user_id": "u1", "name": "dos"},
+        },
+    })
+    client = FirebaseClient("http://firebase.test", transport=httpx.ASGITransport(app=standin.app),
+                            max_retries=0, backoff_base=0.001)
+    monkeypatch.setattr(server, "storage", FirebaseStorage(client))
+    monkeypatch.setattr(server, "_pending_last_used", {})
+    return standin
+
+
+def test_touches_are_flushed_in_one_patch(standin):
+    for _ in range(5):
+        server.touch_api_key("k1")
+    server.touch_api_key("k2")
+    assert standin.count("PATCH") == 0
+    latest = server._pending_last_used["k1"]
+
+    assert asyncio.run(server.flush_api_key_last_used()) == 2
+    assert standin.count("PATCH", "api_keys") == 1
+    assert standin.read("api_keys/k1/last_used") == latest
+    assert standin.read("api_keys/k2/name") == "dos"
+    assert standin.read("api_keys/k2/last_used")
+    assert metrics.counter("api_key_last_used_flushed") == 2
+
+
+def test_empty_flush_sends_nothing(standin):
+    assert asyncio.run(server.flush_api_key_last_used()) == 0
+    assert standin.requests == []
+
+
+def test_failed_flush_keeps_entries(standin):
+    standin.faults.fail_next = 1
+    server.touch_api_key("k1")
+    with pytest.raises(FirebaseUnavailable):
+        asyncio.run(server.flush_api_key_last_used())
+    assert "k1" in server._pending_last_used
+
+    assert asyncio.run(server.flush_api_key_last_used()) == 1
+    assert standin.read("api_keys/k1/last_used")
@@ -0,0 +1,113 @@
+"""
+LLM layer tests - prompt caching markers and usage accounting against the local stand-in
+"""
+import asyncio
+
+import httpx
+
+from llm import AnthropicProvider, LlmClient, normalize_history, stable_window
+from metrics import metrics
+from standins.llm_server import LlmStandin
+
+SYSTEM_PROMPT = "Eres Brainyx, un asistente de inteligencia artificial avanzado y amigable. " * 40
+
+
+def make_client(standin, prompt_caching=True):
+    transport = httpx.ASGITransport(app=standin.app)
+    provider = AnthropicProvider("test-key", base_url="http://llm.test", prompt_caching=prompt_caching,
+                                 transport=transport)
+    return LlmClient(provider)
+
+
+def run_conversation(client, turns):
+    async def main():
+        history, results = [], []
+        for i in range(turns):
+            message = f"Pregunta número {i}: explica el tema con detalle. " * 10
+            result = await client.complete(model="claude-test", system_prompt=SYSTEM_PROMPT,
+                                           history=history, message=message)
+            history += [{"role": "user", "content": message}, {"role": "assistant", "content": result.text}]
+            results.append(result)
+        await client.close()
+        return results
+    return asyncio.run(main())
+
+
+def test_normalize_history():
+    history = [
+        {"role": "assistant", "content": "hola"},
+        {"role": "user", "content": "a"},
+        {"role": "user", "content": "b"},
+        {"role": "assistant", "content": "c"},
+        None,
+        {"role": "user", "content": "pendiente"},
+    ]
+    assert normalize_history(history) == [
+        {"role": "user", "content": "a\n\nb"},
+        {"role": "assistant", "content": "c"},
+    ]
+
+
+def test_stable_window_moves_in_steps():
+    messages = list(range(30))
+    starts = [stable_window(messages[:n], size=10, step=4)[0] for n in range(11, 30)]
+    assert all(len(stable_window(messages[:n], 10, 4)) <= 10 for n in range(30))
+    assert set(start % 4 for start in starts) == {0}
+    assert stable_window(messages[:6], 10, 4) == messages[:6]
+
+
+def test_payload_marks_stable_prefix():
+    provider = AnthropicProvider("k", base_url="http://llm.test")
+    payload = provider.build_payload(model="m", system_prompt="sys", message="nuevo", history=[
+        {"role": "user", "content": "a"}, {"role": "assistant", "content": "b"}
+    ])
+    assert payload["system"][0]["cache_control"] == {"type": "ephemeral"}
+    assert payload["messages"][1]["content"][-1]["cache_control"] == {"type": "ephemeral"}
+    assert "cache_control" not in payload["messages"][-1]["content"][-1]
+
+
+def test_cached_prefix_is_reported_per_call():
+    results = run_conversation(make_client(LlmStandin(base_latency_ms=0)), turns=4)
+    first, later = results[0].usage, results[1:]
+    assert first.cached_input_tokens == 0
+    assert first.cache_write_tokens > 0
+    for result in later:
+        assert result.usage.cached_input_tokens > 0
+        assert result.usage.cached_input_tokens > result.usage.input_tokens
+
+
+def test_without_caching_everything_is_uncached():
+    results = run_conversation(make_client(LlmStandin(base_latency_ms=0), prompt_caching=False), turns=3)
+    for result in results:
+        assert result.usage.cached_input_tokens == 0
+        assert result.usage.cache_write_tokens == 0
+        assert result.usage.input_tokens == result.usage.total_input_tokens
+
+
+def test_usage_metrics_recorded():
+    metrics.reset()
+    results = run_conversation(make_client(LlmStandin(base_latency_ms=0)), turns=3)
+    assert metrics.counter("llm_calls", provider="anthropic") == 3
+    assert metrics.counter("llm_input_tokens", kind="cached") == sum(r.usage.cached_input_tokens for r in results)
+    assert metrics.snapshot()["summaries"]["llm_latency_ms{provider=anthropic}"]["count"] == 3
+
+
+def test_concurrency_limit_queues_extra_calls():
+    client = LlmClient(AnthropicProvider("k", base_url="http://llm.test",
+                                         transport=httpx.ASGITransport(app=LlmStandin(base_latency_ms=20).app)),
+                       max_concurrency=2)
+    peak = []
+
+    async def main():
+        async def watch():
+            while True:
+                peak.append(client.in_flight)
+                await asyncio.sleep(0.005)
+        watcher = asyncio.create_task(watch())
+        await asyncio.gather(*[client.complete(model="claude-test", system_prompt="s", history=[], message="hola")
+                               for _ in range(5)])
+        watcher.cancel()
+
+    asyncio.run(main())
+    assert max(peak) == 2
+    assert client.in_flight == 0
@@ -0,0 +1,101 @@
+"""
+Email filter and login throttling tests - no false negatives, lookups skipped for unknown emails, 429s
+"""
+import asyncio
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+from bloom import BloomFilter
+from metrics import metrics
+from shared_state import MemoryStateBackend
+from storage import SqlStorage
+
+NOW = "2024-01-01T00:00:00+00:00"
+
+
+def test_bloom_filter_has_no_false_negatives_and_stays_near_its_rate():
+    emails = [f"user{i}@brainyx.com" for i in range(10_000)]
+    bloom = BloomFilter(len(emails), error_rate=0.01)
+    for email in emails:
+        bloom.add(email)
+    assert all(email in bloom for email in emails)
+    false_hits = sum(f"other{i}@brainyx.com" in bloom for i in range(20_000))
+    assert false_hits / 20_000 < 0.02
+    assert bloom.false_positive_rate() == pytest.approx(0.01, rel=0.3)
+    assert bloom.size_bytes < 12_500  # ~9.6 bits per email at 1%
+
+
+@pytest.fixture
+def setup(monkeypatch):
+    metrics.reset()
+    storage = SqlStorage("sqlite:///:memory:")
+    asyncio.run(storage.users.create({"id": "u1", "name": "Ana", "email": "ana@brainyx.com",
+                                      "password_hash": server.hash_password("secreto123"),
+                                      "credits": 10, "created_at": NOW, "updated_at": NOW}))
+    lookups = []
+    get_by_email = storage.users.get_by_email
+
+    async def counted(email):
+        lookups.append(email)
+        return await get_by_email(email)
+
+    monkeypatch.setattr(storage.users, "get_by_email", counted)
+    monkeypatch.setattr(server, "storage", storage)
+    monkeypatch.setattr(server, "state", MemoryStateBackend())
+    monkeypatch.setattr(server, "EMAIL_FILTER", True)
+    monkeypatch.setattr(server, "email_filter", None)
+    with TestClient(server.app) as client:
+        deadline = time.monotonic() + 3
+        while server.email_filter is None:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        yield client, storage, lookups
+
+
+def login(client, email, password="secreto123", ip="203.0.113.7"):
+    return client.post("/api/auth/login", json={"email": email, "password": password},
+                       headers={"X-Forwarded-For": ip})
+
+
+def test_unknown_emails_skip_the_lookup(setup):
+    client, storage, lookups = setup
+    assert login(client, "nadie@brainyx.com").status_code == 401
+    assert lookups == []
+    assert login(client, "ana@brainyx.com").status_code == 200
+    assert lookups == ["ana@brainyx.com"]
+
+    registered = client.post("/api/auth/register", json={"name": "Luis", "email": "luis@brainyx.com",
+                                                         "password": "secreto123"})
+    assert registered.status_code == 200
+    assert login(client, "luis@brainyx.com").status_code == 200
+    assert client.post("/api/auth/register", json={"name": "Ana", "email": "ana@brainyx.com",
+                                                   "password": "secreto123"}).status_code == 400
+
+    # Registered on another worker: not in this filter yet, but marked in shared state
+    asyncio.run(storage.users.create({"id": "u3", "name": "Eva", "email": "eva@brainyx.com",
+                                      "password_hash": server.hash_password("secreto123"),
+                                      "created_at": NOW, "updated_at": NOW}))
+    asyncio.run(server.state.set("registered:eva@brainyx.com", "1"))
+    assert login(client, "eva@brainyx.com").status_code == 200
+    assert metrics.counter("email_filter_lookups", result="skipped") == 2
+    assert client.get("/api/metrics").json()["gauges"]["email_filter_items"] == 2
+
+
+def test_login_throttled_per_email_and_per_ip(setup, monkeypatch):
+    client, _, lookups = setup
+    for _ in range(server.LOGIN_FAILURES_PER_EMAIL):
+        assert login(client, "ana@brainyx.com", "incorrecta").status_code == 401
+    looked_up = len(lookups)
+    assert login(client, "ana@brainyx.com").status_code == 429
+    assert len(lookups) == looked_up
+    assert login(client, "ana@brainyx.com", ip="198.51.100.1").status_code == 429
+
+    monkeypatch.setattr(server, "FORWARDED_FOR_HOPS", 1)
+    monkeypatch.setattr(server, "LOGIN_ATTEMPTS_PER_IP_PER_MINUTE", 3)
+    statuses = [login(client, f"x{i}@brainyx.com", ip="198.51.100.2").status_code for i in range(5)]
+    assert statuses == [401, 401, 401, 429, 429]
+    assert login(client, "x9@brainyx.com", ip="198.51.100.3").status_code == 401
+    assert metrics.counter("login_throttled", reason="ip") == 2
@@ -0,0 +1,112 @@
+"""
+Metering tests - token rates, per-call minimum, estimator calibration, preflight admission
+"""
+import time
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+from llm import AnthropicProvider, LlmClient, LlmUsage
+from metering import Meter, TokenEstimator, TokenRates, prompt_chars, rate
+from metrics import metrics
+from model_routing import ModelSpec
+from standins.llm_server import LlmStandin
+
+SONNET = "claude-sonnet-4-5-20250929"
+SPEC = ModelSpec(id="m", credits=1,
+                 rates=TokenRates(input=0.2, output=1.0, cached_input=0.02, cache_write=0.25))
+
+
+def test_rate_rounds_up_and_keeps_the_minimum():
+    assert rate(SPEC.rates, 1, LlmUsage(input_tokens=100, output_tokens=50)).credits == 1
+    charge = rate(SPEC.rates, 1, LlmUsage(input_tokens=10_000, cached_input_tokens=50_000,
+                                          cache_write_tokens=4_000, output_tokens=1_500))
+    assert charge.rated_credits == pytest.approx(2 + 1 + 1 + 1.5)
+    assert charge.credits == 6
+    # 1500 output tokens at 0.2 is exactly 0.3 credits, not a float just above it
+    assert rate(TokenRates(output=0.2), 0, LlmUsage(output_tokens=1_500)).credits == 1
+
+
+def test_estimator_converges_on_provider_counts():
+    estimator = TokenEstimator(chars_per_token=4.0, alpha=0.2)
+    for _ in range(30):
+        estimator.observe("m", 3_000, 1_000)
+    assert estimator.ratio("m") == pytest.approx(3.0, rel=0.01)
+    assert estimator.estimate("m", 9_000) == pytest.approx(3_000, rel=0.01)
+    assert estimator.ratio("other") == 4.0
+    estimator.observe("m", 10, 100)  # clamped to the lower bound
+    assert estimator.ratio("m") >= 1.5
+
+
+def test_charge_calibrates_only_on_provider_usage():
+    meter = Meter(expected_output_tokens=500)
+    estimate = meter.preflight(SPEC, 4_000)
+    assert (estimate.input_tokens, estimate.credits) == (1_000, 1)
+    meter.charge(SPEC, LlmUsage(input_tokens=2_000, estimated=True), estimate)
+    assert meter.estimator.ratio("m") == 4.0
+    charge = meter.charge(SPEC, LlmUsage(input_tokens=2_000, output_tokens=10), estimate)
+    assert meter.estimator.ratio("m") < 4.0
+    assert charge.estimated_input_tokens == 1_000
+    assert meter.charge(SPEC, None, estimate).credits == 1
+
+
+def test_preflight_is_cheap():
+    meter = Meter()
+    history = [{"role": "user", "content": "x" * 400}] * 40
+    began = time.perf_counter()
+    for _ in range(1_000):
+        meter.preflight(SPEC, prompt_chars("y" * 2_000, history, "hola"))
+    assert (time.perf_counter() - began) / 1_000 < 0.001
+
+
+@pytest.fixture
+def setup(monkeypatch):
+    metrics.reset()
+    standin = LlmStandin(base_latency_ms=0)
+    monkeypatch.setattr(server, "llm", LlmClient(AnthropicProvider(
+        "k", base_url="http://llm.test", transport=httpx.ASGITransport(app=standin.app))))
+    monkeypatch.setattr(server, "meter", Meter(expected_output_tokens=500))
+    charges, records = [], []
+
+    async def update_user(user, fields):
+        charges.append(fields["credits"])
+        return True
+
+    async def record_usage(user, credits_used, result=None, **kwargs):
+        records.append((credits_used, kwargs.get("charge")))
+
+    monkeypatch.setattr(server, "update_user", update_user)
+    monkeypatch.setattr(server, "record_usage", record_usage)
+    user = {"id": "u1", "credits": 100, "plan": "premium"}
+    server.app.dependency_overrides[server.get_user_by_api_key] = lambda: user
+    try:
+        with TestClient(server.app) as client:
+            yield client, standin, user, charges, records
+    finally:
+        server.app.dependency_overrides.clear()
+
+
+def test_large_prompt_costs_more_than_the_minimum(setup):
+    client, standin, _, charges, records = setup
+    assert client.post("/api/v1/chat", json={"message": "hola"}).json()["credits_used"] == 1
+
+    response = client.post("/api/v1/chat", json={"message": "palabra " * 8_000})
+    assert response.status_code == 200
+    used = response.json()["credits_used"]
+    assert used > 1
+    assert charges[-1] == 100 - used
+    credits_used, charge = records[-1]
+    assert credits_used == used
+    assert charge.input_credits > 0 and charge.estimated_input_tokens > 0
+    assert metrics.snapshot()["counters"][f"metering_credits{{model={SONNET}}}"] == 1 + used
+
+
+def test_preflight_rejects_what_the_balance_cannot_cover(setup):
+    client, standin, user, charges, _ = setup
+    user["credits"] = 2
+    response = client.post("/api/v1/chat", json={"message": "palabra " * 20_000})
+    assert response.status_code == 402
+    assert standin.requests == [] and charges == []
+    assert metrics.snapshot()["counters"][f"metering_rejected{{model={SONNET}}}"] == 1
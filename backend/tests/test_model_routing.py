@@ -0,0 +1,104 @@
+"""
+Model routing tests - per-plan models, explicit model choice, fallback and model-aware cost
+"""
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+from llm import AnthropicProvider, LlmClient
+from metrics import metrics
+from model_routing import ModelNotAllowed, load_catalog, resolve_model
+from standins.llm_server import LlmStandin
+
+SONNET = "claude-sonnet-4-5-20250929"
+HAIKU = "claude-haiku-4-5-20251001"
+OPUS = "claude-opus-4-1-20250805"
+
+
+def test_catalog_rejects_unknown_fallback():
+    with pytest.raises(ValueError):
+        load_catalog('{"a": {"credits": 1, "fallback": "b"}}')
+
+
+def test_resolve_model_by_plan():
+    catalog = load_catalog()
+    premium = server.PLANS["premium"]
+    assert resolve_model(catalog, premium).id == SONNET
+    assert resolve_model(catalog, premium, OPUS).credits == 4
+    with pytest.raises(ModelNotAllowed):
+        resolve_model(catalog, server.PLANS["estandar"], OPUS)
+    with pytest.raises(KeyError):
+        resolve_model(catalog, premium, "gpt-nada")
+
+
+@pytest.fixture
+def setup(monkeypatch):
+    metrics.reset()
+    standin = LlmStandin(base_latency_ms=0)
+    monkeypatch.setattr(server, "llm", LlmClient(AnthropicProvider(
+        "k", base_url="http://llm.test", transport=httpx.ASGITransport(app=standin.app))))
+    charges = []
+
+    async def update_user(user, fields):
+        charges.append(fields["credits"])
+        return True
+
+    async def record_usage(*args, **kwargs):
+        pass
+
+    monkeypatch.setattr(server, "update_user", update_user)
+    monkeypatch.setattr(server, "record_usage", record_usage)
+    user = {"id": "u1", "credits": 10, "plan": "premium"}
+    server.app.dependency_overrides[server.get_user_by_api_key] = lambda: user
+    try:
+        with TestClient(server.app) as client:
+            yield client, standin, user, charges
+    finally:
+        server.app.dependency_overrides.clear()
+
+
+def test_requested_model_is_used_and_priced(setup):
+    client, standin, _, charges = setup
+    response = client.post("/api/v1/chat", json={"message": "hola", "model": OPUS})
+    assert response.status_code == 200
+    assert response.json()["model"] == OPUS
+    assert standin.requests[-1]["payload"]["model"] == OPUS
+    assert charges == [6]
+
+
+def test_plan_restrictions(setup):
+    client, _, user, _ = setup
+    user["plan"] = "estandar"
+    assert client.post("/api/v1/chat", json={"message": "hola", "model": OPUS}).status_code == 403
+    assert client.post("/api/v1/chat", json={"message": "hola", "model": "gpt-nada"}).status_code == 400
+    user.pop("plan")
+    assert client.post("/api/v1/chat", json={"message": "hola"}).json()["model"] == HAIKU
+
+
+def test_overloaded_model_falls_back(setup):
+    client, standin, _, charges = setup
+    standin.overloaded.add(OPUS)
+    response = client.post("/api/v1/chat", json={"message": "hola", "model": OPUS})
+    assert response.json()["model"] == SONNET
+    # Charged at the price of the model that answered
+    assert charges == [9]
+    assert metrics.counter("llm_fallbacks", model=OPUS, fallback=SONNET) == 1
+    assert metrics.counter("llm_model_errors", model=OPUS, kind="overloaded") == 1
+    assert metrics.counter("llm_model_calls", model=SONNET) == 1
+
+
+def test_slow_model_falls_back(setup, monkeypatch):
+    client, standin, _, _ = setup
+    catalog = load_catalog(f'{{"{SONNET}": {{"timeout": 0.05, "fallback": "{HAIKU}"}}, '
+                           f'"{HAIKU}": {{"timeout": 5}}}}')
+    monkeypatch.setattr(server, "MODEL_CATALOG", catalog)
+    real_complete = server.llm.complete
+
+    async def complete(**kwargs):
+        standin.base_latency_ms = 500 if kwargs["model"] == SONNET else 0
+        return await real_complete(**kwargs)
+
+    monkeypatch.setattr(server.llm, "complete", complete)
+    assert client.post("/api/v1/chat", json={"message": "hola"}).json()["model"] == HAIKU
+    assert metrics.counter("llm_model_errors", model=SONNET, kind="overloaded") == 1
@@ -0,0 +1,48 @@
+"""
+Response serialization tests - the orjson default class keeps UTF-8, ISO datetimes and the JSON content type
+"""
+import asyncio
+import json
+from datetime import datetime, timezone
+
+import pytest
+from fastapi.responses import ORJSONResponse
+from fastapi.testclient import TestClient
+
+import server
+from storage import SqlStorage
+
+NOW = "2024-01-01T00:00:00+00:00"
+CONTENT = "¿Qué tal? Añade ñandú, 東京 y 🚀"
+
+
+def test_default_response_is_orjson():
+    pytest.importorskip("orjson")
+    assert server.DefaultResponse is ORJSONResponse
+
+
+def test_trusted_response_keeps_utf8_and_serializes_datetimes():
+    at = datetime(2024, 5, 1, 10, 30, tzinfo=timezone.utc)
+    response = server.trusted_response({"content": CONTENT, "at": at})
+    assert response.headers["content-type"] == "application/json"
+    # Non-ASCII goes out as UTF-8, not \\u escapes
+    assert CONTENT.encode() in response.body
+    assert json.loads(response.body) == {"content": CONTENT, "at": "2024-05-01T10:30:00+00:00"}
+
+
+def test_conversation_endpoint_round_trips_non_ascii(monkeypatch):
+    storage = SqlStorage("sqlite:///:memory:")
+    asyncio.run(storage.conversations.create({
+        "id": "c1", "user_id": "u1", "created_at": NOW, "updated_at": NOW,
+        "messages": [{"id": "m1", "role": "user", "content": CONTENT, "timestamp": NOW}]}))
+    monkeypatch.setattr(server, "storage", storage)
+    server.app.dependency_overrides[server.get_current_user] = lambda: {"id": "u1", "credits": 10}
+    try:
+        with TestClient(server.app) as client:
+            response = client.get("/api/chat/conversations/c1", headers={"Accept-Encoding": "identity"})
+    finally:
+        server.app.dependency_overrides.clear()
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    assert CONTENT.encode() in response.content
+    assert response.json()["messages"] == [{"id": "m1", "role": "user", "content": CONTENT, "timestamp": NOW}]
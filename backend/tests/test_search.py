@@ -0,0 +1,89 @@
+"""
+Conversation search tests - tokenization, BM25 ranking, snippets, pagination and the endpoint
+"""
+import asyncio
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+from firebase_client import FirebaseClient
+from search import SearchIndex, snippet, tokenize
+from standins.firebase_server import FirebaseStandin
+from storage import FirebaseStorage
+
+
+def msg(message_id, content, role="user"):
+    return {"id": message_id, "role": role, "content": content, "timestamp": "2024-01-01T00:00:00+00:00"}
+
+
+def test_tokenize_spanish_and_english():
+    assert tokenize("Las Canciones de la ciudad") == ["cancion", "ciudad"]
+    assert tokenize("Canción") == ["cancion"]
+    assert tokenize("The reports and the report") == ["report", "report"]
+
+
+def test_ranking_and_user_isolation():
+    index = SearchIndex()
+    index.add_messages("u1", "c1", [msg("m1", "Presupuesto de marketing para el trimestre"),
+                                    msg("m2", "El presupuesto del presupuesto anual, presupuesto final")])
+    index.add_messages("u1", "c2", [msg("m3", "Receta de cocina sin relación")])
+    index.add_messages("u2", "c9", [msg("m9", "presupuesto ajeno")])
+    total, results = index.search("u1", "presupuestos")
+    assert total == 2
+    assert [r["message_id"] for r in results] == ["m2", "m1"]
+    assert all(r["conversation_id"] == "c1" for r in results)
+
+
+def test_reindexing_is_idempotent_and_removal_works():
+    index = SearchIndex()
+    index.add_messages("u1", "c1", [msg("m1", "hola mundo")])
+    index.add_messages("u1", "c1", [msg("m1", "hola mundo")])
+    assert index.search("u1", "mundo")[0] == 1
+    index.remove_conversation("u1", "c1")
+    assert index.search("u1", "mundo") == (0, [])
+
+
+def test_pagination():
+    index = SearchIndex()
+    index.add_messages("u1", "c1", [msg(f"m{i:02d}", f"factura número {i}") for i in range(25)])
+    total, first = index.search("u1", "factura", limit=10)
+    _, last = index.search("u1", "factura", limit=10, offset=20)
+    assert total == 25
+    assert len(first) == 10 and len(last) == 5
+    assert not {r["message_id"] for r in first} & {r["message_id"] for r in last}
+
+
+def test_snippet_is_centred_on_match():
+    content = "x " * 200 + "el contrato de alquiler vence en marzo " + "y " * 200
+    text = snippet(content, tokenize("contrato"))
+    assert "contrato" in text and text.startswith("…") and text.endswith("…")
+
+
+@pytest.fixture
+def client(monkeypatch):
+    standin = FirebaseStandin({"conversations": {
+        "c1": {"id": "c1", "user_id": "u1", "messages": [msg("m1", "Planificamos el viaje a Lisboa")],
+               "created_at": "2024-01-01T00:00:00+00:00", "updated_at": "2024-01-01T00:00:00+00:00"},
+        "c2": {"id": "c2", "user_id": "u2", "messages": [msg("m2", "Viaje a Lisboa de otro usuario")],
+               "created_at": "2024-01-01T00:00:00+00:00", "updated_at": "2024-01-01T00:00:00+00:00"},
+    }})
+    client = FirebaseClient("http://firebase.test", transport=httpx.ASGITransport(app=standin.app))
+    monkeypatch.setattr(server, "storage", FirebaseStorage(client))
+    monkeypatch.setattr(server, "search_index", SearchIndex())
+    server.app.dependency_overrides[server.get_current_user] = lambda: {"id": "u1", "credits": 10}
+    with TestClient(server.app) as test_client:
+        yield test_client
+    server.app.dependency_overrides.clear()
+
+
+def test_search_endpoint_backfills_and_indexes_new_messages(client):
+    response = client.get("/api/chat/search", params={"q": "lisboa"})
+    assert response.status_code == 200
+    body = response.json()
+    assert body["total"] == 1
+    assert body["results"][0]["conversation_id"] == "c1"
+
+    asyncio.run(server.index_messages("u1", "c1", [msg("m3", "Reservamos hotel en Lisboa", role="assistant")]))
+    assert client.get("/api/chat/search", params={"q": "hotel"}).json()["total"] == 1
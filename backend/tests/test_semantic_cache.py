@@ -0,0 +1,126 @@
+"""
+Semantic cache tests - near-identical prompts reuse an answer, scoped per API key and system prompt
+"""
+import json
+import time
+
+import httpx
+import numpy as np
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+from llm import AnthropicProvider, LlmClient
+from metrics import metrics
+from semantic_cache import SemanticCache, scope_key
+from standins.llm_server import LlmStandin
+
+
+def test_paraphrase_hits_and_distinct_question_misses():
+    cache = SemanticCache(threshold=0.9)
+    cache.store("k", "¿Cuánto cuesta el plan premium?", {"response": "500"})
+    hit = cache.lookup("k", "Hola, cuanto cuesta el plan premium por favor")
+    assert hit and hit.answer == {"response": "500"}
+    assert cache.lookup("k", "¿Cuánto cuesta el plan estándar?") is None
+    assert cache.lookup("otra-llave", "¿Cuánto cuesta el plan premium?") is None
+
+
+def test_scope_depends_on_system_prompt_and_model():
+    assert scope_key("k1", "m", "Eres un bot") != scope_key("k1", "m", "Eres otro bot")
+    assert scope_key("k1", "m", "Eres un bot") != scope_key("k1", "m2", "Eres un bot")
+
+
+def test_expired_entries_are_not_served(monkeypatch):
+    cache = SemanticCache(ttl_seconds=60)
+    cache.store("k", "horario de atención", {"response": "9 a 18"})
+    later = time.time() + 120
+    monkeypatch.setattr(time, "time", lambda: later)
+    assert cache.lookup("k", "horario de atención") is None
+    assert cache.store("k", "otra pregunta", {}) == 1
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = SemanticCache(max_entries=2)
+    cache.store("k", "pregunta uno sobre facturas", {"n": 1})
+    cache.store("k", "pregunta dos sobre envíos", {"n": 2})
+    cache.lookup("k", "pregunta uno sobre facturas")
+    assert cache.store("k", "pregunta tres sobre cuentas", {"n": 3}) == 1
+    assert cache.lookup("k", "pregunta uno sobre facturas").answer == {"n": 1}
+    assert cache.lookup("k", "pregunta dos sobre envíos") is None
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / "cache.npz")
+    cache = SemanticCache()
+    for i in range(20):
+        cache.store(f"k{i % 3}", f"pregunta número {i} sobre el producto {i}", {"n": i})
+    cache.save(path)
+    assert not cache.dirty
+
+    restored = SemanticCache()
+    assert restored.load(path) == 20
+    assert restored.stats() == (3, 20)
+    assert restored.lookup("k1", "pregunta número 7 sobre el producto 7").answer == {"n": 7}
+
+
+def test_load_ignores_a_file_whose_answers_do_not_match_its_vectors(tmp_path):
+    path = str(tmp_path / "cache.npz")
+    cache = SemanticCache()
+    for i in range(4):
+        cache.store("k", f"pregunta número {i} sobre el producto {i}", {"n": i})
+    cache.save(path)
+    with np.load(path) as data:
+        meta = json.loads(data["meta"].tobytes())
+        vectors = data["vectors"]
+    meta["scopes"][0]["answers"].pop()
+    np.savez_compressed(path, vectors=vectors, meta=np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8))
+    restored = SemanticCache()
+    assert restored.load(path) == 0 and restored.stats() == (0, 0)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    metrics.reset()
+    standin = LlmStandin(base_latency_ms=0)
+    monkeypatch.setattr(server, "llm", LlmClient(AnthropicProvider(
+        "k", base_url="http://llm.test", transport=httpx.ASGITransport(app=standin.app))))
+    monkeypatch.setattr(server, "semantic_cache", SemanticCache())
+    charges = []
+
+    async def update_user(user, fields):
+        charges.append(fields["credits"])
+        return True
+
+    async def record_usage(*args, **kwargs):
+        pass
+
+    monkeypatch.setattr(server, "update_user", update_user)
+    monkeypatch.setattr(server, "record_usage", record_usage)
+    user = {"id": "u1", "credits": 10, "_api_key_id": "k1"}
+    server.app.dependency_overrides[server.get_user_by_api_key] = lambda: user
+    try:
+        with TestClient(server.app) as client:
+            yield client, standin, charges
+    finally:
+        server.app.dependency_overrides.clear()
+
+
+def test_cached_answer_is_served_without_llm_call(client):
+    client, standin, charges = client
+    first = client.post("/api/v1/chat", json={"message": "¿Cómo cancelo mi plan?", "semantic_cache": True})
+    second = client.post("/api/v1/chat", json={"message": "hola, como cancelo mi plan", "semantic_cache": True})
+    assert first.json()["cached"] is False
+    assert second.json()["cached"] is True
+    assert second.json()["response"] == first.json()["response"]
+    assert len(standin.requests) == 1
+    assert charges == [9]
+    assert metrics.counter("semantic_cache_lookups", result="hit") == 1
+    assert metrics.counter("semantic_cache_lookups", result="miss") == 1
+
+
+def test_cache_is_opt_in(client):
+    client, standin, _ = client
+    for _ in range(2):
+        response = client.post("/api/v1/chat", json={"message": "¿Cómo cancelo mi plan?"})
+        assert response.json()["cached"] is False
+    assert len(standin.requests) == 2
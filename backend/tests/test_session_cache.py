@@ -0,0 +1,160 @@
+"""
+Session tests - JWT verification cache, session snapshots and revocation by version bump
+"""
+import asyncio
+import time
+import uuid
+
+import jwt
+import pytest
+from fastapi import HTTPException
+from fastapi.security import HTTPAuthorizationCredentials
+from fastapi.testclient import TestClient
+
+import server
+from shared_state import MemoryStateBackend
+from storage import UserRepository
+
+
+@pytest.fixture
+def users(monkeypatch):
+    """In-memory `users` collection with a counter of full user lookups"""
+    user_id = str(uuid.uuid4())
+    docs = {"-fb1": {
+        "id": user_id, "name": "Test User", "email": "test@brainyx.com", "password_hash": "x",
+        "system_prompt": server.DEFAULT_SYSTEM_PROMPT, "credits": 500, "plan": "estandar",
+        "created_at": "2026-01-01T00:00:00+00:00"
+    }}
+    lookups = {"count": 0}
+
+    class Users(UserRepository):
+        async def get(self, user_id):
+            lookups["count"] += 1
+            for doc_id, doc in docs.items():
+                if doc.get("id") == user_id:
+                    return dict(doc, _firebase_id=doc_id)
+            return None
+
+        async def update(self, user, fields):
+            docs[user["_firebase_id"]].update(fields)
+            return True
+
+    monkeypatch.setattr(server.storage, "users", Users())
+    monkeypatch.setattr(server, "state", MemoryStateBackend())
+    server._token_cache.clear()
+    return {"docs": docs, "lookups": lookups, "user": docs["-fb1"]}
+
+
+def auth(token):
+    return {"Authorization": f"Bearer {token}"}
+
+
+class TestTokenCache:
+
+    def test_decode_is_cached(self, monkeypatch):
+        server._token_cache.clear()
+        token = server.create_token({"id": "u1"})
+        calls = {"n": 0}
+        real_decode = jwt.decode
+
+        def counting_decode(*args, **kwargs):
+            calls["n"] += 1
+            return real_decode(*args, **kwargs)
+
+        monkeypatch.setattr(server.jwt, "decode", counting_decode)
+        for _ in range(5):
+            assert server.decode_token(token)["sub"] == "u1"
+        assert calls["n"] == 1
+
+    def test_cached_token_honours_exp(self):
+        server._token_cache.clear()
+        token = jwt.encode({"sub": "u1", "exp": int(time.time()) + 1}, server.JWT_SECRET, algorithm=server.JWT_ALGORITHM)
+        assert server.decode_token(token)["sub"] == "u1"
+        server._token_cache[next(iter(server._token_cache))]["exp"] = time.time() - 1
+        with pytest.raises(HTTPException) as exc:
+            server.decode_token(token)
+        assert exc.value.detail == "Token expirado"
+        assert not server._token_cache
+
+    def test_invalid_tokens_are_not_cached(self):
+        server._token_cache.clear()
+        with pytest.raises(HTTPException):
+            server.decode_token("not-a-token")
+        assert not server._token_cache
+
+    def test_cache_is_bounded(self, monkeypatch):
+        server._token_cache.clear()
+        monkeypatch.setattr(server, "TOKEN_CACHE_SIZE", 3)
+        for i in range(10):
+            server.decode_token(server.create_token({"id": f"u{i}"}))
+        assert len(server._token_cache) == 3
+
+
+class TestSessionSnapshot:
+
+    def test_usage_and_settings_served_from_snapshot(self, users):
+        token = server.create_token(users["user"])
+        with TestClient(server.app) as client:
+            assert client.get("/api/auth/me", headers=auth(token)).status_code == 200
+            lookups = users["lookups"]["count"]
+            usage = client.get("/api/usage", headers=auth(token))
+            settings = client.get("/api/settings", headers=auth(token))
+        assert usage.json() == {"credits": 500, "plan": "estandar"}
+        assert settings.json()["system_prompt"] == server.DEFAULT_SYSTEM_PROMPT
+        assert users["lookups"]["count"] == lookups
+
+    def test_snapshot_is_written_only_on_a_miss(self, users, monkeypatch):
+        token = server.create_token(users["user"])
+        writes = []
+        real_store = server.state._store
+        monkeypatch.setattr(server.state, "_store", lambda key, *args: writes.append(key) or real_store(key, *args))
+        with TestClient(server.app) as client:
+            client.get("/api/auth/me", headers=auth(token))
+            first = len(writes)
+            for _ in range(3):
+                assert client.get("/api/auth/me", headers=auth(token)).status_code == 200
+        assert first > 0 and len(writes) == first
+
+    def test_request_racing_an_update_does_not_recache_the_old_doc(self, users, monkeypatch):
+        user_id = users["user"]["id"]
+        real_get = server.storage.users.get
+
+        async def racing_get(user_id):
+            doc = await real_get(user_id)
+            # The update lands after this request read the doc
+            await server.update_user(doc, {"credits": 1})
+            return doc
+
+        monkeypatch.setattr(server.storage.users, "get", racing_get)
+        credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=server.create_token(users["user"]))
+        assert asyncio.run(server.get_current_user(credentials))["credits"] == 500
+        assert asyncio.run(server.state.get_json(f"user:{user_id}")) is None
+
+    def test_user_write_invalidates_snapshot(self, users):
+        token = server.create_token(users["user"])
+        with TestClient(server.app) as client:
+            client.get("/api/usage", headers=auth(token))
+            response = client.put("/api/settings", headers=auth(token),
+                                  json={"system_prompt": "Eres un asistente muy breve."})
+            assert response.status_code == 200
+            settings = client.get("/api/settings", headers=auth(token))
+        assert settings.json()["system_prompt"] == "Eres un asistente muy breve."
+
+    def test_logout_all_revokes_older_tokens(self, users):
+        old_token = server.create_token(users["user"])
+        with TestClient(server.app) as client:
+            assert client.get("/api/usage", headers=auth(old_token)).status_code == 200
+            assert client.post("/api/auth/logout-all", headers=auth(old_token)).status_code == 200
+            revoked = client.get("/api/usage", headers=auth(old_token))
+            assert revoked.status_code == 401
+            assert revoked.json()["detail"] == "Sesión revocada"
+
+            new_token = server.create_token(users["docs"]["-fb1"])
+            assert client.get("/api/usage", headers=auth(new_token)).status_code == 200
+
+    def test_legacy_token_without_version_is_revoked_by_bump(self, users):
+        legacy = jwt.encode({"sub": users["user"]["id"], "exp": int(time.time()) + 3600},
+                            server.JWT_SECRET, algorithm=server.JWT_ALGORITHM)
+        users["user"]["session_version"] = 1
+        with TestClient(server.app) as client:
+            assert client.get("/api/usage", headers=auth(legacy)).status_code == 401
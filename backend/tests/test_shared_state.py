@@ -0,0 +1,88 @@
+"""
+Shared state backend tests - memory backend and Redis backend against the local stand-in
+"""
+import asyncio
+
+import pytest
+
+from shared_state import MemoryStateBackend, RedisStateBackend, StateLock, rate_limit_hit
+from standins.redis_server import RedisStandin
+
+
+def run_with_backend(kind, scenario):
+    async def main():
+        if kind == "memory":
+            backend = MemoryStateBackend()
+            await scenario(backend)
+            return
+        standin = RedisStandin()
+        port = await standin.start()
+        backend = RedisStateBackend(f"redis://127.0.0.1:{port}/0")
+        try:
+            await scenario(backend)
+        finally:
+            await backend.close()
+            await standin.stop()
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("kind", ["memory", "redis"])
+class TestStateBackends:
+    """Both backends must behave the same for the operations the app relies on"""
+
+    def test_get_set_delete(self, kind):
+        async def scenario(backend):
+            assert await backend.get("missing") is None
+            await backend.set("k", "v")
+            assert await backend.get("k") == "v"
+            await backend.delete("k")
+            assert await backend.get("k") is None
+        run_with_backend(kind, scenario)
+
+    def test_ttl_expires(self, kind):
+        async def scenario(backend):
+            await backend.set("short", "v", ttl=0.05)
+            assert await backend.get("short") == "v"
+            await asyncio.sleep(0.1)
+            assert await backend.get("short") is None
+        run_with_backend(kind, scenario)
+
+    def test_add_is_idempotent(self, kind):
+        async def scenario(backend):
+            assert await backend.add("payment:cs_1", "1", ttl=60) is True
+            assert await backend.add("payment:cs_1", "1", ttl=60) is False
+        run_with_backend(kind, scenario)
+
+    def test_incr_and_rate_limit(self, kind):
+        async def scenario(backend):
+            assert await backend.incr("c") == 1
+            assert await backend.incr("c", 4) == 5
+            hits = [await rate_limit_hit(backend, "key", limit=3, window=60) for _ in range(5)]
+            assert hits == [False, False, False, True, True]
+        run_with_backend(kind, scenario)
+
+    def test_json_roundtrip(self, kind):
+        async def scenario(backend):
+            await backend.set_json("doc", {"credits": 10, "plan": "free"})
+            assert await backend.get_json("doc") == {"credits": 10, "plan": "free"}
+        run_with_backend(kind, scenario)
+
+    def test_lock_is_exclusive(self, kind):
+        async def scenario(backend):
+            first = StateLock(backend, "job", ttl=5)
+            second = StateLock(backend, "job", ttl=5)
+            assert await first.acquire() is True
+            assert await second.acquire() is False
+            await first.release()
+            assert await second.acquire() is True
+        run_with_backend(kind, scenario)
+
+
+def test_memory_backend_is_bounded():
+    async def scenario():
+        backend = MemoryStateBackend(max_keys=10)
+        for i in range(50):
+            await backend.set(f"k{i}", "v")
+        assert len(backend._data) <= 10
+        assert await backend.get("k49") == "v"
+    asyncio.run(scenario())
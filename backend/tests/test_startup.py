@@ -0,0 +1,160 @@
+"""
+Startup tests - lazy integrations, liveness vs readiness probes, and the import-time budget
+"""
+import asyncio
+import os
+import subprocess
+import sys
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+from benchmarks.bench_startup import BACKEND_DIR, measure_import
+from firebase_client import FirebaseClient
+from llm import AnthropicProvider, LlmClient
+from readiness import Probe
+from standins.firebase_server import FirebaseStandin
+from standins.llm_server import LlmStandin
+from storage import FirebaseStorage
+
+# Generous default so slow CI machines pass; tighten locally with STARTUP_IMPORT_BUDGET_MS
+IMPORT_BUDGET_MS = float(os.environ.get("STARTUP_IMPORT_BUDGET_MS", 3000))
+
+
+def test_integrations_not_imported_at_startup():
+    """Importing the app must not pull in the LLM or Stripe SDKs, nor NumPy for the semantic cache"""
+    proc = subprocess.run(
+        [sys.executable, "-c",
+         "import sys, server; print(any(m.startswith(('emergentintegrations', 'numpy')) for m in sys.modules))"],
+        cwd=BACKEND_DIR, capture_output=True, text=True, check=True
+    )
+    assert proc.stdout.strip() == "False"
+
+
+def test_import_time_budget():
+    """Track `import server` cost with -X importtime"""
+    result = measure_import("server")
+    print(f"✓ import server: {result['total_ms']:.1f} ms")
+    assert 0 < result["total_ms"] < IMPORT_BUDGET_MS
+
+
+def test_several_workers_require_shared_state():
+    env = dict(os.environ, WEB_CONCURRENCY="2", STATE_BACKEND_URL="memory://")
+    for code in ("import server", "exec(open('gunicorn.conf.py').read())"):
+        proc = subprocess.run([sys.executable, "-c", code], cwd=BACKEND_DIR, env=env, capture_output=True, text=True)
+        assert proc.returncode != 0 and "STATE_BACKEND_URL" in proc.stderr
+    proc = subprocess.run([sys.executable, "-c", "exec(open('gunicorn.conf.py').read()); print(workers)"],
+                          cwd=BACKEND_DIR, env={k: v for k, v in env.items() if k != "WEB_CONCURRENCY"},
+                          capture_output=True, text=True, check=True)
+    assert proc.stdout.strip() == "1"
+
+
+@pytest.fixture
+def deps(monkeypatch):
+    """Firebase and the LLM API on stand-ins, probed on every request unless a test says otherwise"""
+    import server
+
+    firebase = FirebaseStandin({"users": {}})
+    monkeypatch.setattr(server, "storage", FirebaseStorage(FirebaseClient(
+        "http://firebase.test", max_retries=0, transport=httpx.ASGITransport(app=firebase.app))))
+    monkeypatch.setattr(server, "llm", LlmClient(AnthropicProvider(
+        "k", base_url="http://llm.test", transport=httpx.ASGITransport(app=LlmStandin(base_latency_ms=0).app))))
+    monkeypatch.setattr(server, "READY_PROBE_INTERVAL_SECONDS", 0)
+    monkeypatch.setattr(server, "READY_LLM_PROBE_INTERVAL_SECONDS", 0)
+    monkeypatch.setattr(server, "READY_PROBE_TIMEOUT_SECONDS", 0.5)
+    return firebase
+
+
+def shallow_reads(firebase) -> int:
+    return sum(1 for _, _, params in firebase.requests if params.get("shallow"))
+
+
+def test_liveness_and_readiness(deps, monkeypatch):
+    import server
+
+    monkeypatch.setattr(server, "READY_PROBE_INTERVAL_SECONDS", 30)
+    with TestClient(server.app) as client:
+        health = client.get("/api/health")
+        assert health.status_code == 200
+        assert health.json()["status"] == "healthy"
+
+        ready = client.get("/api/ready")
+        assert ready.status_code == 200
+        data = ready.json()
+        assert data["status"] == "ready"
+        assert data["warmup"] == "skipped"
+        assert {name: check["status"] for name, check in data["checks"].items()} == {
+            "storage": "ok", "state": "ok", "llm": "ok", "event_loop": "ok", "llm_queue": "ok"}
+        assert data["queues"]["llm_waiting"] == 0
+
+        # Polls within the interval reuse the probe results
+        for _ in range(5):
+            assert client.get("/api/ready").json()["status"] == "ready"
+        assert shallow_reads(deps) == 1
+
+
+def test_readiness_grades_slow_and_failing_dependencies(deps, monkeypatch):
+    import server
+
+    monkeypatch.setattr(server, "READY_STORAGE_DEGRADED_MS", 30)
+    with TestClient(server.app) as client:
+        deps.faults.latency = 0.05
+        slow = client.get("/api/ready")
+        assert slow.status_code == 200 and slow.json()["status"] == "degraded"
+        assert slow.json()["checks"]["storage"]["value"] >= 30
+
+        # The LLM path failing only degrades the instance
+        deps.faults.latency = 0
+        monkeypatch.setattr(server.llm.provider, "ping", lambda: asyncio.sleep(1))
+        llm_down = client.get("/api/ready").json()
+        assert llm_down["status"] == "degraded" and llm_down["checks"]["llm"]["status"] == "degraded"
+
+        deps.faults.error_rate = 1.0
+        down = client.get("/api/ready")
+        assert down.status_code == 503 and down.json()["status"] == "unready"
+        assert "FirebaseUnavailable" in down.json()["checks"]["storage"]["detail"]
+
+
+def test_hung_storage_ping_is_ended_by_the_client_deadline(deps):
+    import server
+
+    with TestClient(server.app) as client:
+        deps.faults.latency = 2
+        hung = client.get("/api/ready").json()["checks"]["storage"]
+        # The client's deadline ended the read (a breaker failure), not a cancellation from outside
+        assert hung["status"] == "unready" and hung["detail"].startswith("FirebaseUnavailable")
+        assert server.storage.client.breaker.failures == 1
+        deps.faults.latency = 0
+        assert client.get("/api/ready").json()["checks"]["storage"]["status"] == "ok"
+
+
+def test_concurrent_polls_share_one_probe():
+    calls = []
+
+    async def check():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 12.0
+
+    async def scenario():
+        probe = Probe("storage", check, every=60, degraded=10)
+        results = await asyncio.gather(*(probe.result() for _ in range(20)))
+        assert {r.status for r in results} == {"degraded"} and len(calls) == 1
+        await probe.result()
+        assert len(calls) == 1
+
+    asyncio.run(scenario())
+
+
+def test_readiness_reports_failed_warmup(deps):
+    import server
+
+    server.startup["warmup"] = "failed"
+    try:
+        with TestClient(server.app) as client:
+            response = client.get("/api/ready")
+            assert response.status_code == 503
+            assert response.json()["status"] == "unready"
+    finally:
+        server.startup["warmup"] = "skipped"
@@ -0,0 +1,97 @@
+"""
+Storage contract tests - every repository behaves the same on Firebase (stand-in) and SQLite
+"""
+import asyncio
+from datetime import datetime, timezone
+
+import httpx
+import pytest
+
+from firebase_client import FirebaseClient
+from standins.firebase_server import FirebaseStandin
+from storage import FirebaseStorage, SqlStorage
+from usage_rollups import bucket
+
+NOW = "2024-05-01T10:00:00+00:00"
+
+
+@pytest.fixture(params=["firebase", "sqlite"])
+def storage(request):
+    if request.param == "firebase":
+        standin = FirebaseStandin()
+        return FirebaseStorage(FirebaseClient("http://firebase.test", transport=httpx.ASGITransport(app=standin.app)))
+    return SqlStorage("sqlite:///:memory:")
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_users(storage):
+    async def scenario():
+        created = await storage.users.create({"id": "u1", "email": "a@b.com", "credits": 5, "created_at": NOW})
+        await storage.users.update(created, {"credits": 7})
+        return await storage.users.get("u1"), await storage.users.get_by_email("a@b.com"), await storage.users.get("u2")
+    by_id, by_email, missing = run(scenario())
+    assert by_id["credits"] == 7 and by_email["id"] == "u1" and missing is None
+
+
+def test_api_keys(storage):
+    async def scenario():
+        await storage.api_keys.create("k1", {"id": "k1", "user_id": "u1", "name": "uno"})
+        await storage.api_keys.create("k2", {"id": "k2", "user_id": "u2", "name": "dos"})
+        await storage.api_keys.touch({"k1": NOW})
+        mine = await storage.api_keys.list_for_user("u1")
+        await storage.api_keys.delete("k2")
+        return mine, await storage.api_keys.all()
+    mine, remaining = run(scenario())
+    assert list(mine) == ["k1"] and mine["k1"]["last_used"] == NOW
+    assert list(remaining) == ["k1"]
+
+
+def test_conversations(storage):
+    async def scenario():
+        for i in range(3):
+            await storage.conversations.create({"id": f"c{i}", "user_id": "u1", "messages": [],
+                                                "created_at": NOW, "updated_at": f"2024-05-0{i + 1}"})
+        await storage.conversations.append_messages("c0", 0, [{"id": "m1", "role": "user", "content": "hola"},
+                                                              {"id": "m2", "role": "assistant", "content": "¿qué tal?"}],
+                                                    "2024-05-09")
+        await storage.conversations.set_summary("c0", {"text": "saludo", "covers": 2})
+        await storage.conversations.append_messages("c0", 2, [{"id": "m3", "role": "user", "content": "bien"}],
+                                                    "2024-05-10")
+        await storage.conversations.delete("c2")
+        return await storage.conversations.get("c0"), await storage.conversations.list_for_user("u1", limit=5)
+    conv, listed = run(scenario())
+    assert [m["id"] for m in conv["messages"]] == ["m1", "m2", "m3"]
+    assert conv["summary"]["text"] == "saludo" and conv["updated_at"] == "2024-05-10"
+    assert [conv_id for conv_id, _ in listed] == ["c0", "c1"]
+
+
+def test_payments(storage):
+    async def scenario():
+        await storage.transactions.create_payment("t1", {"id": "t1", "session_id": "cs_1", "user_id": "u1",
+                                                         "payment_status": "pending"})
+        await storage.transactions.update_payment("t1", {"payment_status": "completed"})
+        return await storage.transactions.find_payment("cs_1"), await storage.transactions.find_payment("cs_2")
+    found, missing = run(scenario())
+    assert found[0] == "t1" and found[1]["payment_status"] == "completed" and missing is None
+
+
+def test_usage_rollups_and_purge(storage):
+    at = datetime(2024, 5, 1, 10, 30, tzinfo=timezone.utc)
+
+    async def scenario():
+        await storage.usage.record("e1", {"user_id": "u1", "api_key_id": "k1", "credits_used": 1,
+                                          "input_tokens": 10, "timestamp": "2024-05-01T10:30:00+00:00"}, at)
+        await storage.usage.record("e2", {"user_id": "u1", "credits_used": 2,
+                                          "timestamp": "2024-06-01T10:30:00+00:00"}, at)
+        day = bucket(at, "day")
+        user = await storage.usage.rollups("u1", None, "day", day, day)
+        key = await storage.usage.rollups("u1", "k1", "hour", "2024-05-01T00", "2024-05-01T23")
+        purged = await storage.usage.purge_before("2024-05-15")
+        return user[day], key, purged
+    user_day, key_hours, purged = run(scenario())
+    assert user_day["requests"] == 2 and user_day["credits"] == 3 and user_day["input_tokens"] == 10
+    assert list(key_hours) == ["2024-05-01T10"] and key_hours["2024-05-01T10"]["requests"] == 1
+    assert purged == 1
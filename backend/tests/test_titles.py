@@ -0,0 +1,157 @@
+"""
+Conversation title tests - one model call per batch, heuristic fallback, the listing index and ?view=meta
+"""
+import asyncio
+import json
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+from firebase_client import FirebaseClient
+from llm import AnthropicProvider, LlmClient
+from metrics import metrics
+from shared_state import MemoryStateBackend
+from standins.firebase_server import FirebaseStandin
+from standins.llm_server import LlmStandin
+from storage import FirebaseStorage, SqlStorage
+from titles import TitleWorker
+
+NOW = "2024-05-01T10:00:00+00:00"
+
+
+def conversation(conv_id, question, turns=1, updated_at=NOW):
+    messages = []
+    for i in range(turns):
+        messages.append({"id": f"{conv_id}-u{i}", "role": "user", "content": question, "timestamp": NOW})
+        messages.append({"id": f"{conv_id}-a{i}", "role": "assistant", "content": f"respuesta {i}", "timestamp": NOW})
+    return {"id": conv_id, "user_id": "u1", "messages": messages, "created_at": NOW, "updated_at": updated_at}
+
+
+def titled_replies(payload):
+    """One JSON line per numbered conversation in the prompt"""
+    prompt = payload["messages"][-1]["content"]
+    if isinstance(prompt, list):
+        prompt = prompt[-1]["text"]
+    count = prompt.count("### ")
+    return "\n".join(json.dumps({"n": n, "title": f"Título {n}"}) for n in range(1, count + 1))
+
+
+def make_worker(llm_standin, conversations, **kwargs):
+    client = LlmClient(AnthropicProvider("k", base_url="http://llm.test",
+                                         transport=httpx.ASGITransport(app=llm_standin.app)))
+
+    async def load(conversation_id):
+        return conversations.get(conversation_id)
+
+    async def store(conv, meta):
+        conversations[conv["id"]]["meta"] = meta
+
+    options = dict(model="claude-test", load=load, store=store, state=MemoryStateBackend(), batch_size=8)
+    options.update(kwargs)
+    return TitleWorker(client, **options)
+
+
+@pytest.fixture
+def llm_standin():
+    metrics.reset()
+    return LlmStandin(base_latency_ms=0)
+
+
+def test_batch_is_titled_with_one_call_and_unchanged_ones_are_skipped(llm_standin, monkeypatch):
+    monkeypatch.setattr(llm_standin, "reply_text", titled_replies)
+    conversations = {f"c{i}": conversation(f"c{i}", f"pregunta sobre el tema {i}") for i in range(3)}
+    worker = make_worker(llm_standin, conversations)
+
+    assert [worker.enqueue(conv_id) for conv_id in ("c0", "c1", "c0", "c2")] == [True, True, False, True]
+    assert asyncio.run(worker.process(worker.take())) == 3
+    assert len(llm_standin.requests) == 1
+    meta = conversations["c1"]["meta"]
+    assert meta["title"] == "Título 2" and meta["source"] == "llm" and meta["messages"] == 2
+    assert meta["preview"] == "respuesta 0" and meta["updated_at"] == NOW
+
+    # Nothing written since: no call and no write
+    assert asyncio.run(worker.process(["c0", "c1", "c2"])) == 0
+    # A new turn only refreshes the preview until refresh_messages is reached
+    conversations["c0"] = dict(conversation("c0", "otra cosa", turns=2, updated_at="2024-05-02"),
+                               meta=conversations["c0"]["meta"])
+    assert asyncio.run(worker.process(["c0"])) == 1
+    assert len(llm_standin.requests) == 1
+    assert conversations["c0"]["meta"]["title"] == "Título 1"
+    assert conversations["c0"]["meta"]["updated_at"] == "2024-05-02"
+
+
+def test_heuristic_titles_when_the_reply_does_not_parse_or_the_limit_is_reached(llm_standin):
+    conversations = {"c0": conversation("c0", "¿Cómo configuro el servidor de correo en mi empresa pequeña?"),
+                     "c1": conversation("c1", "hola")}
+    worker = make_worker(llm_standin, conversations, llm_calls_per_minute=1, refresh_messages=2)
+
+    # The stand-in answers in prose, not JSON lines
+    asyncio.run(worker.process(["c0"]))
+    assert conversations["c0"]["meta"]["title"] == "¿Cómo configuro el servidor de correo"
+    assert conversations["c0"]["meta"]["source"] == "heuristic"
+
+    asyncio.run(worker.process(["c1"]))
+    assert len(llm_standin.requests) == 1
+    assert conversations["c1"]["meta"]["title"] == "hola"
+    assert metrics.snapshot()["counters"]["titles_rate_limited"] == 1
+
+    # A model title due for a refresh is kept while the limit holds
+    conversations["c1"] = dict(conversation("c1", "hola", turns=3, updated_at="2024-05-02"),
+                               meta=dict(conversations["c1"]["meta"], title="Saludo", source="llm"))
+    asyncio.run(worker.process(["c1"]))
+    assert conversations["c1"]["meta"]["title"] == "Saludo" and conversations["c1"]["meta"]["source"] == "llm"
+
+
+@pytest.mark.parametrize("backend", ["firebase", "sqlite"])
+def test_listing_follows_writes_without_reading_messages(backend):
+    standin = FirebaseStandin()
+    storage = (FirebaseStorage(FirebaseClient("http://firebase.test", transport=httpx.ASGITransport(app=standin.app)))
+               if backend == "firebase" else SqlStorage("sqlite:///:memory:"))
+
+    async def scenario():
+        await storage.conversations.create_many([conversation("c0", "primera"), conversation("c1", "segunda")])
+        await storage.conversations.append_messages(
+            "c0", 2, [{"id": "m", "role": "user", "content": "más", "timestamp": NOW}], "2024-05-03")
+        await storage.conversations.set_meta({"id": "c0", "user_id": "u1"}, {"title": "Primera", "preview": "más"})
+        before_delete = await storage.conversations.list_meta_for_user("u1")
+        await storage.conversations.delete("c1")
+        return before_delete, await storage.conversations.list_meta_for_user("u1")
+
+    listed, after_delete = asyncio.run(scenario())
+    assert [conv_id for conv_id, _ in listed] == ["c0", "c1"]
+    c0 = listed[0][1]
+    assert c0["message_count"] == 3 and c0["updated_at"] == "2024-05-03" and c0["meta"]["title"] == "Primera"
+    assert "meta" not in listed[1][1] and [conv_id for conv_id, _ in after_delete] == ["c0"]
+    if backend == "firebase":
+        assert standin.count("GET", "conversations") == 0
+        # Conversations stored before the index existed are listed once it is rebuilt
+        standin.data.pop("conversation_meta")
+        assert asyncio.run(storage.conversations.rebuild_meta_index()) == 1
+        assert [conv_id for conv_id, _ in asyncio.run(storage.conversations.list_meta_for_user("u1"))] == ["c0"]
+
+
+def test_meta_view_lists_titles_without_messages(monkeypatch):
+    standin = FirebaseStandin()
+    storage = FirebaseStorage(FirebaseClient("http://firebase.test", transport=httpx.ASGITransport(app=standin.app)))
+    asyncio.run(storage.conversations.create(conversation("c0", "pregunta " * 200, turns=20)))
+    monkeypatch.setattr(server, "storage", storage)
+    server.app.dependency_overrides[server.get_current_user] = lambda: {"id": "u1", "credits": 10}
+    try:
+        with TestClient(server.app) as client:
+            full = client.get("/api/chat/conversations")
+            light = client.get("/api/chat/conversations?view=meta")
+            assert light.json() == [{"id": "c0", "title": None, "preview": None, "message_count": 40,
+                                     "created_at": NOW, "updated_at": NOW}]
+            assert len(light.content) * 50 < len(full.content)
+            assert client.get("/api/chat/conversations?view=meta",
+                              headers={"If-None-Match": light.headers["etag"]}).status_code == 304
+
+            asyncio.run(storage.conversations.set_meta(
+                {"id": "c0", "user_id": "u1"}, {"title": "Preguntas", "preview": "respuesta 19", "generated_at": NOW}))
+            again = client.get("/api/chat/conversations?view=meta", headers={"If-None-Match": light.headers["etag"]})
+            assert again.status_code == 200 and again.json()[0]["title"] == "Preguntas"
+            assert client.get("/api/chat/conversations/c0").json()["title"] == "Preguntas"
+    finally:
+        server.app.dependency_overrides.clear()
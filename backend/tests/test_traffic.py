@@ -0,0 +1,70 @@
+"""
+Traffic trace tests - recorded lines keep only shapes, traces merge on one clock, compare flags regressions
+"""
+import asyncio
+import json
+
+from fastapi.testclient import TestClient
+
+import server
+from benchmarks.replay import compare_results, load_trace
+from storage import SqlStorage
+from traffic import TraceLog, TraceRecorder
+
+TOKEN = "token-privado-123"
+
+
+def test_recorder_keeps_route_templates_sizes_and_hashed_clients(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "storage", SqlStorage("sqlite:///:memory:"))
+    monkeypatch.setattr(server, "update_user", lambda *args: asyncio.sleep(0))
+    server.app.dependency_overrides[server.get_current_user] = lambda: {"id": "u1", "credits": 10}
+    log = TraceLog(str(tmp_path / "trace-{pid}.ndjson"))
+    headers = {"Authorization": f"Bearer {TOKEN}"}
+    try:
+        with TestClient(TraceRecorder(server.app, log)) as client:
+            assert client.put("/api/settings", json={"system_prompt": "Instrucciones confidenciales"},
+                              headers=headers).status_code == 200
+            assert client.get("/api/chat/conversations/conv-privada-42", headers=headers).status_code == 404
+            assert client.get("/api/plans?ref=campania").status_code == 200
+    finally:
+        server.app.dependency_overrides.clear()
+    log.flush()
+
+    path = next(tmp_path.glob("trace-*.ndjson"))
+    text = path.read_text()
+    for private in (TOKEN, "confidenciales", "conv-privada-42", "campania"):
+        assert private not in text
+    header, *records = [json.loads(line) for line in text.splitlines()]
+    assert header["type"] == "trace" and header["sample"] == 1.0
+    assert [(r["method"], r["route"], r["status"]) for r in records] == [
+        ("PUT", "/api/settings", 200),
+        ("GET", "/api/chat/conversations/{conversation_id}", 404),
+        ("GET", "/api/plans", 200)]
+    settings, conversation, plans = records
+    assert settings["req_bytes"] > len("Instrucciones confidenciales") and conversation["req_bytes"] == 0
+    assert settings["client"] == conversation["client"] == log.client(TOKEN) and settings["auth"] == "bearer"
+    assert plans["client"] is None and plans["resp_bytes"] > 0
+
+
+def test_traces_merge_on_wall_clock(tmp_path):
+    for name, epoch, offsets in (("a", 100.0, [0.5, 3.0]), ("b", 101.0, [0.0, 1.0])):
+        lines = [{"type": "trace", "version": 1, "sample": 1.0, "started_epoch": epoch}]
+        lines += [{"t": t, "kind": "http", "method": "GET", "route": f"/{name}"} for t in offsets]
+        (tmp_path / f"{name}.ndjson").write_text("\n".join(json.dumps(line) for line in lines) + "\n")
+    events = load_trace([str(tmp_path / "a.ndjson"), str(tmp_path / "b.ndjson")])
+    assert [(e["route"], e["at"]) for e in events] == [("/a", 0.0), ("/b", 0.5), ("/b", 1.5), ("/a", 2.5)]
+
+
+def test_compare_flags_slower_and_failing_routes():
+    def result(latencies, errors=0):
+        return {"routes": {route: {"latencies_ms": samples, "errors": errors.get(route, 0) if errors else 0}
+                           for route, samples in latencies.items()}}
+
+    baseline = result({"GET /api/plans": [10.0] * 100, "POST /api/v1/chat": [400.0] * 100,
+                       "GET /api/auth/me": [2.0] * 100})
+    candidate = result({"GET /api/plans": [10.0] * 90 + [30.0] * 10, "POST /api/v1/chat": [410.0] * 100,
+                        "GET /api/auth/me": [4.0] * 100}, errors={"POST /api/v1/chat": 5})
+    rows, regressions = compare_results(baseline, candidate, threshold=0.15, min_ms=5.0, max_error_increase=0.01)
+    # auth/me doubled but by 2 ms, under --min-ms; chat is only 2.5% slower but started failing
+    assert regressions == ["GET /api/plans", "POST /api/v1/chat"]
+    assert {row[0]: row[4] for row in rows}["GET /api/auth/me"] is False
@@ -0,0 +1,178 @@
+"""
+Conversation export/import tests - streamed NDJSON out, batched writes in, on both storage backends
+"""
+import asyncio
+import gzip
+import json
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+from firebase_client import FirebaseClient
+from search import SearchIndex
+from shared_state import MemoryStateBackend
+from standins.firebase_server import FirebaseStandin
+from storage import FirebaseStorage, SqlStorage
+from transfer import Importer, export_records
+
+NOW = "2024-01-01T00:00:00+00:00"
+
+
+def conversation(conv_id, user_id, n_messages):
+    return {"id": conv_id, "user_id": user_id, "created_at": NOW, "updated_at": NOW,
+            "messages": [{"id": f"{conv_id}-{i}", "role": "user" if i % 2 == 0 else "assistant",
+                          "content": f"mensaje {i} de {conv_id}", "timestamp": NOW} for i in range(n_messages)]}
+
+
+@pytest.fixture(params=["firebase", "sqlite"])
+def storage(request):
+    if request.param == "firebase":
+        standin = FirebaseStandin()
+        return FirebaseStorage(FirebaseClient("http://firebase.test", transport=httpx.ASGITransport(app=standin.app)))
+    return SqlStorage("sqlite:///:memory:")
+
+
+@pytest.fixture
+def client(storage, monkeypatch):
+    monkeypatch.setattr(server, "storage", storage)
+    monkeypatch.setattr(server, "state", MemoryStateBackend())
+    monkeypatch.setattr(server, "search_index", SearchIndex())
+    monkeypatch.setattr(server, "SUPPORT_TOKEN", "soporte")
+    monkeypatch.setattr(server, "EXPORT_PAGE_SIZE", 2)
+    monkeypatch.setattr(server, "IMPORT_BATCH_MESSAGES", 4)
+    server.app.dependency_overrides[server.get_current_user] = lambda: {"id": "u1", "credits": 10}
+    try:
+        with TestClient(server.app) as client:
+            yield client
+    finally:
+        server.app.dependency_overrides.clear()
+
+
+def seed(storage):
+    async def scenario():
+        for i in range(5):
+            await storage.conversations.create(conversation(f"c{i}", "u1", i * 3))
+        await storage.conversations.create(conversation("other", "u2", 2))
+    asyncio.run(scenario())
+
+
+def records(body: bytes):
+    return [json.loads(line) for line in body.splitlines()]
+
+
+def test_iter_for_user_pages_over_all_conversations(storage):
+    seed(storage)
+
+    async def collect():
+        return [conv_id async for conv_id, _ in storage.conversations.iter_for_user("u1", page_size=2)]
+    assert sorted(asyncio.run(collect())) == [f"c{i}" for i in range(5)]
+
+
+def test_export_streams_every_conversation(client, storage):
+    seed(storage)
+    response = client.get("/api/chat/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = records(response.content)
+    assert lines[0]["type"] == "export"
+    assert lines[-1] == {"type": "end", "conversations": 5, "messages": 30}
+    assert {r["id"] for r in lines if r["type"] == "conversation"} == {f"c{i}" for i in range(5)}
+
+
+def test_gzip_export_round_trips_through_import(client, storage):
+    seed(storage)
+    response = client.get("/api/chat/export", params={"compress": "gzip"})
+    assert response.headers["content-disposition"].endswith('.ndjson.gz"')
+    exported = gzip.decompress(response.content)
+
+    server.app.dependency_overrides[server.get_current_user] = lambda: {"id": "u3", "credits": 10}
+    result = client.post("/api/chat/import", params={"job_id": "j1"}, content=response.content).json()
+    assert result["status"] == "done"
+    assert (result["conversations"], result["messages"], result["errors"]) == (5, 30, 0)
+    assert client.get("/api/chat/import/j1").json()["status"] == "done"
+
+    imported = records(client.get("/api/chat/export").content)
+    original = records(exported)
+    assert imported[-1] == original[-1]
+    contents = lambda lines: sorted(r["content"] for r in lines if r["type"] == "message")  # noqa: E731
+    assert contents(imported) == contents(original)
+    message_ids = lambda lines: {r["id"] for r in lines if r["type"] == "message"}  # noqa: E731
+    assert not message_ids(imported) & message_ids(original)
+    assert client.get("/api/chat/search", params={"q": "mensaje"}).json()["total"] == 30
+
+
+def test_import_splits_long_conversation_across_batches(storage):
+    body = b"".join(json.dumps(r).encode() + b"\n" for r in [
+        {"type": "conversation", "id": "x"},
+        *({"type": "message", "conversation_id": "x", "role": "user", "content": f"m{i}"} for i in range(10)),
+    ])
+    batches = []
+
+    async def on_batch(written):
+        batches.append([len(messages) for _, messages in written])
+
+    async def scenario():
+        importer = Importer(storage, "u1", batch_messages=4, on_batch=on_batch)
+        progress = await importer.run(_chunks(body, 7))
+        conv_id, conv = (await storage.conversations.list_for_user("u1"))[0]
+        return progress, conv
+
+    progress, conv = asyncio.run(scenario())
+    assert progress["conversations"] == 1
+    assert [m["content"] for m in conv["messages"]] == [f"m{i}" for i in range(10)]
+    assert batches == [[4], [4], [2]]
+
+
+def test_gzip_import_is_limited_while_it_is_decompressed(storage):
+    bombs = {"línea demasiado larga": gzip.compress(b"a" * 50 * 1024 * 1024),
+             "importación demasiado grande": gzip.compress((b" " * 500 + b"\n") * 100_000)}
+    for reason, body in bombs.items():
+        importer = Importer(storage, "u1", max_line_bytes=64 * 1024, max_bytes=1024 * 1024)
+        inflated = []
+        importer._inflate = lambda decompressor, chunk, inflate=importer._inflate: (
+            inflated.append(piece) or piece for piece in inflate(decompressor, chunk))
+        progress = asyncio.run(importer.run(_chunks(body, len(body))))
+        assert progress["status"] == "failed" and progress["error_samples"][-1].endswith(reason)
+        # Stopped a couple of pieces past the limit, not after inflating the whole chunk
+        assert sum(map(len, inflated)) <= 1024 * 1024 + 64 * 1024
+
+
+def test_import_reports_bad_lines_and_keeps_going(client, storage):
+    body = "\n".join([
+        json.dumps({"type": "conversation", "id": "x"}),
+        "{no es json",
+        json.dumps({"type": "message", "conversation_id": "x", "role": "system", "content": "hola"}),
+        json.dumps({"type": "message", "conversation_id": "x", "role": "user", "content": "hola"}),
+    ])
+    result = client.post("/api/chat/import", content=body.encode()).json()
+    assert result["status"] == "done"
+    assert (result["conversations"], result["messages"], result["errors"]) == (1, 1, 2)
+    assert result["error_samples"][0].startswith("línea 2")
+
+
+def test_support_export_requires_token(client, storage):
+    seed(storage)
+    asyncio.run(storage.users.create({"id": "u1", "email": "u1@brainyx.com", "name": "U"}))
+    assert client.get("/api/support/users/u1/export").status_code == 403
+    response = client.get("/api/support/users/u1/export", headers={"X-Support-Token": "soporte"})
+    assert records(response.content)[-1]["conversations"] == 5
+
+
+async def _chunks(body: bytes, size: int):
+    for i in range(0, len(body), size):
+        yield body[i:i + size]
+
+
+def test_export_records_skip_empty_slots():
+    class Conversations:
+        async def iter_for_user(self, user_id, page_size):
+            yield "c1", {"id": "c1", "messages": [None, {"id": "m", "role": "user", "content": "hola"}]}
+
+    class Storage:
+        conversations = Conversations()
+
+    async def collect():
+        return [r async for r in export_records(Storage(), "u1")]
+    assert asyncio.run(collect())[-1] == {"type": "end", "conversations": 1, "messages": 1}
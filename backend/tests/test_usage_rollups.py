@@ -0,0 +1,108 @@
+"""
+Usage rollup tests - incremental hourly/daily counters, history series and raw event retention
+"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import server
+from firebase_client import FirebaseClient
+from llm import AnthropicProvider, LlmClient, LlmResult, LlmUsage
+from metrics import metrics
+from standins.firebase_server import FirebaseStandin
+from standins.llm_server import LlmStandin
+from storage import FirebaseStorage
+from usage_rollups import bucket, purge_raw_events, series
+
+USER = {"id": "u1", "credits": 10}
+
+
+@pytest.fixture
+def standin(monkeypatch):
+    standin = FirebaseStandin()
+    client = FirebaseClient("http://firebase.test", transport=httpx.ASGITransport(app=standin.app))
+    monkeypatch.setattr(server, "storage", FirebaseStorage(client))
+    return standin
+
+
+def result(input_tokens=100, output_tokens=20):
+    return LlmResult(text="ok", provider="test", model="m", latency_ms=1.0,
+                     usage=LlmUsage(input_tokens=input_tokens, output_tokens=output_tokens))
+
+
+def test_record_usage_increments_rollups(standin):
+    async def scenario():
+        await server.record_usage(USER, 1, result(), api_key_id="k1")
+        await server.record_usage(USER, 2, result(input_tokens=50))
+    asyncio.run(scenario())
+
+    now = datetime.now(timezone.utc)
+    day = standin.read(f"usage_rollups/u1/day/{bucket(now, 'day')}")
+    assert day == {"requests": 2, "credits": 3, "input_tokens": 150, "output_tokens": 40}
+    key_hour = standin.read(f"usage_rollups/u1/keys/k1/hour/{bucket(now, 'hour')}")
+    assert key_hour["requests"] == 1 and key_hour["credits"] == 1
+    assert len(standin.read("api_usage")) == 2
+    assert standin.count("PATCH") == 2
+
+
+def test_failed_usage_write_does_not_fail_the_answer(standin, monkeypatch):
+    metrics.reset()
+    llm_standin = LlmStandin(base_latency_ms=0)
+    monkeypatch.setattr(server, "llm", LlmClient(AnthropicProvider(
+        "k", base_url="http://llm.test", transport=httpx.ASGITransport(app=llm_standin.app))))
+    charges = []
+
+    async def update_user(user, fields):
+        charges.append(fields["credits"])
+        return True
+
+    monkeypatch.setattr(server, "update_user", update_user)
+    standin.faults.methods = {"PATCH"}
+    standin.faults.error_rate = 1.0
+    server.app.dependency_overrides[server.get_user_by_api_key] = lambda: dict(USER)
+    try:
+        with TestClient(server.app) as client:
+            response = client.post("/api/v1/chat", json={"message": "hola"})
+    finally:
+        server.app.dependency_overrides.clear()
+    assert response.status_code == 200 and response.json()["response"]
+    assert charges == [10 - response.json()["credits_used"]]
+    assert standin.count("PATCH") >= 1
+    assert metrics.counter("usage_record_failures", source="api") == 1
+
+
+def test_series_is_zero_filled():
+    start = datetime(2024, 5, 1, tzinfo=timezone.utc)
+    points = series({"2024-05-02": {"requests": 4}}, "day", start, start + timedelta(days=2))
+    assert [p["bucket"] for p in points] == ["2024-05-01", "2024-05-02", "2024-05-03"]
+    assert [p["requests"] for p in points] == [0, 4, 0]
+
+
+def test_history_endpoint(standin):
+    asyncio.run(server.record_usage(USER, 3, result()))
+    server.app.dependency_overrides[server.get_session_user] = lambda: USER
+    try:
+        with TestClient(server.app) as client:
+            hourly = client.get("/api/usage/history", params={"granularity": "hour"}).json()
+            bad = client.get("/api/usage/history", params={"granularity": "week"})
+            too_long = client.get("/api/usage/history", params={"start": "2000-01-01"})
+    finally:
+        server.app.dependency_overrides.clear()
+    assert len(hourly["points"]) == 24
+    assert hourly["totals"]["credits"] == 3
+    assert hourly["totals"]["requests"] == 1
+    assert bad.status_code == 400 and too_long.status_code == 400
+
+
+def test_retention_purges_only_old_events(standin):
+    old = (datetime.now(timezone.utc) - timedelta(days=120)).isoformat()
+    new = datetime.now(timezone.utc).isoformat()
+    standin.data["api_usage"] = {f"old{i}": {"timestamp": old} for i in range(5)}
+    standin.data["api_usage"]["new"] = {"timestamp": new}
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=90)).isoformat()
+    deleted = asyncio.run(purge_raw_events(server.storage.client, cutoff, batch_size=2))
+    assert deleted == 5
+    assert list(standin.read("api_usage")) == ["new"]
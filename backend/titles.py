@@ -0,0 +1,225 @@
+"""
+Conversation titles and previews, generated in the background.
+
+Each conversation may carry a `meta` next to its messages:
+
+    {"title": "...", "preview": "...", "source": "llm" | "heuristic", "messages": 12,
+     "updated_at": "...", "generated_at": "..."}
+
+`updated_at` is the conversation's own at the time the meta was written, so a
+conversation nobody wrote to since is skipped; `messages` is how many it had.
+After a turn the handlers enqueue the conversation id; the TitleWorker takes
+the queue in batches and titles every conversation of a batch that needs one
+with a single call to a cheap model. Conversations without a model title yet,
+with only a heuristic one, or that grew by `refresh_messages` since their
+title go to the model; the others keep their title. The preview is always the
+start of the last message, so it needs no model call.
+
+The model calls are rate limited across workers. When the limit is reached,
+or the reply does not parse, the title is taken from the first user message
+and replaced by a model title on a later turn.
+"""
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from llm import LlmClient
+from metrics import metrics
+from shared_state import StateBackend, rate_limit_hit
+
+logger = logging.getLogger(__name__)
+
+TITLE_SYSTEM_PROMPT = """Eres un asistente que pone títulos a conversaciones.
+Recibirás varias conversaciones numeradas. Para cada una responde una línea JSON con
+{"n": <número>, "title": <título de 3 a 6 palabras>}
+en el idioma de la conversación, sin comillas dentro del título.
+Responde solo con las líneas JSON, una por conversación."""
+
+TITLE_MAX_CHARS = 60
+PREVIEW_MAX_CHARS = 140
+EXCERPT_CHARS = 300  # per message sent to the model
+
+
+def clip(text: str, limit: int) -> str:
+    """`text` on one line, cut at a word boundary to at most `limit` characters"""
+    text = " ".join((text or "").split())
+    if len(text) <= limit:
+        return text
+    cut = text[:limit - 1].rsplit(" ", 1)[0] or text[:limit - 1]
+    return cut.rstrip(" ,.;:") + "…"
+
+
+def heuristic_title(messages: List[Optional[dict]]) -> str:
+    first = next((m for m in messages if m and m.get("role") == "user"), None)
+    words = " ".join((first or {}).get("content", "").split()[:6])
+    return clip(words, TITLE_MAX_CHARS) or "Nueva conversación"
+
+
+def heuristic_preview(messages: List[Optional[dict]]) -> str:
+    last = next((m for m in reversed(messages) if m), None)
+    return clip((last or {}).get("content", ""), PREVIEW_MAX_CHARS)
+
+
+def excerpt(messages: List[Optional[dict]]) -> str:
+    """The opening exchange and the latest one, each message cut to EXCERPT_CHARS"""
+    stored = [m for m in messages if m]
+    picked = stored if len(stored) <= 4 else stored[:2] + stored[-2:]
+    return "\n".join(f"{m.get('role')}: {clip(m.get('content', ''), EXCERPT_CHARS)}" for m in picked)
+
+
+def parse_titles(text: str, count: int) -> Dict[int, str]:
+    """{position: title} for the reply lines that parse; the rest are left out"""
+    parsed = {}
+    for line in text.splitlines():
+        line = line.strip().strip(",")
+        if not line.startswith("{"):
+            continue
+        try:
+            item = json.loads(line)
+            n = int(item["n"])
+        except (ValueError, KeyError, TypeError):
+            continue
+        title = clip(str(item.get("title") or "").strip('"'), TITLE_MAX_CHARS)
+        if 1 <= n <= count and title:
+            parsed[n - 1] = title
+    return parsed
+
+
+class TitleWorker:
+    """Queue of conversations whose title or preview may be out of date, drained in batches"""
+
+    def __init__(self, llm: LlmClient, *, model: str,
+                 load: Callable[[str], Awaitable[Optional[dict]]],
+                 store: Callable[[dict, dict], Awaitable[object]],
+                 state: Optional[StateBackend] = None, batch_size: int = 8, batch_wait: float = 2.0,
+                 max_queue: int = 1000, llm_calls_per_minute: int = 30, refresh_messages: int = 20,
+                 enabled: bool = True):
+        self.llm = llm
+        self.model = model
+        self.load = load
+        self.store = store
+        self.state = state
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.max_queue = max_queue
+        self.llm_calls_per_minute = llm_calls_per_minute
+        self.refresh_messages = refresh_messages
+        self.enabled = enabled
+        self._queue: Dict[str, None] = {}  # insertion-ordered set of conversation ids
+        self._wake: Optional[asyncio.Event] = None
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    def enqueue(self, conversation_id: str) -> bool:
+        """Queue the conversation unless it is queued already; a full queue drops it"""
+        if not self.enabled or conversation_id in self._queue:
+            return False
+        if len(self._queue) >= self.max_queue:
+            metrics.incr("titles_dropped")
+            return False
+        self._queue[conversation_id] = None
+        if self._wake:
+            self._wake.set()
+        return True
+
+    def take(self) -> List[str]:
+        batch = list(self._queue)[:self.batch_size]
+        for conversation_id in batch:
+            del self._queue[conversation_id]
+        return batch
+
+    async def run(self):
+        # Created here, in the loop that runs the worker
+        self._wake = asyncio.Event()
+        while True:
+            if not self._queue:
+                self._wake.clear()
+                await self._wake.wait()
+            # Give a batch time to fill, so nearby turns share one model call
+            deadline = time.monotonic() + self.batch_wait
+            while len(self._queue) < self.batch_size and time.monotonic() < deadline:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), deadline - time.monotonic())
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self.process(self.take())
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error generating conversation titles: {e}")
+
+    # ---- one batch ----
+
+    def due(self, conversation: dict) -> Optional[str]:
+        """None when the meta is current, "llm" for a new title, "keep" for only a new preview"""
+        messages = conversation.get("messages") or []
+        meta = conversation.get("meta") or {}
+        if not any(messages) or meta.get("updated_at") == conversation.get("updated_at"):
+            return None
+        if meta.get("source") != "llm" or len(messages) - meta.get("messages", 0) >= self.refresh_messages:
+            return "llm"
+        return "keep"
+
+    async def process(self, conversation_ids: List[str]) -> int:
+        """Refresh the meta of these conversations; returns how many were written"""
+        if not conversation_ids:
+            return 0
+        began = time.perf_counter()
+        loaded = await asyncio.gather(*(self.load(conversation_id) for conversation_id in conversation_ids))
+        due = []
+        for conversation_id, conversation in zip(conversation_ids, loaded):
+            what = self.due(conversation) if conversation else None
+            if what is None:
+                metrics.incr("titles_skipped")
+                continue
+            due.append((what, dict(conversation, id=conversation.get("id", conversation_id))))
+        to_title = [conversation for what, conversation in due if what == "llm"]
+        titles = await self.generate(to_title) if to_title else {}
+        now = datetime.now(timezone.utc).isoformat()
+        written = 0
+        for what, conversation in due:
+            messages = conversation["messages"]
+            old = conversation.get("meta") or {}
+            if conversation["id"] in titles:
+                meta = {"title": titles[conversation["id"]], "source": "llm", "messages": len(messages)}
+            elif what == "keep" or old.get("source") == "llm":
+                # A model title due for a refresh stays until the refresh gets through
+                meta = {"title": old["title"], "source": "llm", "messages": old.get("messages", 0)}
+            else:
+                meta = {"title": heuristic_title(messages), "source": "heuristic", "messages": len(messages)}
+            meta.update(preview=heuristic_preview(messages), updated_at=conversation["updated_at"],
+                        generated_at=now)
+            await self.store(conversation, meta)
+            metrics.incr("titles_written", source=meta["source"])
+            written += 1
+        metrics.observe("titles_batch_ms", (time.perf_counter() - began) * 1000)
+        return written
+
+    async def generate(self, conversations: List[dict]) -> Dict[str, str]:
+        """{conversation id: title} from one model call; empty when the limit is reached"""
+        if self.state and await rate_limit_hit(self.state, "titles:llm", self.llm_calls_per_minute, 60):
+            metrics.incr("titles_rate_limited", len(conversations))
+            return {}
+        prompt = "\n\n".join(f"### {n}\n{excerpt(conversation['messages'])}"
+                             for n, conversation in enumerate(conversations, start=1))
+        try:
+            result = await self.llm.complete(model=self.model, system_prompt=TITLE_SYSTEM_PROMPT, history=[],
+                                             message=prompt, session_id="titles")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            metrics.incr("titles_llm_failures")
+            logger.error(f"Error generating conversation titles: {e}")
+            return {}
+        metrics.incr("titles_llm_calls")
+        parsed = parse_titles(result.text, len(conversations))
+        if len(parsed) < len(conversations):
+            metrics.incr("titles_unparsed", len(conversations) - len(parsed))
+        return {conversations[i]["id"]: title for i, title in parsed.items()}
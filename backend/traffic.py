@@ -0,0 +1,175 @@
+"""
+Sanitized traffic traces for record-and-replay benchmarks (benchmarks/replay.py).
+
+TraceRecorder is a pure ASGI middleware; with a TraceLog it appends one JSON
+line per sampled request:
+
+    {"t": 12.034, "kind": "http", "method": "POST", "route": "/api/v1/chat", "status": 200,
+     "req_bytes": 512, "resp_bytes": 1830, "ms": 840.2, "client": "9f2c1a0d4b7e", "auth": "api_key"}
+
+and one per WebSocket connection, when it closes, with the offset, `type`
+and size of every frame the client sent (`frames`).
+
+Only shapes are kept: the route template (never the path with its ids), the
+HTTP method, status, byte counts and timings. No query strings, headers,
+bodies or message text. `client` is a keyed hash of the credential
+(Authorization or X-API-Key); the key is random per TraceLog and never
+written, so one client's requests can be grouped within a trace but not
+traced back to an account. `t` is seconds since the log was opened, and the
+header line carries the wall clock it started at, so traces of several
+workers can be merged.
+"""
+import hashlib
+import hmac
+import json
+import os
+import random
+import secrets
+import threading
+import time
+from datetime import datetime, timezone
+from typing import List, Optional
+
+VERSION = 1
+FRAME_TYPES = {"auth", "open", "message", "cancel", "ping", "pong"}
+MAX_FRAMES = 500
+
+
+class TraceLog:
+    def __init__(self, path: str, sample: float = 1.0, flush_every: int = 200):
+        self.path = path.replace("{pid}", str(os.getpid()))
+        self.sample = sample
+        self.flush_every = flush_every
+        self.started = time.monotonic()
+        self.recorded = 0
+        self._key = secrets.token_bytes(32)
+        self._lines: List[str] = []
+        self._lock = threading.Lock()
+        self._write([json.dumps({"type": "trace", "version": VERSION, "sample": sample,
+                                 "started_at": datetime.now(timezone.utc).isoformat(),
+                                 "started_epoch": round(time.time(), 3)})])
+
+    def sampled(self) -> bool:
+        return self.sample >= 1 or random.random() < self.sample
+
+    def client(self, credential: Optional[str]) -> Optional[str]:
+        if not credential:
+            return None
+        return hmac.new(self._key, credential.encode(), hashlib.sha256).hexdigest()[:12]
+
+    def offset(self) -> float:
+        return round(time.monotonic() - self.started, 4)
+
+    def add(self, record: dict):
+        with self._lock:
+            self._lines.append(json.dumps(record, separators=(",", ":")))
+            self.recorded += 1
+            if len(self._lines) < self.flush_every:
+                return
+            lines, self._lines = self._lines, []
+        self._write(lines)
+
+    def flush(self):
+        with self._lock:
+            lines, self._lines = self._lines, []
+        if lines:
+            self._write(lines)
+
+    def _write(self, lines: List[str]):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+
+
+def _credential(scope) -> tuple:
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            # Hashed without the scheme, so a JWT maps to the same client over HTTP and the WebSocket
+            return "bearer", value.decode("latin-1").split(" ", 1)[-1]
+        if name == b"x-api-key":
+            return "api_key", value.decode("latin-1")
+    return None, None
+
+
+def _route(scope) -> str:
+    route = scope.get("route")
+    return getattr(route, "path", None) or "unmatched"
+
+
+class TraceRecorder:
+    def __init__(self, app, log: Optional[TraceLog] = None):
+        self.app = app
+        self.log = log
+
+    async def __call__(self, scope, receive, send):
+        if self.log is None or scope["type"] not in ("http", "websocket") or not self.log.sampled():
+            await self.app(scope, receive, send)
+            return
+        if scope["type"] == "websocket":
+            await self._websocket(scope, receive, send)
+            return
+        log = self.log
+        t, began = log.offset(), time.perf_counter()
+        sizes = {"req": 0, "resp": 0}
+        status = 500
+
+        async def counting_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                sizes["req"] += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sizes["resp"] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            auth, credential = _credential(scope)
+            log.add({"t": t, "kind": "http", "method": scope["method"], "route": _route(scope),
+                     "status": status, "req_bytes": sizes["req"], "resp_bytes": sizes["resp"],
+                     "ms": round((time.perf_counter() - began) * 1000, 2),
+                     "client": log.client(credential), "auth": auth})
+
+    async def _websocket(self, scope, receive, send):
+        log = self.log
+        t, began = log.offset(), time.perf_counter()
+        frames, sent = [], {"frames": 0, "bytes": 0}
+        close_code = client = None
+
+        async def recording_receive():
+            nonlocal client
+            message = await receive()
+            if message["type"] == "websocket.receive" and len(frames) < MAX_FRAMES:
+                text = message.get("text") or ""
+                kind = None
+                try:
+                    parsed = json.loads(text)
+                    kind = parsed.get("type") if isinstance(parsed, dict) else None
+                    if kind == "auth" and client is None:
+                        client = log.client(str(parsed.get("token") or ""))
+                except ValueError:
+                    pass
+                frames.append([round(time.perf_counter() - began, 4), kind if kind in FRAME_TYPES else "other",
+                               len(text.encode()) + len(message.get("bytes") or b"")])
+            return message
+
+        async def recording_send(message):
+            nonlocal close_code
+            if message["type"] == "websocket.send":
+                sent["frames"] += 1
+                sent["bytes"] += len((message.get("text") or "").encode()) + len(message.get("bytes") or b"")
+            elif message["type"] == "websocket.close":
+                close_code = message.get("code", 1000)
+            await send(message)
+
+        try:
+            await self.app(scope, recording_receive, recording_send)
+        finally:
+            log.add({"t": t, "kind": "ws", "route": _route(scope), "close_code": close_code, "client": client,
+                     "ms": round((time.perf_counter() - began) * 1000, 2), "frames": frames,
+                     "sent_frames": sent["frames"], "sent_bytes": sent["bytes"]})
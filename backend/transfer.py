@@ -0,0 +1,246 @@
+"""
+Conversation export and import as NDJSON.
+
+One JSON object per line, in this order:
+
+    {"type": "export", "format": "brainyx.conversations", "version": 1, ...}
+    {"type": "conversation", "id": ..., "created_at": ..., "updated_at": ...}
+    {"type": "message", "conversation_id": ..., "id": ..., "role": ..., "content": ..., "timestamp": ...}
+    ...
+    {"type": "end", "conversations": N, "messages": M}
+
+The export is generated page by page from the repository and streamed, so
+memory stays flat however long the history is; the trailing `end` line lets
+a client tell a complete file from a truncated one. The import reads the
+request body incrementally (plain or gzip), gives imported conversations and
+messages new ids owned by the importing user, and writes them in batches.
+"""
+import json
+import uuid
+import zlib
+from datetime import datetime, timezone
+from typing import AsyncIterator, Awaitable, Callable, Iterator, List, Optional
+
+from storage import Storage
+
+FORMAT = "brainyx.conversations"
+VERSION = 1
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def _line(record: dict) -> bytes:
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":")).encode() + b"\n"
+
+
+async def export_records(storage: Storage, user_id: str, page_size: int = 100) -> AsyncIterator[dict]:
+    yield {"type": "export", "format": FORMAT, "version": VERSION, "user_id": user_id,
+           "exported_at": datetime.now(timezone.utc).isoformat()}
+    conversations = messages = 0
+    async for conv_id, conv in storage.conversations.iter_for_user(user_id, page_size):
+        conversations += 1
+        yield {"type": "conversation", "id": conv.get("id", conv_id),
+               "created_at": conv.get("created_at"), "updated_at": conv.get("updated_at")}
+        for msg in conv.get("messages") or []:
+            if msg:
+                messages += 1
+                yield {"type": "message", "conversation_id": conv.get("id", conv_id), "id": msg.get("id"),
+                       "role": msg.get("role"), "content": msg.get("content"), "timestamp": msg.get("timestamp")}
+    yield {"type": "end", "conversations": conversations, "messages": messages}
+
+
+async def ndjson_chunks(records: AsyncIterator[dict], chunk_size: int = 64 * 1024) -> AsyncIterator[bytes]:
+    """Serialized lines grouped into chunks of about chunk_size bytes"""
+    buffer = bytearray()
+    async for record in records:
+        buffer += _line(record)
+        if len(buffer) >= chunk_size:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+async def gzip_chunks(chunks: AsyncIterator[bytes], level: int = 6) -> AsyncIterator[bytes]:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    async for chunk in chunks:
+        out = compressor.compress(chunk)
+        if out:
+            yield out
+    yield compressor.flush()
+
+
+class InvalidImport(ValueError):
+    pass
+
+
+class Importer:
+    """Turns a stream of NDJSON lines into batched conversation writes"""
+
+    MAX_ERROR_SAMPLES = 5
+
+    def __init__(self, storage: Storage, user_id: str, *, batch_messages: int = 500,
+                 max_line_bytes: int = 1024 * 1024, max_bytes: int = 0,
+                 on_batch: Optional[Callable[[List[tuple]], Awaitable[None]]] = None,
+                 on_progress: Optional[Callable[[dict], Awaitable[None]]] = None):
+        self.storage = storage
+        self.user_id = user_id
+        self.batch_messages = batch_messages
+        self.max_line_bytes = max_line_bytes
+        self.max_bytes = max_bytes  # decompressed; 0 = no limit
+        self.on_batch = on_batch
+        self.on_progress = on_progress
+        self.progress = {"status": "running", "bytes": 0, "lines": 0, "conversations": 0, "messages": 0,
+                         "errors": 0, "error_samples": []}
+        self._source_id: Optional[str] = None   # id of the conversation being read, as in the file
+        self._current: Optional[dict] = None    # that conversation, under its new id
+        self._stored = False                    # _current has been created in storage
+        self._written = 0                       # messages of _current already stored
+        self._pending: List[dict] = []          # complete conversations not stored yet
+        self._tails: List[tuple] = []           # (conversation, first unstored index) of stored ones
+        self._buffered = 0
+        self._inflated = 0
+
+    def _error(self, message: str):
+        self.progress["errors"] += 1
+        if len(self.progress["error_samples"]) < self.MAX_ERROR_SAMPLES:
+            self.progress["error_samples"].append(f"línea {self.progress['lines']}: {message}")
+
+    # ---- records ----
+
+    def _start_conversation(self, record: dict):
+        self._close_conversation()
+        now = datetime.now(timezone.utc).isoformat()
+        self._source_id = record.get("id")
+        self._current = {
+            "id": str(uuid.uuid4()),
+            "user_id": self.user_id,
+            "messages": [],
+            "created_at": record.get("created_at") or now,
+            "updated_at": record.get("updated_at") or now,
+        }
+        self._stored = False
+        self._written = 0
+
+    def _close_conversation(self):
+        if self._current is not None:
+            if not self._stored:
+                self._pending.append(self._current)
+            elif self._written < len(self._current["messages"]):
+                self._tails.append((self._current, self._written))
+        self._current = None
+        self._source_id = None
+
+    def _add_message(self, record: dict):
+        if self._current is None or record.get("conversation_id") != self._source_id:
+            raise InvalidImport("mensaje fuera de su conversación")
+        if record.get("role") not in ("user", "assistant") or not isinstance(record.get("content"), str):
+            raise InvalidImport("mensaje no válido")
+        self._current["messages"].append({
+            # New ids, like the conversation's: re-importing an export must not collide with the originals
+            "id": str(uuid.uuid4()),
+            "role": record["role"],
+            "content": record["content"],
+            "timestamp": record.get("timestamp") or self._current["updated_at"],
+        })
+        self._buffered += 1
+        self.progress["messages"] += 1
+
+    def handle(self, record: dict):
+        kind = record.get("type")
+        if kind == "conversation":
+            self._start_conversation(record)
+        elif kind == "message":
+            self._add_message(record)
+        elif kind not in ("export", "end"):
+            raise InvalidImport(f"tipo de registro desconocido: {kind}")
+
+    # ---- writes ----
+
+    async def flush(self, final: bool = False):
+        if final:
+            self._close_conversation()
+        batch = list(self._pending)
+        tails = list(self._tails)
+        if self._current is not None:
+            if not self._stored:
+                # A long conversation is stored in parts: created now, appended to later
+                batch.append(self._current)
+            elif self._written < len(self._current["messages"]):
+                tails.append((self._current, self._written))
+        if batch:
+            await self.storage.conversations.create_many(batch)
+        for conv, first_index in tails:
+            await self.storage.conversations.append_messages(
+                conv["id"], first_index, conv["messages"][first_index:], conv["updated_at"],
+                user_id=self.user_id)
+        if self.on_batch:
+            await self.on_batch([(conv["id"], conv["messages"]) for conv in batch] +
+                                [(conv["id"], conv["messages"][first_index:]) for conv, first_index in tails])
+        self.progress["conversations"] += len(batch)
+        if self._current is not None:
+            self._stored = True
+            self._written = len(self._current["messages"])
+        self._pending.clear()
+        self._tails.clear()
+        self._buffered = 0
+        if self.on_progress:
+            await self.on_progress(self.progress)
+
+    # ---- stream ----
+
+    def _inflate(self, decompressor, chunk: bytes) -> Iterator[bytes]:
+        """The chunk decompressed in pieces of at most max_line_bytes, so a small upload that
+        expands a lot is stopped by the limits before it is all in memory"""
+        while chunk:
+            piece = decompressor.decompress(chunk, self.max_line_bytes)
+            chunk = decompressor.unconsumed_tail
+            yield piece
+
+    async def _lines(self, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        decompressor = None
+        buffer = b""
+        first = True
+        async for chunk in chunks:
+            self.progress["bytes"] += len(chunk)
+            if first:
+                first = False
+                if chunk.startswith(GZIP_MAGIC):
+                    decompressor = zlib.decompressobj(31)
+            for piece in (self._inflate(decompressor, chunk) if decompressor is not None else [chunk]):
+                self._inflated += len(piece)
+                if self.max_bytes and self._inflated > self.max_bytes:
+                    raise InvalidImport("importación demasiado grande")
+                buffer += piece
+                *lines, buffer = buffer.split(b"\n")
+                if len(buffer) > self.max_line_bytes:
+                    raise InvalidImport("línea demasiado larga")
+                for line in lines:
+                    yield line
+        if decompressor is not None:
+            buffer += decompressor.flush()
+        if buffer:
+            yield buffer
+
+    async def run(self, chunks: AsyncIterator[bytes]) -> dict:
+        try:
+            async for line in self._lines(chunks):
+                self.progress["lines"] += 1
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                    if not isinstance(record, dict):
+                        raise InvalidImport("se esperaba un objeto JSON")
+                    self.handle(record)
+                except (ValueError, InvalidImport) as e:
+                    self._error(str(e) if isinstance(e, InvalidImport) else "JSON no válido")
+                if self._buffered >= self.batch_messages:
+                    await self.flush()
+        except (zlib.error, InvalidImport) as e:
+            # Whatever was read before the error is still stored
+            self._error("gzip no válido" if isinstance(e, zlib.error) else str(e))
+            self.progress["status"] = "failed"
+        else:
+            self.progress["status"] = "done"
+        await self.flush(final=True)
+        return self.progress
@@ -0,0 +1,87 @@
+"""
+Pre-aggregated usage counters.
+
+Every usage record also increments hourly and daily buckets, per user and per
+API key, in the same multi-path PATCH that stores the raw event:
+
+    usage_rollups/{user_id}/{hour|day}/{bucket}/{counter}
+    usage_rollups/{user_id}/keys/{api_key_id}/{hour|day}/{bucket}/{counter}
+
+Buckets are UTC (`2024-05-01T13` for hours, `2024-05-01` for days) and the
+counters use Firebase server-side increments, so concurrent workers never
+overwrite each other. History queries read a key range of buckets instead of
+scanning `api_usage`, which the retention job can then prune.
+"""
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+COUNTERS = ("requests", "credits", "input_tokens", "cached_input_tokens", "cache_write_tokens", "output_tokens")
+
+GRANULARITIES = {
+    "hour": ("%Y-%m-%dT%H", timedelta(hours=1)),
+    "day": ("%Y-%m-%d", timedelta(days=1)),
+}
+
+
+def bucket(at: datetime, granularity: str) -> str:
+    return at.astimezone(timezone.utc).strftime(GRANULARITIES[granularity][0])
+
+
+def rollup_root(user_id: str, api_key_id: Optional[str] = None) -> str:
+    return f"usage_rollups/{user_id}/keys/{api_key_id}" if api_key_id else f"usage_rollups/{user_id}"
+
+
+def rollup_updates(record: dict, at: datetime) -> Dict[str, dict]:
+    """Multi-path PATCH entries incrementing every bucket the record falls in"""
+    amounts = {
+        "requests": 1,
+        "credits": record.get("credits_used", 0),
+        **{name: record.get(name, 0) for name in COUNTERS[2:]},
+    }
+    roots = [rollup_root(record["user_id"])]
+    if record.get("api_key_id"):
+        roots.append(rollup_root(record["user_id"], record["api_key_id"]))
+    updates = {}
+    for root in roots:
+        for granularity in GRANULARITIES:
+            prefix = f"{root}/{granularity}/{bucket(at, granularity)}"
+            for name, amount in amounts.items():
+                if amount:
+                    updates[f"{prefix}/{name}"] = {".sv": {"increment": amount}}
+    return updates
+
+
+def default_range(granularity: str, now: datetime) -> tuple:
+    """Last 24 hours or last 30 days, ending at the current bucket"""
+    span = timedelta(hours=23) if granularity == "hour" else timedelta(days=29)
+    return now - span, now
+
+
+def series(buckets: Optional[dict], granularity: str, start: datetime, end: datetime) -> List[dict]:
+    """One point per bucket from start to end, zero-filled where nothing was recorded"""
+    buckets = buckets or {}
+    fmt, step = GRANULARITIES[granularity]
+    current = datetime.strptime(bucket(start, granularity), fmt).replace(tzinfo=timezone.utc)
+    points = []
+    while current <= end:
+        key = current.strftime(fmt)
+        counters = buckets.get(key) or {}
+        points.append({"bucket": key, **{name: counters.get(name, 0) for name in COUNTERS}})
+        current += step
+    return points
+
+
+async def purge_raw_events(firebase, cutoff: str, batch_size: int = 500) -> int:
+    """Delete `api_usage` events older than `cutoff` (ISO timestamp), batch by batch.
+    Needs `".indexOn": ["timestamp"]` on api_usage in the database rules."""
+    deleted = 0
+    while True:
+        old = await firebase.get("api_usage", params={
+            "orderBy": '"timestamp"', "endAt": f'"{cutoff}"', "limitToFirst": batch_size,
+        })
+        if not old:
+            return deleted
+        await firebase.patch("api_usage", {event_id: None for event_id in old})
+        deleted += len(old)
+        if len(old) < batch_size:
+            return deleted